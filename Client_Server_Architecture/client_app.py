@@ -1,6 +1,14 @@
+import os
 import socket
 import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.framing import send_frame
+from common.rpc import RpcConnection, RpcError
+
+RPC_TIMEOUT = 30  # Seconds to wait for a response
+
 
 def start_client(server_ip, server_port):
     """Starts the client application."""
@@ -17,7 +25,7 @@ def start_client(server_ip, server_port):
         while True:
             message = input("Enter message (type 'terminate' to exit): ")
             encoded_message = message.encode("utf-8")
-            client_socket.sendall(encoded_message)
+            send_frame(client_socket, encoded_message)
 
             if message.lower() == "terminate":
                 print("Client terminating.")
@@ -37,9 +45,44 @@ def start_client(server_ip, server_port):
             client_socket.close()
 
 
+def start_rpc_client(server_ip, server_port):
+    """Calls the server's RPC handlers interactively: '<method> [payload]' per line."""
+    rpc = None
+    try:
+        print(f"Connecting to {server_ip} port {server_port} (RPC)")
+        rpc = RpcConnection(server_ip, server_port)
+        while True:
+            line = input("Enter '<method> [payload]' (type 'terminate' to exit): ")
+            if line.strip().lower() == "terminate":
+                print("Client terminating.")
+                break
+            method, _, payload = line.strip().partition(" ")
+            if not method:
+                continue
+            try:
+                result = rpc.call(method, payload.encode("utf-8")).result(RPC_TIMEOUT)
+                print(result.decode("utf-8", errors="replace"))
+            except RpcError as e:
+                print(f"Error: {e}")
+
+    except ConnectionRefusedError:
+        print(
+            f"Error: Connection refused. Is the server running on {server_ip}:{server_port}?"
+        )
+    except socket.gaierror:
+        print(f"Error: Could not resolve server IP address '{server_ip}'.")
+    except Exception as e:
+        print(f"Client error: {e}")
+    finally:
+        if rpc:
+            print("Closing RPC connection.")
+            rpc.close()
+
+
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python my_client_app.py <Server IP> <Server PORT>")
+    rpc_mode = len(sys.argv) == 4 and sys.argv[3].upper() == "RPC"
+    if len(sys.argv) != 3 and not rpc_mode:
+        print("Usage: python my_client_app.py <Server IP> <Server PORT> [RPC]")
         sys.exit(1)
     try:
         server_ip = sys.argv[1]
@@ -47,7 +90,10 @@ if __name__ == "__main__":
         if not (1024 <= server_port <= 65535):
             print("Server port number must be between 1024 and 65535.")
             sys.exit(1)
-        start_client(server_ip, server_port)
+        if rpc_mode:
+            start_rpc_client(server_ip, server_port)
+        else:
+            start_client(server_ip, server_port)
     except ValueError:
         print("Invalid server port number. Please provide an integer.")
         sys.exit(1)
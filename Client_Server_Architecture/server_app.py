@@ -1,9 +1,86 @@
+import argparse
+import importlib
+import logging
+import os
+import queue
+import selectors
 import socket
 import sys
+import threading
+import time
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def start_server(port):
-    """Starts the server application."""
+from common.framing import DEFAULT_MAX_FRAME_SIZE, FrameReader, set_max_frame_size
+from common.limits import raise_open_file_limit
+from common.log import DEFAULT_LOG_LEVEL, LOG_LEVELS, SERVER_LOGGER, configure_logging
+from common.rpc import RPC_HELLO, RpcDispatcher
+
+log = logging.getLogger(SERVER_LOGGER)
+
+DEFAULT_BACKLOGS = {
+    "blocking": 1,  # One client at a time: the others wait in the kernel's queue
+    "selectors": socket.SOMAXCONN,  # Bursts of new clients are queued, not refused
+}
+SELECTOR_BUFFER_SIZE = 4096  # Per-client receive buffer; grows for large messages
+
+
+# Handlers of RPC connections (see common/rpc.py); --rpc-workers sets the pool size
+dispatcher = RpcDispatcher()
+
+
+@dispatcher.handler()
+def echo(payload):
+    return payload
+
+
+@dispatcher.handler()
+def now(payload):
+    """The server's time, in seconds since the epoch."""
+    return b"%.6f" % time.time()
+
+
+@dispatcher.handler(cpu_bound=True)
+def primes(payload):
+    """How many primes are below the number in the payload; CPU-heavy on purpose."""
+    limit = int(payload or b"100000")
+    sieve = bytearray([1]) * max(limit, 2)
+    sieve[0] = sieve[1] = 0
+    for number in range(2, int(limit**0.5) + 1):
+        if sieve[number]:
+            sieve[number * number :: number] = bytes(len(range(number * number, limit, number)))
+    return b"%d" % sum(sieve)
+
+
+def load_handlers(module_name):
+    """Imports a module of extra RPC handlers; it registers them in register(dispatcher)."""
+    importlib.import_module(module_name).register(dispatcher)
+
+
+def locked_sender(connection):
+    """Sends RPC responses on a blocking connection, from any thread, one at a time."""
+    lock = threading.Lock()
+
+    def send(frame):
+        with lock:
+            try:
+                connection.sendall(frame)
+            except OSError:
+                pass  # The client went away; its reader cleans up
+
+    return send
+
+
+def decode_message(data):
+    return data.decode("utf-8", errors="replace").strip()
+
+
+def is_terminate(data):
+    return decode_message(data).lower() == "terminate"
+
+
+def start_server(port, backlog=DEFAULT_BACKLOGS["blocking"]):
+    """Starts the server application, serving one client at a time."""
     server_socket = None
     try:
         # 1. Create a TCP/IP socket
@@ -14,56 +91,288 @@ def start_server(port):
 
         # 2. Bind the socket to the port
         server_address = ("0.0.0.0", port)  # Listen on all available interfaces
-        print(f"Starting up server on {server_address[0]} port {server_address[1]}")
+        log.info(f"Starting up server on {server_address[0]} port {server_address[1]}")
         server_socket.bind(server_address)
 
         # 3. Listen for incoming connections
-        server_socket.listen(
-            1
-        )  # Allow one client connection at a time for this basic example
+        server_socket.listen(backlog)  # Connections waiting while a client is served
 
+        debug = log.isEnabledFor(logging.DEBUG)  # Checked once, not per message
         while True:
-            print("\nWaiting for a connection...")
+            log.info("Waiting for a connection...")
             connection, client_address = server_socket.accept()
             try:
-                print(f"Connection from {client_address}")
-
-                # 4. Receive data in a loop
-                while True:
-                    data = connection.recv(1024)  # Receive up to 1024 bytes
-                    if data:
-                        decoded_data = data.decode("utf-8").strip()
-                        print(f"Received from {client_address}: {decoded_data}")
-                        if decoded_data.lower() == "terminate":
-                            print(f"Client {client_address} requested termination.")
-                            break  # Exit inner loop, close connection
-                    else:
-                        print(f"No more data from {client_address}, disconnecting.")
-                        break  # No data, client disconnected
+                log.info(f"Connection from {client_address}")
 
+                # 4. Receive framed messages in a loop
+                reader = FrameReader(connection)
+                rpc = None  # Sends the responses once the client opened an RPC connection
+                for data in reader.iter_frames():
+                    if rpc is not None:
+                        try:
+                            dispatcher.dispatch(data, rpc)
+                        except ValueError as e:
+                            log.warning(f"Bad RPC request from {client_address}: {e}")
+                            break
+                        continue
+                    if data == RPC_HELLO:
+                        log.info(f"Client {client_address} opened an RPC connection.")
+                        # Responses are small and pipelined: do not hold them back for ACKs
+                        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                        rpc = locked_sender(connection)
+                        continue
+                    if debug:
+                        log.debug(f"Received from {client_address}: {decode_message(data)}")
+                    if is_terminate(data):
+                        log.info(f"Client {client_address} requested termination.")
+                        break  # Exit inner loop, close connection
+                else:
+                    log.info(f"No more data from {client_address}, disconnecting.")
+
+            except OSError as e:  # e.g. connection reset or broken pipe: only this client is lost
+                log.info(f"Connection from {client_address} failed: {e}")
+            except ValueError as e:  # e.g. a frame over --max-frame-size
+                log.warning(f"Bad frame from {client_address}: {e}")
             finally:
                 # Clean up the connection
-                print(f"Closing connection from {client_address}")
+                log.info(f"Closing connection from {client_address}")
                 connection.close()
 
     except Exception as e:
-        print(f"Server error: {e}")
+        log.error(f"Server error: {e}")
+    finally:
+        if server_socket:
+            log.info("Server shutting down.")
+            server_socket.close()
+
+
+def start_selector_server(port, backlog=DEFAULT_BACKLOGS["selectors"]):
+    """
+    Starts the server application in selectors mode: one thread serves every
+    client over non-blocking sockets, waiting for whichever is ready with
+    epoll (or the best mechanism the platform has). A client's "terminate"
+    closes only its own connection.
+
+    RPC responses are buffered per connection and written when the socket
+    is writable. Those of cpu_bound handlers complete on a pool thread and
+    are handed to the loop through a queue and a wakeup socket.
+    """
+    raise_open_file_limit()
+    selector = selectors.DefaultSelector()
+    server_socket = None
+    readers = {}  # connection -> its FrameReader
+    outbound = {}  # RPC connection -> responses not written yet
+    repliers = {}  # RPC connection -> its reply callable for the dispatcher
+    completed = queue.SimpleQueue()  # (connection, response) from pool threads
+    waker, wakeup = socket.socketpair()
+    loop_thread = threading.get_ident()
+    try:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        log.info(f"Starting up server on 0.0.0.0 port {port} ({type(selector).__name__})")
+        server_socket.bind(("0.0.0.0", port))
+        server_socket.listen(backlog)
+        server_socket.setblocking(False)
+        selector.register(server_socket, selectors.EVENT_READ)
+        waker.setblocking(False)
+        wakeup.setblocking(False)
+        selector.register(waker, selectors.EVENT_READ)
+
+        def close(connection, client_address):
+            log.info(f"Closing connection from {client_address}")
+            selector.unregister(connection)
+            del readers[connection]
+            outbound.pop(connection, None)
+            repliers.pop(connection, None)
+            connection.close()
+
+        def replier(connection):
+            def reply(frame):
+                if threading.get_ident() == loop_thread:
+                    buffered = outbound.get(connection)
+                    if buffered is not None:  # Not closed meanwhile
+                        buffered += frame
+                    return
+                completed.put((connection, frame))
+                try:
+                    wakeup.send(b"\0")
+                except BlockingIOError:
+                    pass  # Already woken up, more than enough
+
+            return reply
+
+        def flush(connection, client_address):
+            """Writes what the socket takes and waits for writability if anything is left."""
+            buffered = outbound.get(connection)
+            if buffered is None:
+                return
+            if buffered:
+                try:
+                    del buffered[: connection.send(buffered)]
+                except BlockingIOError:
+                    pass
+                except OSError as e:
+                    log.info(f"Connection from {client_address} failed: {e}")
+                    close(connection, client_address)
+                    return
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if buffered else 0)
+            if selector.get_key(connection).events != events:
+                selector.modify(connection, events, client_address)
+
+        debug = log.isEnabledFor(logging.DEBUG)  # Checked once, not per message
+        log.info("Waiting for connections...")
+        while True:
+            for key, events in selector.select():
+                if key.fileobj is waker:
+                    try:
+                        while waker.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    touched = set()
+                    while not completed.empty():
+                        connection, frame = completed.get()
+                        if connection in outbound:
+                            outbound[connection] += frame
+                            touched.add(connection)
+                    for connection in touched:
+                        flush(connection, selector.get_key(connection).data)
+                    continue
+                if key.fileobj is server_socket:
+                    # Take every pending connection, not one per wakeup
+                    while True:
+                        try:
+                            connection, client_address = server_socket.accept()
+                        except BlockingIOError:
+                            break
+                        except OSError as e:  # e.g. out of file descriptors
+                            log.warning(f"Cannot accept a connection: {e}")
+                            break
+                        log.info(f"Connection from {client_address}")
+                        connection.setblocking(False)
+                        readers[connection] = FrameReader(connection, SELECTOR_BUFFER_SIZE)
+                        selector.register(connection, selectors.EVENT_READ, client_address)
+                    continue
+
+                connection, client_address = key.fileobj, key.data
+                if events & selectors.EVENT_WRITE:
+                    flush(connection, client_address)
+                    if connection not in readers:
+                        continue
+                if not events & selectors.EVENT_READ:
+                    continue
+                try:
+                    frames = readers[connection].read_available()
+                except OSError as e:  # e.g. connection reset by the client
+                    log.info(f"Connection from {client_address} failed: {e}")
+                    frames = None
+                except ValueError as e:  # e.g. a frame over --max-frame-size
+                    log.warning(f"Bad frame from {client_address}: {e}")
+                    frames = None
+                if frames is None:
+                    log.info(f"No more data from {client_address}, disconnecting.")
+                    close(connection, client_address)
+                    continue
+                for data in frames:
+                    reply = repliers.get(connection)
+                    if reply is not None:
+                        try:
+                            dispatcher.dispatch(data, reply)
+                        except ValueError as e:
+                            log.warning(f"Bad RPC request from {client_address}: {e}")
+                            close(connection, client_address)
+                            break
+                        continue
+                    if data == RPC_HELLO:
+                        log.info(f"Client {client_address} opened an RPC connection.")
+                        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                        outbound[connection] = bytearray()
+                        repliers[connection] = replier(connection)
+                        continue
+                    if debug:
+                        log.debug(f"Received from {client_address}: {decode_message(data)}")
+                    if is_terminate(data):
+                        log.info(f"Client {client_address} requested termination.")
+                        close(connection, client_address)
+                        break  # Ignore anything it sent after terminate
+                else:
+                    flush(connection, client_address)  # Every response of this read at once
+
+    except Exception as e:
+        log.error(f"Server error: {e}")
     finally:
+        for connection in readers:
+            connection.close()
+        selector.close()
+        waker.close()
+        wakeup.close()
         if server_socket:
-            print("Server shutting down.")
+            log.info("Server shutting down.")
             server_socket.close()
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python my_server_app.py <PORT>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Client-Server server.")
+    parser.add_argument("port", type=int, help="Port to listen on (1024-65535)")
+    parser.add_argument(
+        "--mode",
+        choices=list(DEFAULT_BACKLOGS),
+        default="blocking",
+        help="blocking: one client at a time (default); selectors: every client in one thread",
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        help="Connections the kernel queues until they are accepted "
+        "(default 1 in blocking mode, SOMAXCONN in selectors mode)",
+    )
+    parser.add_argument(
+        "--rpc-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Processes running CPU-heavy RPC handlers; 0 runs them inline (default: CPU count)",
+    )
+    parser.add_argument(
+        "--handlers",
+        action="append",
+        default=[],
+        metavar="MODULE",
+        help="Module with extra RPC handlers, registered by its register(dispatcher); repeatable",
+    )
+    parser.add_argument(
+        "--max-frame-size",
+        type=int,
+        default=DEFAULT_MAX_FRAME_SIZE,
+        help="Largest message, in bytes, a client may send; a connection announcing a larger "
+        f"one is closed (default {DEFAULT_MAX_FRAME_SIZE})",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=LOG_LEVELS,
+        default=DEFAULT_LOG_LEVEL,
+        help="Server log verbosity; debug logs every message (default info)",
+    )
+    args = parser.parse_args()
+    if args.backlog is not None and args.backlog < 1:
+        parser.error("--backlog must be at least 1")
+    if args.rpc_workers < 0:
+        parser.error("--rpc-workers must be at least 0")
     try:
-        port = int(sys.argv[1])
-        if not (1024 <= port <= 65535):  # Common range for user-defined ports
-            print("Port number must be between 1024 and 65535.")
-            sys.exit(1)
-        start_server(port)
-    except ValueError:
-        print("Invalid port number. Please provide an integer.")
+        set_max_frame_size(args.max_frame_size)
+    except ValueError as e:
+        parser.error(str(e))
+    configure_logging(args.log_level, prefix="")
+    if not (1024 <= args.port <= 65535):  # Common range for user-defined ports
+        print("Port number must be between 1024 and 65535.")
         sys.exit(1)
+    dispatcher.workers = args.rpc_workers
+    for module_name in args.handlers:
+        load_handlers(module_name)
+    backlog = args.backlog or DEFAULT_BACKLOGS[args.mode]
+    try:
+        if args.mode == "selectors":
+            start_selector_server(args.port, backlog)
+        else:
+            start_server(args.port, backlog)
+    finally:
+        dispatcher.close()
@@ -1,18 +1,35 @@
+import os
 import socket
 import sys
 import threading
 import time
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def receive_messages(client_socket):
+from common.framing import FrameReader, send_frame
+from common.handshake import split_options
+from common.heartbeat import heartbeat_from_options, is_pong, start_heartbeat
+from common.qos import QosReceiver, qos_from_options
+
+# Held around every write, so heartbeats and acks never interleave with typed messages
+send_lock = threading.Lock()
+
+
+def receive_messages(client_socket, qos=None):
     """
     Function for a subscriber client to continuously receive messages from the server.
-    Runs in a separate thread.
+    Runs in a separate thread. With a QosReceiver (QoS 1), duplicates of
+    redelivered messages are skipped and every batch is acknowledged.
     """
+    reader = FrameReader(client_socket)
     while True:
         try:
-            data = client_socket.recv(1024)
-            if data:
+            frames = reader.read_frames()
+            for data in frames:
+                if is_pong(data):
+                    continue  # The server answering our heartbeat
+                if qos is not None and not qos.accept(data):
+                    continue  # A sequence marker or a message already shown
                 message = data.decode("utf-8").strip()
                 # Print received message clearly, especially for subscribers
                 print(
@@ -20,7 +37,11 @@ def receive_messages(client_socket):
                     end="",
                     flush=True,
                 )
-            else:
+            ack = qos.ack() if qos is not None else None
+            if ack:
+                with send_lock:
+                    client_socket.sendall(ack)
+            if not frames:
                 # Server disconnected
                 print("\n[CLIENT] Server disconnected. Exiting receiver thread.")
                 break
@@ -35,16 +56,42 @@ def receive_messages(client_socket):
     # Signal the main thread that receiver is done (if needed for graceful shutdown)
 
 
+def drain_replies(client_socket):
+    """
+    Function for a publisher client to read what the server sends back: the
+    PUBACKs it asked for with qos=1 and the PONGs answering its heartbeat.
+    Runs in a separate thread, so they never fill up the socket's buffers.
+    """
+    reader = FrameReader(client_socket)
+    try:
+        while reader.read_frames():
+            pass  # Nothing to show; the messages were sent on
+    except (OSError, ValueError):
+        return
+    print("\n[CLIENT] Server disconnected.")
+
+
 def start_client(server_ip, server_port, client_role):
     """Starts the client application as a Publisher or Subscriber."""
     client_socket = None
     client_role = client_role.upper()  # Normalize role to uppercase
+    # A subscriber may append replay options, e.g. "SUBSCRIBER;offset=0"
+    role_name = client_role.split(";", 1)[0].strip()
 
-    if client_role not in ["PUBLISHER", "SUBSCRIBER"]:
+    if role_name not in ["PUBLISHER", "SUBSCRIBER"]:
         print(
             f"[CLIENT] Invalid client role: {client_role}. Must be PUBLISHER or SUBSCRIBER."
         )
         sys.exit(1)
+    try:
+        # "SUBSCRIBER;qos=1" asks for at-least-once delivery, acknowledged by receive_messages,
+        # and ";heartbeat=<seconds>" for a PING that often
+        options = split_options(client_role)[1]
+        qos = QosReceiver() if qos_from_options(options) else None
+        heartbeat = heartbeat_from_options(options)
+    except ValueError as e:
+        print(f"[CLIENT] {e}")
+        sys.exit(1)
 
     try:
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -56,17 +103,22 @@ def start_client(server_ip, server_port, client_role):
         client_socket.connect(server_address)
 
         # Send the role to the server immediately after connecting
-        client_socket.sendall(client_role.encode("utf-8"))
+        send_frame(client_socket, client_role.encode("utf-8"))
+        if heartbeat:
+            start_heartbeat(client_socket, heartbeat, lock=send_lock)
         print(f"[CLIENT] Connected successfully as {client_role}.")
 
         receiver_thread = None
-        if client_role == "SUBSCRIBER":
+        if role_name == "SUBSCRIBER":
             # For subscribers, start a separate thread to receive messages
             receiver_thread = threading.Thread(
-                target=receive_messages, args=(client_socket,)
+                target=receive_messages, args=(client_socket, qos)
             )
             receiver_thread.daemon = True  # Allow main thread to exit
             receiver_thread.start()
+        elif qos is not None or heartbeat:
+            # A publisher's PUBACKs and PONGs are read and dropped
+            threading.Thread(target=drain_replies, args=(client_socket,), daemon=True).start()
 
         # Main loop for sending messages (for Publishers) or termination signal
         while True:
@@ -76,7 +128,8 @@ def start_client(server_ip, server_port, client_role):
                 continue
 
             encoded_message = user_input.encode("utf-8")
-            client_socket.sendall(encoded_message)
+            with send_lock:
+                send_frame(client_socket, encoded_message)
 
             if user_input.lower() == "terminate":
                 print("[CLIENT] Termination command sent. Disconnecting.")
@@ -105,6 +158,9 @@ if __name__ == "__main__":
     if len(sys.argv) != 4:
         print("Usage: python client_app.py <Server IP> <Server PORT> <ROLE>")
         print("Roles: PUBLISHER or SUBSCRIBER")
+        print('Replay missed messages: "SUBSCRIBER;offset=<N>" or "SUBSCRIBER;from_ts=<unix time>"')
+        print('At-least-once delivery: "SUBSCRIBER;qos=1;client_id=<name>"')
+        print('Heartbeats: "SUBSCRIBER;heartbeat=<seconds>"')
         sys.exit(1)
     try:
         server_ip = sys.argv[1]
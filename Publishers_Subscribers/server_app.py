@@ -1,12 +1,291 @@
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
 import socket
 import sys
 import threading
-import time  # For slight delays if needed
+import time
 
-# List to keep track of all connected clients and their roles
-# Each entry will be a dictionary: {'socket': conn, 'address': addr, 'role': role_str}
-connected_clients = []
-client_lock = threading.Lock()  # Lock to protect access to connected_clients list
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.framing import (
+    DEFAULT_MAX_FRAME_SIZE,
+    AsyncFrameReader,
+    FrameReader,
+    encode_frame,
+    set_max_frame_size,
+)
+from common.handshake import split_options
+from common.heartbeat import (
+    DEFAULT_TCP_KEEPALIVE,
+    HEARTBEAT_GRACE,
+    IdleMonitor,
+    close_quietly,
+    drop_pings,
+    enable_keepalive,
+    heartbeat_from_options,
+    pong_frame,
+)
+from common.limits import raise_open_file_limit
+from common.log import DEFAULT_LOG_LEVEL, LOG_LEVELS, SERVER_LOGGER, configure_logging
+from common.message_log import DEFAULT_SEGMENT_BYTES, MessageLog, parse_replay_options
+from common.metrics import Metrics, serve_metrics
+from common.outbound import (
+    DEFAULT_QUEUE_SIZE,
+    DISCONNECT,
+    DROP_OLDEST,
+    OVERFLOW_POLICIES,
+    AsyncSubscriberWriter,
+    SubscriberWriter,
+)
+from common.qos import (
+    DEFAULT_ACK_TIMEOUT,
+    DEFAULT_SESSION_EXPIRY,
+    DEFAULT_WINDOW,
+    QosSessions,
+    client_id_from_options,
+    encode_puback,
+    encode_seq,
+    qos_from_options,
+    sweep_interval,
+)
+from common.transport import format_address
+
+log = logging.getLogger(SERVER_LOGGER)
+
+# Server-wide settings, filled in from the command line in __main__
+settings = {
+    "queue_size": DEFAULT_QUEUE_SIZE,  # Frames buffered per subscriber
+    "overflow_policy": DROP_OLDEST,  # What to do when a subscriber's queue is full
+    "coalesce": True,  # One vectored write per drained batch instead of one per frame
+    "qos_window": DEFAULT_WINDOW,  # Unacknowledged messages kept per QoS-1 subscriber
+    "ack_timeout": DEFAULT_ACK_TIMEOUT,  # Seconds before unacknowledged messages are resent
+    "session_expiry": DEFAULT_SESSION_EXPIRY,  # Seconds a disconnected QoS-1 session is kept
+    "idle_timeout": 0,  # Seconds of silence before a client without heartbeats is dropped; 0: never
+    "tcp_keepalive": DEFAULT_TCP_KEEPALIVE,  # Idle seconds before TCP keepalive probes; 0: off
+}
+
+# Every connected client and its role, keyed by its socket so a client is
+# added and removed in O(1), with the subscribers indexed apart for fan-out:
+# {conn: {'socket': conn, 'address': addr, 'role': role_str,
+#         'subscriber': SubscriberWriter or None, 'qos': QosSession of a QoS-1 subscriber or None}}
+connected_clients = {}
+subscriber_clients = {}  # conn -> entry, subscribers only
+client_lock = threading.Lock()  # Lock to protect access to connected_clients and subscriber_clients
+
+# Clients of the asyncio mode, keyed by their StreamWriter:
+# {writer: {'address': addr, 'role': role_str, 'subscriber': AsyncSubscriberWriter or None,
+#           'qos': QosSession or None}}
+# Only touched from the event loop thread, so no lock is needed.
+async_clients = {}
+async_subscribers = {}  # writer -> entry, subscribers only
+
+# Durable log of every published message, created in __main__ when --log-dir is given
+message_log = None
+LOG_TOPIC = "ALL"  # This server has no topics, so everything goes to one log
+# Held while a message is logged and fanned out, and while a replaying subscriber
+# joins, so each message reaches that subscriber exactly once: replayed or live
+log_lock = threading.Lock()
+
+# At-least-once sessions of QoS-1 subscribers, kept across reconnects by client id
+qos_sessions = QosSessions()
+
+# Deadlines of the clients with heartbeats or an idle timeout, keyed by socket / StreamWriter
+idle_monitor = IdleMonitor()
+
+
+def client_entries():
+    """Every connected client's entry, in whichever mode the server runs."""
+    with client_lock:
+        entries = list(connected_clients.values())
+    return entries + list(async_clients.values())
+
+
+def connection_counts():
+    counts = {"PUBLISHER": 0, "SUBSCRIBER": 0}
+    for client in client_entries():
+        counts[client["role"]] += 1
+    return counts
+
+
+def queue_depths():
+    return {
+        format_address(client["address"]): len(client["subscriber"].queue)
+        for client in client_entries()
+        if client["subscriber"] is not None
+    }
+
+
+# Hot-path counters and gauges, served over HTTP with --metrics-port
+metrics = Metrics()
+metrics.counter("broker_messages_published_total", "Messages received from publishers")
+metrics.counter("broker_messages_delivered_total", "Messages queued for subscribers")
+metrics.counter(
+    "broker_subscribers_disconnected_total",
+    "Subscribers disconnected because their queue overflowed or closed",
+)
+metrics.counter(
+    "broker_messages_redelivered_total",
+    "Unacknowledged messages sent again to QoS-1 subscribers",
+)
+metrics.counter("broker_connections_total", "Connections accepted, by role", label="role")
+metrics.counter(
+    "broker_connections_timed_out_total",
+    "Clients disconnected for missing heartbeats or staying idle",
+)
+metrics.histogram("broker_fanout_seconds", "Time to queue one publish for every subscriber")
+metrics.gauge("broker_connections", "Open connections, by role", connection_counts, label="role")
+metrics.gauge("broker_qos_sessions", "QoS-1 subscriber sessions, connected or not", qos_sessions.__len__)
+metrics.gauge(
+    "broker_queue_depth",
+    "Frames waiting in each subscriber's queue",
+    queue_depths,
+    label="connection",
+)
+
+
+def log_guard():
+    """log_lock when the message log is enabled, otherwise a no-op context."""
+    return log_lock if message_log is not None else contextlib.nullcontext()
+
+
+def replay_ranges(options, addr):
+    """
+    Returns the message log ranges a subscriber asked for with its ";offset=N"
+    or ";from_ts=T" handshake option, or [] if it asked for none.
+    Raises ValueError for a malformed option. Call with log_guard() held.
+    """
+    replay = parse_replay_options(options)
+    if replay is None:
+        return []
+    if message_log is None:
+        log.warning(f"{addr} asked for a replay, but the message log is disabled.")
+        return []
+    ranges = message_log.replay(LOG_TOPIC, **replay)
+    total = sum(count for _, _, count in ranges)
+    log.info(f"Replaying {total} bytes of the message log to {addr}.")
+    return ranges
+
+
+def queue_settings(qos):
+    """
+    Queue size and overflow policy of a new subscriber's writer. A QoS-1
+    subscriber is disconnected rather than silently losing frames, which
+    would break its message numbering; its queue has room for a whole
+    redelivery window on top of live traffic.
+    """
+    if not qos:
+        return settings["queue_size"], settings["overflow_policy"]
+    return settings["queue_size"] + settings["qos_window"] + 1, DISCONNECT
+
+
+def attach_qos(subscriber, client_id):
+    """
+    Opens the QoS-1 session of a new subscriber, or resumes the one of its
+    client id, and redelivers what that session had not had acknowledged.
+    """
+    session = qos_sessions.open(client_id, settings["qos_window"], settings["ack_timeout"])
+    redelivered = session.attach(subscriber.send_many, encode_seq, subscriber.close)
+    if redelivered:
+        metrics.inc("broker_messages_redelivered_total", redelivered)
+        log.info(f"Redelivered {redelivered} unacknowledged message(s) to {subscriber.address}.")
+    return session
+
+
+def acknowledge(session, message, addr):
+    """Applies a subscriber's "ACK:<n>" to its QoS-1 session."""
+    if session is None:
+        log.warning(f"ACK from {addr}, which did not ask for QoS 1; ignored.")
+        return
+    try:
+        session.ack(int(message[4:]))
+    except ValueError:
+        log.warning(f"Malformed acknowledgement '{message}' from {addr}.")
+
+
+def deliver(client, frame):
+    """Queues a published frame on a subscriber, through its QoS-1 session if it has one."""
+    if client["qos"] is not None:
+        return client["qos"].deliver([frame])
+    return client["subscriber"].send(frame)
+
+
+def sweep_qos():
+    """Resends QoS-1 messages whose ack timed out and drops expired sessions."""
+    redelivered, expired = qos_sessions.sweep(time.monotonic(), settings["session_expiry"])
+    if redelivered:
+        metrics.inc("broker_messages_redelivered_total", redelivered)
+    if expired:
+        log.info(f"Expired {expired} disconnected QoS-1 session(s).")
+
+
+def sweep_idle():
+    """Disconnects the clients whose heartbeat or idle timeout passed."""
+    expired = idle_monitor.sweep(time.monotonic())
+    if expired:
+        metrics.inc("broker_connections_timed_out_total", expired)
+        log.info(f"Disconnected {expired} client(s) that missed their heartbeat or idle timeout.")
+
+
+def sweep_log():
+    """Deletes expired message log segments, even of topics nobody publishes on any more."""
+    if message_log is None:
+        return
+    try:
+        deleted = message_log.sweep()
+    except OSError as e:
+        log.warning(f"Message log retention failed: {e}")
+        return
+    if deleted:
+        log.info(f"Deleted {deleted} expired message log segment(s).")
+
+
+def client_timeout(heartbeat):
+    """Seconds of silence after which a client is disconnected, or 0 for never."""
+    return heartbeat * HEARTBEAT_GRACE if heartbeat else settings["idle_timeout"]
+
+
+def housekeeping_interval():
+    return min(sweep_interval(settings["ack_timeout"]), idle_monitor.tick)
+
+
+def run_housekeeping():
+    """Sweeps the QoS-1 sessions, the idle timeouts and the message log periodically (threaded mode)."""
+    while True:
+        time.sleep(housekeeping_interval())
+        sweep_qos()
+        sweep_idle()
+        sweep_log()
+
+
+async def run_housekeeping_async():
+    """Sweeps the QoS-1 sessions, the idle timeouts and the message log on the event loop (asyncio mode)."""
+    while True:
+        await asyncio.sleep(housekeeping_interval())
+        sweep_qos()
+        sweep_idle()
+        sweep_log()
+
+
+async def stop_task(task, name):
+    """Cancels a background task on shutdown and waits for it, logging how it failed, if it did."""
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        log.error(f"{name} task failed: {e}")
+
+
+def build_published_frame(message):
+    """
+    Formats and frames a published message once per publish.
+    The returned bytes are immutable, so every subscriber queue shares the same object.
+    """
+    return encode_frame(f"[PUBLISHED] {message}".encode("utf-8"))
 
 
 def handle_client(conn, addr):
@@ -14,95 +293,162 @@ def handle_client(conn, addr):
     Handles a single client connection in a separate thread.
     Receives initial role, then processes messages based on role.
     """
-    print(f"[SERVER] Handling new connection from {addr}")
+    log.debug(f"Handling new connection from {addr}")
     client_role = None
+    subscriber = None
+    qos_session = None
+    debug = log.isEnabledFor(logging.DEBUG)  # Checked once, not per message
 
     try:
-        # First message from client should be its role (PUBLISHER/SUBSCRIBER)
-        role_data = conn.recv(1024)
+        # Every message arrives as a length-prefixed frame; frames that arrive
+        # together are handled as one batch
+        reader = FrameReader(conn)
+        frames = reader.read_frames()
+
+        # First message from client should be its role (PUBLISHER/SUBSCRIBER),
+        # optionally followed by options such as ";offset=42"
+        role_data = frames[0] if frames else None
         if role_data:
-            client_role = role_data.decode("utf-8").strip().upper()
+            client_role, options = split_options(role_data.decode("utf-8"))
+            client_role = client_role.upper()
             if client_role not in ["PUBLISHER", "SUBSCRIBER"]:
-                print(
-                    f"[SERVER] Invalid role '{client_role}' from {addr}. Disconnecting."
-                )
+                log.warning(f"Invalid role '{client_role}' from {addr}. Disconnecting.")
                 return  # Disconnect invalid clients
-            print(f"[SERVER] Client {addr} identified as {client_role}")
+            try:
+                qos = qos_from_options(options)
+                heartbeat = heartbeat_from_options(options)  # Seconds between the client's PINGs
+            except ValueError as e:
+                log.warning(f"Invalid option from {addr}: {e} Disconnecting.")
+                return  # Disconnect invalid clients
+            log.info(f"Client {addr} identified as {client_role}" + (" (QoS 1)" if qos else ""))
+            metrics.inc("broker_connections_total", label=client_role)
+            timeout = client_timeout(heartbeat)
+            if timeout:
+                idle_monitor.watch(conn, timeout, lambda: close_quietly(conn))
 
-            # Add client to our global list
-            with client_lock:
-                connected_clients.append(
-                    {"socket": conn, "address": addr, "role": client_role}
-                )
-            print(f"[SERVER] Current active clients: {len(connected_clients)}")
+            with log_guard():
+                if client_role == "SUBSCRIBER":
+                    try:
+                        replay = replay_ranges(options, addr)
+                    except ValueError as e:
+                        log.warning(f"Invalid replay option from {addr}: {e} Disconnecting.")
+                        return  # Disconnect invalid clients
+                    # Each subscriber gets its own bounded queue and writer thread;
+                    # the replay is written before any live message
+                    subscriber = SubscriberWriter(
+                        conn,
+                        addr,
+                        *queue_settings(qos),
+                        settings["coalesce"],
+                        replay,
+                    )
+                    if qos:
+                        qos_session = attach_qos(subscriber, client_id_from_options(options))
+
+                # Add client to our global index
+                entry = {
+                    "socket": conn,
+                    "address": addr,
+                    "role": client_role,
+                    "subscriber": subscriber,
+                    "qos": qos_session,
+                }
+                with client_lock:
+                    connected_clients[conn] = entry
+                    if subscriber:
+                        subscriber_clients[conn] = entry
+            log.info(f"Current active clients: {len(connected_clients)}")
 
+            frames = frames[1:]  # Messages that arrived together with the handshake
+            received = 0  # Frames from a QoS-1 publisher, acknowledged after each batch
+            terminated = False
             while True:
-                data = conn.recv(1024)
-                if data:
+                if timeout:
+                    idle_monitor.seen(conn)
+                if heartbeat:
+                    frames, pinged = drop_pings(frames)
+                    if pinged and subscriber:
+                        subscriber.send(pong_frame())
+                    elif pinged:
+                        conn.sendall(pong_frame())
+                for data in frames:
+                    if not data:  # Ignore empty frames
+                        continue
                     message = data.decode("utf-8").strip()
-                    print(f"[SERVER] Received from {addr} ({client_role}): {message}")
+                    if debug:
+                        log.debug(f"Received from {addr} ({client_role}): {message}")
 
                     if message.lower() == "terminate":
-                        print(
-                            f"[SERVER] Client {addr} ({client_role}) requested termination."
-                        )
-                        break  # Exit loop, clean up connection
+                        terminated = True
+                        break  # Clean up the connection once this batch is acknowledged
 
-                    if client_role == "PUBLISHER":
+                    if client_role == "SUBSCRIBER" and message.upper().startswith("ACK:"):
+                        acknowledge(qos_session, message, addr)
+                    elif client_role == "PUBLISHER":
                         # If this client is a Publisher, echo message to all Subscribers
-                        print(
-                            f"[SERVER] Broadcasting message from PUBLISHER {addr} to Subscribers..."
-                        )
+                        started = time.perf_counter()
                         subscribers_count = 0
-                        with client_lock:
-                            for client in connected_clients:
-                                if (
-                                    client["role"] == "SUBSCRIBER"
-                                    and client["socket"] != conn
-                                ):  # Don't send back to self if somehow subscriber (safety)
-                                    try:
-                                        # Prefix message to indicate it's a published message
-                                        published_msg = f"[PUBLISHED] {message}"
-                                        client["socket"].sendall(
-                                            published_msg.encode("utf-8")
-                                        )
-                                        subscribers_count += 1
-                                    except BrokenPipeError:
-                                        print(
-                                            f"[SERVER] Subscriber {client['address']} pipe broken, will be removed."
-                                        )
-                                        # Mark for removal or remove directly (careful with iteration)
-                                    except Exception as e:
-                                        print(
-                                            f"[SERVER] Error sending to subscriber {client['address']}: {e}"
-                                        )
-                        print(
-                            f"[SERVER] Message sent to {subscribers_count} subscriber(s)."
-                        )
-                else:
+                        # Prefix message to indicate it's a published message (encoded once, shared)
+                        published_msg = build_published_frame(message)
+                        with log_guard():
+                            if message_log is not None:
+                                message_log.append(LOG_TOPIC, published_msg)
+                            # Only collect the subscribers under the lock; sending happens outside it
+                            with client_lock:
+                                targets = list(subscriber_clients.values())
+                            for target in targets:
+                                # Sending only enqueues, so a stalled subscriber never blocks this thread
+                                if deliver(target, published_msg):
+                                    subscribers_count += 1
+                                else:
+                                    metrics.inc("broker_subscribers_disconnected_total")
+                                    log.warning(
+                                        f"Subscriber {target['address']} disconnected (queue full or closed)."
+                                    )
+                        metrics.inc("broker_messages_published_total")
+                        metrics.inc("broker_messages_delivered_total", subscribers_count)
+                        metrics.observe("broker_fanout_seconds", time.perf_counter() - started)
+                        if debug:
+                            log.debug(
+                                f"Message from PUBLISHER {addr} sent to {subscribers_count} subscriber(s)."
+                            )
+
+                if qos and client_role == "PUBLISHER":
+                    received += len(frames)
+                    conn.sendall(encode_puback(received))
+                if terminated:
+                    log.info(f"Client {addr} ({client_role}) requested termination.")
+                    break
+
+                frames = reader.read_frames()
+                if not frames:
                     # Client disconnected without sending "terminate"
-                    print(
-                        f"[SERVER] Client {addr} ({client_role}) disconnected unexpectedly."
-                    )
+                    log.info(f"Client {addr} ({client_role}) disconnected unexpectedly.")
                     break
 
     except ConnectionResetError:
-        print(f"[SERVER] Client {addr} ({client_role}) forcibly closed the connection.")
+        log.info(f"Client {addr} ({client_role}) forcibly closed the connection.")
     except Exception as e:
-        print(f"[SERVER] Error handling client {addr}: {e}")
+        log.error(f"Error handling client {addr}: {e}")
     finally:
-        # Remove client from global list and close socket
-        if conn in [c["socket"] for c in connected_clients]:  # Check if still in list
-            with client_lock:
-                # Find and remove the correct client entry
-                connected_clients[:] = [
-                    c for c in connected_clients if c["socket"] != conn
-                ]
-                print(
-                    f"[SERVER] Removed {addr} ({client_role}). Active clients: {len(connected_clients)}"
-                )
+        if qos_session is not None:
+            qos_sessions.close(qos_session, subscriber.send_many)
+        if subscriber:
+            subscriber.close()
+            stats = subscriber.stats()
+            log.info(
+                f"Subscriber {addr} queue: {stats['enqueued']} queued, {stats['dropped']} dropped, {stats['writes']} writes, {stats['replayed']} bytes replayed."
+            )
+        # Remove client from the global index and close socket
+        idle_monitor.forget(conn)
+        with client_lock:
+            removed = connected_clients.pop(conn, None)
+            subscriber_clients.pop(conn, None)
+            active_clients = len(connected_clients)
+        if removed is not None:
+            log.info(f"Removed {addr} ({client_role}). Active clients: {active_clients}")
         conn.close()
-        print(f"[SERVER] Connection to {addr} closed.")
+        log.info(f"Connection to {addr} closed.")
 
 
 def start_server(port):
@@ -115,15 +461,18 @@ def start_server(port):
         )  # Allows reuse of the address
 
         server_address = ("0.0.0.0", port)
-        print(
-            f"[SERVER] Starting up server on {server_address[0]} port {server_address[1]}"
-        )
+        log.info(f"Starting up server on {server_address[0]} port {server_address[1]}")
         server_socket.bind(server_address)
-        server_socket.listen(5)  # Allow up to 5 pending connections
+        raise_open_file_limit()
+        server_socket.listen(socket.SOMAXCONN)  # Queue bursts of new subscribers
+        threading.Thread(target=run_housekeeping, daemon=True).start()
 
         while True:
-            print("\n[SERVER] Waiting for a connection...")
+            log.debug("Waiting for a connection...")
             conn, addr = server_socket.accept()
+            if settings["tcp_keepalive"]:
+                # Lets the kernel find peers that vanished without closing the connection
+                enable_keepalive(conn, settings["tcp_keepalive"])
             # Start a new thread to handle the client
             client_thread = threading.Thread(target=handle_client, args=(conn, addr))
             client_thread.daemon = (
@@ -132,23 +481,297 @@ def start_server(port):
             client_thread.start()
 
     except Exception as e:
-        print(f"[SERVER] Server error: {e}")
+        log.error(f"Server error: {e}")
     finally:
         if server_socket:
-            print("[SERVER] Server shutting down.")
+            log.info("Server shutting down.")
             server_socket.close()
 
 
+async def handle_client_async(reader, writer):
+    """
+    Handles a single client connection as a coroutine on the event loop.
+    Same handshake and routing rules as handle_client, without a thread per client.
+    """
+    addr = writer.get_extra_info("peername")
+    client_role = None
+    subscriber = None
+    qos_session = None
+    debug = log.isEnabledFor(logging.DEBUG)  # Checked once, not per message
+    if settings["tcp_keepalive"]:
+        enable_keepalive(writer.get_extra_info("socket"), settings["tcp_keepalive"])
+
+    try:
+        # Every message arrives as a length-prefixed frame; frames that arrive
+        # together are handled as one batch
+        frame_reader = AsyncFrameReader(reader)
+        frames = await frame_reader.read_frames()
+
+        # First message from client should be its role (PUBLISHER/SUBSCRIBER)
+        role_data = frames[0] if frames else None
+        if role_data:
+            client_role, options = split_options(role_data.decode("utf-8"))
+            client_role = client_role.upper()
+            if client_role not in ["PUBLISHER", "SUBSCRIBER"]:
+                log.warning(f"Invalid role '{client_role}' from {addr}. Disconnecting.")
+                return  # Disconnect invalid clients
+            try:
+                qos = qos_from_options(options)
+                heartbeat = heartbeat_from_options(options)  # Seconds between the client's PINGs
+            except ValueError as e:
+                log.warning(f"Invalid option from {addr}: {e} Disconnecting.")
+                return  # Disconnect invalid clients
+
+            log.info(f"Client {addr} identified as {client_role}" + (" (QoS 1)" if qos else ""))
+            metrics.inc("broker_connections_total", label=client_role)
+            timeout = client_timeout(heartbeat)
+            if timeout:
+                idle_monitor.watch(writer, timeout, writer.transport.abort)
+            if client_role == "SUBSCRIBER":
+                try:
+                    replay = replay_ranges(options, addr)
+                except ValueError as e:
+                    log.warning(f"Invalid replay option from {addr}: {e} Disconnecting.")
+                    return  # Disconnect invalid clients
+                subscriber = AsyncSubscriberWriter(
+                    writer,
+                    addr,
+                    *queue_settings(qos),
+                    settings["coalesce"],
+                    replay,
+                )
+                if qos:
+                    qos_session = attach_qos(subscriber, client_id_from_options(options))
+            async_clients[writer] = {
+                "address": addr,
+                "role": client_role,
+                "subscriber": subscriber,
+                "qos": qos_session,
+            }
+            if subscriber:
+                async_subscribers[writer] = async_clients[writer]
+
+            frames = frames[1:]  # Messages that arrived together with the handshake
+            received = 0  # Frames from a QoS-1 publisher, acknowledged after each batch
+            terminated = False
+            while True:
+                if timeout:
+                    idle_monitor.seen(writer)
+                if heartbeat:
+                    frames, pinged = drop_pings(frames)
+                    if pinged and subscriber:
+                        subscriber.send(pong_frame())
+                    elif pinged:
+                        writer.write(pong_frame())
+                for data in frames:
+                    if not data:  # Ignore empty frames
+                        continue
+
+                    message = data.decode("utf-8").strip()
+                    if debug:
+                        log.debug(f"Received from {addr} ({client_role}): {message}")
+                    if message.lower() == "terminate":
+                        terminated = True
+                        break  # Clean up the connection once this batch is acknowledged
+
+                    if client_role == "SUBSCRIBER" and message.upper().startswith("ACK:"):
+                        acknowledge(qos_session, message, addr)
+                    elif client_role == "PUBLISHER":
+                        # Echo message to all Subscribers; sending only enqueues
+                        started = time.perf_counter()
+                        subscribers_count = 0
+                        published_msg = build_published_frame(message)
+                        if message_log is not None:
+                            message_log.append(LOG_TOPIC, published_msg)
+                        for client in list(async_subscribers.values()):
+                            if deliver(client, published_msg):
+                                subscribers_count += 1
+                            else:
+                                metrics.inc("broker_subscribers_disconnected_total")
+                        metrics.inc("broker_messages_published_total")
+                        metrics.inc("broker_messages_delivered_total", subscribers_count)
+                        metrics.observe("broker_fanout_seconds", time.perf_counter() - started)
+
+                if qos and client_role == "PUBLISHER":
+                    received += len(frames)
+                    writer.write(encode_puback(received))
+                    await writer.drain()
+                if terminated:
+                    break  # Exit loop, clean up connection
+
+                frames = await frame_reader.read_frames()
+                if not frames:
+                    break  # Client disconnected without sending "terminate"
+
+    except ConnectionResetError:
+        log.info(f"Client {addr} ({client_role}) forcibly closed the connection.")
+    except Exception as e:
+        log.error(f"Error handling client {addr}: {e}")
+    finally:
+        idle_monitor.forget(writer)
+        async_clients.pop(writer, None)
+        async_subscribers.pop(writer, None)
+        if qos_session is not None:
+            qos_sessions.close(qos_session, subscriber.send_many)
+        if subscriber:
+            subscriber.close()
+            stats = subscriber.stats()
+            log.info(
+                f"Subscriber {addr} queue: {stats['enqueued']} queued, {stats['dropped']} dropped, {stats['writes']} writes, {stats['replayed']} bytes replayed."
+            )
+        writer.close()
+        log.info(f"Connection to {addr} closed.")
+
+
+async def start_async_server(port):
+    """Starts the asyncio server: one event loop serves every connection."""
+    raise_open_file_limit()
+    server = await asyncio.start_server(
+        handle_client_async, "0.0.0.0", port, backlog=socket.SOMAXCONN
+    )
+    log.info(f"Starting up asyncio server on 0.0.0.0 port {port}")
+    housekeeping = asyncio.get_running_loop().create_task(run_housekeeping_async())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await stop_task(housekeeping, "Housekeeping")
+
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python server_app.py <PORT>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Publish/Subscribe server.")
+    parser.add_argument("port", type=int, help="Port to listen on (1024-65535)")
+    parser.add_argument(
+        "--mode",
+        choices=["threaded", "asyncio"],
+        default="threaded",
+        help="threaded: one thread per client (default); asyncio: one event loop for all clients",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help=f"Frames buffered per subscriber (default {DEFAULT_QUEUE_SIZE})",
+    )
+    parser.add_argument(
+        "--overflow-policy",
+        choices=OVERFLOW_POLICIES,
+        default=DROP_OLDEST,
+        help="What to do when a subscriber's queue is full (default drop-oldest)",
+    )
+    parser.add_argument(
+        "--no-coalesce",
+        dest="coalesce",
+        action="store_false",
+        help="Write each message to a subscriber separately instead of batching pending ones",
+    )
+    parser.add_argument(
+        "--log-dir",
+        help="Keep published messages in a log under this directory so subscribers can replay them",
+    )
+    parser.add_argument(
+        "--log-segment-bytes",
+        type=int,
+        default=DEFAULT_SEGMENT_BYTES,
+        help=f"Size at which the log rolls over to a new segment file (default {DEFAULT_SEGMENT_BYTES})",
+    )
+    parser.add_argument(
+        "--log-retention-bytes",
+        type=int,
+        default=0,
+        help="Delete the oldest segments once the log is larger than this (default 0: keep all)",
+    )
+    parser.add_argument(
+        "--log-retention-seconds",
+        type=float,
+        default=0,
+        help="Delete segments whose messages are all older than this (default 0: keep all)",
+    )
+    parser.add_argument(
+        "--qos-window",
+        type=int,
+        default=DEFAULT_WINDOW,
+        help=f"Unacknowledged messages kept for redelivery per QoS-1 subscriber; a subscriber with a full window is disconnected (default {DEFAULT_WINDOW})",
+    )
+    parser.add_argument(
+        "--ack-timeout",
+        type=float,
+        default=DEFAULT_ACK_TIMEOUT,
+        help=f"Seconds without an acknowledgement before QoS-1 messages are sent again (default {DEFAULT_ACK_TIMEOUT:g})",
+    )
+    parser.add_argument(
+        "--session-expiry",
+        type=float,
+        default=DEFAULT_SESSION_EXPIRY,
+        help=f"Seconds the session of a disconnected QoS-1 subscriber with a client_id is kept (default {DEFAULT_SESSION_EXPIRY:g})",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=0,
+        help="Disconnect clients without heartbeats that send nothing for this many seconds (default 0: never)",
+    )
+    parser.add_argument(
+        "--tcp-keepalive",
+        type=int,
+        default=DEFAULT_TCP_KEEPALIVE,
+        help=f"Idle seconds before the kernel probes a client connection for a dead peer (default {DEFAULT_TCP_KEEPALIVE}, 0: off)",
+    )
+    parser.add_argument(
+        "--max-frame-size",
+        type=int,
+        default=DEFAULT_MAX_FRAME_SIZE,
+        help="Largest message, in bytes, a client may send; a connection announcing a larger "
+        f"one is closed (default {DEFAULT_MAX_FRAME_SIZE})",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=LOG_LEVELS,
+        default=DEFAULT_LOG_LEVEL,
+        help="Server log verbosity; debug logs every message (default info)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Serve counters and histograms at http://127.0.0.1:PORT/metrics (default 0: off)",
+    )
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    if args.qos_window < 1 or args.ack_timeout <= 0 or args.session_expiry < 0:
+        parser.error("--qos-window and --ack-timeout must be positive, --session-expiry at least 0")
+    if args.idle_timeout < 0 or args.tcp_keepalive < 0:
+        parser.error("--idle-timeout and --tcp-keepalive must be at least 0")
     try:
-        port = int(sys.argv[1])
-        if not (1024 <= port <= 65535):
-            print("Port number must be between 1024 and 65535.")
-            sys.exit(1)
-        start_server(port)
-    except ValueError:
-        print("Invalid port number. Please provide an integer.")
+        set_max_frame_size(args.max_frame_size)
+    except ValueError as e:
+        parser.error(str(e))
+    settings["queue_size"] = args.queue_size
+    settings["overflow_policy"] = args.overflow_policy
+    settings["coalesce"] = args.coalesce
+    settings["qos_window"] = args.qos_window
+    settings["ack_timeout"] = args.ack_timeout
+    settings["session_expiry"] = args.session_expiry
+    settings["idle_timeout"] = args.idle_timeout
+    settings["tcp_keepalive"] = args.tcp_keepalive
+    if args.log_dir:
+        message_log = MessageLog(
+            args.log_dir,
+            args.log_segment_bytes,
+            args.log_retention_bytes,
+            args.log_retention_seconds,
+        )
+
+    if not (1024 <= args.port <= 65535):
+        print("Port number must be between 1024 and 65535.")
         sys.exit(1)
+    if args.metrics_port:
+        serve_metrics(metrics, args.metrics_port)
+        log.info(f"Metrics at http://127.0.0.1:{args.metrics_port}/metrics")
+    if args.mode == "asyncio":
+        try:
+            asyncio.run(start_async_server(args.port))
+        except KeyboardInterrupt:
+            log.info("Server shutting down.")
+    else:
+        start_server(args.port)
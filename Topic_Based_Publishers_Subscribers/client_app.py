@@ -1,24 +1,46 @@
+import os
 import socket
 import sys
 import threading
 import time
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def receive_messages(client_socket):
+from common.framing import FrameReader, send_frame
+from common.handshake import split_options
+from common.heartbeat import heartbeat_from_options, is_pong, start_heartbeat
+from common.qos import QosReceiver, qos_from_options
+from common.transport import connect, describe, unix_path
+
+# Held around every write, so heartbeats and acks never interleave with typed messages
+send_lock = threading.Lock()
+
+
+def receive_messages(client_socket, qos=None):
     """
     Function for a subscriber client to continuously receive messages from the server.
-    Runs in a separate thread.
+    Runs in a separate thread. With a QosReceiver (QoS 1), duplicates of
+    redelivered messages are skipped and every batch is acknowledged.
     """
+    reader = FrameReader(client_socket)
     while True:
         try:
-            data = client_socket.recv(1024)
-            if data:
+            frames = reader.read_frames()
+            for data in frames:
+                if is_pong(data):
+                    continue  # The server answering our heartbeat
+                if qos is not None and not qos.accept(data):
+                    continue  # A sequence marker or a message already shown
                 message = data.decode("utf-8").strip()
                 # Print received message clearly, ensuring it doesn't interfere with input prompt
                 sys.stdout.write(f"\n[RECEIVED] {message}\n")
                 sys.stdout.write("Enter message (type 'terminate' to exit): ")
                 sys.stdout.flush()
-            else:
+            ack = qos.ack() if qos is not None else None
+            if ack:
+                with send_lock:
+                    client_socket.sendall(ack)
+            if not frames:
                 # Server disconnected or no more data
                 print("\n[CLIENT] Server disconnected. Exiting receiver thread.")
                 break
@@ -32,11 +54,32 @@ def receive_messages(client_socket):
             break
 
 
+def drain_replies(client_socket):
+    """
+    Function for a publisher client to read what the server sends back: the
+    PUBACKs it asked for with qos=1 and the PONGs answering its heartbeat.
+    Runs in a separate thread, so they never fill up the socket's buffers.
+    """
+    reader = FrameReader(client_socket)
+    try:
+        while reader.read_frames():
+            pass  # Nothing to show; the messages were routed
+    except (OSError, ValueError):
+        return
+    print("\n[CLIENT] Server disconnected.")
+
+
 def start_client(server_ip, server_port, client_role, client_topic):
-    """Starts the client application as a Publisher or Subscriber with a specific topic."""
+    """
+    Starts the client application as a Publisher or Subscriber with a specific topic.
+    server_ip may be "unix:/path" for the server's Unix socket, with server_port None.
+    """
     client_socket = None
     client_role = client_role.upper()  # Normalize role
-    client_topic = client_topic.upper()  # Normalize topic
+    topic, separator, topic_options = client_topic.partition(";")
+    # Normalize the topic; options such as a content filter keep their case
+    topic = topic.upper()
+    client_topic = topic + separator + topic_options
 
     if client_role not in ["PUBLISHER", "SUBSCRIBER"]:
         print(
@@ -46,31 +89,50 @@ def start_client(server_ip, server_port, client_role, client_topic):
     if not client_topic:
         print("[CLIENT] Topic cannot be empty. Please provide a topic.")
         sys.exit(1)
-
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_address = (server_ip, server_port)
+        # "NEWS;qos=1" asks for at-least-once delivery, acknowledged by receive_messages,
+        # and ";heartbeat=<seconds>" for a PING that often
+        options = split_options(client_topic)[1]
+        qos = QosReceiver() if qos_from_options(options) else None
+        heartbeat = heartbeat_from_options(options)
+    except ValueError as e:
+        print(f"[CLIENT] {e}")
+        sys.exit(1)
 
+    try:
         print(
-            f"[CLIENT] Connecting to {server_address[0]} port {server_address[1]} as {client_role} on TOPIC: {client_topic}..."
+            f"[CLIENT] Connecting to {describe(server_ip, server_port)} as {client_role} on TOPIC: {client_topic}..."
         )
-        client_socket.connect(server_address)
+        client_socket = connect(server_ip, server_port)
 
         # Send the role and topic to the server immediately after connecting
         initial_info = f"{client_role}:{client_topic}"
-        client_socket.sendall(initial_info.encode("utf-8"))
+        send_frame(client_socket, initial_info.encode("utf-8"))
+        if heartbeat:
+            start_heartbeat(client_socket, heartbeat, lock=send_lock)
         print(
             f"[CLIENT] Connected successfully as {client_role} on TOPIC: {client_topic}."
         )
 
         receiver_thread = None
         if client_role == "SUBSCRIBER":
+            print(
+                "[CLIENT] Type 'subscribe <topics>' or 'unsubscribe <topics>' to change topics "
+                "(comma-separated, wildcards: '*' = one level, '#' = any levels)."
+            )
+            print(
+                "[CLIENT] Type 'filter <expression>' to filter messages by content, "
+                "'filter' alone to remove the filter."
+            )
             # For subscribers, start a separate thread to receive messages
             receiver_thread = threading.Thread(
-                target=receive_messages, args=(client_socket,)
+                target=receive_messages, args=(client_socket, qos)
             )
             receiver_thread.daemon = True  # Allow main thread to exit
             receiver_thread.start()
+        elif qos is not None or heartbeat:
+            # A publisher's PUBACKs and PONGs are read and dropped
+            threading.Thread(target=drain_replies, args=(client_socket,), daemon=True).start()
 
         # Main loop for sending messages (prepending topic for Publishers) or termination signal
         while True:
@@ -83,11 +145,19 @@ def start_client(server_ip, server_port, client_role, client_topic):
 
             message_to_send = user_input
             if client_role == "PUBLISHER" and user_input.lower() != "terminate":
-                # For publishers, prepend the topic to the message content
-                message_to_send = f"{client_topic}:{user_input}"
+                # For publishers, prepend the bare topic (without its options) to the message content
+                message_to_send = f"{topic}:{user_input}"
+            elif client_role == "SUBSCRIBER":
+                # "subscribe <topics>" / "unsubscribe <topics>" change topics on this connection
+                command, _, topics = user_input.strip().partition(" ")
+                if command.lower() in ("subscribe", "unsubscribe") and topics.strip():
+                    message_to_send = f"{command.upper()}:{topics.strip().upper()}"
+                elif command.lower() == "filter":
+                    message_to_send = f"FILTER:{topics.strip()}"
 
             encoded_message = message_to_send.encode("utf-8")
-            client_socket.sendall(encoded_message)
+            with send_lock:
+                send_frame(client_socket, encoded_message)
 
             if user_input.lower() == "terminate":
                 print("[CLIENT] Termination command sent. Disconnecting.")
@@ -96,9 +166,11 @@ def start_client(server_ip, server_port, client_role, client_topic):
             # Add a small delay for better readability in rapid message exchanges
             # time.sleep(0.1)
 
+    except FileNotFoundError:
+        print(f"[CLIENT] Error: No server socket at {unix_path(server_ip)}.")
     except ConnectionRefusedError:
         print(
-            f"[CLIENT] Error: Connection refused. Is the server running on {server_ip}:{server_port}?"
+            f"[CLIENT] Error: Connection refused. Is the server running on {describe(server_ip, server_port)}?"
         )
     except socket.gaierror:
         print(f"[CLIENT] Error: Could not resolve server IP address '{server_ip}'.")
@@ -112,10 +184,23 @@ def start_client(server_ip, server_port, client_role, client_topic):
 
 
 if __name__ == "__main__":
+    if len(sys.argv) == 4 and unix_path(sys.argv[1]) is not None:
+        # A server on this host's Unix socket: "unix:/path" takes the IP and port's place
+        start_client(sys.argv[1], None, sys.argv[2], sys.argv[3])
+        sys.exit(0)
     if len(sys.argv) != 5:
         print("Usage: python client_app.py <Server IP> <Server PORT> <ROLE> <TOPIC>")
+        print("       python client_app.py unix:<socket path> <ROLE> <TOPIC>")
         print("Roles: PUBLISHER or SUBSCRIBER")
         print("Topics: Any string (e.g., NEWS, WEATHER, SPORTS)")
+        print('Replay missed messages: "NEWS;offset=<N>" or "NEWS;from_ts=<unix time>"')
+        print('At-least-once delivery: "NEWS;qos=1;client_id=<name>"')
+        print('Heartbeats: "NEWS;heartbeat=<seconds>"')
+        print('Content filters on JSON messages: "NEWS;filter=region=eu&price<20"')
+        print(
+            "Subscribers may list several comma-separated topics and use wildcards "
+            "(e.g., SPORTS.*,NEWS.#)"
+        )
         sys.exit(1)
     try:
         server_ip = sys.argv[1]
@@ -1,163 +1,1405 @@
+import argparse
+import asyncio
+import contextlib
+import itertools
+import logging
+import os
 import socket
 import sys
 import threading
 import time
 
-# List to keep track of all connected clients and their roles/topics
-# Each entry will be a dictionary: {'socket': conn, 'address': addr, 'role': role_str, 'topic': topic_str}
-connected_clients = []
-client_lock = threading.Lock()  # Lock to protect access to connected_clients list
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.binary_protocol import (
+    BINARY,
+    TEXT,
+    OP_ACK,
+    OP_PUBLISH,
+    OP_PUBLISH_COMPRESSED,
+    OP_REGISTER,
+    OP_SUBSCRIBE,
+    OP_TERMINATE,
+    OP_UNSUBSCRIBE,
+    BinarySession,
+    TopicAliases,
+    TopicTable,
+    decode,
+    decode_sequence,
+    encode_publish,
+    encode_publish_compressed,
+    protocol_from_options,
+    split_compressed,
+)
+from common.compression import (
+    DEFAULT_MIN_BYTES,
+    CompressionPolicy,
+    codecs_from_options,
+    decompress,
+    maybe_compress,
+    parse_rule,
+)
+from common.dedup import (
+    DEFAULT_MAX_BYTES as DEFAULT_DEDUP_BYTES,
+    DEFAULT_MAX_IDS as DEFAULT_DEDUP_IDS,
+    DEFAULT_TTL as DEFAULT_DEDUP_TTL,
+    DedupCache,
+    msg_ids_from_options,
+    split_message_id,
+)
+from common.federation import Federation, parse_peers
+from common.filters import FilterIndex, compile_filter, filter_from_options, message_attributes
+from common.framing import (
+    DEFAULT_MAX_FRAME_SIZE,
+    AsyncFrameReader,
+    FrameReader,
+    encode_frame,
+    set_max_frame_size,
+)
+from common.handshake import split_options
+from common.heartbeat import (
+    DEFAULT_TCP_KEEPALIVE,
+    HEARTBEAT_GRACE,
+    HEARTBEAT_OPTION,
+    IdleMonitor,
+    close_quietly,
+    drop_pings,
+    enable_keepalive,
+    heartbeat_from_options,
+    pong_frame,
+)
+from common.lanes import (
+    ACK_QUEUE_SIZE,
+    DEFAULT_LANE_SIZE,
+    DEFAULT_WEIGHTS,
+    AsyncLaneScheduler,
+    LaneScheduler,
+    PriorityPolicy,
+    RoutedAcks,
+    parse_priority_rule,
+    parse_weights,
+)
+from common.limits import raise_open_file_limit
+from common.log import DEFAULT_LOG_LEVEL, LOG_LEVELS, SERVER_LOGGER, configure_logging
+from common.message_log import DEFAULT_SEGMENT_BYTES, MessageLog, parse_replay_options
+from common.metrics import Metrics, serve_metrics
+from common.outbound import (
+    DEFAULT_QUEUE_SIZE,
+    DISCONNECT,
+    DROP_OLDEST,
+    OVERFLOW_POLICIES,
+    AsyncSubscriberWriter,
+    SubscriberWriter,
+)
+from common.qos import (
+    DEFAULT_ACK_TIMEOUT,
+    DEFAULT_SESSION_EXPIRY,
+    DEFAULT_WINDOW,
+    QosSessions,
+    client_id_from_options,
+    encode_puback,
+    encode_seq,
+    qos_from_options,
+    sweep_interval,
+)
+from common.registry import SubscriberRegistry
+from common.retained import DEFAULT_RETAINED_BYTES, RetainedCache
+from common.sharding import PEER_ROLE, ShardCluster, run_workers, worker_socket_path
+from common.shm_ring import SHM_OPTION, AsyncShmFrameReader, ShmFrameReader
+from common.topic_trie import TopicTrie, is_wildcard, validate_pattern, validate_topic
+from common.transport import UNIX_PREFIX, format_address, listen_unix, remove_stale_socket
+
+log = logging.getLogger(SERVER_LOGGER)
+
+# Server-wide settings, filled in from the command line in __main__
+settings = {
+    "queue_size": DEFAULT_QUEUE_SIZE,  # Frames buffered per subscriber
+    "overflow_policy": DROP_OLDEST,  # What to do when a subscriber's queue is full
+    "coalesce": True,  # One vectored write per drained batch instead of one per frame
+    "max_frame_size": DEFAULT_MAX_FRAME_SIZE,  # Largest frame a client may send (--max-frame-size)
+    "compression": CompressionPolicy(),  # Topics whose payloads are compressed (--compress)
+    "qos_window": DEFAULT_WINDOW,  # Unacknowledged messages kept per QoS-1 subscriber
+    "ack_timeout": DEFAULT_ACK_TIMEOUT,  # Seconds before unacknowledged messages are resent
+    "session_expiry": DEFAULT_SESSION_EXPIRY,  # Seconds a disconnected QoS-1 session is kept
+    "idle_timeout": 0,  # Seconds of silence before a client without heartbeats is dropped; 0: never
+    "tcp_keepalive": DEFAULT_TCP_KEEPALIVE,  # Idle seconds before TCP keepalive probes; 0: off
+    "dedup_ids": DEFAULT_DEDUP_IDS,  # Message IDs remembered per publisher
+    "dedup_ttl": DEFAULT_DEDUP_TTL,  # Seconds a message ID is remembered
+    "dedup_bytes": DEFAULT_DEDUP_BYTES,  # Memory cap of all publishers' message IDs
+    "priority": PriorityPolicy(),  # Lane of each topic (--priority); no rules: no lanes
+    "lane_weights": DEFAULT_WEIGHTS,  # Share of the routing work each lane gets
+    "lane_size": DEFAULT_LANE_SIZE,  # Publishes waiting per lane before publishers wait
+}
+
+# All connected clients keyed by socket, so joining and leaving are O(1)
+# Each value is a dictionary: {'address': addr, 'role': role_str, 'topic': topic_str}
+connected_clients = {}
+client_lock = threading.Lock()  # Lock to protect access to connected_clients
+
+# Subscribers indexed by topic; a publish only looks at its own topic's subscribers
+subscriber_registry = SubscriberRegistry()
+
+# Subscribers of the asyncio mode indexed by topic
+async_registry = SubscriberRegistry()
+
+# Clients of the asyncio mode, keyed by their StreamWriter, with the same values
+# as connected_clients. Only touched from the event loop thread, so no lock is needed.
+async_clients = {}
+
+# Topic ids of the binary protocol, and the ids each binary subscriber already knows
+topic_table = TopicTable()
+binary_sessions = {}  # subscriber writer -> BinarySession
+
+# At-least-once sessions of QoS-1 subscribers, and the session of each connected one
+qos_sessions = QosSessions()
+qos_links = {}  # subscriber writer -> QosSession
+
+# Deadlines of the clients with heartbeats or an idle timeout, keyed by socket / StreamWriter
+idle_monitor = IdleMonitor()
+
+# Message IDs seen from the publishers that send them (";msg_ids=1"), to drop resends;
+# rebuilt from settings in __main__ and in each worker
+dedup_cache = DedupCache()
+
+# Routes publishers' publishes lane by lane when there are --priority rules, else None
+lanes = None
+
+# Content filters of the subscribers that set one, in either mode
+subscriber_filters = FilterIndex()
+
+# Durable per-topic log of published messages, created in __main__ when --log-dir is given
+message_log = None
+# Last messages of each topic, sent to new subscribers; created in __main__ when --retain is given
+retained = None
+# Held while messages are logged or retained and fanned out, and while a subscriber
+# joins, so each message reaches that subscriber exactly once: replayed, retained or live
+log_lock = threading.Lock()
+
+
+# Numbers the clients of the Unix socket, which have no address of their own
+unix_client_ids = itertools.count(1)
+
+
+# This worker's view of the cluster when started with --workers N (N > 1), else None
+cluster = None
+# Other workers that have subscribers for topics this worker owns, indexed by pattern
+peer_registry = SubscriberRegistry()
+
+# This node's links to the other brokers when started with --peers, else None
+federation = None
+
+
+def connection_counts():
+    counts = {"PUBLISHER": 0, "SUBSCRIBER": 0}
+    with client_lock:
+        clients = list(connected_clients.values())
+    for client in clients + list(async_clients.values()):
+        counts[client["role"]] += 1
+    return counts
+
+
+def queue_depths():
+    subscribers = subscriber_registry.all_subscribers() + async_registry.all_subscribers()
+    return {
+        format_address(subscriber.address): len(subscriber.queue)
+        for subscriber in subscribers
+    }
+
+
+def retained_bytes():
+    return retained.bytes if retained is not None else 0
+
+
+def retained_topics():
+    return len(retained) if retained is not None else 0
+
+
+def lane_depths():
+    return lanes.depths() if lanes is not None else {}
+
+
+# Hot-path counters and gauges, served over HTTP with --metrics-port
+metrics = Metrics()
+metrics.counter(
+    "broker_messages_published_total", "Messages received from publishers", label="topic"
+)
+metrics.counter(
+    "broker_messages_delivered_total", "Messages queued for subscribers", label="topic"
+)
+metrics.counter(
+    "broker_messages_forwarded_total", "Publishes forwarded to the worker owning their topic"
+)
+metrics.counter(
+    "broker_messages_federated_total", "Publishes sent to other broker nodes with subscribers"
+)
+metrics.counter(
+    "broker_federated_unmatched_total",
+    "Publishes received from other broker nodes without a local subscriber",
+)
+metrics.counter(
+    "broker_messages_filtered_total",
+    "Messages not delivered to a subscriber on their topic because of its content filter",
+    label="topic",
+)
+metrics.counter(
+    "broker_duplicates_dropped_total",
+    "Publishes dropped because their message ID was seen from the same publisher",
+)
+metrics.counter(
+    "broker_subscribers_disconnected_total",
+    "Subscribers disconnected because their queue overflowed or closed",
+)
+metrics.counter(
+    "broker_messages_compressed_total",
+    "Payloads the server compressed for subscribers, by codec",
+    label="codec",
+)
+metrics.counter(
+    "broker_messages_redelivered_total",
+    "Unacknowledged messages sent again to QoS-1 subscribers",
+)
+metrics.counter(
+    "broker_lane_routed_total", "Publishes routed from each priority lane", label="lane"
+)
+metrics.counter("broker_connections_total", "Connections accepted, by role", label="role")
+metrics.counter(
+    "broker_connections_timed_out_total",
+    "Clients disconnected for missing heartbeats or staying idle",
+)
+metrics.histogram(
+    "broker_fanout_seconds", "Time to queue the publishes of one read for every subscriber"
+)
+metrics.gauge("broker_connections", "Open connections, by role", connection_counts, label="role")
+metrics.gauge("broker_qos_sessions", "QoS-1 subscriber sessions, connected or not", qos_sessions.__len__)
+metrics.gauge("broker_retained_bytes", "Payload bytes in the retained cache", retained_bytes)
+metrics.gauge("broker_retained_topics", "Topics with retained messages", retained_topics)
+metrics.gauge("broker_dedup_ids", "Message IDs in the dedup windows", lambda: len(dedup_cache))
+metrics.gauge(
+    "broker_dedup_bytes", "Estimated memory of the dedup windows", lambda: dedup_cache.bytes
+)
+metrics.gauge(
+    "broker_dedup_hit_ratio",
+    "Share of the publishes with a message ID that were duplicates",
+    lambda: dedup_cache.hit_rate,
+)
+metrics.gauge("broker_lane_depth", "Publishes waiting in each priority lane", lane_depths, label="lane")
+metrics.gauge(
+    "broker_queue_depth",
+    "Frames waiting in each subscriber's queue",
+    queue_depths,
+    label="connection",
+)
+
+
+def log_guard():
+    """log_lock when the message log or the retained cache is enabled, otherwise a no-op context."""
+    if message_log is None and retained is None:
+        return contextlib.nullcontext()
+    return log_lock
+
+
+def build_published_frame(topic, content):
+    """
+    Formats and frames a published message (content as bytes) once per publish.
+    The returned bytes are immutable, so every subscriber queue shares the same object.
+    """
+    return encode_frame(b"[PUBLISHED - " + topic.encode("utf-8") + b"] " + content)
+
+
+def is_terminate(data):
+    """Whether a text frame is the "terminate" command, checked without decoding messages."""
+    return len(data) < 64 and data.strip().lower() == b"terminate"
+
+
+def split_patterns(topics_text):
+    """Splits a comma-separated topic list ("NEWS,SPORTS.*") into normalized patterns."""
+    return [topic.strip().upper() for topic in topics_text.split(",") if topic.strip()]
+
+
+def update_subscriptions(registry, subscriber, command, topics_text, warm_up=True):
+    """
+    Applies a subscriber's SUBSCRIBE or UNSUBSCRIBE command to the registry.
+    With the retained cache enabled and `warm_up`, the retained messages of
+    the newly subscribed patterns are queued for the subscriber; call with
+    log_guard() held. Returns a list of error messages for patterns that
+    were rejected.
+    """
+    errors = []
+    added = []
+    for pattern in split_patterns(topics_text):
+        try:
+            validate_pattern(pattern)
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+        if command == "SUBSCRIBE":
+            if registry.add(pattern, subscriber):
+                added.append(pattern)
+                add_interest(pattern)
+        else:
+            if registry.remove(pattern, subscriber):
+                remove_interest(pattern)
+    if added and warm_up and retained is not None:
+        send_retained(subscriber, added)
+    return errors
+
+
+def drop_subscriber(registry, subscriber):
+    """Removes every subscription, and the filter, of a disconnecting subscriber."""
+    subscriber_filters.remove(subscriber)
+    for pattern in registry.remove_all(subscriber):
+        remove_interest(pattern)
+
+
+def set_filter(subscriber, expression, addr):
+    """Applies a subscriber's "FILTER:<expression>" command; an empty one removes its filter."""
+    try:
+        content_filter = compile_filter(expression)
+    except ValueError as e:
+        log.warning(f"{addr} FILTER rejected: {e}")
+        return
+    subscriber_filters.set(subscriber, content_filter)
+    log.info(f"Subscriber {addr} filter: {content_filter or 'none'}")
+
+
+def split_filtered(targets):
+    """Splits a topic's subscribers into those without a content filter and those with one."""
+    if not len(subscriber_filters):
+        return targets, frozenset()
+    filtered = frozenset(target for target in targets if target in subscriber_filters)
+    if not filtered:
+        return targets, filtered
+    return tuple(target for target in targets if target not in filtered), filtered
+
+
+def filter_targets(frames, index, targets):
+    """
+    The subscribers of a topic that get the publish at `index`: those
+    without a filter, and those whose filter its attributes satisfy.
+    """
+    unfiltered, filtered = targets
+    if not filtered:
+        return unfiltered
+    payload = frames.payload(index)
+    attributes = message_attributes(payload) if payload is not None else {}
+    passed = subscriber_filters.matching(attributes, filtered)
+    return (*unfiltered, *passed) if passed else unfiltered
+
+
+def add_interest(pattern):
+    """Tells the other workers or nodes, if any, about a new local subscription."""
+    if cluster is not None:
+        cluster.add_interest(pattern)
+    if federation is not None:
+        federation.add_interest(pattern)
+
+
+def remove_interest(pattern):
+    if cluster is not None:
+        cluster.remove_interest(pattern)
+    if federation is not None:
+        federation.remove_interest(pattern)
+
+
+def send_retained(subscriber, patterns):
+    """
+    Queues the retained messages of every topic matching one of `patterns`
+    on a subscriber, topic by topic, oldest message first. Call with
+    log_guard() held and the patterns already registered, so no publish is
+    missed or sent twice in between.
+    """
+    # Exact topics are looked up directly; only wildcards scan the retained topics
+    topics = [pattern for pattern in patterns if not is_wildcard(pattern)]
+    wildcards = [pattern for pattern in patterns if is_wildcard(pattern)]
+    if wildcards:
+        matcher = TopicTrie()
+        for pattern in wildcards:
+            matcher.add(pattern, pattern)
+        topics.extend(
+            topic
+            for topic in retained.topics()
+            if topic not in topics and matcher.match(topic)
+        )
+    publishes = []
+    for topic in topics:
+        publishes.extend(
+            (topic, content, compressed) for content, compressed in retained.values(topic)
+        )
+    frames = PublishFrames(publishes)
+    indexes = range(len(publishes))
+    if subscriber in subscriber_filters:
+        targets = ((), frozenset([subscriber]))
+        indexes = [index for index in indexes if filter_targets(frames, index, targets)]
+    if indexes:
+        send_publishes(subscriber, frames, indexes)
+        log.debug(f"Sent {len(indexes)} retained message(s) to {subscriber.address}.")
+
+
+def parse_publish(data):
+    """
+    Splits a publisher message b"TOPIC:MESSAGE_CONTENT" into (topic, content).
+    Only the topic is decoded; the content stays bytes and is routed as is.
+    Returns None if the message is malformed or names a wildcard topic.
+    """
+    topic, separator, content = data.partition(b":")
+    if not separator:
+        return None
+    try:
+        published_topic = topic.decode("utf-8").upper()
+        validate_topic(published_topic)
+    except ValueError:  # Also a topic that is not UTF-8
+        return None
+    return published_topic, content
+
+
+def strip_message_id(content, dedup_key, addr):
+    """
+    Splits the message ID off a publish's content and records it in the
+    publisher's dedup window. Returns the rest of the content, or None if
+    the publish is a duplicate or has no valid ID; it is then not routed.
+    """
+    try:
+        message_id, content = split_message_id(content)
+    except ValueError as e:
+        log.warning(f"{e} From {addr}; not routed.")
+        return None
+    if dedup_cache.seen(dedup_key, message_id):
+        metrics.inc("broker_duplicates_dropped_total")
+        return None
+    return content
+
+
+def parse_text_frames(frames, client_role, addr, debug=False, dedup_key=None):
+    """
+    Reads the frames of a text-protocol client: "TOPIC:MESSAGE_CONTENT"
+    publishes from a publisher, "SUBSCRIBE:<topics>" / "UNSUBSCRIBE:<topics>",
+    "FILTER:<expression>" and "ACK:<n>" commands from a subscriber. Returns the (topic, content) publishes, the
+    (command, topics) subscription commands, and whether the client sent
+    "terminate"; frames after it are ignored. Each publish is a (topic,
+    content, compressed) triple, see route_publishes(). With a `dedup_key`,
+    every publish starts with a message ID, and duplicates are left out.
+    """
+    publishes, commands = [], []
+    for data in frames:
+        if not data:  # Ignore empty frames
+            continue
+        if debug:
+            log.debug(f"Received from {addr} ({client_role}): {data.decode('utf-8', 'replace')}")
+        if is_terminate(data):
+            return publishes, commands, True
+        if client_role == "PUBLISHER":
+            publish = parse_publish(data.strip())
+            if publish is None:
+                log.warning(
+                    f"Malformed message from PUBLISHER {addr}: '{data.decode('utf-8', 'replace')}'. Not routed."
+                )
+                continue
+            if dedup_key is not None:
+                published_content = strip_message_id(publish[1], dedup_key, addr)
+                if published_content is None:
+                    continue
+                publish = (publish[0], published_content)
+            publishes.append((*publish, None))
+        else:
+            # Subscribers can change their topics and filter on the same connection,
+            # and QoS-1 subscribers acknowledge what they received
+            command, _, topics_text = data.decode("utf-8").strip().partition(":")
+            command = command.upper()
+            if command in ("SUBSCRIBE", "UNSUBSCRIBE", "FILTER", "ACK"):
+                commands.append((command, topics_text))
+    return publishes, commands, False
+
+
+def parse_binary_frames(
+    frames, client_role, aliases, addr, codecs=frozenset(), dedup_key=None
+):
+    """
+    Reads the frames of a binary-protocol client (see common/binary_protocol.py)
+    and returns the same as parse_text_frames. A publisher's REGISTERs are
+    recorded in `aliases`; compressed publishes are accepted in the `codecs`
+    it negotiated and kept compressed. With a `dedup_key`, duplicates are
+    left out as in parse_text_frames.
+    """
+    publishes, commands = [], []
+    for data in frames:
+        try:
+            opcode, topic_id, body = decode(data)
+        except ValueError as e:
+            log.warning(f"Malformed binary frame from {addr}: {e}")
+            continue
+        if opcode == OP_TERMINATE:
+            return publishes, commands, True
+        if client_role == "PUBLISHER" and opcode == OP_PUBLISH:
+            published_topic = aliases.topic(topic_id)
+            if published_topic is None:
+                log.warning(f"PUBLISH on unregistered topic id {topic_id} from {addr}. Not routed.")
+                continue
+            if dedup_key is not None:
+                body = strip_message_id(body, dedup_key, addr)
+                if body is None:
+                    continue
+            publishes.append((published_topic, body, None))
+        elif client_role == "PUBLISHER" and opcode == OP_PUBLISH_COMPRESSED:
+            published_topic = aliases.topic(topic_id)
+            if published_topic is None:
+                log.warning(f"PUBLISH on unregistered topic id {topic_id} from {addr}. Not routed.")
+                continue
+            try:
+                codec, compressed = split_compressed(body)
+            except ValueError as e:
+                log.warning(f"Malformed binary frame from {addr}: {e}")
+                continue
+            if codec not in codecs:
+                log.warning(f"{codec} payload from {addr}, which did not negotiate it. Not routed.")
+                continue
+            if dedup_key is not None:
+                compressed = strip_message_id(compressed, dedup_key, addr)
+                if compressed is None:
+                    continue
+            publishes.append((published_topic, None, (codec, compressed)))
+        elif client_role == "PUBLISHER" and opcode == OP_REGISTER:
+            try:
+                published_topic = body.decode("utf-8").upper()
+                validate_topic(published_topic)
+            except ValueError as e:
+                log.warning(f"Invalid REGISTER from {addr}: {e}")
+                continue
+            aliases.register(topic_id, published_topic)
+        elif client_role == "SUBSCRIBER" and opcode in (OP_SUBSCRIBE, OP_UNSUBSCRIBE):
+            command = "SUBSCRIBE" if opcode == OP_SUBSCRIBE else "UNSUBSCRIBE"
+            commands.append((command, body.decode("utf-8")))
+        elif client_role == "SUBSCRIBER" and opcode == OP_ACK:
+            try:
+                commands.append(("ACK", str(decode_sequence(data))))
+            except ValueError as e:
+                log.warning(f"Malformed binary frame from {addr}: {e}")
+        else:
+            log.warning(f"Unexpected binary opcode {opcode} from {client_role} {addr}.")
+    return publishes, commands, False
+
+
+class PublishFrames:
+    """
+    The frames of a list of (topic, content, compressed) publishes, built on
+    first use, so a message nobody reads in a protocol (or compressed) costs
+    nothing, and at most once, so every recipient shares the same bytes.
+    """
+
+    def __init__(self, publishes):
+        self.publishes = publishes
+        self.corrupt = set()  # Indexes of compressed publishes that did not decompress
+        self._plain = {}  # publish index -> decompressed payload of a compressed publish
+        self._compressed = {}  # publish index -> (codec, payload), or None to send it plain
+        self._text = {}  # publish index -> text frame
+        self._binary = {}  # publish index -> (topic id, binary PUBLISH frame)
+        self._binary_compressed = {}  # publish index -> (topic id, PUBLISH_COMPRESSED frame)
+
+    def payload(self, index):
+        """The plain payload, or None if a compressed one does not decompress."""
+        published_topic, published_content, compressed = self.publishes[index]
+        if published_content is not None:
+            return published_content
+        if index not in self._plain:
+            try:
+                self._plain[index] = decompress(*compressed)
+            except ValueError as e:
+                log.warning(f"Dropped a message on '{published_topic}': {e}")
+                self._plain[index] = None
+                self.corrupt.add(index)
+        return self._plain[index]
+
+    def compressed(self, index):
+        """
+        The (codec, payload) a publisher sent, or the payload compressed
+        per the topic's compression rule; None if it goes out plain.
+        """
+        if index not in self._compressed:
+            published_topic, _, compressed = self.publishes[index]
+            if compressed is None:
+                setting = settings["compression"].for_topic(published_topic)
+                if setting is not None:
+                    codec, min_bytes = setting
+                    data = maybe_compress(codec, self.payload(index), min_bytes)
+                    if data is not None:
+                        compressed = (codec, data)
+                        metrics.inc("broker_messages_compressed_total", label=codec)
+            self._compressed[index] = compressed
+        return self._compressed[index]
+
+    def text(self, index):
+        """The text frame, or None if the payload does not decompress."""
+        frame = self._text.get(index)
+        if frame is None:
+            published_content = self.payload(index)
+            if published_content is None:
+                return None
+            frame = self._text[index] = build_published_frame(
+                self.publishes[index][0], published_content
+            )
+        return frame
+
+    def binary(self, index, codecs):
+        """
+        The (topic id, frame) delivery for a binary subscriber accepting
+        `codecs`, or None if the payload does not decompress.
+        """
+        if codecs:
+            compressed = self.compressed(index)
+            if compressed is not None and compressed[0] in codecs:
+                delivery = self._binary_compressed.get(index)
+                if delivery is None:
+                    topic_id = topic_table.id_for(self.publishes[index][0])
+                    delivery = self._binary_compressed[index] = (
+                        topic_id,
+                        encode_publish_compressed(topic_id, *compressed),
+                    )
+                return delivery
+        delivery = self._binary.get(index)
+        if delivery is None:
+            published_content = self.payload(index)
+            if published_content is None:
+                return None
+            topic_id = topic_table.id_for(self.publishes[index][0])
+            delivery = self._binary[index] = (
+                topic_id,
+                encode_publish(topic_id, published_content),
+            )
+        return delivery
+
+
+def send_publishes(target, frames, indexes):
+    """
+    Queues the publishes at `indexes` of a PublishFrames on one subscriber,
+    in its protocol, with a single send_many(); through its QoS-1 session,
+    if it has one. Returns False if the subscriber was disconnected (queue
+    full or closed).
+    """
+    qos = qos_links.get(target)
+    session = binary_sessions.get(target)
+    if session is None:
+        batch = [frames.text(index) for index in indexes]
+        if frames.corrupt:
+            batch = [frame for frame in batch if frame is not None]
+        return target.send_many(batch) if qos is None else qos.deliver(batch)
+    deliveries = [frames.binary(index, session.codecs) for index in indexes]
+    if frames.corrupt:
+        deliveries = [delivery for delivery in deliveries if delivery is not None]
+    if qos is not None:
+        return qos.deliver(deliveries)
+    return session.send_many(target, deliveries)
+
+
+def queue_settings(qos):
+    """
+    Queue size and overflow policy of a new subscriber's writer. A QoS-1
+    subscriber is disconnected rather than silently losing frames, which
+    would break its message numbering; its queue has room for a whole
+    redelivery window (with binary REGISTERs) on top of live traffic.
+    """
+    if not qos:
+        return settings["queue_size"], settings["overflow_policy"]
+    return settings["queue_size"] + 2 * settings["qos_window"] + 1, DISCONNECT
+
+
+def acknowledge(session, seq, addr):
+    """Applies a subscriber's "ACK:<n>" to its QoS-1 session."""
+    if session is None:
+        log.warning(f"ACK from {addr}, which did not ask for QoS 1; ignored.")
+        return
+    try:
+        session.ack(int(seq))
+    except ValueError:
+        log.warning(f"Malformed ACK '{seq}' from {addr}.")
+
+
+def attach_qos(subscriber, protocol, client_id):
+    """
+    Opens the QoS-1 session of a new subscriber, or resumes the one of its
+    client id, and redelivers what that session had not had acknowledged.
+    Returns the session and the `send` callable it is attached with.
+    """
+    session = qos_sessions.open(client_id, settings["qos_window"], settings["ack_timeout"])
+    if protocol == BINARY:
+        binary_session = binary_sessions[subscriber]
+
+        def send(deliveries):
+            return binary_session.send_many(subscriber, deliveries)
+
+        def marker(seq):
+            return None, encode_seq(seq, BINARY)
+
+    else:
+        send, marker = subscriber.send_many, encode_seq
+    qos_links[subscriber] = session
+    redelivered = session.attach(send, marker, subscriber.close)
+    if redelivered:
+        metrics.inc("broker_messages_redelivered_total", redelivered)
+        log.info(f"Redelivered {redelivered} unacknowledged message(s) to {subscriber.address}.")
+    return session, send
+
+
+def sweep_qos():
+    """Resends QoS-1 messages whose ack timed out and drops expired sessions."""
+    redelivered, expired = qos_sessions.sweep(time.monotonic(), settings["session_expiry"])
+    if redelivered:
+        metrics.inc("broker_messages_redelivered_total", redelivered)
+    if expired:
+        log.info(f"Expired {expired} disconnected QoS-1 session(s).")
+
+
+def sweep_idle():
+    """Disconnects the clients whose heartbeat or idle timeout passed."""
+    expired = idle_monitor.sweep(time.monotonic())
+    if expired:
+        metrics.inc("broker_connections_timed_out_total", expired)
+        log.info(f"Disconnected {expired} client(s) that missed their heartbeat or idle timeout.")
+
+
+def sweep_log():
+    """Deletes expired message log segments, even of topics nobody publishes on any more."""
+    if message_log is None:
+        return
+    try:
+        deleted = message_log.sweep()
+    except OSError as e:
+        log.warning(f"Message log retention failed: {e}")
+        return
+    if deleted:
+        log.info(f"Deleted {deleted} expired message log segment(s).")
+
+
+def client_timeout(heartbeat):
+    """Seconds of silence after which a client is disconnected, or 0 for never."""
+    return heartbeat * HEARTBEAT_GRACE if heartbeat else settings["idle_timeout"]
+
+
+def housekeeping_interval():
+    return min(sweep_interval(settings["ack_timeout"]), idle_monitor.tick)
+
+
+def run_housekeeping():
+    """Sweeps the QoS-1 sessions, idle timeouts, message log and dedup windows periodically (threaded mode)."""
+    while True:
+        time.sleep(housekeeping_interval())
+        sweep_qos()
+        sweep_idle()
+        sweep_log()
+        dedup_cache.sweep()
+
+
+async def run_housekeeping_async():
+    """Sweeps the QoS-1 sessions, idle timeouts, message log and dedup windows on the event loop (asyncio mode)."""
+    while True:
+        await asyncio.sleep(housekeeping_interval())
+        sweep_qos()
+        sweep_idle()
+        sweep_log()
+        dedup_cache.sweep()
+
+
+async def stop_task(task, name):
+    """Cancels a background task on shutdown and waits for it, logging how it failed, if it did."""
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        log.error(f"{name} task failed: {e}")
+
+
+def route_publishes(registry, publishes, from_owner=False):
+    """
+    Fans out the publishes read together, e.g. one publisher batch, as a
+    unit: each topic is resolved once, each message is framed at most once
+    per protocol (text and binary), and every subscriber receives all of its
+    frames with a single send_many(). The content is never decoded.
+    With the message log enabled, every text frame is appended to its topic's log first.
+
+    A publish is a (topic, content, compressed) triple: `compressed` is the
+    (codec, payload) a publisher sent, in which case `content` is None until
+    some recipient needs the plain payload. Compressed payloads go as they
+    are to binary subscribers that accept the codec; topics with a
+    compression rule are compressed here, once per message, when the first
+    such subscriber needs them.
+
+    In a sharded broker, publishes on topics owned by another worker are
+    forwarded to it, and publishes owned here are also delivered to the other
+    workers with matching subscribers. In a federation, publishes are also
+    sent once to each other node whose summary may match their topic.
+    `from_owner` marks publishes the owner or another node already routed,
+    which only go to this worker's own subscribers.
+
+    Subscribers with a content filter only get the publishes whose
+    attributes pass it (see common/filters.py); the payload is parsed once
+    per publish, and only if its topic has such a subscriber.
+
+    Returns the recipient count of each publish (None if it was forwarded to
+    its owner) and the subscribers that were disconnected (queue full or closed).
+    """
+    started = time.perf_counter()
+    counts = [None] * len(publishes)
+    owned = []
+    forwarded = {}  # owner worker id -> PUBLISH frames
+    for index, publish in enumerate(publishes):
+        if cluster is None or from_owner or cluster.owns(publish[0]):
+            owned.append(index)
+        else:
+            forwarded.setdefault(cluster.owner(publish[0]), []).append(
+                peer_frame(b"PUBLISH", publish)
+            )
+    for worker_id, worker_frames in forwarded.items():
+        cluster.peers[worker_id].send_many(worker_frames)
+        metrics.inc("broker_messages_forwarded_total", len(worker_frames))
+
+    frames = PublishFrames(publishes)
+    recipients = {}  # subscriber -> indexes of its publishes, in publish order
+    peer_frames = {}  # peer worker or node link -> DELIVER frames
+    targets_by_topic = {}
+    nodes_by_topic = {}
+    published = {}  # topic -> publishes on it in this call
+    delivered = {}  # topic -> frames queued for its subscribers in this call
+    with log_guard():
+        for index in owned:
+            published_topic, published_content, compressed = publishes[index]
+            if message_log is not None:
+                frame = frames.text(index)
+                if frame is not None:
+                    message_log.append(published_topic, frame)
+            if retained is not None:
+                size = len(published_content if compressed is None else compressed[1])
+                retained.add(published_topic, (published_content, compressed), size)
+            targets = targets_by_topic.get(published_topic)
+            if targets is None:
+                targets = targets_by_topic[published_topic] = split_filtered(
+                    registry.subscribers(published_topic)
+                )
+            targets = filter_targets(frames, index, targets)
+            for target in targets:
+                recipients.setdefault(target, []).append(index)
+            counts[index] = len(targets)
+            published[published_topic] = published.get(published_topic, 0) + 1
+            delivered[published_topic] = delivered.get(published_topic, 0) + len(targets)
+            if cluster is not None and not from_owner:
+                peers = peer_registry.subscribers(published_topic)
+                if peers:
+                    deliver = peer_frame(b"DELIVER", publishes[index])
+                    for peer in peers:
+                        peer_frames.setdefault(peer, []).append(deliver)
+            if federation is not None and not from_owner:
+                nodes = nodes_by_topic.get(published_topic)
+                if nodes is None:
+                    nodes = nodes_by_topic[published_topic] = federation.links_for(published_topic)
+                if nodes:
+                    deliver = peer_frame(b"DELIVER", publishes[index])
+                    for node in nodes:
+                        peer_frames.setdefault(node, []).append(deliver)
+                    metrics.inc("broker_messages_federated_total", len(nodes))
+        disconnected = []
+        for target, indexes in recipients.items():
+            if not send_publishes(target, frames, indexes):
+                disconnected.append(target)
+        for peer, deliveries in peer_frames.items():
+            # A node link that closed is redialed by the federation, not dropped here
+            if not peer.send_many(deliveries) and cluster is not None:
+                disconnected.append(peer)
+    # Counted once per topic per call, not per message
+    for published_topic, published_count in published.items():
+        if not from_owner:  # The owner already counted the publish
+            metrics.inc("broker_messages_published_total", published_count, published_topic)
+        metrics.inc("broker_messages_delivered_total", delivered[published_topic], published_topic)
+        unfiltered, filtered = targets_by_topic[published_topic]
+        skipped = published_count * (len(unfiltered) + len(filtered)) - delivered[published_topic]
+        if skipped:
+            metrics.inc("broker_messages_filtered_total", skipped, published_topic)
+    if disconnected:
+        metrics.inc("broker_subscribers_disconnected_total", len(disconnected))
+    metrics.observe("broker_fanout_seconds", time.perf_counter() - started)
+    return counts, disconnected
+
+
+def write_to_publisher(writer, frame):
+    """Writes a frame to an asyncio publisher from the lane dispatcher; a closed one is ignored."""
+    if not writer.is_closing():
+        writer.write(frame)
+
+
+def route_lane(registry, lane, publishes):
+    """Routes the publishes the lane scheduler took from one lane in a single pass."""
+    _, disconnected = route_publishes(registry, publishes)
+    for target in disconnected:
+        log.warning(f"Subscriber {target.address} disconnected (queue full or closed).")
+    metrics.inc("broker_lane_routed_total", len(publishes), lane)
+
+
+def peer_frame(command, publish):
+    """
+    Frames a PUBLISH or DELIVER message for another worker:
+    b"COMMAND:TOPIC:content", or b"COMMAND;codec:TOPIC:payload" for a publish
+    that arrived compressed, which stays compressed.
+    """
+    published_topic, published_content, compressed = publish
+    if published_content is None:
+        command += b";" + compressed[0].encode("utf-8")
+        published_content = compressed[1]
+    return encode_frame(command + b":" + published_topic.encode("utf-8") + b":" + published_content)
+
+
+def parse_peer_publish(codec, data):
+    """Reads the b"TOPIC:content" of a peer PUBLISH or DELIVER into a publish triple."""
+    publish = parse_publish(data)
+    if publish is None:
+        return None
+    if codec:
+        return publish[0], None, (codec.decode("utf-8"), publish[1])
+    return publish[0], publish[1], None
+
+
+def process_peer_frames(registry, peer, frames):
+    """
+    Handles the frames another worker sent over its link: publishes to route
+    as owner, deliveries for local subscribers, and interest updates.
+    """
+    owned, delivered = [], []
+    for data in frames:
+        command, _, rest = data.partition(b":")
+        command, _, codec = command.partition(b";")
+        if command == b"PUBLISH":
+            owned.append(parse_peer_publish(codec, rest))
+        elif command == b"DELIVER":
+            delivered.append(parse_peer_publish(codec, rest))
+        elif command == b"SUBSCRIBE":
+            peer_registry.add(rest.decode("utf-8"), peer)
+        elif command == b"UNSUBSCRIBE":
+            peer_registry.remove(rest.decode("utf-8"), peer)
+    if owned:
+        route_publishes(registry, [publish for publish in owned if publish])
+    if delivered:
+        route_publishes(registry, [publish for publish in delivered if publish], True)
+
+
+def process_node_frames(registry, frames):
+    """Delivers the publishes another broker node forwarded to this node's subscribers."""
+    delivered = []
+    for data in frames:
+        command, _, rest = data.partition(b":")
+        _, _, codec = command.partition(b";")
+        publish = parse_peer_publish(codec, rest)
+        if publish is not None:
+            delivered.append(publish)
+    if delivered:
+        counts, _ = route_publishes(registry, delivered, True)
+        unmatched = counts.count(0)  # Bloom filter false positives, or just unsubscribed
+        if unmatched:
+            metrics.inc("broker_federated_unmatched_total", unmatched)
+
+
+def peer_link(handshake, addr):
+    """Returns the link back to the worker that sent a "PEER:<id>" handshake."""
+    role, _, worker_id = handshake.decode("utf-8").partition(":")
+    if role != PEER_ROLE or not worker_id.isdigit() or int(worker_id) not in cluster.peers:
+        log.warning(f"Invalid worker handshake from {addr}. Disconnecting.")
+        return None
+    return cluster.peers[int(worker_id)]
+
+
+def handle_peer(conn, addr):
+    """Reads the frames another worker sends to this one (threaded mode)."""
+    reader = FrameReader(conn)
+    frames = reader.read_frames()
+    cluster.connected.wait()  # Our links to the others may still be opening
+    peer = peer_link(frames[0], addr) if frames else None
+    frames = frames[1:]
+    while peer is not None:
+        process_peer_frames(subscriber_registry, peer, frames)
+        frames = reader.read_frames()
+        if not frames:
+            break
+    conn.close()
+
+
+def accept_peers(peer_socket):
+    """Accepts the other workers' links, one reader thread each."""
+    while True:
+        conn, addr = peer_socket.accept()
+        threading.Thread(target=handle_peer, args=(conn, addr), daemon=True).start()
+
+
+async def handle_peer_async(reader, writer):
+    """Reads the frames another worker sends to this one (asyncio mode)."""
+    frame_reader = AsyncFrameReader(reader)
+    frames = await frame_reader.read_frames()
+    peer = peer_link(frames[0], "a worker") if frames else None
+    frames = frames[1:]
+    while peer is not None:
+        process_peer_frames(async_registry, peer, frames)
+        frames = await frame_reader.read_frames()
+        if not frames:
+            break
+    writer.close()
+
+
+def replay_ranges(topics_text, options, addr, protocol=TEXT):
+    """
+    Returns the message log ranges a subscriber asked for with its ";offset=N"
+    or ";from_ts=T" handshake option, or [] if it asked for none. Every logged
+    topic matching one of its patterns is replayed in turn, topic by topic; an
+    offset applies to each topic's own log. Raises ValueError for a malformed
+    option, or for a replay over the binary protocol (the log holds text
+    frames). Call with log_guard() held.
+    """
+    replay = parse_replay_options(options)
+    if replay is None:
+        return []
+    if message_log is None:
+        log.warning(f"{addr} asked for a replay, but the message log is disabled.")
+        return []
+    if protocol != TEXT:
+        raise ValueError("The message log can only be replayed over the text protocol.")
+    patterns = TopicTrie()
+    for pattern in split_patterns(topics_text):
+        patterns.add(pattern, pattern)
+    ranges = []
+    for topic in message_log.topics():
+        if patterns.match(topic):
+            ranges.extend(message_log.replay(topic, **replay))
+    total = sum(count for _, _, count in ranges)
+    log.info(f"Replaying {total} bytes of the message log to {addr}.")
+    return ranges
+
+
+def shm_ring_name(client_role, options):
+    """
+    The shared-memory ring a publisher's ";shm=<name>" handshake option
+    names. Raises ValueError for a subscriber or a publisher with heartbeats,
+    whose PINGs would arrive on the socket the ring only uses as a doorbell.
+    """
+    if client_role != "PUBLISHER":
+        raise ValueError("Only publishers can send through shared memory.")
+    if HEARTBEAT_OPTION in options:
+        raise ValueError("Heartbeats need the socket transport.")
+    if not options[SHM_OPTION]:
+        raise ValueError("No ring named.")
+    return options[SHM_OPTION]
+
+
+def unix_client_address(path):
+    """A name for a Unix socket client in the logs, e.g. "unix:/tmp/broker.sock#3"."""
+    return f"{UNIX_PREFIX}{path}#{next(unix_client_ids)}"
+
+
+def accept_unix_clients(unix_socket, path):
+    """Serves the clients of the Unix socket, a thread each as for TCP clients."""
+    while True:
+        conn, _ = unix_socket.accept()
+        threading.Thread(
+            target=handle_client, args=(conn, unix_client_address(path)), daemon=True
+        ).start()
 
 
 def handle_client(conn, addr):
-    # IMPORTANT: Declare global variable at the very beginning of the function
-    # if it's going to be assigned to later in the function.
-    global connected_clients
     """
     Handles a single client connection in a separate thread.
     Receives initial role and topic, then processes messages based on role and topic.
+    Subscribers may send "SUBSCRIBE:<topics>" / "UNSUBSCRIBE:<topics>" at any time
+    to change their comma-separated list of topic patterns, and
+    "FILTER:<expression>" to change their content filter.
     """
-    print(f"[SERVER] Handling new connection from {addr}")
+    log.debug(f"Handling new connection from {addr}")
     client_role = None
     client_topic = None
+    subscriber = None
+    qos_session = qos_send = None
+    shm_reader = None  # Reads a shared-memory publisher's ring instead of the socket
+    dedup_key = None  # Dedup window of a publisher that sends message IDs
+    replies = None  # Outbound queue of a QoS-1 publisher whose PUBACKs the lane dispatcher sends
+    debug = log.isEnabledFor(logging.DEBUG)  # Checked once, not per message
 
     try:
+        # Every message arrives as a length-prefixed frame; a publisher batch
+        # arrives as one list of frames and is routed as a unit
+        reader = FrameReader(conn)
+        frames = reader.read_frames()
+
         # First message from client should be its role and topic (e.g., "PUBLISHER:TOPIC_A")
-        initial_data = conn.recv(1024)
-        if initial_data:
-            initial_info = initial_data.decode("utf-8").strip()
+        if frames:
+            initial_data = frames[0]
+            # Options such as ";offset=42" may follow the role and topic
+            initial_info, options = split_options(initial_data.decode("utf-8"))
             parts = initial_info.split(":", 1)  # Split only on the first colon
 
             if len(parts) == 2:
                 client_role = parts[0].upper()
                 client_topic = parts[1].upper()  # Normalize topic to uppercase
             else:
-                print(
-                    f"[SERVER] Invalid initial format '{initial_info}' from {addr}. Disconnecting."
-                )
+                log.warning(f"Invalid initial format '{initial_info}' from {addr}. Disconnecting.")
                 return  # Disconnect invalid clients
 
             if client_role not in ["PUBLISHER", "SUBSCRIBER"] or not client_topic:
-                print(
-                    f"[SERVER] Invalid role '{client_role}' or topic '{client_topic}' from {addr}. Disconnecting."
+                log.warning(
+                    f"Invalid role '{client_role}' or topic '{client_topic}' from {addr}. Disconnecting."
                 )
                 return  # Disconnect invalid clients
 
-            print(
-                f"[SERVER] Client {addr} identified as {client_role} on TOPIC: {client_topic}"
-            )
+            try:
+                if client_role == "SUBSCRIBER":
+                    for pattern in split_patterns(client_topic):
+                        validate_pattern(pattern)
+                else:
+                    validate_topic(client_topic)
+            except ValueError as e:
+                log.warning(f"Invalid topic from {addr}: {e} Disconnecting.")
+                return  # Disconnect invalid clients
 
-            # Add client to our global list
+            try:
+                protocol = protocol_from_options(options)
+                codecs = codecs_from_options(options)  # Compression codecs the client accepts
+                if codecs and protocol != BINARY:
+                    raise ValueError("Compression needs the binary protocol.")
+                qos = qos_from_options(options)
+                heartbeat = heartbeat_from_options(options)  # Seconds between the client's PINGs
+                content_filter = filter_from_options(options)  # Only for subscribers
+                msg_ids = msg_ids_from_options(options)  # Only for publishers
+            except ValueError as e:
+                log.warning(f"Invalid protocol option from {addr}: {e} Disconnecting.")
+                return  # Disconnect invalid clients
+            aliases = TopicAliases()  # Topics a binary publisher registered
+            if SHM_OPTION in options:
+                try:
+                    shm_reader = reader = ShmFrameReader(conn, shm_ring_name(client_role, options))
+                except (ValueError, OSError) as e:
+                    log.warning(f"Invalid shared memory ring from {addr}: {e} Disconnecting.")
+                    return  # Disconnect invalid clients
+
+            wire = "+".join([protocol, *sorted(codecs)])  # e.g. "binary+zlib"
+            if qos:
+                wire += ", QoS 1"
+            if shm_reader is not None:
+                wire += ", shared memory"
+            if content_filter is not None and client_role == "SUBSCRIBER":
+                wire += f", filter {content_filter}"
+            if msg_ids and client_role == "PUBLISHER":
+                # A client id keeps the window across reconnects; else it is this connection's
+                dedup_key = client_id_from_options(options) or addr
+                wire += ", message IDs"
+            log.info(f"Client {addr} identified as {client_role} on TOPIC: {client_topic} ({wire})")
+            metrics.inc("broker_connections_total", label=client_role)
+            timeout = client_timeout(heartbeat)
+            if timeout:
+                idle_monitor.watch(conn, timeout, lambda: close_quietly(conn))
+
+            # Add client to our global map, and subscribers to the topic index
             with client_lock:
-                connected_clients.append(
-                    {
-                        "socket": conn,
-                        "address": addr,
-                        "role": client_role,
-                        "topic": client_topic,
-                    }
-                )
-            print(f"[SERVER] Current active clients: {len(connected_clients)}")
+                connected_clients[conn] = {
+                    "address": addr,
+                    "role": client_role,
+                    "topic": client_topic,
+                }
+                active_clients = len(connected_clients)
+            if client_role == "SUBSCRIBER":
+                with log_guard():
+                    try:
+                        replay = replay_ranges(client_topic, options, addr, protocol)
+                    except ValueError as e:
+                        log.warning(f"Invalid replay option from {addr}: {e} Disconnecting.")
+                        return  # Disconnect invalid clients
+                    # Each subscriber gets its own bounded queue and writer thread;
+                    # the replay is written before any live message
+                    subscriber = SubscriberWriter(
+                        conn,
+                        addr,
+                        *queue_settings(qos),
+                        settings["coalesce"],
+                        replay,
+                    )
+                    if protocol == BINARY:
+                        binary_sessions[subscriber] = BinarySession(topic_table, codecs)
+                    if qos:
+                        qos_session, qos_send = attach_qos(
+                            subscriber, protocol, client_id_from_options(options)
+                        )
+                    if content_filter is not None:
+                        subscriber_filters.set(subscriber, content_filter)
+                    # A replaying subscriber gets the topic's history instead of retained messages
+                    update_subscriptions(
+                        subscriber_registry, subscriber, "SUBSCRIBE", client_topic, not replay
+                    )
+            log.info(f"Current active clients: {active_clients}")
 
+            frames = frames[1:]  # Messages that arrived together with the handshake
+            received = 0  # Frames from a QoS-1 publisher, acknowledged after routing
+            acks = None
+            if qos and client_role == "PUBLISHER" and lanes is not None:
+                # The dispatcher only queues PUBACKs; this publisher's writer thread sends them,
+                # so a publisher that stops reading never blocks the dispatcher
+                replies = SubscriberWriter(conn, addr, ACK_QUEUE_SIZE, DROP_OLDEST)
+                acks = RoutedAcks(lambda count: replies.send(encode_puback(count, protocol)))
             while True:
-                data = conn.recv(1024)
-                if data:
-                    message_raw = data.decode("utf-8").strip()
-                    print(
-                        f"[SERVER] Received from {addr} ({client_role}, {client_topic}): {message_raw}"
+                if timeout:
+                    idle_monitor.seen(conn)
+                if heartbeat:
+                    frames, pinged = drop_pings(frames, protocol)
+                    if pinged and (subscriber or replies):
+                        (subscriber or replies).send(pong_frame(protocol))
+                    elif pinged:
+                        conn.sendall(pong_frame(protocol))
+                if protocol == BINARY:
+                    publishes, commands, terminated = parse_binary_frames(
+                        frames, client_role, aliases, addr, codecs, dedup_key
+                    )
+                else:
+                    publishes, commands, terminated = parse_text_frames(
+                        frames, client_role, addr, debug, dedup_key
                     )
 
-                    if message_raw.lower() == "terminate":
-                        print(
-                            f"[SERVER] Client {addr} ({client_role}, {client_topic}) requested termination."
+                for command, topics_text in commands:
+                    if command == "ACK":
+                        acknowledge(qos_session, topics_text, addr)
+                        continue
+                    if command == "FILTER":
+                        set_filter(subscriber, topics_text, addr)
+                        continue
+                    with log_guard():
+                        errors = update_subscriptions(
+                            subscriber_registry, subscriber, command, topics_text
                         )
-                        break  # Exit loop, clean up connection
-
-                    if client_role == "PUBLISHER":
-                        # Publishers send messages with their topic prefixed: "TOPIC:MESSAGE_CONTENT"
-                        # Extract the topic and content from the incoming message
-                        msg_parts = message_raw.split(":", 1)
-                        if len(msg_parts) == 2:
-                            published_topic = msg_parts[0].upper()
-                            published_content = msg_parts[1]
-                            print(
-                                f"[SERVER] PUBLISHER {addr} publishing on '{published_topic}': '{published_content}'"
-                            )
-
-                            subscribers_count = 0
-                            with client_lock:
-                                for client in connected_clients:
-                                    # Forward message only to SUBSCRIBERS on the matching topic
-                                    if (
-                                        client["role"] == "SUBSCRIBER"
-                                        and client["topic"] == published_topic
-                                    ):
-                                        try:
-                                            # Format message for subscribers to see the topic
-                                            full_message = f"[PUBLISHED - {published_topic}] {published_content}"
-                                            client["socket"].sendall(
-                                                full_message.encode("utf-8")
-                                            )
-                                            subscribers_count += 1
-                                        except BrokenPipeError:
-                                            print(
-                                                f"[SERVER] Subscriber {client['address']} pipe broken, will be removed soon."
-                                            )
-                                        except Exception as e:
-                                            print(
-                                                f"[SERVER] Error sending to subscriber {client['address']} on topic {client['topic']}: {e}"
-                                            )
-                            print(
-                                f"[SERVER] Message sent to {subscribers_count} subscriber(s) for topic '{published_topic}'."
-                            )
-                        else:
-                            print(
-                                f"[SERVER] Warning: Malformed message from PUBLISHER {addr}: '{message_raw}'. Not routed."
-                            )
-                else:
+                    for error in errors:
+                        log.warning(f"{addr} {command} rejected: {error}")
+                    log.info(
+                        f"Subscriber {addr} topics: {subscriber_registry.patterns(subscriber)}"
+                    )
+
+                if qos and client_role == "PUBLISHER":
+                    received += len(frames)
+                if acks is not None:
+                    # PUBACK once routed, in order, sent by whichever thread routes them
+                    routed = acks.read(received)
+                    if publishes:
+                        lanes.submit(publishes, routed)  # Waits while their lane is full
+                    else:
+                        routed()
+                elif publishes and lanes is not None:
+                    lanes.submit(publishes)  # Waits while their lane is full
+                elif publishes:
+                    # Forward only to SUBSCRIBERS on matching topics.
+                    # send_many() only enqueues, so a stalled subscriber never blocks this thread.
+                    counts, disconnected = route_publishes(subscriber_registry, publishes)
+                    for target in disconnected:
+                        log.warning(
+                            f"Subscriber {target.address} disconnected (queue full or closed)."
+                        )
+                    if debug:
+                        for (published_topic, *_), subscribers_count in zip(publishes, counts):
+                            if subscribers_count is None:
+                                log.debug(
+                                    f"Message for topic '{published_topic}' forwarded to worker {cluster.owner(published_topic)}."
+                                )
+                            else:
+                                log.debug(
+                                    f"Message sent to {subscribers_count} subscriber(s) for topic '{published_topic}'."
+                                )
+                if qos and client_role == "PUBLISHER" and acks is None:
+                    conn.sendall(encode_puback(received, protocol))
+                if terminated:
+                    # Everything that came before "terminate" was routed; clean up the connection
+                    log.info(
+                        f"Client {addr} ({client_role}, {client_topic}) requested termination."
+                    )
+                    break
+
+                frames = reader.read_frames()
+                if not frames:
                     # Client disconnected without sending "terminate"
-                    print(
-                        f"[SERVER] Client {addr} ({client_role}, {client_topic}) disconnected unexpectedly."
+                    log.info(
+                        f"Client {addr} ({client_role}, {client_topic}) disconnected unexpectedly."
                     )
                     break
 
     except ConnectionResetError:
-        print(
-            f"[SERVER] Client {addr} ({client_role}, {client_topic}) forcibly closed the connection."
-        )
+        log.info(f"Client {addr} ({client_role}, {client_topic}) forcibly closed the connection.")
     except Exception as e:
-        print(f"[SERVER] Error handling client {addr}: {e}")
+        log.error(f"Error handling client {addr}: {e}")
     finally:
-        # Remove client from global list and close socket
-        with client_lock:
-            # Rebuild the connected_clients list excluding the disconnected client
-            connected_clients = [c for c in connected_clients if c["socket"] != conn]
-            print(
-                f"[SERVER] Removed {addr} ({client_role}, {client_topic}). Active clients: {len(connected_clients)}"
+        # Remove client from the global map and topic index, then close socket
+        idle_monitor.forget(conn)
+        if subscriber:
+            drop_subscriber(subscriber_registry, subscriber)
+            if qos_session is not None:
+                qos_links.pop(subscriber, None)
+                qos_sessions.close(qos_session, qos_send)
+            binary_sessions.pop(subscriber, None)
+            subscriber.close()
+            stats = subscriber.stats()
+            log.info(
+                f"Subscriber {addr} queue: {stats['enqueued']} queued, {stats['dropped']} dropped, {stats['writes']} writes, {stats['replayed']} bytes replayed."
             )
+        if replies is not None:
+            replies.close()
+        if dedup_key == addr:  # A window no later connection can use
+            dedup_cache.drop(dedup_key)
+        with client_lock:
+            connected_clients.pop(conn, None)
+            active_clients = len(connected_clients)
+        log.info(f"Removed {addr} ({client_role}, {client_topic}). Active clients: {active_clients}")
+        if shm_reader is not None:
+            shm_reader.close()
         conn.close()
-        print(f"[SERVER] Connection to {addr} closed.")
+        log.info(f"Connection to {addr} closed.")
 
 
-def start_server(port):
-    """Starts the server application, listening for connections."""
+def start_server(port, ready=None, unix_path=None):
+    """
+    Starts the server application, listening for connections, also on a
+    Unix socket at `unix_path` if given.
+    In a sharded broker, `ready` is the barrier all workers pass once they
+    accept links from each other.
+    """
+    global lanes
     server_socket = None
     try:
+        if len(settings["priority"]):
+            lanes = LaneScheduler(
+                settings["priority"],
+                lambda lane, publishes: route_lane(subscriber_registry, lane, publishes),
+                settings["lane_weights"],
+                settings["lane_size"],
+            )
+            lanes.start()
+        if unix_path:
+            unix_socket = listen_unix(unix_path)
+            threading.Thread(
+                target=accept_unix_clients, args=(unix_socket, unix_path), daemon=True
+            ).start()
+            log.info(f"Listening on Unix socket {unix_path}")
+        if cluster is not None:
+            peer_socket = listen_unix(worker_socket_path(cluster.socket_dir, cluster.worker_id))
+            threading.Thread(target=accept_peers, args=(peer_socket,), daemon=True).start()
+            ready.wait()
+            cluster.connect()
+        if federation is not None:
+            federation.start(lambda frames: process_node_frames(subscriber_registry, frames))
+
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(
             socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
         )  # Allows reuse of the address
+        if cluster is not None:
+            # Every worker listens on the same port; the kernel spreads connections
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         server_address = ("0.0.0.0", port)
-        print(
-            f"[SERVER] Starting up server on {server_address[0]} port {server_address[1]}"
-        )
+        log.info(f"Starting up server on {server_address[0]} port {server_address[1]}")
         server_socket.bind(server_address)
-        server_socket.listen(5)  # Allow up to 5 pending connections
+        raise_open_file_limit()
+        server_socket.listen(socket.SOMAXCONN)  # Queue bursts of new subscribers
+        threading.Thread(target=run_housekeeping, daemon=True).start()
 
         while True:
-            print("\n[SERVER] Waiting for a connection...")
+            log.debug("Waiting for a connection...")
             conn, addr = server_socket.accept()
+            if settings["tcp_keepalive"]:
+                # Lets the kernel find peers that vanished without closing the connection
+                enable_keepalive(conn, settings["tcp_keepalive"])
             # Start a new thread to handle the client
             client_thread = threading.Thread(target=handle_client, args=(conn, addr))
             client_thread.daemon = (
@@ -166,23 +1408,577 @@ def start_server(port):
             client_thread.start()
 
     except Exception as e:
-        print(f"[SERVER] Server error: {e}")
+        log.error(f"Server error: {e}")
     finally:
         if server_socket:
-            print("[SERVER] Server shutting down.")
+            log.info("Server shutting down.")
             server_socket.close()
+        if unix_path:
+            remove_stale_socket(unix_path)
+
+
+async def handle_client_async(reader, writer):
+    """
+    Handles a single client connection as a coroutine on the event loop.
+    Same handshake and topic routing as handle_client, without a thread per client.
+    """
+    addr = writer.get_extra_info("peername")
+    if not addr:  # A client of the Unix socket
+        addr = unix_client_address(writer.get_extra_info("sockname"))
+    client_role = None
+    client_topic = None
+    subscriber = None
+    qos_session = qos_send = None
+    shm_reader = None  # Reads a shared-memory publisher's ring instead of the socket
+    dedup_key = None  # Dedup window of a publisher that sends message IDs
+    debug = log.isEnabledFor(logging.DEBUG)  # Checked once, not per message
+    if settings["tcp_keepalive"] and writer.get_extra_info("socket").family != socket.AF_UNIX:
+        enable_keepalive(writer.get_extra_info("socket"), settings["tcp_keepalive"])
+
+    try:
+        frame_reader = AsyncFrameReader(reader)
+        frames = await frame_reader.read_frames()
+
+        # First message from client should be its role and topic (e.g., "PUBLISHER:TOPIC_A")
+        if frames:
+            initial_data = frames[0]
+            # Options such as ";offset=42" may follow the role and topic
+            initial_info, options = split_options(initial_data.decode("utf-8"))
+            parts = initial_info.split(":", 1)  # Split only on the first colon
+
+            if len(parts) == 2:
+                client_role = parts[0].upper()
+                client_topic = parts[1].upper()  # Normalize topic to uppercase
+            else:
+                log.warning(f"Invalid initial format '{initial_info}' from {addr}. Disconnecting.")
+                return  # Disconnect invalid clients
+
+            if client_role not in ["PUBLISHER", "SUBSCRIBER"] or not client_topic:
+                log.warning(
+                    f"Invalid role '{client_role}' or topic '{client_topic}' from {addr}. Disconnecting."
+                )
+                return  # Disconnect invalid clients
+
+            try:
+                if client_role == "SUBSCRIBER":
+                    for pattern in split_patterns(client_topic):
+                        validate_pattern(pattern)
+                else:
+                    validate_topic(client_topic)
+            except ValueError as e:
+                log.warning(f"Invalid topic from {addr}: {e} Disconnecting.")
+                return  # Disconnect invalid clients
+
+            try:
+                protocol = protocol_from_options(options)
+                codecs = codecs_from_options(options)  # Compression codecs the client accepts
+                if codecs and protocol != BINARY:
+                    raise ValueError("Compression needs the binary protocol.")
+                qos = qos_from_options(options)
+                heartbeat = heartbeat_from_options(options)  # Seconds between the client's PINGs
+                content_filter = filter_from_options(options)  # Only for subscribers
+                msg_ids = msg_ids_from_options(options)  # Only for publishers
+            except ValueError as e:
+                log.warning(f"Invalid protocol option from {addr}: {e} Disconnecting.")
+                return  # Disconnect invalid clients
+            aliases = TopicAliases()  # Topics a binary publisher registered
+            if SHM_OPTION in options:
+                try:
+                    shm_reader = frame_reader = AsyncShmFrameReader(
+                        reader, shm_ring_name(client_role, options), writer.get_extra_info("socket")
+                    )
+                except (ValueError, OSError) as e:
+                    log.warning(f"Invalid shared memory ring from {addr}: {e} Disconnecting.")
+                    return  # Disconnect invalid clients
+
+            wire = "+".join([protocol, *sorted(codecs)])  # e.g. "binary+zlib"
+            if qos:
+                wire += ", QoS 1"
+            if shm_reader is not None:
+                wire += ", shared memory"
+            if content_filter is not None and client_role == "SUBSCRIBER":
+                wire += f", filter {content_filter}"
+            if msg_ids and client_role == "PUBLISHER":
+                # A client id keeps the window across reconnects; else it is this connection's
+                dedup_key = client_id_from_options(options) or addr
+                wire += ", message IDs"
+            log.info(f"Client {addr} identified as {client_role} on TOPIC: {client_topic} ({wire})")
+            metrics.inc("broker_connections_total", label=client_role)
+            timeout = client_timeout(heartbeat)
+            if timeout:
+                idle_monitor.watch(writer, timeout, writer.transport.abort)
+            async_clients[writer] = {
+                "address": addr,
+                "role": client_role,
+                "topic": client_topic,
+            }
+            if client_role == "SUBSCRIBER":
+                try:
+                    replay = replay_ranges(client_topic, options, addr, protocol)
+                except ValueError as e:
+                    log.warning(f"Invalid replay option from {addr}: {e} Disconnecting.")
+                    return  # Disconnect invalid clients
+                subscriber = AsyncSubscriberWriter(
+                    writer,
+                    addr,
+                    *queue_settings(qos),
+                    settings["coalesce"],
+                    replay,
+                )
+                if protocol == BINARY:
+                    binary_sessions[subscriber] = BinarySession(topic_table, codecs)
+                if qos:
+                    qos_session, qos_send = attach_qos(
+                        subscriber, protocol, client_id_from_options(options)
+                    )
+                if content_filter is not None:
+                    subscriber_filters.set(subscriber, content_filter)
+                update_subscriptions(
+                    async_registry, subscriber, "SUBSCRIBE", client_topic, not replay
+                )
+
+            frames = frames[1:]  # Messages that arrived together with the handshake
+            received = 0  # Frames from a QoS-1 publisher, acknowledged after routing
+            acks = None
+            if qos and client_role == "PUBLISHER" and lanes is not None:
+                acks = RoutedAcks(
+                    lambda count: write_to_publisher(writer, encode_puback(count, protocol))
+                )
+            while True:
+                if timeout:
+                    idle_monitor.seen(writer)
+                if heartbeat:
+                    frames, pinged = drop_pings(frames, protocol)
+                    if pinged and subscriber:
+                        subscriber.send(pong_frame(protocol))
+                    elif pinged:
+                        writer.write(pong_frame(protocol))
+                if protocol == BINARY:
+                    publishes, commands, terminated = parse_binary_frames(
+                        frames, client_role, aliases, addr, codecs, dedup_key
+                    )
+                else:
+                    publishes, commands, terminated = parse_text_frames(
+                        frames, client_role, addr, debug, dedup_key
+                    )
+
+                for command, topics_text in commands:
+                    if command == "ACK":
+                        acknowledge(qos_session, topics_text, addr)
+                        continue
+                    if command == "FILTER":
+                        set_filter(subscriber, topics_text, addr)
+                        continue
+                    for error in update_subscriptions(
+                        async_registry, subscriber, command, topics_text
+                    ):
+                        log.warning(f"{addr} {command} rejected: {error}")
+
+                # Forward only to SUBSCRIBERS on matching topics; send_many() only enqueues
+                if qos and client_role == "PUBLISHER":
+                    received += len(frames)
+                if acks is not None:
+                    # PUBACK once routed, in order, written by whoever routes them
+                    routed = acks.read(received)
+                    if publishes:
+                        await lanes.submit(publishes, routed)
+                    else:
+                        routed()
+                    await writer.drain()
+                elif publishes and lanes is not None:
+                    await lanes.submit(publishes)
+                elif publishes:
+                    route_publishes(async_registry, publishes)
+                if qos and client_role == "PUBLISHER" and acks is None:
+                    writer.write(encode_puback(received, protocol))
+                    await writer.drain()
+                if terminated:
+                    break  # Everything before "terminate" was routed; clean up connection
+
+                frames = await frame_reader.read_frames()
+                if not frames:
+                    # Client disconnected without sending "terminate"
+                    break
+
+    except ConnectionResetError:
+        log.info(f"Client {addr} ({client_role}, {client_topic}) forcibly closed the connection.")
+    except Exception as e:
+        log.error(f"Error handling client {addr}: {e}")
+    finally:
+        idle_monitor.forget(writer)
+        async_clients.pop(writer, None)
+        if subscriber:
+            drop_subscriber(async_registry, subscriber)
+            if qos_session is not None:
+                qos_links.pop(subscriber, None)
+                qos_sessions.close(qos_session, qos_send)
+            binary_sessions.pop(subscriber, None)
+            subscriber.close()
+            stats = subscriber.stats()
+            log.info(
+                f"Subscriber {addr} queue: {stats['enqueued']} queued, {stats['dropped']} dropped, {stats['writes']} writes, {stats['replayed']} bytes replayed."
+            )
+        if dedup_key == addr:  # A window no later connection can use
+            dedup_cache.drop(dedup_key)
+        if shm_reader is not None:
+            shm_reader.close()
+        writer.close()
+        log.info(f"Connection to {addr} closed.")
+
+
+async def start_async_server(port, ready=None, unix_path=None):
+    """
+    Starts the asyncio server: one event loop serves every connection,
+    including those of the Unix socket at `unix_path` if given.
+    """
+    global lanes
+    raise_open_file_limit()
+    if len(settings["priority"]):
+        lanes = AsyncLaneScheduler(
+            settings["priority"],
+            lambda lane, publishes: route_lane(async_registry, lane, publishes),
+            settings["lane_weights"],
+            settings["lane_size"],
+        )
+        lanes.start()
+    if cluster is not None:
+        await asyncio.start_unix_server(
+            handle_peer_async, worker_socket_path(cluster.socket_dir, cluster.worker_id)
+        )
+        ready.wait()  # Brief; the other workers only need our socket to be listening
+        cluster.connect()
+    if federation is not None:
+        loop = asyncio.get_running_loop()
+        federation.start(
+            lambda frames: loop.call_soon_threadsafe(process_node_frames, async_registry, frames)
+        )
+    server = await asyncio.start_server(
+        handle_client_async,
+        "0.0.0.0",
+        port,
+        backlog=socket.SOMAXCONN,
+        reuse_port=cluster is not None,
+    )
+    log.info(f"Starting up asyncio server on 0.0.0.0 port {port}")
+    if unix_path:
+        remove_stale_socket(unix_path)
+        await asyncio.start_unix_server(handle_client_async, unix_path, backlog=socket.SOMAXCONN)
+        log.info(f"Listening on Unix socket {unix_path}")
+    housekeeping = asyncio.get_running_loop().create_task(run_housekeeping_async())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await stop_task(housekeeping, "Housekeeping")
+        if unix_path:
+            remove_stale_socket(unix_path)
+
+
+def run_worker(
+    worker_id, workers, socket_dir, ready, port, mode, worker_settings, log_level, metrics_port
+):
+    """
+    Entry point of one worker process of a sharded broker. Each worker
+    serves its own metrics, at metrics_port + its id.
+    """
+    global cluster, dedup_cache
+    settings.update(worker_settings)
+    set_max_frame_size(settings["max_frame_size"])
+    dedup_cache = DedupCache(settings["dedup_ids"], settings["dedup_ttl"], settings["dedup_bytes"])
+    configure_logging(log_level, f"[SERVER {worker_id + 1}/{workers}] ")
+    cluster = ShardCluster(worker_id, workers, socket_dir)
+    log.info(f"Worker {worker_id + 1}/{workers} (pid {os.getpid()}) starting.")
+    if metrics_port:
+        serve_metrics(metrics, metrics_port + worker_id)
+        log.info(f"Metrics at http://127.0.0.1:{metrics_port + worker_id}/metrics")
+    if mode == "asyncio":
+        try:
+            asyncio.run(start_async_server(port, ready))
+        except KeyboardInterrupt:
+            pass
+    else:
+        try:
+            start_server(port, ready)
+        except KeyboardInterrupt:
+            pass
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python server_app.py <PORT>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Topic-based Publish/Subscribe server.")
+    parser.add_argument("port", type=int, help="Port to listen on (1024-65535)")
+    parser.add_argument(
+        "--mode",
+        choices=["threaded", "asyncio"],
+        default="threaded",
+        help="threaded: one thread per client (default); asyncio: one event loop for all clients",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help=f"Frames buffered per subscriber (default {DEFAULT_QUEUE_SIZE})",
+    )
+    parser.add_argument(
+        "--overflow-policy",
+        choices=OVERFLOW_POLICIES,
+        default=DROP_OLDEST,
+        help="What to do when a subscriber's queue is full (default drop-oldest)",
+    )
+    parser.add_argument(
+        "--no-coalesce",
+        dest="coalesce",
+        action="store_false",
+        help="Write each message to a subscriber separately instead of batching pending ones",
+    )
+    parser.add_argument(
+        "--log-dir",
+        help="Keep published messages in per-topic logs under this directory so subscribers can replay them",
+    )
+    parser.add_argument(
+        "--log-segment-bytes",
+        type=int,
+        default=DEFAULT_SEGMENT_BYTES,
+        help=f"Size at which a topic's log rolls over to a new segment file (default {DEFAULT_SEGMENT_BYTES})",
+    )
+    parser.add_argument(
+        "--log-retention-bytes",
+        type=int,
+        default=0,
+        help="Delete a topic's oldest segments once its log is larger than this (default 0: keep all)",
+    )
+    parser.add_argument(
+        "--log-retention-seconds",
+        type=float,
+        default=0,
+        help="Delete segments whose messages are all older than this (default 0: keep all)",
+    )
+    parser.add_argument(
+        "--retain",
+        type=int,
+        default=0,
+        metavar="K",
+        help="Keep the last K messages of every topic in memory and send them to new subscribers (default 0: off)",
+    )
+    parser.add_argument(
+        "--retain-bytes",
+        type=int,
+        default=DEFAULT_RETAINED_BYTES,
+        help=f"Memory cap of the retained messages; least recently used topics are evicted first (default {DEFAULT_RETAINED_BYTES})",
+    )
+    parser.add_argument(
+        "--compress",
+        action="append",
+        default=[],
+        metavar="PATTERN=CODEC[:MIN_BYTES]",
+        help="Compress payloads on topics matching PATTERN with zlib or lzma for binary subscribers that accept it; repeatable, the first matching rule wins",
+    )
+    parser.add_argument(
+        "--compress-min-bytes",
+        type=int,
+        default=DEFAULT_MIN_BYTES,
+        help=f"Smallest payload a --compress rule without MIN_BYTES compresses (default {DEFAULT_MIN_BYTES})",
+    )
+    parser.add_argument(
+        "--qos-window",
+        type=int,
+        default=DEFAULT_WINDOW,
+        help=f"Unacknowledged messages kept for redelivery per QoS-1 subscriber; a subscriber with a full window is disconnected (default {DEFAULT_WINDOW})",
+    )
+    parser.add_argument(
+        "--ack-timeout",
+        type=float,
+        default=DEFAULT_ACK_TIMEOUT,
+        help=f"Seconds without an acknowledgement before QoS-1 messages are sent again (default {DEFAULT_ACK_TIMEOUT:g})",
+    )
+    parser.add_argument(
+        "--session-expiry",
+        type=float,
+        default=DEFAULT_SESSION_EXPIRY,
+        help=f"Seconds the session of a disconnected QoS-1 subscriber with a client_id is kept (default {DEFAULT_SESSION_EXPIRY:g})",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=0,
+        help="Disconnect clients without heartbeats that send nothing for this many seconds (default 0: never)",
+    )
+    parser.add_argument(
+        "--tcp-keepalive",
+        type=int,
+        default=DEFAULT_TCP_KEEPALIVE,
+        help=f"Idle seconds before the kernel probes a client connection for a dead peer (default {DEFAULT_TCP_KEEPALIVE}, 0: off)",
+    )
+    parser.add_argument(
+        "--dedup-ids",
+        type=int,
+        default=DEFAULT_DEDUP_IDS,
+        help=f"Message IDs remembered per publisher that sends them (;msg_ids=1) to drop resends (default {DEFAULT_DEDUP_IDS})",
+    )
+    parser.add_argument(
+        "--dedup-ttl",
+        type=float,
+        default=DEFAULT_DEDUP_TTL,
+        help=f"Seconds a publisher's message ID is remembered (default {DEFAULT_DEDUP_TTL:g})",
+    )
+    parser.add_argument(
+        "--dedup-bytes",
+        type=int,
+        default=DEFAULT_DEDUP_BYTES,
+        help=f"Memory cap of all remembered message IDs; the oldest are forgotten first (default {DEFAULT_DEDUP_BYTES})",
+    )
+    parser.add_argument(
+        "--priority",
+        action="append",
+        default=[],
+        metavar="PATTERN=CLASS",
+        help="Route publishes on topics matching PATTERN in the high, normal or bulk priority lane; repeatable, the first matching rule wins, other topics are normal",
+    )
+    parser.add_argument(
+        "--lane-weights",
+        default="",
+        metavar="CLASS=N,...",
+        help="Share of the routing work of each priority lane (default high=16,normal=4,bulk=1)",
+    )
+    parser.add_argument(
+        "--lane-size",
+        type=int,
+        default=DEFAULT_LANE_SIZE,
+        help=f"Publishes waiting in a priority lane before its publishers wait (default {DEFAULT_LANE_SIZE})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes sharing the port (SO_REUSEPORT), topics split between them (default 1)",
+    )
+    parser.add_argument(
+        "--unix",
+        metavar="PATH",
+        help="Also accept clients on a Unix socket at PATH (clients connect to unix:PATH)",
+    )
+    parser.add_argument(
+        "--node-port",
+        type=int,
+        help="Port this broker accepts other broker nodes on, for a federation with --peers",
+    )
+    parser.add_argument(
+        "--peers",
+        metavar="HOST:PORT,...",
+        help="--node-port addresses of every other broker node; publishes reach their subscribers too",
+    )
+    parser.add_argument(
+        "--node-name",
+        help="Name of this node in the other nodes' logs (default: host name and port)",
+    )
+    parser.add_argument(
+        "--max-frame-size",
+        type=int,
+        default=DEFAULT_MAX_FRAME_SIZE,
+        help="Largest message, in bytes, a client may send; a connection announcing a larger "
+        f"one is closed (default {DEFAULT_MAX_FRAME_SIZE})",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=LOG_LEVELS,
+        default=DEFAULT_LOG_LEVEL,
+        help="Server log verbosity; debug logs every message (default info)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Serve counters and histograms at http://127.0.0.1:PORT/metrics; worker N of --workers uses PORT+N (default 0: off)",
+    )
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    if args.workers > 1 and args.log_dir:
+        parser.error("--log-dir needs a single worker: each topic's log has one writer process")
+    if args.retain < 0:
+        parser.error("--retain must be 0 (off) or a positive number of messages")
+    if args.workers > 1 and args.retain:
+        parser.error("--retain needs a single worker: a new subscriber's worker may not own its topics")
+    if args.qos_window < 1 or args.ack_timeout <= 0 or args.session_expiry < 0:
+        parser.error("--qos-window and --ack-timeout must be positive, --session-expiry at least 0")
+    if args.idle_timeout < 0 or args.tcp_keepalive < 0:
+        parser.error("--idle-timeout and --tcp-keepalive must be at least 0")
+    if args.dedup_ids < 1 or args.dedup_ttl <= 0 or args.dedup_bytes < 1:
+        parser.error("--dedup-ids, --dedup-ttl and --dedup-bytes must be positive")
+    if bool(args.peers) != bool(args.node_port):
+        parser.error("--peers and --node-port go together")
+    if args.unix and args.workers > 1:
+        parser.error("--unix needs a single worker: a Unix socket cannot be shared with SO_REUSEPORT")
+    if args.peers and args.workers > 1:
+        parser.error("--peers needs a single worker: each node has one link to every other node")
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers needs SO_REUSEPORT, which this platform does not support")
+    settings["queue_size"] = args.queue_size
+    settings["overflow_policy"] = args.overflow_policy
+    settings["coalesce"] = args.coalesce
+    settings["qos_window"] = args.qos_window
+    settings["ack_timeout"] = args.ack_timeout
+    settings["session_expiry"] = args.session_expiry
+    settings["idle_timeout"] = args.idle_timeout
+    settings["tcp_keepalive"] = args.tcp_keepalive
+    settings["dedup_ids"] = args.dedup_ids
+    settings["dedup_ttl"] = args.dedup_ttl
+    settings["dedup_bytes"] = args.dedup_bytes
     try:
-        port = int(sys.argv[1])
-        if not (1024 <= port <= 65535):
-            print("Port number must be between 1024 and 65535.")
-            sys.exit(1)
-        start_server(port)
-    except ValueError:
-        print("Invalid port number. Please provide an integer.")
+        set_max_frame_size(args.max_frame_size)
+    except ValueError as e:
+        parser.error(str(e))
+    settings["max_frame_size"] = args.max_frame_size
+    dedup_cache = DedupCache(args.dedup_ids, args.dedup_ttl, args.dedup_bytes)
+    try:
+        settings["compression"] = CompressionPolicy(
+            parse_rule(rule, args.compress_min_bytes) for rule in args.compress
+        )
+        settings["priority"] = PriorityPolicy(parse_priority_rule(rule) for rule in args.priority)
+        settings["lane_weights"] = parse_weights(args.lane_weights)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.lane_size < 1:
+        parser.error("--lane-size must be positive")
+    settings["lane_size"] = args.lane_size
+    if args.peers:
+        try:
+            peers = parse_peers(args.peers)
+        except ValueError as e:
+            parser.error(str(e))
+        node_name = args.node_name or f"{socket.gethostname()}:{args.port}"
+        federation = Federation(node_name, args.node_port, peers)
+    if args.retain:
+        retained = RetainedCache(args.retain, args.retain_bytes)
+    if args.log_dir:
+        message_log = MessageLog(
+            args.log_dir,
+            args.log_segment_bytes,
+            args.log_retention_bytes,
+            args.log_retention_seconds,
+        )
+
+    if not (1024 <= args.port <= 65535):
+        print("Port number must be between 1024 and 65535.")
         sys.exit(1)
+    if args.workers > 1:
+        log.info(f"Starting {args.workers} workers on port {args.port}.")
+        run_workers(
+            args.workers,
+            run_worker,
+            args.port,
+            args.mode,
+            dict(settings),
+            args.log_level,
+            args.metrics_port,
+        )
+        log.info("Server shutting down.")
+    else:
+        if args.metrics_port:
+            serve_metrics(metrics, args.metrics_port)
+            log.info(f"Metrics at http://127.0.0.1:{args.metrics_port}/metrics")
+        if args.mode == "asyncio":
+            try:
+                asyncio.run(start_async_server(args.port, unix_path=args.unix))
+            except KeyboardInterrupt:
+                log.info("Server shutting down.")
+        else:
+            start_server(args.port, unix_path=args.unix)
@@ -0,0 +1,3 @@
+"""
+Headless benchmarks for the middleware servers. Run them from the repository root.
+"""
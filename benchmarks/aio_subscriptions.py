@@ -0,0 +1,91 @@
+"""
+Many subscriptions in one process with common/aio_client.py: how long it
+takes to subscribe to N topics over a few connections, the delivery rate
+when every topic gets a message, and the client's memory per subscription.
+
+Usage: python benchmarks/aio_subscriptions.py [--subscriptions N] [--connections K] [--json FILE]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import rss_bytes, start_server, stop_server
+from common.aio_client import AsyncClient
+
+
+async def measure(port, subscriptions, connections, rounds):
+    baseline = rss_bytes(os.getpid())
+    async with AsyncClient("127.0.0.1", port, subscriber_connections=connections) as client:
+        start = time.perf_counter()
+        subs = [client.subscribe(f"BENCH.{index}") for index in range(subscriptions)]
+        # Subscribed once a message on the last topic arrives
+        while True:
+            await client.publish(f"BENCH.{subscriptions - 1}", b"ready")
+            try:
+                await asyncio.wait_for(subs[-1].get(), 0.05)
+                break
+            except asyncio.TimeoutError:
+                pass
+        subscribed = time.perf_counter() - start
+        try:
+            while True:
+                await asyncio.wait_for(subs[-1].get(), 0.2)  # Extra "ready" messages
+        except asyncio.TimeoutError:
+            pass
+
+        start = time.perf_counter()
+        for round_ in range(rounds):
+            for index in range(subscriptions):
+                await client.publish(f"BENCH.{index}", b"%d" % round_)
+            for subscription in subs:
+                await subscription.get()
+        delivered = time.perf_counter() - start
+        loaded = rss_bytes(os.getpid())
+    return {
+        "subscriptions": subscriptions,
+        "connections": connections,
+        "subscribe_seconds": subscribed,
+        "messages_per_second": subscriptions * rounds / delivered,
+        "client_bytes_per_subscription": (loaded - baseline) / subscriptions,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subscriptions", type=int, default=10_000)
+    parser.add_argument("--connections", type=int, default=2)
+    parser.add_argument("--rounds", type=int, default=5, help="Messages per topic")
+    parser.add_argument("--port", type=int, default=5670)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    # Each round fits in the server's per-subscriber queues, so none is dropped
+    server = start_server(
+        "topic",
+        args.port,
+        ["--mode", "asyncio", "--queue-size", str(args.subscriptions), "--log-level", "warning"],
+    )
+    try:
+        result = asyncio.run(measure(args.port, args.subscriptions, args.connections, args.rounds))
+    finally:
+        stop_server(server)
+    print(
+        f"{result['subscriptions']:,} subscriptions over {result['connections']} connections: "
+        f"subscribed in {result['subscribe_seconds']:.2f} s, "
+        f"{result['messages_per_second']:,.0f} messages/s delivered, "
+        f"{result['client_bytes_per_subscription'] / 1024:.1f} KiB per subscription in the client"
+    )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(result, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Connections/s and messages/s of the Client-Server server's blocking loop
+against its selectors mode, with many clients connecting at once.
+
+Each client thread connects, sends its messages and "terminate", then waits
+for the server to close the connection, so a client only counts once the
+server has read everything it sent. In the messages test the clients send
+in bursts with a pause in between and stay connected meanwhile. The last
+test keeps many clients connected without terminating, as interactive users
+do, and times how long one more client waits to be served.
+
+Usage: python benchmarks/client_server_throughput.py [--clients N] [--messages M] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import start_server, stop_server
+from common.framing import encode_frame
+from common.limits import raise_open_file_limit
+
+TERMINATE = encode_frame(b"terminate")
+
+
+def session(port, bursts, think=0.0):
+    """
+    One client: connects, sends each burst of frames `think` seconds apart,
+    then waits until the server hangs up. Returns False if the connection failed.
+    """
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=60) as sock:
+            for index, burst in enumerate(bursts):
+                if index and think:
+                    time.sleep(think)
+                sock.sendall(burst)
+            while sock.recv(4096):
+                pass
+    except OSError:
+        return False
+    return True
+
+
+def run_clients(clients, target):
+    """Runs `target` in that many threads at once. Returns the seconds until all finished."""
+    threads = [threading.Thread(target=target) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def connection_rate(port, clients, seconds):
+    """
+    Connections served per second while `clients` threads reconnect in a
+    loop, and how many connections failed.
+    """
+    bursts = [encode_frame(b"hello") + TERMINATE]
+    outcomes = []  # One entry per connection; list.append is thread-safe
+    deadline = time.monotonic() + seconds
+
+    def client():
+        while time.monotonic() < deadline:
+            outcomes.append(session(port, bursts))
+
+    elapsed = run_clients(clients, client)
+    return sum(outcomes) / elapsed, outcomes.count(False)
+
+
+def message_rate(port, clients, messages, size, burst, think):
+    """
+    Messages read per second while `clients` clients each send `messages`,
+    `burst` at a time, and how many clients failed.
+    """
+    frame = encode_frame(b"x" * size)
+    bursts = [frame * min(burst, messages - sent) for sent in range(0, messages, burst)]
+    bursts.append(TERMINATE)
+    outcomes = []
+
+    elapsed = run_clients(clients, lambda: outcomes.append(session(port, bursts, think)))
+    return sum(outcomes) * messages / elapsed, outcomes.count(False)
+
+
+def newcomer_wait(port, idle, timeout):
+    """
+    Opens `idle` connections that each send a message and stay open, then
+    returns the seconds one more client waits until its message and
+    "terminate" are read, or None if it was not served within `timeout`.
+    """
+    held = []
+    try:
+        for _ in range(idle):
+            sock = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+            sock.sendall(encode_frame(b"hello"))
+            held.append(sock)
+        start = time.perf_counter()
+        with socket.create_connection(("127.0.0.1", port), timeout=timeout) as sock:
+            sock.sendall(encode_frame(b"hello") + TERMINATE)
+            while sock.recv(4096):
+                pass
+        return time.perf_counter() - start
+    except OSError:
+        return None
+    finally:
+        for sock in held:
+            sock.close()
+
+
+def measure(mode, port, args):
+    """Runs both tests against a fresh server in the given mode."""
+    extra_args = ["--mode", mode, "--log-level", "warning"]
+    if args.backlog:
+        extra_args += ["--backlog", str(args.backlog)]
+    server = start_server("client_server", port, extra_args)
+    try:
+        connections, failed_connections = connection_rate(port, args.clients, args.seconds)
+        messages, failed_clients = message_rate(
+            port, args.clients, args.messages, args.size, args.burst, args.think / 1000
+        )
+        waited = newcomer_wait(port, args.idle, args.timeout)
+        return {
+            "mode": mode,
+            "clients": args.clients,
+            "connections_per_second": connections,
+            "failed_connections": failed_connections,
+            "messages_per_second": messages,
+            "failed_clients": failed_clients,
+            "idle_clients": args.idle,
+            "newcomer_wait_seconds": waited,
+        }
+    finally:
+        stop_server(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=50, help="Clients connecting at once")
+    parser.add_argument("--seconds", type=float, default=5.0, help="Duration of the connection test")
+    parser.add_argument("--messages", type=int, default=1000, help="Messages per client")
+    parser.add_argument("--size", type=int, default=100, help="Bytes per message")
+    parser.add_argument("--burst", type=int, default=100, help="Messages sent back to back")
+    parser.add_argument("--think", type=float, default=10.0, help="Milliseconds between bursts")
+    parser.add_argument("--idle", type=int, default=1000, help="Clients left connected")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Seconds a newcomer waits at most")
+    parser.add_argument("--backlog", type=int, help="Listen backlog (default: each mode's own)")
+    parser.add_argument("--port", type=int, default=5650)
+    parser.add_argument("--modes", nargs="+", default=["blocking", "selectors"])
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    results = []
+    port = args.port
+    for mode in args.modes:
+        result = measure(mode, port, args)
+        port += 1  # Avoid waiting for TIME_WAIT sockets of the previous run
+        results.append(result)
+        waited = result["newcomer_wait_seconds"]
+        print(
+            f"{mode:>9}: {args.clients} clients, "
+            f"{result['connections_per_second']:8.0f} connections/s, "
+            f"{result['messages_per_second']:9.0f} messages/s "
+            f"({result['failed_connections']} connections, {result['failed_clients']} clients failed); "
+            f"newcomer next to {args.idle} idle clients served "
+            + (f"in {waited * 1e3:.1f} ms" if waited is not None else f"not within {args.timeout:g} s")
+        )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Measures subscriber delivery with write coalescing on and off.
+
+A publisher pushes bursts of small messages into one subscriber writer
+(SubscriberWriter or AsyncSubscriberWriter) connected over loopback TCP to
+a reader thread. Each message carries the time it was queued, so the reader
+can compute its delivery latency.
+
+Reports socket write calls per delivered message and p50/p99 delivery
+latency for each writer with coalescing on and off.
+
+Usage: python benchmarks/coalesced_delivery.py [--messages N] [--burst N] [--json FILE]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.framing import FrameReader, encode_frame
+from common.outbound import AsyncSubscriberWriter, SubscriberWriter
+
+TIMESTAMP = struct.Struct("!Q")  # Nanoseconds at which the message was queued
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def make_frame(padding):
+    return encode_frame(TIMESTAMP.pack(time.perf_counter_ns()) + padding)
+
+
+def start_reader(listener, messages, latencies):
+    """Accepts the writer's connection and records the latency of every message."""
+
+    def read():
+        conn, _ = listener.accept()
+        reader = FrameReader(conn)
+        while len(latencies) < messages:
+            frames = reader.read_frames()
+            if not frames:
+                break
+            now = time.perf_counter_ns()
+            for frame in frames:
+                latencies.append(now - TIMESTAMP.unpack_from(frame)[0])
+        conn.close()
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    return thread
+
+
+def run_threaded(args, coalesce, padding):
+    listener = socket.create_server(("127.0.0.1", 0))
+    latencies = []
+    reader = start_reader(listener, args.messages, latencies)
+    conn = socket.create_connection(listener.getsockname())
+    writer = SubscriberWriter(
+        conn, "bench", maxsize=args.messages, coalesce=coalesce
+    )
+    for sent in range(0, args.messages, args.burst):
+        for _ in range(min(args.burst, args.messages - sent)):
+            writer.send(make_frame(padding))
+        time.sleep(args.interval)
+    reader.join(timeout=60)
+    writes = writer.stats()["writes"]
+    writer.close()
+    conn.close()
+    listener.close()
+    return writes, latencies
+
+
+def run_asyncio(args, coalesce, padding):
+    listener = socket.create_server(("127.0.0.1", 0))
+    latencies = []
+    reader = start_reader(listener, args.messages, latencies)
+
+    async def publish():
+        _, stream_writer = await asyncio.open_connection(*listener.getsockname())
+        writer = AsyncSubscriberWriter(
+            stream_writer, "bench", maxsize=args.messages, coalesce=coalesce
+        )
+        for sent in range(0, args.messages, args.burst):
+            for _ in range(min(args.burst, args.messages - sent)):
+                writer.send(make_frame(padding))
+            await asyncio.sleep(args.interval)
+        while len(latencies) < args.messages and reader.is_alive():
+            await asyncio.sleep(0.01)
+        writes = writer.stats()["writes"]
+        writer.close()
+        return writes
+
+    writes = asyncio.run(publish())
+    reader.join(timeout=60)
+    listener.close()
+    return writes, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--burst", type=int, default=100, help="Messages published back to back")
+    parser.add_argument("--interval", type=float, default=0.001, help="Pause between bursts (s)")
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    padding = b"x" * max(0, args.payload_size - TIMESTAMP.size)
+    writers = {"threaded": run_threaded, "asyncio": run_asyncio}
+    results = []
+    print(f"{'writer':>9} {'coalesce':>9} {'writes/msg':>11} {'p50 us':>9} {'p99 us':>9}")
+    for name, run in writers.items():
+        for coalesce in (False, True):
+            writes, latencies = run(args, coalesce, padding)
+            if len(latencies) < args.messages:
+                raise RuntimeError(f"{name}: only {len(latencies)} messages delivered")
+            p50 = percentile(latencies, 0.50) / 1000
+            p99 = percentile(latencies, 0.99) / 1000
+            results.append(
+                {
+                    "writer": name,
+                    "coalesce": coalesce,
+                    "messages": args.messages,
+                    "writes_per_message": writes / args.messages,
+                    "p50_latency_us": p50,
+                    "p99_latency_us": p99,
+                }
+            )
+            print(
+                f"{name:>9} {'on' if coalesce else 'off':>9} {writes / args.messages:>11.3f}"
+                f" {p50:>9.0f} {p99:>9.0f}"
+            )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
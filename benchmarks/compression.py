@@ -0,0 +1,86 @@
+"""
+Bytes on the wire against CPU time for the payload codecs of the binary
+protocol, on repetitive JSON payloads from 128 bytes to 64 KB.
+
+For each codec and payload size it reports the compressed size, the CPU time
+to compress one payload (paid once per message by the publisher or the
+server) and to decompress it (paid by every subscriber), and how many
+subscribers a message must reach before compressing it saves more bytes
+than a 1 Gbit/s link moves in the time it took to compress.
+
+Usage: python benchmarks/compression.py [--payload padding|json] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.harness import message_body
+from common.compression import CODEC_IDS, compress, decompress
+
+SIZES = (128, 512, 2048, 8192, 65536)
+LINK_BYTES_PER_SECOND = 125e6  # 1 Gbit/s
+
+
+def cpu_per_call(function, *args, min_seconds=0.2):
+    """Average CPU seconds per call."""
+    calls = 0
+    start = time.process_time()
+    while time.process_time() - start < min_seconds:
+        function(*args)
+        calls += 1
+    return (time.process_time() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--payload", choices=["padding", "json"], default="json")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(
+        f"{'bytes':>6} {'codec':>5} {'wire bytes':>10} {'ratio':>6} "
+        f"{'compress us':>11} {'decompress us':>13} {'break-even subs':>15}"
+    )
+    for size in SIZES:
+        payload = b"%019d|" % time.monotonic_ns() + message_body(size, args.payload)
+        for codec in sorted(CODEC_IDS):
+            compressed = compress(codec, payload)
+            assert decompress(codec, compressed) == payload
+            compress_cpu = cpu_per_call(compress, codec, payload)
+            decompress_cpu = cpu_per_call(decompress, codec, compressed)
+            saved = len(payload) - len(compressed)
+            # Wire time saved per recipient versus the one-off compression cost
+            break_even = (
+                compress_cpu / (saved / LINK_BYTES_PER_SECOND) if saved > 0 else None
+            )
+            results.append(
+                {
+                    "payload_bytes": len(payload),
+                    "codec": codec,
+                    "wire_bytes": len(compressed),
+                    "ratio": len(payload) / len(compressed),
+                    "compress_us": compress_cpu * 1e6,
+                    "decompress_us": decompress_cpu * 1e6,
+                    "break_even_subscribers": break_even,
+                }
+            )
+            shown = f"{break_even:.1f}" if break_even is not None else "never"
+            print(
+                f"{len(payload):>6} {codec:>5} {len(compressed):>10} "
+                f"{len(payload) / len(compressed):>6.2f} {compress_cpu * 1e6:>11.1f} "
+                f"{decompress_cpu * 1e6:>13.1f} {shown:>15}"
+            )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures server memory per idle subscriber connection for the threaded and
+asyncio modes of the Publishers/Subscribers and Topic-based servers.
+
+Usage: python benchmarks/connection_memory.py [--connections N] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import rss_bytes, start_server, stop_server, thread_count
+from common.framing import encode_frame
+from common.limits import raise_open_file_limit
+
+HANDSHAKES = {"pubsub": b"SUBSCRIBER", "topic": b"SUBSCRIBER:IDLE"}
+
+
+def wait_for_steady_rss(pid, settle=0.5, timeout=30):
+    """Waits until the server's RSS stops growing and returns it."""
+    deadline = time.monotonic() + timeout
+    previous = rss_bytes(pid)
+    while time.monotonic() < deadline:
+        time.sleep(settle)
+        current = rss_bytes(pid)
+        if current == previous:
+            return current
+        previous = current
+    return previous
+
+
+def measure(architecture, mode, connections, port):
+    """Opens idle subscribers against one server and returns its memory figures."""
+    server = start_server(architecture, port, ["--mode", mode])
+    sockets = []
+    try:
+        baseline = wait_for_steady_rss(server.pid)
+        handshake = encode_frame(HANDSHAKES[architecture])
+        for _ in range(connections):
+            sock = socket.create_connection(("127.0.0.1", port))
+            sock.sendall(handshake)
+            sockets.append(sock)
+        loaded = wait_for_steady_rss(server.pid)
+        return {
+            "architecture": architecture,
+            "mode": mode,
+            "connections": connections,
+            "threads": thread_count(server.pid),
+            "baseline_rss_bytes": baseline,
+            "loaded_rss_bytes": loaded,
+            "bytes_per_connection": (loaded - baseline) / connections,
+        }
+    finally:
+        for sock in sockets:
+            sock.close()
+        stop_server(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--port", type=int, default=5600)
+    parser.add_argument("--architectures", nargs="+", default=["pubsub", "topic"])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    results = []
+    port = args.port
+    for architecture in args.architectures:
+        for mode in args.modes:
+            result = measure(architecture, mode, args.connections, port)
+            port += 1  # Avoid waiting for TIME_WAIT sockets of the previous run
+            results.append(result)
+            print(
+                f"{architecture:>7} {mode:>9}: {result['connections']} connections, "
+                f"{result['threads']} threads, "
+                f"{result['bytes_per_connection'] / 1024:.1f} KiB per connection"
+            )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Server-side content filters: how a publish is matched against many filters,
+and what filtering in the broker saves compared with sending every message
+to every subscriber and filtering in the client.
+
+- Matching: --filters subscribers, each with a filter such as
+  "region=R7&price<40", or a price range or symbol prefix only. Messages/s
+  through FilterIndex.matching(), which only tests the filters its lookups
+  find, against testing every filter on every message.
+- Delivery: a broker with --subscribers subscribers on one topic, each
+  interested in one of --regions regions, and one publisher of --messages
+  JSON messages. Messages and bytes delivered, the time until the last
+  subscriber has its messages, and the broker's CPU time, with
+  ";filter=region=<R>" subscriptions and with plain ones.
+
+Usage: python benchmarks/content_filters.py [--filters N] [--subscribers S]
+                                            [--regions R] [--messages M] [--json FILE]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import cpu_seconds, start_server, stop_server
+from common.filters import FilterIndex, compile_filter
+from common.framing import FrameReader, send_frame
+from common.limits import raise_open_file_limit
+from common.publisher import Publisher
+
+SYMBOLS = [f"{a}{b}{c}" for a in "ABCDEFGH" for b in "ABCDEFGH" for c in "ABCD"]
+
+
+def random_filter(rng, regions):
+    roll = rng.random()
+    if roll < 0.7:
+        return f"region=R{rng.randrange(regions)}&price<{rng.randrange(10, 100)}"
+    if roll < 0.85:
+        low = rng.randrange(0, 95)
+        return f"price>={low}&price<{low + 5}&side=buy"
+    return f"symbol^={rng.choice(SYMBOLS)[:2]}&price>{rng.randrange(50, 100)}"
+
+
+def random_message(rng, regions):
+    return {
+        "region": f"R{rng.randrange(regions)}",
+        "price": rng.randrange(100),
+        "side": rng.choice(("buy", "sell")),
+        "symbol": rng.choice(SYMBOLS),
+    }
+
+
+def measure_matching(count, regions, messages, seconds, seed=1):
+    """Messages/s through the index and through a scan of every filter, and the mean matches."""
+    rng = random.Random(seed)
+    filters = {subscriber: compile_filter(random_filter(rng, regions)) for subscriber in range(count)}
+    index = FilterIndex()
+    for subscriber, compiled in filters.items():
+        index.set(subscriber, compiled)
+    everyone = frozenset(filters)
+    samples = [random_message(rng, regions) for _ in range(messages)]
+
+    def rate(match):
+        matched = done = 0
+        started = time.perf_counter()
+        while time.perf_counter() - started < seconds:
+            for attributes in samples:
+                matched += len(match(attributes))
+            done += len(samples)
+        return done / (time.perf_counter() - started), matched / done
+
+    indexed, matches = rate(lambda attributes: index.matching(attributes, everyone))
+    scanned, scan_matches = rate(
+        lambda attributes: [s for s, f in filters.items() if f.matches(attributes)]
+    )
+    assert matches == scan_matches
+    return {
+        "filters": count,
+        "matches_per_message": matches,
+        "indexed_msgs_per_second": indexed,
+        "scan_msgs_per_second": scanned,
+    }
+
+
+def run_subscribers(port, subscribers, regions, filtered, expected, ready, results):
+    raise_open_file_limit()
+    selector = selectors.DefaultSelector()
+    for index in range(subscribers):
+        sock = socket.create_connection(("127.0.0.1", port))
+        handshake = "SUBSCRIBER:BENCH.TRADES"
+        if filtered:
+            handshake += f";filter=region=R{index % regions}"
+        send_frame(sock, handshake.encode("utf-8"))
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, FrameReader(sock))
+    ready.put(True)
+    received = received_bytes = 0
+    deadline = time.monotonic() + 120
+    while received < expected and time.monotonic() < deadline:
+        for key, _ in selector.select(timeout=1):
+            frames = key.data.read_available()
+            if frames is None:
+                selector.unregister(key.fileobj)
+                continue
+            received += len(frames)
+            received_bytes += sum(len(frame) + 4 for frame in frames)  # With the length prefix
+    results.put((received, received_bytes, time.monotonic()))
+
+
+def measure_delivery(port, filtered, args):
+    messages = [
+        json.dumps(
+            {"region": f"R{index % args.regions}", "price": index % 100, "pad": "x" * 32}
+        ).encode("utf-8")
+        for index in range(args.messages)
+    ]
+    per_region = args.messages // args.regions
+    expected = (
+        args.subscribers * per_region if filtered else args.subscribers * args.messages
+    )
+    server = start_server(
+        "topic",
+        port,
+        ["--mode", "asyncio", "--queue-size", str(args.messages), "--log-level", "warning"],
+    )
+    try:
+        ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+        receiver = multiprocessing.Process(
+            target=run_subscribers,
+            args=(port, args.subscribers, args.regions, filtered, expected, ready, results),
+        )
+        receiver.start()
+        ready.get(timeout=60)
+        time.sleep(0.5)  # Let the subscriptions register
+        cpu_before = cpu_seconds(server.pid)
+        started = time.monotonic()
+        with Publisher("127.0.0.1", port, "BENCH.TRADES") as publisher:
+            for message in messages:
+                publisher.publish(message)
+        received, received_bytes, finished = results.get(timeout=180)
+        receiver.join()
+        broker_cpu = cpu_seconds(server.pid) - cpu_before
+    finally:
+        stop_server(server)
+    return {
+        "filtered": filtered,
+        "subscribers": args.subscribers,
+        "delivered": received,
+        "expected": expected,
+        "delivered_bytes": received_bytes,
+        "seconds": finished - started,
+        "broker_cpu_seconds": broker_cpu,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--filters", default="1000,10000", help="Comma-separated filter counts")
+    parser.add_argument("--subscribers", type=int, default=200)
+    parser.add_argument("--regions", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=20_000, help="Messages in the delivery test")
+    parser.add_argument("--seconds", type=float, default=2.0, help="Time per matching run")
+    parser.add_argument("--port", type=int, default=6000)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = {"matching": [], "delivery": []}
+    print(f"{'filters':>8} {'matches/msg':>11} {'indexed msg/s':>14} {'scan msg/s':>11}")
+    for count in (int(count) for count in args.filters.split(",")):
+        result = measure_matching(count, args.regions, 1000, args.seconds)
+        results["matching"].append(result)
+        print(
+            f"{count:>8,} {result['matches_per_message']:>11.1f} "
+            f"{result['indexed_msgs_per_second']:>14,.0f} {result['scan_msgs_per_second']:>11,.0f}"
+        )
+
+    print()
+    print(f"{'subscribers':>18} {'delivered':>10} {'MB':>7} {'seconds':>8} {'broker CPU':>10}")
+    for index, filtered in enumerate((False, True)):
+        result = measure_delivery(args.port + index, filtered, args)
+        results["delivery"].append(result)
+        kind = "filtered" if filtered else "plain"
+        print(
+            f"{result['subscribers']:>9,} {kind:>8} {result['delivered']:>10,} "
+            f"{result['delivered_bytes'] / 1e6:>7.1f} {result['seconds']:>8.2f} "
+            f"{result['broker_cpu_seconds']:>9.2f}s"
+        )
+        if result["delivered"] < result["expected"]:
+            print(f"      {result['expected'] - result['delivered']:,} messages missing")
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Compares per-subscriber formatting/encoding with encode-once fan-out, as the
+number of subscribers on a topic grows from 1 to 10k.
+
+For each fan-out it reports CPU time per publish and the number of memory
+blocks (Python object allocations) each publish leaves behind in the queues.
+
+Usage: python benchmarks/fanout_encoding.py [--payload-size BYTES] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.framing import encode_frame
+from common.outbound import OutboundQueue
+
+FANOUTS = (1, 10, 100, 1000, 10000)
+TOPIC = "NEWS"
+
+
+def publish_per_subscriber(queues, content):
+    """The old fan-out: format and encode the message again for every subscriber."""
+    for queue in queues:
+        full_message = f"[PUBLISHED - {TOPIC}] {content}"
+        queue.put(encode_frame(full_message.encode("utf-8")))
+
+
+def publish_encode_once(queues, content):
+    """The new fan-out: build the frame once and share it with every queue."""
+    full_message = encode_frame(f"[PUBLISHED - {TOPIC}] {content}".encode("utf-8"))
+    for queue in queues:
+        queue.put(full_message)
+
+
+def cpu_per_publish(publish, queues, content, min_seconds=0.2):
+    """Average CPU seconds per publish, emptying the queues between publishes."""
+    publishes = 0
+    elapsed = 0.0
+    while elapsed < min_seconds:
+        start = time.process_time()
+        publish(queues, content)
+        elapsed += time.process_time() - start
+        publishes += 1
+        for queue in queues:
+            queue.take_all()
+    return elapsed / publishes
+
+
+def blocks_per_publish(publish, queues, content):
+    """Memory blocks still allocated (held by the queues) after one publish."""
+    publish(queues, content)  # Warm up so the queues' own storage is already allocated
+    for queue in queues:
+        queue.take_all()
+    blocks_before = sys.getallocatedblocks()
+    publish(queues, content)
+    blocks = sys.getallocatedblocks() - blocks_before
+    for queue in queues:
+        queue.take_all()
+    return blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--payload-size", type=int, default=256)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    content = "x" * args.payload_size
+    strategies = {
+        "per-subscriber": publish_per_subscriber,
+        "encode-once": publish_encode_once,
+    }
+    results = []
+    print(f"{'subscribers':>11} {'strategy':>15} {'us/publish':>11} {'blocks/publish':>15}")
+    for fanout in FANOUTS:
+        queues = [OutboundQueue(maxsize=fanout + 1) for _ in range(fanout)]
+        for name, publish in strategies.items():
+            cpu = cpu_per_publish(publish, queues, content)
+            blocks = blocks_per_publish(publish, queues, content)
+            results.append(
+                {
+                    "subscribers": fanout,
+                    "strategy": name,
+                    "cpu_us_per_publish": cpu * 1e6,
+                    "blocks_per_publish": blocks,
+                }
+            )
+            print(f"{fanout:>11} {name:>15} {cpu * 1e6:>11.1f} {blocks:>15}")
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Measures how a federation of topic-based brokers (--peers) scales with the
+number of nodes.
+
+Each node gets the same load: --subscribers subscribers, spread over its
+own --topics topics ("BENCH.<node>.<k>"), and one publisher that publishes
+--rounds messages on every topic of every node. Most publishes are
+therefore for another node's subscribers and cross exactly one inter-node
+link; broadcasting every publish to every node would cross N - 1 links.
+
+Reports the subscribers served, messages delivered per second summed over
+all nodes, link crossings (against broadcasting), Bloom filter false
+positives, and each node's memory and CPU time per delivered message,
+which stay flat as nodes, and with them subscribers, are added.
+
+Usage: python benchmarks/federation_capacity.py [--nodes 1,2,3] [--subscribers N]
+                                                [--topics K] [--rounds R] [--json FILE]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import cpu_seconds, rss_bytes, start_server, stop_server
+from common.framing import FrameReader, send_frame
+from common.limits import raise_open_file_limit
+from common.publisher import Publisher
+
+NODE_PORT_OFFSET = 100  # --node-port of each node, relative to its client port
+METRICS_PORT_OFFSET = 200  # --metrics-port of each node, relative to its client port
+
+
+def run_subscribers(port, node, subscribers, topics, expected, ready, results):
+    """Subscribes on one node and reports when its subscribers have `expected` messages."""
+    raise_open_file_limit()
+    selector = selectors.DefaultSelector()
+    for index in range(subscribers):
+        sock = socket.create_connection(("127.0.0.1", port))
+        send_frame(sock, f"SUBSCRIBER:BENCH.{node}.{index % topics}".encode("utf-8"))
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, FrameReader(sock))
+    ready.put(node)
+    received = 0
+    deadline = time.monotonic() + 120
+    while received < expected and time.monotonic() < deadline:
+        for key, _ in selector.select(timeout=1):
+            frames = key.data.read_available()
+            if frames is None:
+                selector.unregister(key.fileobj)
+                continue
+            received += len(frames)
+    results.put((node, received, time.monotonic()))
+
+
+def run_publisher(port, nodes, topics, rounds, payload_size, start):
+    content = b"x" * payload_size
+    with Publisher("127.0.0.1", port, "BENCH") as publisher:
+        start.wait()
+        for _ in range(rounds):
+            for node in range(nodes):
+                for index in range(topics):
+                    publisher.publish(content, f"BENCH.{node}.{index}")
+        publisher.flush()
+
+
+def scrape(metrics_port, name):
+    """Value of an unlabelled counter on a node's metrics page."""
+    page = urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics").read()
+    for line in page.decode("utf-8").splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[1])
+    return 0.0
+
+
+def measure(port, nodes, args):
+    ports = [port + node for node in range(nodes)]
+    per_subscriber = nodes * args.rounds  # One publisher per node, `rounds` per topic each
+    servers = []
+    for node, node_port in enumerate(ports):
+        extra_args = [
+            "--mode",
+            "asyncio",
+            "--queue-size",
+            str(max(1024, 2 * per_subscriber)),
+            "--metrics-port",
+            str(node_port + METRICS_PORT_OFFSET),
+            "--log-level",
+            "warning",
+        ]
+        if nodes > 1:
+            peers = [f"127.0.0.1:{other + NODE_PORT_OFFSET}" for other in ports if other != node_port]
+            extra_args += [
+                "--node-port",
+                str(node_port + NODE_PORT_OFFSET),
+                "--peers",
+                ",".join(peers),
+                "--node-name",
+                f"node-{node}",
+            ]
+        servers.append(start_server("topic", node_port, extra_args))
+    try:
+        ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+        start = multiprocessing.Event()
+        subscribers = [
+            multiprocessing.Process(
+                target=run_subscribers,
+                args=(
+                    node_port,
+                    node,
+                    args.subscribers,
+                    args.topics,
+                    args.subscribers * per_subscriber,
+                    ready,
+                    results,
+                ),
+            )
+            for node, node_port in enumerate(ports)
+        ]
+        publishers = [
+            multiprocessing.Process(
+                target=run_publisher,
+                args=(node_port, nodes, args.topics, args.rounds, args.payload_size, start),
+            )
+            for node_port in ports
+        ]
+        for process in subscribers + publishers:
+            process.start()
+        for _ in subscribers:
+            ready.get(timeout=120)
+        time.sleep(1)  # Let every node's summary reach the others
+        cpu_before = [cpu_seconds(server.pid) for server in servers]
+        started = time.monotonic()
+        start.set()
+        outcomes = [results.get(timeout=180) for _ in subscribers]
+        for process in subscribers + publishers:
+            process.join()
+        elapsed = max(finished for _, _, finished in outcomes) - started
+        delivered = sum(received for _, received, _ in outcomes)
+        crossings = sum(scrape(p + METRICS_PORT_OFFSET, "broker_messages_federated_total") for p in ports)
+        unmatched = sum(scrape(p + METRICS_PORT_OFFSET, "broker_federated_unmatched_total") for p in ports)
+        node_cpu = [cpu_seconds(server.pid) - before for server, before in zip(servers, cpu_before)]
+        node_rss = [rss_bytes(server.pid) for server in servers]
+    finally:
+        for server in servers:
+            stop_server(server)
+    publishes = nodes * args.rounds * nodes * args.topics
+    return {
+        "nodes": nodes,
+        "subscribers": nodes * args.subscribers,
+        "delivered": delivered,
+        "expected": nodes * args.subscribers * per_subscriber,
+        "seconds": elapsed,
+        "msgs_per_second": delivered / elapsed,
+        "publishes": publishes,
+        "link_crossings": crossings,
+        "broadcast_crossings": publishes * (nodes - 1),
+        "unmatched_crossings": unmatched,
+        "max_node_rss_bytes": max(node_rss),
+        "node_cpu_us_per_delivery": max(node_cpu) / (delivered / nodes) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--nodes", default="1,2,3", help="Comma-separated node counts")
+    parser.add_argument("--subscribers", type=int, default=500, help="Subscribers per node")
+    parser.add_argument("--topics", type=int, default=50, help="Topics per node")
+    parser.add_argument("--rounds", type=int, default=20, help="Messages per topic per publisher")
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--port", type=int, default=5800)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{os.cpu_count()} CPU core(s)")
+    print(
+        f"{'nodes':>5} {'subs':>6} {'delivered':>10} {'msg/s':>9} {'crossings':>10} "
+        f"{'broadcast':>10} {'false+':>6} {'node RSS':>9} {'node CPU/msg':>12}"
+    )
+    for index, nodes in enumerate(int(count) for count in args.nodes.split(",")):
+        # Avoid waiting for TIME_WAIT sockets of the previous run
+        result = measure(args.port + 10 * index, nodes, args)
+        results.append(result)
+        print(
+            f"{nodes:>5} {result['subscribers']:>6,} {result['delivered']:>10,} "
+            f"{result['msgs_per_second']:>9,.0f} {result['link_crossings']:>10,.0f} "
+            f"{result['broadcast_crossings']:>10,} {result['unmatched_crossings']:>6,.0f} "
+            f"{result['max_node_rss_bytes'] / 2**20:>7.1f}MB "
+            f"{result['node_cpu_us_per_delivery']:>10.1f}us"
+        )
+        if result["delivered"] < result["expected"]:
+            print(f"      {result['expected'] - result['delivered']:,} messages missing")
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,568 @@
+"""
+Headless load generator and benchmark harness for the three architectures.
+
+Starts one of the server_app.py servers on localhost, then runs M publisher
+and N subscriber processes on K topics for a fixed time. Every message
+carries its send time (a system-wide monotonic clock), so subscribers measure
+end-to-end latency. The harness reports:
+
+    msgs/s and MB/s delivered to subscribers (sent, for client_server)
+    p50 / p99 / p999 end-to-end latency
+    server CPU use and peak RSS (summed over worker processes)
+    bytes on the wire per message and the clients' CPU time, which show
+    what compression (--compression) saves and costs
+
+With --qos 1 subscribers acknowledge what they receive and publishers keep
+at most --max-unacked frames ahead of the server's acknowledgements, so
+the cost of at-least-once delivery shows against the default (--qos 0).
+
+With --json the results are written together with the configuration and
+the git commit, and --compare prints the change against such a file, so
+regressions show up between commits.
+
+The client_server server has no subscribers and serves one connection at a
+time, so it is measured with one publisher and no latency figures.
+
+Usage: python benchmarks/harness.py --arch topic --publishers 4 --subscribers 16 --topics 4
+           --message-size 128 --rate 5000 --duration 10 --server-args="--mode asyncio"
+           [--protocol binary [--compression zlib [--publisher-compression]]]
+           [--payload json] [--qos 1] [--json FILE] [--compare BASELINE.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import (
+    REPO_ROOT,
+    SERVER_SCRIPTS,
+    start_server,
+    stop_server,
+    tree_cpu_seconds,
+    tree_rss_bytes,
+)
+from common.binary_protocol import (
+    BINARY,
+    OP_PUBLISH_COMPRESSED,
+    OP_REGISTER,
+    OP_TERMINATE,
+    PROTOCOLS,
+    TEXT,
+    TOPIC_HEADER,
+    encode_command,
+    encode_publish,
+    encode_publish_compressed,
+    encode_register,
+    split_compressed,
+)
+from common.compression import CODEC_IDS, DEFAULT_MIN_BYTES, decompress, maybe_compress
+from common.framing import FrameBuffer, encode_batch, encode_frame
+from common.limits import raise_open_file_limit
+from common.qos import DEFAULT_MAX_UNACKED, QosReceiver, parse_puback
+
+TIMESTAMP_DIGITS = 19  # Send time in ns, zero-padded, at the start of every message
+TICK = 0.001  # Publishers send whatever is due once per tick
+
+# Metrics shown by --compare, and whether a higher value is better
+COMPARED_METRICS = {
+    "msgs_per_second": True,
+    "mb_per_second": True,
+    "latency_p50_us": False,
+    "latency_p99_us": False,
+    "latency_p999_us": False,
+    "server_cpu_percent": False,
+    "server_peak_rss_bytes": False,
+    "subscriber_wire_bytes_per_message": False,
+}
+
+
+def handshake(arch, role, topic, protocol=TEXT, compression=None, qos=0):
+    """First frame a client sends to each architecture's server."""
+    qos_option = ";qos=1" if qos else ""
+    if arch == "topic":
+        options = f";proto={protocol}" if protocol == BINARY else ""
+        if compression:
+            options += f";compress={compression}"
+        return f"{role}:{topic}{options}{qos_option}".encode("utf-8")
+    if arch == "pubsub":
+        return f"{role}{qos_option}".encode("utf-8")
+    return None  # client_server has no handshake
+
+
+def message_prefix(arch, topic):
+    return f"{topic}:".encode("utf-8") if arch == "topic" else b""
+
+
+def message_body(size, kind):
+    """
+    What follows the send time in every message: "padding" (b"xxx...") or
+    "json", a repetitive JSON document of the kind compression is meant for.
+    """
+    size = max(0, size - TIMESTAMP_DIGITS - 1)
+    if kind == "padding":
+        return b"x" * size
+    readings = []
+    body = b"{}"
+    while len(body) < size:
+        index = len(readings)
+        readings.append(
+            {
+                "sensor": f"rack-{index % 8}/probe-{index % 3}",
+                "unit": "celsius",
+                "value": 20 + index % 7,
+            }
+        )
+        body = json.dumps({"site": "bench", "readings": readings}).encode("utf-8")
+    return body[:size]
+
+
+def send_time(frame, protocol=TEXT):
+    """Reads the embedded send time back out of a delivered frame."""
+    if protocol == BINARY and frame[0] == OP_PUBLISH_COMPRESSED:
+        frame = decompress(*split_compressed(frame[TOPIC_HEADER.size :]))
+        start = 0
+    elif protocol == BINARY:
+        start = TOPIC_HEADER.size  # The payload follows the opcode and topic id
+    else:
+        start = frame.find(b"] ") + 2  # After "[PUBLISHED] " or "[PUBLISHED - TOPIC] "
+    return int(frame[start : start + TIMESTAMP_DIGITS])
+
+
+def read_acks(sock, buffer, protocol, block):
+    """Returns the highest count the server acknowledged so far, or None if none arrived."""
+    sock.setblocking(block)
+    try:
+        count = sock.recv_into(buffer.writable())
+    except BlockingIOError:
+        return None
+    if not count:
+        raise ConnectionError("Server closed the connection.")
+    buffer.advance(count)
+    frames = buffer.frames()
+    return max(parse_puback(frame, protocol) for frame in frames) if frames else None
+
+
+def run_publisher(arch, port, topic, args, go, results):
+    """Publishes on one topic at the configured rate until the duration is over."""
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    codec = args.compression if args.publisher_compression else None
+    first = handshake(arch, "PUBLISHER", topic, args.protocol, codec, args.qos)
+    if first:
+        sock.sendall(encode_frame(first))
+    frames_sent = acked = 0  # Frames after the handshake, and the server's PUBACK (QoS 1)
+    acks = FrameBuffer()
+    if args.protocol == BINARY:
+        sock.sendall(encode_register(0, topic))  # Messages then carry id 0, not the topic
+        frames_sent += 1
+    prefix = message_prefix(arch, topic)
+    padding = message_body(args.message_size, args.payload)
+    go.wait()
+
+    sent = wire_bytes = 0
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    end = start + args.duration
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        if args.rate:
+            count = min(int((now - start) * args.rate) - sent, args.max_burst)
+            if count <= 0:
+                time.sleep(TICK)
+                continue
+        else:
+            count = args.max_burst
+        if codec:
+            frames = []
+            for _ in range(count):
+                payload = b"%019d|" % time.monotonic_ns() + padding
+                compressed = maybe_compress(codec, payload, DEFAULT_MIN_BYTES)
+                if compressed is None:
+                    frames.append(encode_publish(0, payload))
+                else:
+                    frames.append(encode_publish_compressed(0, codec, compressed))
+        elif args.protocol == BINARY:
+            frames = [
+                encode_publish(0, b"%019d|" % time.monotonic_ns() + padding)
+                for _ in range(count)
+            ]
+        else:
+            frames = [
+                encode_frame(prefix + b"%019d|" % time.monotonic_ns() + padding)
+                for _ in range(count)
+            ]
+        if args.qos:
+            # Take the acks that arrived, and wait while --max-unacked frames are outstanding
+            acked = max(acked, read_acks(sock, acks, args.protocol, False) or 0)
+            while acked < frames_sent and frames_sent + count - acked > args.max_unacked:
+                acked = max(acked, read_acks(sock, acks, args.protocol, True) or 0)
+            sock.setblocking(True)
+        # All due messages leave in one write, as one batch frame with --batch-frames
+        data = encode_batch(frames) if args.batch_frames else b"".join(frames)
+        sock.sendall(data)
+        sent += count
+        frames_sent += count
+        wire_bytes += len(data)
+    while args.qos and acked < frames_sent:
+        acked = max(acked, read_acks(sock, acks, args.protocol, True) or 0)
+    sock.setblocking(True)
+    if args.protocol == BINARY:
+        sock.sendall(encode_command(OP_TERMINATE))
+    else:
+        sock.sendall(encode_frame(b"terminate"))
+    sock.close()
+    results.put(("publisher", topic, sent, wire_bytes, time.process_time() - cpu_start))
+
+
+def run_subscribers(arch, port, topics, protocol, compression, qos, ready, stop, results):
+    """Runs several subscribers in one process and records every message's latency."""
+    selector = selectors.DefaultSelector()
+    for topic in topics:
+        sock = socket.create_connection(("127.0.0.1", port))
+        first = handshake(arch, "SUBSCRIBER", topic, protocol, compression, qos)
+        sock.sendall(encode_frame(first))
+        sock.setblocking(False)
+        receiver = QosReceiver(protocol) if qos else None
+        selector.register(sock, selectors.EVENT_READ, (FrameBuffer(), receiver))
+    ready.put(len(topics))
+
+    latencies = array("q")
+    received = received_bytes = wire_bytes = 0
+    first_receive = last_receive = None
+    cpu_start = time.process_time()
+    while not stop.is_set():
+        for key, _ in selector.select(timeout=0.1):
+            buffer, receiver = key.data
+            try:
+                count = key.fileobj.recv_into(buffer.writable())
+            except BlockingIOError:
+                continue
+            if not count:
+                selector.unregister(key.fileobj)
+                continue
+            buffer.advance(count)
+            wire_bytes += count
+            frames = buffer.frames()
+            if receiver is not None:
+                # Only new messages count; every read is acknowledged at once
+                frames = [frame for frame in frames if receiver.accept(frame)]
+                ack = receiver.ack()
+                if ack:
+                    key.fileobj.sendall(ack)
+            elif protocol == BINARY:
+                frames = [frame for frame in frames if frame[0] != OP_REGISTER]
+            if not frames:
+                continue
+            now = time.monotonic_ns()
+            first_receive = first_receive or now
+            last_receive = now
+            received += len(frames)
+            for frame in frames:
+                received_bytes += len(frame)
+                latencies.append(now - send_time(frame, protocol))
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    results.put(
+        (
+            "subscribers",
+            received,
+            received_bytes,
+            wire_bytes,
+            time.process_time() - cpu_start,
+            first_receive,
+            last_receive,
+            latencies.tobytes(),
+        )
+    )
+
+
+def percentile_us(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] / 1000
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """Runs one benchmark and returns its results."""
+    topics = [f"BENCH.T{index}" for index in range(args.topics)]
+    publisher_topics = [topics[index % len(topics)] for index in range(args.publishers)]
+    subscriber_topics = [topics[index % len(topics)] for index in range(args.subscribers)]
+    groups = [
+        subscriber_topics[index :: args.subscriber_processes]
+        for index in range(args.subscriber_processes)
+    ]
+    groups = [group for group in groups if group]
+
+    server = start_server(args.arch, args.port, shlex.split(args.server_args))
+    results = multiprocessing.Queue()
+    ready = multiprocessing.Queue()
+    go = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    subscribers = [
+        multiprocessing.Process(
+            target=run_subscribers,
+            args=(
+                args.arch,
+                args.port,
+                group,
+                args.protocol,
+                args.compression,
+                args.qos,
+                ready,
+                stop,
+                results,
+            ),
+        )
+        for group in groups
+    ]
+    publishers = [
+        multiprocessing.Process(
+            target=run_publisher, args=(args.arch, args.port, topic, args, go, results)
+        )
+        for topic in publisher_topics
+    ]
+    try:
+        for process in subscribers:
+            process.start()
+        for _ in groups:
+            ready.get(timeout=60)
+        time.sleep(args.settle)  # Let the server register every subscription
+        for process in publishers:
+            process.start()
+        time.sleep(args.settle)  # Publishers connect, then all start together
+
+        peak_rss = tree_rss_bytes(server.pid)
+        cpu_before = tree_cpu_seconds(server.pid)
+        started = time.monotonic()
+        go.set()
+        drain_until = None
+        while drain_until is None or time.monotonic() < drain_until:
+            time.sleep(0.2)
+            peak_rss = max(peak_rss, tree_rss_bytes(server.pid))
+            if drain_until is None and not any(p.is_alive() for p in publishers):
+                drain_until = time.monotonic() + args.drain
+        cpu_seconds = tree_cpu_seconds(server.pid) - cpu_before
+        wall_seconds = time.monotonic() - started
+        stop.set()
+
+        sent_per_topic = {}
+        received = received_bytes = 0
+        publisher_wire_bytes = subscriber_wire_bytes = 0
+        publisher_cpu = subscriber_cpu = 0.0
+        first_receive = last_receive = None
+        latencies = array("q")
+        for _ in range(len(publishers) + len(subscribers)):
+            outcome = results.get(timeout=60)
+            if outcome[0] == "publisher":
+                _, topic, count, wire, cpu = outcome
+                sent_per_topic[topic] = sent_per_topic.get(topic, 0) + count
+                publisher_wire_bytes += wire
+                publisher_cpu += cpu
+                continue
+            _, count, size, wire, cpu, first, last, raw = outcome
+            received += count
+            received_bytes += size
+            subscriber_wire_bytes += wire
+            subscriber_cpu += cpu
+            if first is not None:
+                first_receive = min(first, first_receive or first)
+                last_receive = max(last, last_receive or last)
+            latencies.frombytes(raw)
+        for process in publishers + subscribers:
+            process.join()
+    finally:
+        stop.set()
+        stop_server(server)
+
+    sent = sum(sent_per_topic.values())
+    if args.arch == "pubsub":
+        expected = sent * len(subscriber_topics)  # Every subscriber gets every message
+    else:
+        expected = sum(
+            sent_per_topic.get(topic, 0) * subscriber_topics.count(topic) for topic in topics
+        )
+    if args.subscribers:
+        window = (last_receive - first_receive) / 1e9 if received > 1 else 0
+        delivered, delivered_bytes = received, received_bytes
+    else:
+        # No subscribers (client_server): count what the publishers sent
+        window = args.duration
+        delivered = sent
+        delivered_bytes = sent * (args.message_size + 4)
+    ordered = sorted(latencies)
+    return {
+        "messages_sent": sent,
+        "messages_expected": expected if args.subscribers else sent,
+        "messages_received": delivered,
+        "delivery_ratio": delivered / expected if args.subscribers and expected else None,
+        "msgs_per_second": delivered / window if window else None,
+        "mb_per_second": delivered_bytes / window / 1e6 if window else None,
+        "latency_p50_us": percentile_us(ordered, 0.50),
+        "latency_p99_us": percentile_us(ordered, 0.99),
+        "latency_p999_us": percentile_us(ordered, 0.999),
+        "server_cpu_seconds": cpu_seconds,
+        "server_cpu_percent": 100 * cpu_seconds / wall_seconds,
+        "server_peak_rss_bytes": peak_rss,
+        "publisher_wire_bytes_per_message": publisher_wire_bytes / sent if sent else None,
+        "subscriber_wire_bytes_per_message": (
+            subscriber_wire_bytes / received if args.subscribers and received else None
+        ),
+        "publisher_cpu_seconds": publisher_cpu,
+        "subscriber_cpu_seconds": subscriber_cpu,
+    }
+
+
+def print_results(results):
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = f"{value:,.2f}"
+        elif isinstance(value, int):
+            value = f"{value:,}"
+        print(f"{key:>22}: {value}")
+
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"\nCompared with {baseline_path} (commit {baseline.get('git_commit')}):")
+    for key, higher_is_better in COMPARED_METRICS.items():
+        old, new = baseline["results"].get(key), results.get(key)
+        if not old or new is None:
+            continue
+        change = 100 * (new - old) / old
+        better = (change > 0) == higher_is_better
+        verdict = "better" if better else "worse"
+        print(f"{key:>22}: {old:>14,.2f} -> {new:>14,.2f} ({change:+.1f}%, {verdict})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--arch", choices=sorted(SERVER_SCRIPTS), default="topic")
+    parser.add_argument(
+        "--server-args", default="", help='Extra server arguments, e.g. "--mode asyncio"'
+    )
+    parser.add_argument("--publishers", type=int, default=1, help="M publisher processes")
+    parser.add_argument("--subscribers", type=int, default=4, help="N subscriber connections")
+    parser.add_argument("--topics", type=int, default=1, help="K topics (topic architecture)")
+    parser.add_argument("--message-size", type=int, default=128, help="Payload bytes")
+    parser.add_argument(
+        "--rate", type=float, default=1000, help="Messages/s per publisher (0: as fast as possible)"
+    )
+    parser.add_argument("--duration", type=float, default=5, help="Seconds of publishing")
+    parser.add_argument(
+        "--max-burst", type=int, default=1000, help="Most messages a publisher writes at once"
+    )
+    parser.add_argument(
+        "--batch-frames", action="store_true", help="Send each burst as one batch frame"
+    )
+    parser.add_argument(
+        "--protocol",
+        choices=PROTOCOLS,
+        default=TEXT,
+        help="Wire protocol of the topic server's clients (default text)",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=sorted(CODEC_IDS),
+        help="Binary subscribers accept payloads compressed with this codec (compressed by the "
+        'server with --server-args="--compress BENCH.#=CODEC", or see --publisher-compression)',
+    )
+    parser.add_argument(
+        "--publisher-compression",
+        action="store_true",
+        help="Publishers compress their payloads with the --compression codec",
+    )
+    parser.add_argument(
+        "--payload",
+        choices=["padding", "json"],
+        default="padding",
+        help="Message body after the send time: b'xxx...' (default) or repetitive JSON",
+    )
+    parser.add_argument(
+        "--qos",
+        type=int,
+        choices=[0, 1],
+        default=0,
+        help="1: subscribers acknowledge and publishers wait for the server's acks (default 0)",
+    )
+    parser.add_argument(
+        "--max-unacked",
+        type=int,
+        default=DEFAULT_MAX_UNACKED,
+        help=f"Frames a --qos 1 publisher sends ahead of the server's acks (default {DEFAULT_MAX_UNACKED})",
+    )
+    parser.add_argument(
+        "--subscriber-processes",
+        type=int,
+        default=max(1, min(4, os.cpu_count() or 1)),
+        help="Processes the subscriber connections are spread over",
+    )
+    parser.add_argument("--settle", type=float, default=0.5, help="Seconds to let clients connect")
+    parser.add_argument(
+        "--drain", type=float, default=2, help="Seconds to keep receiving after publishing ends"
+    )
+    parser.add_argument("--port", type=int, default=5800)
+    parser.add_argument("--json", help="Write the configuration and results to this file")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.arch == "client_server":
+        # One connection at a time and nothing is delivered back
+        args.publishers, args.subscribers = 1, 0
+    elif args.arch == "pubsub":
+        args.topics = 1
+    if args.arch != "topic":
+        args.protocol = TEXT  # Only the topic server speaks the binary protocol
+    if args.protocol != BINARY and args.compression:
+        parser.error("--compression needs --arch topic --protocol binary")
+    if args.publisher_compression and not args.compression:
+        parser.error("--publisher-compression needs --compression")
+    if args.qos and args.arch == "client_server":
+        parser.error("--qos needs --arch topic or pubsub")
+    raise_open_file_limit()
+
+    results = run(args)
+    print_results(results)
+    if args.compare:
+        print_comparison(results, args.compare)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(
+                {
+                    "git_commit": git_commit(),
+                    "timestamp": time.time(),
+                    "config": vars(args),
+                    "results": results,
+                },
+                output,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
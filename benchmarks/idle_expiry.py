@@ -0,0 +1,135 @@
+"""
+Cost of finding and removing dead connections among many live ones: the
+IdleMonitor's timing wheel against scanning every connection's last-seen
+time on each sweep, and the indexed client registry against rebuilding a
+client list for every removal.
+
+Usage: python benchmarks/idle_expiry.py [--connections N] [--dead K] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.heartbeat import IdleMonitor
+
+TIMEOUT = 1.0  # Seconds of silence before a connection is closed
+TICK = 0.05  # Seconds between sweeps
+
+
+def run_sweeps(connections, dead, watch, seen, sweep):
+    """
+    Watches every connection, hears from all but the first `dead` half a
+    timeout later, and sweeps every TICK until the dead ones are closed.
+    Returns (sweeps, seconds spent sweeping).
+    """
+    for key in range(connections):
+        watch(key)
+    started = time.monotonic()
+    heard = False
+    sweeps = closed = 0
+    spent = 0.0
+    while closed < dead:
+        time.sleep(TICK)
+        if not heard and time.monotonic() - started > TIMEOUT / 2:
+            for key in range(dead, connections):
+                seen(key)
+            heard = True
+        start = time.perf_counter()
+        closed += sweep(time.monotonic())
+        spent += time.perf_counter() - start
+        sweeps += 1
+    assert closed == dead
+    return sweeps, spent
+
+
+def wheel_sweeps(connections, dead):
+    """The IdleMonitor: a timing wheel of deadlines, pushed back lazily."""
+    monitor = IdleMonitor(TICK)
+    return run_sweeps(
+        connections,
+        dead,
+        lambda key: monitor.watch(key, TIMEOUT, lambda: None),
+        monitor.seen,
+        monitor.sweep,
+    )
+
+
+def scan_sweeps(connections, dead):
+    """Baseline: every sweep checks every connection's last-seen time."""
+    last_seen = {}
+
+    def watch(key):
+        last_seen[key] = time.monotonic()
+
+    def seen(key):
+        last_seen[key] = time.monotonic()
+
+    def sweep(now):
+        expired = [key for key, seen in last_seen.items() if now - seen > TIMEOUT]
+        for key in expired:
+            del last_seen[key]
+        return len(expired)
+
+    return run_sweeps(connections, dead, watch, seen, sweep)
+
+
+def removals(connections, dead):
+    """Seconds to remove `dead` clients from a list rebuilt per removal, and from a dict."""
+    clients = [{"socket": key} for key in range(connections)]
+    start = time.perf_counter()
+    for key in range(dead):
+        if key in [client["socket"] for client in clients]:
+            clients[:] = [client for client in clients if client["socket"] != key]
+    rebuilt = time.perf_counter() - start
+
+    index = {key: {"socket": key} for key in range(connections)}
+    start = time.perf_counter()
+    for key in range(dead):
+        index.pop(key, None)
+    indexed = time.perf_counter() - start
+    return rebuilt, indexed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=100_000)
+    parser.add_argument("--dead", type=int, default=1_000)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    wheel_count, wheel_seconds = wheel_sweeps(args.connections, args.dead)
+    scan_count, scan_seconds = scan_sweeps(args.connections, args.dead)
+    rebuilt, indexed = removals(args.connections, args.dead)
+
+    results = {
+        "connections": args.connections,
+        "dead": args.dead,
+        "wheel_sweeps": wheel_count,
+        "wheel_sweep_ms_total": wheel_seconds * 1e3,
+        "scan_sweeps": scan_count,
+        "scan_sweep_ms_total": scan_seconds * 1e3,
+        "list_removal_ms": rebuilt * 1e3,
+        "dict_removal_ms": indexed * 1e3,
+    }
+    print(f"{args.connections:,} connections, {args.dead:,} dead, {TIMEOUT:g} s timeout")
+    print(
+        f"  sweeping until the dead are closed: wheel {wheel_seconds * 1e3:8.1f} ms "
+        f"({wheel_count} sweeps), scan {scan_seconds * 1e3:8.1f} ms ({scan_count} sweeps)"
+    )
+    print(
+        f"  removing the dead from the registry: dict {indexed * 1e3:8.2f} ms, "
+        f"list rebuilt per removal {rebuilt * 1e3:8.1f} ms"
+    )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Loopback TCP against a Unix socket and a shared-memory ring for a publisher
+on the broker's host: messages/s from one batching Publisher to one
+subscriber, and the latency of single messages (publish to delivery, one
+at a time, no batching). The subscriber uses TCP in the TCP run and the
+Unix socket in the other two.
+
+Usage: python benchmarks/local_transports.py [--messages N] [--samples K] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import start_server, stop_server
+from common.framing import FrameReader, send_frame
+from common.publisher import Publisher
+from common.transport import connect
+
+TRANSPORTS = ("tcp", "unix", "shm")
+
+
+def subscribe(host, port, topic):
+    sock = connect(host, port)
+    send_frame(sock, f"SUBSCRIBER:{topic}".encode("utf-8"))
+    time.sleep(0.2)  # Let the subscription register before publishing
+    return sock, FrameReader(sock)
+
+
+def throughput(host, port, shm_size, messages, payload_size):
+    """Messages/s from a batching publisher until the subscriber has them all."""
+    sock, reader = subscribe(host, port, "BENCH.RATE")
+    received = 0
+
+    def receive():
+        nonlocal received
+        while received < messages:
+            frames = reader.read_frames()
+            if not frames:
+                return
+            received += len(frames)
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    content = b"x" * payload_size
+    start = time.perf_counter()
+    with Publisher(host, port, "BENCH.RATE", shm_size=shm_size) as publisher:
+        for _ in range(messages):
+            publisher.publish(content)
+    receiver.join()
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return received / elapsed
+
+
+def latency(host, port, shm_size, samples, payload_size):
+    """Median and 99th percentile seconds from publish() to delivery of single messages."""
+    sock, reader = subscribe(host, port, "BENCH.PING")
+    content = b"x" * payload_size
+    latencies = []
+    with Publisher(host, port, "BENCH.PING", linger=0, shm_size=shm_size) as publisher:
+        for _ in range(samples):
+            start = time.perf_counter()
+            publisher.publish(content)
+            reader.read_frames()
+            latencies.append(time.perf_counter() - start)
+    sock.close()
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500_000, help="Messages in the rate test")
+    parser.add_argument("--samples", type=int, default=5000, help="Messages timed one at a time")
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--shm-size", type=int, default=4 * 1024 * 1024, help="Ring bytes")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--port", type=int, default=5900)
+    parser.add_argument("--transports", nargs="+", choices=TRANSPORTS, default=list(TRANSPORTS))
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    socket_path = os.path.join(tempfile.mkdtemp(prefix="broker-bench-"), "broker.sock")
+    server = start_server(
+        "topic",
+        args.port,
+        ["--mode", args.mode, "--unix", socket_path, "--queue-size", str(args.messages), "--log-level", "warning"],
+    )
+    results = []
+    try:
+        for transport in args.transports:
+            host = "127.0.0.1" if transport == "tcp" else f"unix:{socket_path}"
+            shm_size = args.shm_size if transport == "shm" else 0
+            rate = throughput(host, args.port, shm_size, args.messages, args.payload_size)
+            median, p99 = latency(host, args.port, shm_size, args.samples, args.payload_size)
+            results.append(
+                {
+                    "transport": transport,
+                    "mode": args.mode,
+                    "msgs_per_second": rate,
+                    "latency_median_us": median * 1e6,
+                    "latency_p99_us": p99 * 1e6,
+                }
+            )
+            print(
+                f"{transport:>4}: {rate:>9,.0f} msgs/s, latency median "
+                f"{median * 1e6:6.1f} us, p99 {p99 * 1e6:7.1f} us"
+            )
+    finally:
+        stop_server(server)
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Latency of a latency-critical topic while a bulk topic bursts, with and
+without priority lanes (--priority ORDERS=high --priority LOGS=bulk).
+
+An ORDERS publisher sends one small message every --interval seconds,
+stamped with time.monotonic_ns(), and one ORDERS subscriber records how
+long each took to arrive. Meanwhile --bulk-publishers publishers send
+--bulk-messages LOGS messages each as fast as they can, to
+--bulk-subscribers subscribers. Reports the ORDERS latency percentiles
+and the LOGS delivery rate, for ORDERS alone, under the burst, and under
+the burst with lanes.
+
+Usage: python benchmarks/priority_lanes.py [--mode asyncio|threaded] [--json FILE]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import start_server, stop_server
+from common.framing import FrameReader, send_frame
+from common.publisher import Publisher
+
+SCENARIOS = (
+    ("orders alone", False, []),
+    ("burst, no lanes", True, []),
+    ("burst, lanes", True, ["--priority", "ORDERS=high", "--priority", "LOGS=bulk"]),
+)
+
+
+def run_orders_subscriber(port, ready, stop, results):
+    sock = socket.create_connection(("127.0.0.1", port))
+    send_frame(sock, b"SUBSCRIBER:ORDERS")
+    sock.settimeout(0.2)
+    reader = FrameReader(sock)
+    ready.put(True)
+    latencies = []
+    while not stop.is_set():
+        try:
+            frames = reader.read_frames()
+        except socket.timeout:
+            continue
+        if not frames:
+            break
+        now = time.monotonic_ns()
+        for frame in frames:
+            sent = int(frame.rsplit(b" ", 1)[1])
+            latencies.append((now - sent) / 1e3)  # Microseconds
+    results.put(latencies)
+
+
+def run_bulk_subscribers(port, subscribers, expected, ready, results):
+    selector = selectors.DefaultSelector()
+    for _ in range(subscribers):
+        sock = socket.create_connection(("127.0.0.1", port))
+        send_frame(sock, b"SUBSCRIBER:LOGS")
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, FrameReader(sock))
+    ready.put(True)
+    received = 0
+    started = None
+    deadline = time.monotonic() + 300
+    while received < expected and time.monotonic() < deadline:
+        for key, _ in selector.select(timeout=1):
+            frames = key.data.read_available()
+            if frames is None:
+                selector.unregister(key.fileobj)
+                continue
+            if started is None:
+                started = time.monotonic()
+            received += len(frames)
+    results.put((received, time.monotonic() - (started or time.monotonic())))
+
+
+def run_bulk_publisher(port, messages, payload_size, start):
+    content = b"l" * payload_size
+    with Publisher("127.0.0.1", port, "LOGS") as publisher:
+        start.wait()
+        for _ in range(messages):
+            publisher.publish(content)
+
+
+def measure(port, burst, server_args, args):
+    server = start_server(
+        "topic",
+        port,
+        [
+            "--mode",
+            args.mode,
+            "--queue-size",
+            str(args.bulk_messages * args.bulk_publishers),
+            "--log-level",
+            "warning",
+            *server_args,
+        ],
+    )
+    try:
+        ready, order_results, bulk_results = (multiprocessing.Queue() for _ in range(3))
+        stop, start = multiprocessing.Event(), multiprocessing.Event()
+        processes = [
+            multiprocessing.Process(target=run_orders_subscriber, args=(port, ready, stop, order_results))
+        ]
+        expected = args.bulk_subscribers * args.bulk_messages * args.bulk_publishers
+        if burst:
+            processes.append(
+                multiprocessing.Process(
+                    target=run_bulk_subscribers,
+                    args=(port, args.bulk_subscribers, expected, ready, bulk_results),
+                )
+            )
+            processes += [
+                multiprocessing.Process(
+                    target=run_bulk_publisher,
+                    args=(port, args.bulk_messages, args.payload_size, start),
+                )
+                for _ in range(args.bulk_publishers)
+            ]
+        for process in processes:
+            process.start()
+        for _ in range(2 if burst else 1):
+            ready.get(timeout=60)
+        time.sleep(0.5)
+        with Publisher("127.0.0.1", port, "ORDERS", linger=0) as orders:
+            start.set()
+            deadline = time.monotonic() + args.seconds
+            bulk = None
+            while time.monotonic() < deadline:
+                orders.publish(b"order %d" % time.monotonic_ns())
+                time.sleep(args.interval)
+                if burst and bulk is None and not bulk_results.empty():
+                    bulk = bulk_results.get()
+                    break  # The burst is over
+        time.sleep(0.5)
+        stop.set()
+        latencies = order_results.get(timeout=30)
+        if burst and bulk is None:
+            bulk = bulk_results.get(timeout=300)
+        for process in processes:
+            process.join()
+    finally:
+        stop_server(server)
+    latencies.sort()
+    result = {
+        "orders": len(latencies),
+        "latency_median_us": statistics.median(latencies),
+        "latency_p99_us": latencies[int(len(latencies) * 0.99)],
+        "latency_max_us": latencies[-1],
+    }
+    if burst:
+        received, seconds = bulk
+        result["bulk_delivered"] = received
+        result["bulk_msgs_per_second"] = received / seconds if seconds else 0.0
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--bulk-publishers", type=int, default=2)
+    parser.add_argument("--bulk-messages", type=int, default=100_000, help="LOGS messages per publisher")
+    parser.add_argument("--bulk-subscribers", type=int, default=10)
+    parser.add_argument("--payload-size", type=int, default=256)
+    parser.add_argument("--interval", type=float, default=0.002, help="Seconds between ORDERS")
+    parser.add_argument("--seconds", type=float, default=5.0, help="Longest time ORDERS are sent")
+    parser.add_argument("--port", type=int, default=6200)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{args.mode} mode, {os.cpu_count()} CPU core(s)")
+    print(f"{'scenario':>16} {'orders':>7} {'median':>9} {'p99':>9} {'max':>9} {'LOGS msg/s':>11}")
+    for index, (name, burst, server_args) in enumerate(SCENARIOS):
+        result = measure(args.port + index, burst, server_args, args)
+        result.update(scenario=name, mode=args.mode)
+        results.append(result)
+        rate = f"{result['bulk_msgs_per_second']:>11,.0f}" if burst else f"{'-':>11}"
+        print(
+            f"{name:>16} {result['orders']:>7,} {result['latency_median_us']:>7,.0f}us "
+            f"{result['latency_p99_us']:>7,.0f}us {result['latency_max_us']:>7,.0f}us {rate}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
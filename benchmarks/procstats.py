@@ -0,0 +1,114 @@
+"""
+Helpers for starting a server under test and reading its resource usage
+from /proc (Linux only).
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_SCRIPTS = {
+    "client_server": os.path.join(REPO_ROOT, "Client_Server_Architecture", "server_app.py"),
+    "pubsub": os.path.join(REPO_ROOT, "Publishers_Subscribers", "server_app.py"),
+    "topic": os.path.join(REPO_ROOT, "Topic_Based_Publishers_Subscribers", "server_app.py"),
+}
+
+
+def start_server(architecture, port, extra_args=()):
+    """Starts one of the server_app.py scripts and waits until it accepts connections."""
+    process = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPTS[architecture], str(port), *extra_args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"{architecture} server did not start on port {port}")
+
+
+def stop_server(process):
+    """Stops a server started with start_server."""
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def _status_field(pid, field):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def rss_bytes(pid):
+    """Resident set size of a process in bytes."""
+    return _status_field(pid, "VmRSS") * 1024
+
+
+def thread_count(pid):
+    """Number of OS threads in a process."""
+    return _status_field(pid, "Threads")
+
+
+def cpu_seconds(pid):
+    """User plus system CPU time consumed by a process so far."""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    ticks = int(fields[11]) + int(fields[12])  # utime + stime
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def process_tree(pid):
+    """A process and all of its descendants (e.g. the workers of a sharded broker)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except OSError:
+            continue  # The process exited while we were scanning
+        children.setdefault(parent, []).append(int(entry))
+    tree = [pid]
+    for member in tree:
+        tree.extend(children.get(member, ()))
+    return tree
+
+
+def tree_rss_bytes(pid):
+    """Resident set size summed over a process tree."""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            total += rss_bytes(member)
+        except OSError:
+            pass
+    return total
+
+
+def tree_cpu_seconds(pid):
+    """CPU time summed over a process tree."""
+    total = 0.0
+    for member in process_tree(pid):
+        try:
+            total += cpu_seconds(member)
+        except OSError:
+            pass
+    return total
@@ -0,0 +1,182 @@
+"""
+Publish-side deduplication (";msg_ids=1"): the cost of the dedup cache, its
+memory cap, and what it saves when publishers resend after a reconnect.
+
+- Cache: DedupCache.seen() calls per second for unique IDs, and the memory
+  the cache really holds (tracemalloc) against its own estimate and cap,
+  after more IDs than fit under --cache-bytes.
+- Broker: --publishers publishers each send --messages messages, then
+  reconnect with the same client id and resend the last --resend share of
+  them, as a publisher does that did not know what arrived before the
+  connection dropped. --subscribers subscribers count what they get, with
+  message IDs and without; the broker's CPU time and publish rate show
+  the cost of checking every ID.
+
+Usage: python benchmarks/publish_dedup.py [--messages N] [--resend 0.3] [--json FILE]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import cpu_seconds, rss_bytes, start_server, stop_server
+from common.dedup import DedupCache
+from common.framing import FrameReader, send_frame
+from common.publisher import Publisher
+
+
+def measure_cache(ids, max_bytes, publishers=10):
+    cache = DedupCache(max_ids=ids, ttl=3600, max_bytes=max_bytes)
+    keys = [f"publisher-{index}" for index in range(publishers)]
+    message_ids = [b"%016x" % index for index in range(ids)]
+    started = time.perf_counter()
+    for index, message_id in enumerate(message_ids):
+        cache.seen(keys[index % publishers], message_id)
+    elapsed = time.perf_counter() - started
+    # Again under tracemalloc, which slows it down too much to be timed
+    cache = DedupCache(max_ids=ids, ttl=3600, max_bytes=max_bytes)
+    tracemalloc.start()
+    for index, message_id in enumerate(message_ids):
+        cache.seen(keys[index % publishers], message_id)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {
+        "ids_offered": ids,
+        "ids_kept": len(cache),
+        "seen_per_second": ids / elapsed,
+        "estimated_bytes": cache.bytes,
+        "traced_bytes": held,
+        "cap_bytes": max_bytes,
+    }
+
+
+def run_subscribers(port, subscribers, expected, ready, results):
+    selector = selectors.DefaultSelector()
+    for _ in range(subscribers):
+        sock = socket.create_connection(("127.0.0.1", port))
+        send_frame(sock, b"SUBSCRIBER:BENCH.DEDUP")
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, FrameReader(sock))
+    ready.put(True)
+    received = 0
+    idle_since = time.monotonic()
+    # With message IDs the resent messages never arrive; stop once nothing more comes
+    while received < expected and time.monotonic() - idle_since < 2:
+        for key, _ in selector.select(timeout=0.2):
+            frames = key.data.read_available()
+            if frames is None:
+                selector.unregister(key.fileobj)
+                continue
+            received += len(frames)
+            idle_since = time.monotonic()
+    results.put(received)
+
+
+def run_publisher(port, index, messages, resend, message_ids):
+    client_id = f"bench-{index}"
+    ids = [f"{index}-{number}" for number in range(messages)]
+    kwargs = {"message_ids": True, "client_id": client_id} if message_ids else {}
+
+    def send(numbers):
+        with Publisher("127.0.0.1", port, "BENCH.DEDUP", **kwargs) as publisher:
+            for number in numbers:
+                message_id = ids[number] if message_ids else None
+                publisher.publish(b"payload %d" % number, message_id=message_id)
+
+    send(range(messages))
+    send(range(messages - int(messages * resend), messages))  # After "reconnecting"
+
+
+def measure_broker(port, message_ids, args):
+    unique = args.publishers * args.messages
+    sent = args.publishers * (args.messages + int(args.messages * args.resend))
+    server = start_server(
+        "topic",
+        port,
+        ["--mode", "asyncio", "--queue-size", str(2 * unique), "--log-level", "warning"],
+    )
+    try:
+        ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+        receiver = multiprocessing.Process(
+            target=run_subscribers,
+            args=(port, args.subscribers, args.subscribers * sent, ready, results),
+        )
+        receiver.start()
+        ready.get(timeout=60)
+        time.sleep(0.3)
+        cpu_before = cpu_seconds(server.pid)
+        started = time.monotonic()
+        publishers = [
+            multiprocessing.Process(
+                target=run_publisher,
+                args=(port, index, args.messages, args.resend, message_ids),
+            )
+            for index in range(args.publishers)
+        ]
+        for publisher in publishers:
+            publisher.start()
+        for publisher in publishers:
+            publisher.join()
+        published_seconds = time.monotonic() - started
+        received = results.get(timeout=180)
+        receiver.join()
+        broker_cpu = cpu_seconds(server.pid) - cpu_before
+        broker_rss = rss_bytes(server.pid)
+    finally:
+        stop_server(server)
+    return {
+        "message_ids": message_ids,
+        "published": sent,
+        "publish_rate": sent / published_seconds,
+        "delivered_per_subscriber": received / args.subscribers,
+        "unique_messages": unique,
+        "broker_cpu_seconds": broker_cpu,
+        "broker_rss_bytes": broker_rss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cache-ids", type=int, default=1_000_000, help="IDs offered to the cache")
+    parser.add_argument("--cache-bytes", type=int, default=64 * 1024 * 1024, help="Cache memory cap")
+    parser.add_argument("--publishers", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=50_000, help="Messages per publisher")
+    parser.add_argument("--resend", type=float, default=0.3, help="Share resent after reconnecting")
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--port", type=int, default=6100)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    cache = measure_cache(args.cache_ids, args.cache_bytes)
+    print(
+        f"Cache: {cache['seen_per_second']:,.0f} seen()/s, {cache['ids_kept']:,} of "
+        f"{cache['ids_offered']:,} IDs kept, estimate {cache['estimated_bytes'] / 2**20:.1f} MB, "
+        f"traced {cache['traced_bytes'] / 2**20:.1f} MB, cap {cache['cap_bytes'] / 2**20:.1f} MB"
+    )
+
+    results = {"cache": cache, "broker": []}
+    print(f"{'message IDs':>11} {'published':>10} {'msg/s':>9} {'per subscriber':>15} {'broker CPU':>10}")
+    for index, message_ids in enumerate((False, True)):
+        result = measure_broker(args.port + index, message_ids, args)
+        results["broker"].append(result)
+        print(
+            f"{'yes' if message_ids else 'no':>11} {result['published']:>10,} "
+            f"{result['publish_rate']:>9,.0f} {result['delivered_per_subscriber']:>15,.0f} "
+            f"{result['broker_cpu_seconds']:>9.2f}s"
+        )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Compares one frame per message with Publisher batching, end to end through
+the topic-based server: a publisher sends N small messages and a
+subscriber on the same topic counts them as they arrive.
+
+Reports messages per second at the publisher (time to hand every message
+to the socket), end to end (until the subscriber has all of them), and
+how many sendall() calls the publisher made.
+The server logs every message it routes, so end-to-end numbers are bound
+by that logging rather than by the wire protocol.
+
+Usage: python benchmarks/publisher_batching.py [--messages N] [--payload-size BYTES]
+                                               [--mode threaded|asyncio] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import start_server, stop_server
+from common.framing import FrameReader, send_frame
+from common.publisher import Publisher
+
+TOPIC = "BENCH"
+
+
+def publish_unbatched(port, contents):
+    """The interactive client's way: one frame and one sendall() per message."""
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    send_frame(sock, f"PUBLISHER:{TOPIC}".encode("utf-8"))
+    prefix = f"{TOPIC}:".encode("utf-8")
+    for content in contents:
+        send_frame(sock, prefix + content)
+    send_frame(sock, b"terminate")
+    sock.close()
+    return len(contents)
+
+
+def publish_batched(port, contents, batch_size):
+    """Publisher batching: messages leave in batch frames of up to batch_size bytes."""
+    with Publisher("127.0.0.1", port, TOPIC, batch_size=batch_size) as publisher:
+        for content in contents:
+            publisher.publish(content)
+    return publisher.sent_batches
+
+
+def run(port, contents, publish):
+    """Returns (publisher seconds, end-to-end seconds, sendall calls) for one run."""
+    subscriber = socket.create_connection(("127.0.0.1", port))
+    send_frame(subscriber, f"SUBSCRIBER:{TOPIC}".encode("utf-8"))
+    time.sleep(0.2)  # Let the server register the subscription
+
+    received = threading.Event()
+
+    def count_messages():
+        reader = FrameReader(subscriber)
+        count = 0
+        while count < len(contents):
+            frames = reader.read_frames()
+            if not frames:
+                break
+            count += len(frames)
+        received.set()
+
+    threading.Thread(target=count_messages, daemon=True).start()
+    start = time.perf_counter()
+    sends = publish(port, contents)
+    published = time.perf_counter() - start
+    if not received.wait(timeout=300):
+        raise RuntimeError("Subscriber did not receive every message")
+    delivered = time.perf_counter() - start
+    subscriber.close()
+    return published, delivered, sends
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=64 * 1024)
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--port", type=int, default=5600)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    contents = [b"x" * args.payload_size] * args.messages
+    strategies = {
+        "unbatched": publish_unbatched,
+        "batched": lambda port, items: publish_batched(port, items, args.batch_size),
+    }
+    # Queues sized so no message is dropped while the subscriber catches up
+    server = start_server(
+        "topic", args.port, ["--mode", args.mode, "--queue-size", str(args.messages)]
+    )
+    results = []
+    try:
+        print(f"{'strategy':>10} {'publish msg/s':>14} {'end-to-end msg/s':>17} {'sendall calls':>14}")
+        for name, publish in strategies.items():
+            published, delivered, sends = run(args.port, contents, publish)
+            results.append(
+                {
+                    "strategy": name,
+                    "messages": args.messages,
+                    "payload_size": args.payload_size,
+                    "publish_msgs_per_second": args.messages / published,
+                    "end_to_end_msgs_per_second": args.messages / delivered,
+                    "sendall_calls": sends,
+                }
+            )
+            print(
+                f"{name:>10} {args.messages / published:>14,.0f}"
+                f" {args.messages / delivered:>17,.0f} {sends:>14,}"
+            )
+    finally:
+        stop_server(server)
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+RPC calls/s of the Client-Server server's selectors mode, one call at a time
+against many in flight on one connection and over a connection pool, and
+the latency of quick calls while CPU-heavy ones run inline or in the
+process pool.
+
+Usage: python benchmarks/rpc_throughput.py [--calls N] [--in-flight K] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import start_server, stop_server
+from common.rpc import RpcConnection, RpcPool
+
+
+def calls_per_second(call, calls, in_flight):
+    """Makes `calls` echo calls with at most `in_flight` outstanding."""
+    start = time.perf_counter()
+    window = []
+    for index in range(calls):
+        window.append(call("echo", b"%d" % index))
+        if len(window) >= in_flight:
+            for future in window:
+                future.result()
+            window.clear()
+    for future in window:
+        future.result()
+    return calls / (time.perf_counter() - start)
+
+
+def latency_under_load(port, heavy_calls, limit, samples):
+    """
+    Median and worst latency (seconds) of echo calls made while `heavy_calls`
+    primes calls run, and the seconds until the heavy calls finished.
+    """
+    with RpcConnection("127.0.0.1", port) as heavy, RpcConnection("127.0.0.1", port) as quick:
+        start = time.perf_counter()
+        pending = [heavy.call("primes", b"%d" % limit) for _ in range(heavy_calls)]
+        latencies = []
+        while len(latencies) < samples and not all(future.done() for future in pending):
+            sent = time.perf_counter()
+            quick.call("echo", b"ping").result()
+            latencies.append(time.perf_counter() - sent)
+            time.sleep(0.005)
+        for future in pending:
+            future.result()
+        return statistics.median(latencies), max(latencies), time.perf_counter() - start
+
+
+def measure(port, workers, args):
+    server = start_server(
+        "client_server",
+        port,
+        ["--mode", "selectors", "--rpc-workers", str(workers), "--log-level", "warning"],
+    )
+    try:
+        result = {"rpc_workers": workers}
+        with RpcConnection("127.0.0.1", port) as rpc:
+            rpc.call("primes", b"10").result()  # Starts the process pool, if any
+            result["sequential_calls_per_second"] = calls_per_second(rpc.call, args.calls, 1)
+            result["multiplexed_calls_per_second"] = calls_per_second(
+                rpc.call, args.calls, args.in_flight
+            )
+        with RpcPool("127.0.0.1", port, size=args.pool_size) as pool:
+            result["pooled_calls_per_second"] = calls_per_second(pool.call, args.calls, args.in_flight)
+        median, worst, heavy_seconds = latency_under_load(
+            port, args.heavy_calls, args.primes_limit, args.samples
+        )
+        result.update(
+            echo_median_latency_ms=median * 1e3,
+            echo_worst_latency_ms=worst * 1e3,
+            heavy_calls_seconds=heavy_seconds,
+        )
+        return result
+    finally:
+        stop_server(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--in-flight", type=int, default=256, help="Calls outstanding at once")
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--heavy-calls", type=int, default=8, help="CPU-heavy calls in the latency test")
+    parser.add_argument("--primes-limit", type=int, default=2_000_000)
+    parser.add_argument("--samples", type=int, default=200, help="Echo calls timed under load")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2], help="--rpc-workers values")
+    parser.add_argument("--port", type=int, default=5660)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    port = args.port
+    for workers in args.workers:
+        result = measure(port, workers, args)
+        port += 1  # Avoid waiting for TIME_WAIT sockets of the previous run
+        results.append(result)
+        print(
+            f"rpc-workers {workers}: {result['sequential_calls_per_second']:7.0f} calls/s one at a time, "
+            f"{result['multiplexed_calls_per_second']:7.0f} with {args.in_flight} in flight, "
+            f"{result['pooled_calls_per_second']:7.0f} over {args.pool_size} connections; "
+            f"echo during {args.heavy_calls} primes calls: median "
+            f"{result['echo_median_latency_ms']:.1f} ms, worst {result['echo_worst_latency_ms']:.1f} ms"
+        )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
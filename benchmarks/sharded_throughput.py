@@ -0,0 +1,125 @@
+"""
+Measures how the topic-based broker's throughput scales with --workers.
+
+For each worker count, one client process per topic runs a subscriber and
+a batching Publisher on its own topic; the kernel spreads their connections
+across the workers, so publishes also travel between workers when the
+subscriber, the publisher and the topic's owner are on different ones.
+Reports messages delivered per second, summed over all topics.
+
+Usage: python benchmarks/sharded_throughput.py [--workers 1,2,4] [--topics N]
+                                               [--messages N] [--json FILE]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.procstats import start_server, stop_server
+from common.framing import FrameReader, send_frame
+from common.publisher import Publisher
+
+
+def run_topic(port, topic, messages, payload_size, results):
+    """Publishes `messages` on one topic and times until its subscriber has them all."""
+    subscriber = socket.create_connection(("127.0.0.1", port))
+    send_frame(subscriber, f"SUBSCRIBER:{topic}".encode("utf-8"))
+    time.sleep(0.5)  # Let the subscription reach the topic's owner
+    content = b"x" * payload_size
+
+    start = time.perf_counter()
+    publisher = Publisher("127.0.0.1", port, topic)
+    reader = FrameReader(subscriber)
+    received = 0
+    for _ in range(messages):
+        publisher.publish(content)
+    publisher.flush()
+    subscriber.settimeout(30)
+    while received < messages:
+        frames = reader.read_frames()
+        if not frames:
+            break
+        received += len(frames)
+    elapsed = time.perf_counter() - start
+    publisher.close()
+    subscriber.close()
+    results.put((received, elapsed))
+
+
+def measure(port, workers, args):
+    server = start_server(
+        "topic",
+        port,
+        ["--mode", "asyncio", "--workers", str(workers), "--queue-size", str(args.messages)],
+    )
+    try:
+        time.sleep(0.5)  # start_server returns once one worker accepts; let the rest start
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(
+                target=run_topic,
+                args=(port, f"BENCH.T{index}", args.messages, args.payload_size, results),
+            )
+            for index in range(args.topics)
+        ]
+        for client in clients:
+            client.start()
+        outcomes = [results.get(timeout=120) for _ in clients]
+        for client in clients:
+            client.join()
+    finally:
+        stop_server(server)
+    delivered = sum(received for received, _ in outcomes)
+    elapsed = max(seconds for _, seconds in outcomes)
+    return delivered, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--workers",
+        default=",".join(str(2**i) for i in range(8) if 2**i <= max(2, os.cpu_count())),
+        help="Comma-separated worker counts (default: powers of two up to the core count)",
+    )
+    parser.add_argument("--topics", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=20000, help="Messages per topic")
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--port", type=int, default=5700)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{os.cpu_count()} CPU core(s)")
+    print(f"{'workers':>7} {'delivered':>10} {'seconds':>8} {'msg/s':>10} {'speedup':>8}")
+    baseline = None
+    for index, workers in enumerate(int(count) for count in args.workers.split(",")):
+        delivered, elapsed = measure(args.port + index, workers, args)
+        rate = delivered / elapsed
+        baseline = baseline or rate
+        results.append(
+            {
+                "workers": workers,
+                "topics": args.topics,
+                "delivered": delivered,
+                "seconds": elapsed,
+                "msgs_per_second": rate,
+                "speedup": rate / baseline,
+            }
+        )
+        print(
+            f"{workers:>7} {delivered:>10,} {elapsed:>8.2f} {rate:>10,.0f} {rate / baseline:>7.2f}x"
+        )
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
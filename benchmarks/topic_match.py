@@ -0,0 +1,119 @@
+"""
+Match throughput of the topic trie with 100k subscriptions, compared with a
+linear scan that tests every subscription pattern on each publish.
+
+Usage: python benchmarks/topic_match.py [--subscriptions N] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.topic_trie import TopicTrie
+
+REGIONS, CATEGORIES, ITEMS = 50, 40, 50  # 100k distinct three-level topics
+
+
+def random_topic(rng):
+    return (
+        f"R{rng.randrange(REGIONS)}.C{rng.randrange(CATEGORIES)}.I{rng.randrange(ITEMS)}"
+    )
+
+
+def build_subscriptions(count, wildcard_share, rng):
+    """Exact topics plus a share of '*' and '#' patterns, one subscriber id each."""
+    subscriptions = []
+    for subscriber in range(count):
+        roll = rng.random()
+        if roll < wildcard_share / 2:
+            pattern = f"R{rng.randrange(REGIONS)}.*.I{rng.randrange(ITEMS)}"
+        elif roll < wildcard_share:
+            pattern = f"R{rng.randrange(REGIONS)}.C{rng.randrange(CATEGORIES)}.#"
+        else:
+            pattern = random_topic(rng)
+        subscriptions.append((pattern, subscriber))
+    return subscriptions
+
+
+def linear_match(subscriptions, topic):
+    """Baseline: test every pattern against the topic."""
+    levels = topic.split(".")
+    matched = set()
+    for pattern, subscriber in subscriptions:
+        pattern_levels = pattern.split(".")
+        if pattern_levels[-1] == "#":
+            prefix = pattern_levels[:-1]
+            if len(levels) >= len(prefix) and all(
+                p in ("*", level) for p, level in zip(prefix, levels)
+            ):
+                matched.add(subscriber)
+        elif len(pattern_levels) == len(levels) and all(
+            p in ("*", level) for p, level in zip(pattern_levels, levels)
+        ):
+            matched.add(subscriber)
+    return matched
+
+
+def measure(match, topics, min_seconds):
+    """Returns (matches per second, average recipients per match)."""
+    done = recipients = 0
+    start = time.perf_counter()
+    while True:
+        for topic in topics:
+            recipients += len(match(topic))
+            done += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return done / elapsed, recipients / done
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subscriptions", type=int, default=100_000)
+    parser.add_argument("--wildcard-share", type=float, default=0.1)
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    subscriptions = build_subscriptions(args.subscriptions, args.wildcard_share, rng)
+    topics = [random_topic(rng) for _ in range(1000)]
+
+    trie = TopicTrie()
+    start = time.perf_counter()
+    for pattern, subscriber in subscriptions:
+        trie.add(pattern, subscriber)
+    build_seconds = time.perf_counter() - start
+
+    trie_rate, trie_recipients = measure(trie.match, topics, args.seconds)
+    linear_rate, linear_recipients = measure(
+        lambda topic: linear_match(subscriptions, topic), topics[:20], args.seconds
+    )
+
+    results = {
+        "subscriptions": args.subscriptions,
+        "wildcard_share": args.wildcard_share,
+        "trie_build_seconds": build_seconds,
+        "trie_matches_per_second": trie_rate,
+        "linear_matches_per_second": linear_rate,
+        "average_recipients": trie_recipients,
+        "speedup": trie_rate / linear_rate,
+    }
+    print(f"{args.subscriptions} subscriptions ({args.wildcard_share:.0%} wildcard)")
+    print(f"  trie build:   {build_seconds:.2f} s")
+    print(f"  trie match:   {trie_rate:,.0f} matches/s ({trie_recipients:.1f} recipients avg)")
+    print(f"  linear scan:  {linear_rate:,.1f} matches/s ({linear_recipients:.1f} recipients avg)")
+    print(f"  speedup:      {results['speedup']:,.0f}x")
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+"""
+Shared building blocks for the Client-Server, Publishers/Subscribers and
+Topic-Based Publishers/Subscribers applications.
+"""
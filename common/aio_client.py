@@ -0,0 +1,468 @@
+"""
+asyncio client library for the topic-based server, for applications that
+publish and subscribe without the interactive client_app.py.
+
+    async with AsyncClient("127.0.0.1", 5000) as client:
+        await client.publish("NEWS", b"hello")
+        async with client.subscribe("SPORTS.*", "NEWS") as subscription:
+            async for message in subscription:
+                print(message.topic, message.payload)
+
+For a server on the same host, `host` may be "unix:/path" (see
+common/transport.py); the port is then ignored.
+
+Every publish goes over one publisher connection. Subscriptions share
+`subscriber_connections` subscriber connections, chosen by the hash of a
+subscription's first pattern. On a connection, a pattern is subscribed on
+the server once, however many subscriptions use it, and messages are
+dispatched to the subscriptions locally with a TopicTrie. Thousands of
+subscriptions therefore cost the server thousands of patterns on one or a
+few connections, not thousands of connections. SUBSCRIBE and UNSUBSCRIBE commands made in the
+same event-loop iteration go out as one frame.
+
+A lost connection is re-established in the background with exponential
+backoff and full jitter. A subscriber connection comes back with all of its
+patterns. publish() waits while the publisher is disconnected.
+
+Flow control:
+
+- publish() awaits the transport's drain(), so a server that stops reading
+  slows the publisher down instead of filling its memory.
+- With qos=1 (see common/qos.py), at most max_unacked messages are
+  unacknowledged. Those are sent again after a reconnect.
+- Each subscription buffers at most queue_size messages. While one is full,
+  its connection stops reading, and the server's per-subscriber queue and
+  overflow policy take over. A slow subscription therefore holds up the
+  others on its connection, never the publishers.
+"""
+
+import asyncio
+import random
+import zlib
+from collections import deque
+from typing import NamedTuple
+
+from common.framing import AsyncFrameReader, encode_frame
+from common.heartbeat import HEARTBEAT_OPTION, drop_pongs, ping_frame
+from common.qos import (
+    CLIENT_ID_OPTION,
+    DEFAULT_MAX_UNACKED,
+    QOS_OPTION,
+    QosReceiver,
+    parse_puback,
+)
+from common.topic_trie import TopicTrie, validate_pattern, validate_topic
+from common.transport import open_connection
+
+DEFAULT_SUBSCRIPTION_QUEUE = 1024  # Messages buffered per subscription
+DEFAULT_SUBSCRIBER_CONNECTIONS = 1
+INITIAL_BACKOFF = 0.1  # Seconds before the first reconnect attempt
+MAX_BACKOFF = 10.0  # Longest wait between reconnect attempts
+PUBLISHED_PREFIX = b"[PUBLISHED - "
+
+
+class Message(NamedTuple):
+    topic: str
+    payload: bytes
+
+
+def parse_delivery(data):
+    """Splits a delivered b"[PUBLISHED - TOPIC] content" frame, or returns None."""
+    if not data.startswith(PUBLISHED_PREFIX):
+        return None
+    topic, separator, payload = data[len(PUBLISHED_PREFIX) :].partition(b"] ")
+    if not separator:
+        return None
+    return Message(topic.decode("utf-8"), payload)
+
+
+def backoff_delays(initial=INITIAL_BACKOFF, maximum=MAX_BACKOFF):
+    """Reconnect delays: exponential backoff with full jitter, capped at `maximum`."""
+    ceiling = initial
+    while True:
+        yield random.uniform(0, ceiling)
+        ceiling = min(maximum, ceiling * 2)
+
+
+class Subscription:
+    """
+    Messages (topic, payload) of the topics matching some patterns, as an
+    async iterator. Iteration ends once the subscription is closed.
+    """
+
+    def __init__(self, link, patterns, queue_size):
+        self.patterns = patterns
+        self.closed = False
+        self._link = link
+        self._queue = asyncio.Queue(queue_size)
+        self._getters = set()  # Reads waiting for a message, cancelled by close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        if not self._queue.empty():
+            return self._queue.get_nowait()
+        # close() cancels the read instead of queueing a marker, which could take the
+        # slot a full subscription's connection is waiting for
+        getter = asyncio.ensure_future(self._queue.get())
+        self._getters.add(getter)
+        try:
+            return await getter
+        except asyncio.CancelledError:
+            if self.closed:
+                raise StopAsyncIteration from None
+            raise
+        finally:
+            self._getters.discard(getter)
+
+    async def get(self):
+        """The next message. Raises StopAsyncIteration once closed."""
+        return await self.__anext__()
+
+    def close(self):
+        """Unsubscribes and ends the iteration; messages not read yet are discarded."""
+        if self.closed:
+            return
+        self.closed = True
+        self._link.remove(self)
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        for getter in self._getters:
+            getter.cancel()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class _Link:
+    """One connection to the server, re-established with backoff whenever it is lost."""
+
+    def __init__(self, client):
+        self.client = client
+        self.connected = asyncio.Event()
+        self.reconnects = 0
+        self.writer = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def wait_until_needed(self):
+        """Returns once there is a reason to (re)connect."""
+
+    def handshake(self):
+        raise NotImplementedError
+
+    def on_connected(self, writer):
+        """
+        Called right after the handshake is written, before anything else
+        can use the connection; must not await, so nothing slips in between.
+        """
+
+    async def on_frames(self, frames):
+        raise NotImplementedError
+
+    def options(self):
+        options = ""
+        if self.client.qos:
+            options += f";{QOS_OPTION}=1"
+        if self.client.heartbeat:
+            options += f";{HEARTBEAT_OPTION}={self.client.heartbeat:g}"
+        return options
+
+    async def _run(self):
+        delays = backoff_delays(self.client.initial_backoff, self.client.max_backoff)
+        while True:
+            await self.wait_until_needed()
+            try:
+                reader, writer = await open_connection(self.client.host, self.client.port)
+            except OSError:
+                await asyncio.sleep(next(delays))
+                continue
+            heartbeat = None
+            try:
+                writer.write(encode_frame(self.handshake().encode("utf-8")))
+                self.writer = writer
+                self.on_connected(writer)
+                self.connected.set()
+                await writer.drain()
+                delays = backoff_delays(self.client.initial_backoff, self.client.max_backoff)
+                if self.client.heartbeat:
+                    heartbeat = asyncio.get_running_loop().create_task(self._ping(writer))
+                frames_reader = AsyncFrameReader(reader)
+                while True:
+                    frames = await frames_reader.read_frames()
+                    if not frames:
+                        break  # The server closed the connection
+                    await self.on_frames(drop_pongs(frames))
+            except (OSError, ValueError):
+                pass
+            finally:
+                self.connected.clear()
+                self.writer = None
+                if heartbeat is not None:
+                    heartbeat.cancel()
+                writer.close()
+            self.reconnects += 1
+            await asyncio.sleep(next(delays))
+
+    async def _ping(self, writer):
+        frame = ping_frame()
+        while True:
+            await asyncio.sleep(self.client.heartbeat)
+            writer.write(frame)
+
+
+class _PublisherLink(_Link):
+    def __init__(self, client, topic):
+        super().__init__(client)
+        self.topic = topic  # Only named in the handshake; publishes carry their own
+        self._unacked = deque()  # Frames sent but not acknowledged (QoS 1)
+        self._acked = 0  # Frames acknowledged on the current connection
+        self._window = asyncio.Condition()
+
+    def handshake(self):
+        return f"PUBLISHER:{self.topic}" + self.options()
+
+    async def publish(self, frame):
+        if self.client.qos:
+            async with self._window:
+                await self._window.wait_for(lambda: len(self._unacked) < self.client.max_unacked)
+                # Written now if connected, otherwise with the others on the next connection,
+                # never both: the server's PUBACK counts must line up with _unacked
+                self._unacked.append(frame)
+                writer = self.writer if self.connected.is_set() else None
+                if writer is None:
+                    return  # Sent by on_connected() once reconnected
+                writer.write(frame)
+        else:
+            writer = None
+            while writer is None:  # The connection may be lost again before we get to write
+                await self.connected.wait()
+                writer = self.writer
+            writer.write(frame)
+        try:
+            await writer.drain()
+        except OSError:
+            pass  # Lost with the connection: QoS 1 resends it, QoS 0 gives no guarantee
+
+    async def flush(self):
+        """Waits until every QoS-1 message was acknowledged."""
+        async with self._window:
+            await self._window.wait_for(lambda: not self._unacked)
+
+    def on_connected(self, writer):
+        self._acked = 0
+        if self._unacked:
+            writer.writelines(list(self._unacked))
+
+    async def on_frames(self, frames):
+        for data in frames:
+            try:
+                count = parse_puback(data)
+            except ValueError:
+                continue
+            async with self._window:
+                for _ in range(min(count - self._acked, len(self._unacked))):
+                    self._unacked.popleft()
+                self._acked = max(self._acked, count)
+                self._window.notify_all()
+
+
+class _SubscriberLink(_Link):
+    def __init__(self, client, index):
+        super().__init__(client)
+        self.index = index
+        self.messages = 0
+        self.subscriptions = set()
+        self._trie = TopicTrie()  # pattern -> Subscriptions, for local dispatch
+        self._users = {}  # pattern -> number of subscriptions using it
+        self._pending = {}  # pattern -> "SUBSCRIBE" / "UNSUBSCRIBE" not sent yet
+        self._flush_scheduled = False
+        self._needed = asyncio.Event()  # Set while there is a pattern to subscribe to
+        self._qos = None
+
+    def handshake(self):
+        options = self.options()
+        if self.client.client_id:
+            options += f";{CLIENT_ID_OPTION}={self.client.client_id}-{self.index}"
+        return f"SUBSCRIBER:{','.join(self._users)}" + options
+
+    async def wait_until_needed(self):
+        await self._needed.wait()
+
+    def add(self, subscription):
+        self.subscriptions.add(subscription)
+        self._needed.set()
+        for pattern in subscription.patterns:
+            self._trie.add(pattern, subscription)
+            self._users[pattern] = self._users.get(pattern, 0) + 1
+            if self._users[pattern] == 1:
+                self._command(pattern, "SUBSCRIBE")
+        self.start()
+
+    def remove(self, subscription):
+        self.subscriptions.discard(subscription)
+        for pattern in subscription.patterns:
+            self._trie.remove(pattern, subscription)
+            self._users[pattern] -= 1
+            if not self._users[pattern]:
+                del self._users[pattern]
+                self._command(pattern, "UNSUBSCRIBE")
+        if not self._users:
+            self._needed.clear()  # Stay connected, but do not reconnect without patterns
+
+    def on_connected(self, writer):
+        self._pending.clear()  # The handshake named every current pattern
+        if self.client.qos and (self._qos is None or not self.client.client_id):
+            # A named session resumes its numbering; an anonymous one starts over
+            self._qos = QosReceiver()
+
+    async def on_frames(self, frames):
+        for data in frames:
+            if self._qos is not None and not self._qos.accept(data):
+                continue  # A sequence marker or a redelivered duplicate
+            message = parse_delivery(data)
+            if message is None:
+                continue
+            self.messages += 1
+            for subscription in self._trie.match(message.topic):
+                if not subscription.closed:
+                    # Waits while the subscription is full: backpressure to the server
+                    await subscription._queue.put(message)
+        ack = self._qos.ack() if self._qos is not None else None
+        if ack and self.writer is not None:
+            self.writer.write(ack)
+
+    def _command(self, pattern, command):
+        if not self.connected.is_set():
+            self._pending.clear()  # The next handshake names the current patterns
+            return
+        self._pending[pattern] = command
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush_commands)
+
+    def _flush_commands(self):
+        self._flush_scheduled = False
+        pending, self._pending = self._pending, {}
+        if self.writer is None:
+            return
+        for command in ("SUBSCRIBE", "UNSUBSCRIBE"):
+            patterns = [pattern for pattern, wanted in pending.items() if wanted == command]
+            if patterns:
+                self.writer.write(encode_frame(f"{command}:{','.join(patterns)}".encode("utf-8")))
+
+
+class AsyncClient:
+    """
+    Publishes and subscribes on the topic-based server from asyncio code.
+    Connections are opened lazily: the publisher connection on the first
+    publish(), subscriber connections with the first subscriptions on them.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        subscriber_connections=DEFAULT_SUBSCRIBER_CONNECTIONS,
+        queue_size=DEFAULT_SUBSCRIPTION_QUEUE,
+        qos=0,
+        max_unacked=DEFAULT_MAX_UNACKED,
+        client_id=None,
+        heartbeat=None,
+        initial_backoff=INITIAL_BACKOFF,
+        max_backoff=MAX_BACKOFF,
+    ):
+        if subscriber_connections < 1:
+            raise ValueError("At least one subscriber connection is needed.")
+        if qos not in (0, 1):
+            raise ValueError(f"Unsupported QoS level '{qos}'.")
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.qos = qos
+        self.max_unacked = max_unacked
+        self.client_id = client_id
+        self.heartbeat = heartbeat
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._publisher = None
+        self._subscribers = [_SubscriberLink(self, index) for index in range(subscriber_connections)]
+
+    async def publish(self, topic, payload):
+        """
+        Publishes one message (bytes, or str sent as UTF-8). Returns once it
+        is written, waiting while disconnected or while the server is not
+        keeping up; with qos=1 also while max_unacked are unacknowledged.
+        """
+        topic = topic.upper()
+        validate_topic(topic)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if self._publisher is None:
+            self._publisher = _PublisherLink(self, topic)
+            self._publisher.start()
+        await self._publisher.publish(encode_frame(topic.encode("utf-8") + b":" + payload))
+
+    async def flush(self):
+        """With qos=1, waits until the server acknowledged every publish."""
+        if self._publisher is not None and self.qos:
+            await self._publisher.flush()
+
+    def subscribe(self, *patterns, queue_size=None):
+        """
+        Subscribes to topic patterns (e.g. "NEWS", "SPORTS.*", "SPORTS.#")
+        and returns the Subscription to iterate over. Raises ValueError for
+        a malformed pattern.
+        """
+        patterns = tuple(dict.fromkeys(pattern.strip().upper() for pattern in patterns))
+        if not patterns:
+            raise ValueError("Subscribe to at least one pattern.")
+        for pattern in patterns:
+            validate_pattern(pattern)
+        link = self._subscribers[zlib.crc32(patterns[0].encode("utf-8")) % len(self._subscribers)]
+        subscription = Subscription(link, patterns, queue_size or self.queue_size)
+        link.add(subscription)
+        return subscription
+
+    def stats(self):
+        """Reconnects and messages received so far, per connection."""
+        stats = {
+            f"subscriber_{link.index}": {"reconnects": link.reconnects, "messages": link.messages}
+            for link in self._subscribers
+        }
+        if self._publisher is not None:
+            stats["publisher"] = {"reconnects": self._publisher.reconnects}
+        return stats
+
+    async def close(self):
+        """Closes every subscription and connection; pending QoS-1 publishes are abandoned."""
+        for link in self._subscribers:
+            for subscription in list(link.subscriptions):
+                subscription.close()
+            await link.close()
+        if self._publisher is not None:
+            await self._publisher.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
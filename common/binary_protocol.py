@@ -0,0 +1,224 @@
+"""
+Binary wire protocol of the topic-based server, with interned topic ids.
+
+A client opts in with the ";proto=binary" handshake option, e.g.
+"PUBLISHER:NEWS;proto=binary". The handshake itself stays text; every frame
+after it starts with a one-byte opcode:
+
+    REGISTER     opcode, topic id (!I), topic name (UTF-8)
+    PUBLISH      opcode, topic id (!I), payload (raw bytes)
+    PUBLISH_COMPRESSED
+                 opcode, topic id (!I), codec (!B), compressed payload
+    SUBSCRIBE    opcode, comma-separated patterns (UTF-8)
+    UNSUBSCRIBE  opcode, comma-separated patterns (UTF-8)
+    TERMINATE    opcode
+    ACK          opcode, sequence number (!Q)
+    SEQ          opcode, sequence number (!Q)
+    PING         opcode
+    PONG         opcode
+
+Ids are per direction. A publisher REGISTERs a topic under an id of its
+choosing once, then PUBLISHes with only that id. The server interns every
+topic under a server-wide id and REGISTERs it to each binary subscriber
+before the first delivery on it; deliveries are PUBLISH frames, which are
+encoded once per message and shared by every binary subscriber. The
+payload is never decoded on the way through.
+
+PUBLISH_COMPRESSED is only sent to, and accepted from, clients that listed
+the codec in a ";compress=" handshake option (see common/compression.py),
+ACK / SEQ only on QoS-1 connections (see common/qos.py), and PING / PONG
+only on connections with heartbeats (see common/heartbeat.py).
+"""
+
+import struct
+import threading
+
+from common.compression import CODEC_IDS, CODEC_NAMES, decompress
+from common.framing import encode_frame
+
+OP_TERMINATE = 0
+OP_REGISTER = 1
+OP_PUBLISH = 2
+OP_SUBSCRIBE = 3
+OP_UNSUBSCRIBE = 4
+OP_PUBLISH_COMPRESSED = 5
+OP_ACK = 6
+OP_SEQ = 7
+OP_PING = 8
+OP_PONG = 9
+
+OPCODE = struct.Struct("!B")
+TOPIC_HEADER = struct.Struct("!BI")  # Opcode, topic id
+COMPRESSED_HEADER = struct.Struct("!BIB")  # Opcode, topic id, codec
+SEQUENCE = struct.Struct("!BQ")  # Opcode, sequence number (ACK and SEQ)
+MAX_TOPIC_ID = 0xFFFFFFFF
+
+TEXT = "text"
+BINARY = "binary"
+PROTOCOLS = (TEXT, BINARY)
+PROTOCOL_OPTION = "proto"  # Handshake option naming the protocol
+
+
+def protocol_from_options(options):
+    """Reads the ";proto=" handshake option. Raises ValueError for an unknown protocol."""
+    protocol = options.get(PROTOCOL_OPTION, TEXT).lower()
+    if protocol not in PROTOCOLS:
+        raise ValueError(f"Unknown protocol '{protocol}'.")
+    return protocol
+
+
+def encode_register(topic_id, topic):
+    return encode_frame(TOPIC_HEADER.pack(OP_REGISTER, topic_id) + topic.encode("utf-8"))
+
+
+def encode_publish(topic_id, payload):
+    return encode_frame(TOPIC_HEADER.pack(OP_PUBLISH, topic_id) + payload)
+
+
+def encode_publish_compressed(topic_id, codec, compressed):
+    """Frames a payload compressed with `codec` (a name from common.compression)."""
+    header = COMPRESSED_HEADER.pack(OP_PUBLISH_COMPRESSED, topic_id, CODEC_IDS[codec])
+    return encode_frame(header + compressed)
+
+
+def split_compressed(body):
+    """
+    Splits the body decode() returns for PUBLISH_COMPRESSED into (codec name,
+    compressed payload). Raises ValueError for an unknown codec.
+    """
+    if not body:
+        raise ValueError("Truncated binary frame.")
+    codec = CODEC_NAMES.get(body[0])
+    if codec is None:
+        raise ValueError(f"Unknown compression codec id {body[0]}.")
+    return codec, body[1:]
+
+
+def encode_command(opcode, text=""):
+    """Frames a SUBSCRIBE, UNSUBSCRIBE, TERMINATE, PING or PONG command."""
+    return encode_frame(OPCODE.pack(opcode) + text.encode("utf-8"))
+
+
+def encode_sequence(opcode, seq):
+    """Frames an ACK or SEQ with its sequence number."""
+    return encode_frame(SEQUENCE.pack(opcode, seq))
+
+
+def decode_sequence(data):
+    """Returns the sequence number of an ACK or SEQ frame. Raises ValueError if truncated."""
+    if len(data) != SEQUENCE.size:
+        raise ValueError("Truncated binary frame.")
+    return SEQUENCE.unpack(data)[1]
+
+
+def decode(data):
+    """
+    Splits a binary frame into (opcode, topic id, body). The topic id is None
+    for opcodes without one. Raises ValueError for an empty or truncated frame.
+    """
+    if not data:
+        raise ValueError("Empty binary frame.")
+    opcode = data[0]
+    if opcode in (OP_REGISTER, OP_PUBLISH, OP_PUBLISH_COMPRESSED):
+        if len(data) < TOPIC_HEADER.size:
+            raise ValueError("Truncated binary frame.")
+        _, topic_id = TOPIC_HEADER.unpack_from(data)
+        return opcode, topic_id, data[TOPIC_HEADER.size :]
+    return opcode, None, data[1:]
+
+
+class TopicTable:
+    """Server-wide interning of topic names to small integer ids. Thread-safe."""
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+        self._lock = threading.Lock()
+
+    def id_for(self, topic):
+        topic_id = self._ids.get(topic)
+        if topic_id is None:
+            with self._lock:
+                topic_id = self._ids.get(topic)
+                if topic_id is None:
+                    topic_id = len(self._names)
+                    if topic_id > MAX_TOPIC_ID:
+                        raise ValueError("Too many topics for the binary protocol.")
+                    self._names.append(topic)
+                    self._ids[topic] = topic_id
+        return topic_id
+
+    def name_of(self, topic_id):
+        return self._names[topic_id]
+
+
+class BinarySession:
+    """
+    The topic ids one binary subscriber has been told about, and the codecs
+    it accepts compressed payloads in. send_many() puts a REGISTER frame in
+    front of the first delivery on each topic; the lock keeps that REGISTER
+    ahead of deliveries queued by other threads.
+    """
+
+    def __init__(self, table, codecs=frozenset()):
+        self.table = table
+        self.codecs = codecs
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def send_many(self, writer, deliveries):
+        """
+        Queues (topic id, PUBLISH frame) deliveries on a subscriber writer;
+        a frame with topic id None (e.g. a SEQ) is queued as it is.
+        """
+        with self._lock:
+            frames = []
+            for topic_id, frame in deliveries:
+                if topic_id is not None and topic_id not in self._known:
+                    self._known.add(topic_id)
+                    frames.append(encode_register(topic_id, self.table.name_of(topic_id)))
+                frames.append(frame)
+            return writer.send_many(frames)
+
+
+class TopicAliases:
+    """
+    The other side of a connection's ids: the topics a client registered
+    (on the server), or the topics the server registered (on a subscriber).
+    """
+
+    def __init__(self):
+        self._topics = {}  # id -> topic
+        self._ids = {}  # topic -> id, for registering outgoing topics
+
+    def register(self, topic_id, topic):
+        self._topics[topic_id] = topic
+
+    def topic(self, topic_id):
+        """Returns the topic registered under an id, or None."""
+        return self._topics.get(topic_id)
+
+    def outgoing(self, topic):
+        """
+        Returns (id, REGISTER frame or None) for publishing on a topic; the
+        frame must be sent before the first PUBLISH on a new topic.
+        """
+        topic_id = self._ids.get(topic)
+        if topic_id is not None:
+            return topic_id, None
+        topic_id = self._ids[topic] = len(self._ids)
+        return topic_id, encode_register(topic_id, topic)
+
+    def decode_delivery(self, data):
+        """
+        Reads one frame a binary subscriber received: returns (topic, payload)
+        for a delivery, with a compressed payload decompressed, or None for a
+        REGISTER (which it records).
+        """
+        opcode, topic_id, body = decode(data)
+        if opcode == OP_REGISTER:
+            self.register(topic_id, body.decode("utf-8"))
+            return None
+        if opcode == OP_PUBLISH_COMPRESSED:
+            body = decompress(*split_compressed(body))
+        return self._topics.get(topic_id), body
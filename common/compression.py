@@ -0,0 +1,132 @@
+"""
+Payload compression for the topic-based server's binary protocol.
+
+A binary client lists the codecs it understands in its handshake, e.g.
+"SUBSCRIBER:LOGS.#;proto=binary;compress=zlib,lzma". Publishers may send
+payloads already compressed, and the server compresses the payloads of
+the topics configured with --compress PATTERN=CODEC[:MIN_BYTES] once per
+message, when the first subscriber that accepts the codec needs it. The
+compressed bytes are then forwarded as they are to every subscriber that
+accepts the codec; the others receive the plain payload.
+
+Payloads smaller than the threshold, or that do not shrink, stay plain:
+compressing them costs CPU and saves nothing on the wire.
+"""
+
+import lzma
+import zlib
+
+from common.topic_trie import TopicTrie, validate_pattern
+
+ZLIB = "zlib"
+LZMA = "lzma"
+CODEC_IDS = {ZLIB: 1, LZMA: 2}  # Codec byte of a compressed binary frame
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+COMPRESS_OPTION = "compress"  # Handshake option listing a client's codecs
+
+DEFAULT_MIN_BYTES = 256  # Smaller payloads are not worth compressing
+MAX_DECOMPRESSED_BYTES = 64 * 1024 * 1024  # Guards against decompression bombs
+# Raw LZMA2 with a small dictionary: the .xz container adds ~60 bytes to every
+# payload, and setting up a preset's 1+ MB dictionary costs ~1 ms per message
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 0, "dict_size": 64 * 1024}]
+
+
+def codecs_from_options(options):
+    """
+    Reads the ";compress=" handshake option into a frozenset of codec names.
+    Raises ValueError for an unknown codec.
+    """
+    listed = options.get(COMPRESS_OPTION, "").split(",")
+    codecs = frozenset(codec.strip().lower() for codec in listed if codec.strip())
+    unknown = sorted(codecs - CODEC_IDS.keys())
+    if unknown:
+        raise ValueError(f"Unknown compression codec '{unknown[0]}'.")
+    return codecs
+
+
+def compress(codec, data):
+    if codec == ZLIB:
+        return zlib.compress(data)
+    return lzma.compress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+
+
+def decompress(codec, data, max_bytes=MAX_DECOMPRESSED_BYTES):
+    """
+    Returns the plain payload. Raises ValueError if the data is corrupt or
+    would decompress to more than max_bytes.
+    """
+    try:
+        if codec == ZLIB:
+            decompressor = zlib.decompressobj()
+            plain = decompressor.decompress(data, max_bytes)
+            complete = decompressor.eof and not decompressor.unconsumed_tail
+        else:
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+            plain = decompressor.decompress(data, max_bytes)
+            complete = decompressor.eof
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ValueError(f"Corrupt {codec} payload: {e}") from None
+    if not complete:
+        raise ValueError(f"Truncated {codec} payload, or larger than {max_bytes} bytes.")
+    return plain
+
+
+def maybe_compress(codec, data, min_bytes):
+    """Returns the compressed payload, or None if it is too small or does not shrink."""
+    if len(data) < min_bytes:
+        return None
+    compressed = compress(codec, data)
+    return compressed if len(compressed) < len(data) else None
+
+
+def parse_rule(rule, default_min_bytes=DEFAULT_MIN_BYTES):
+    """
+    Parses a --compress rule "PATTERN=CODEC[:MIN_BYTES]" into
+    (pattern, codec, min_bytes). Raises ValueError if it is malformed.
+    """
+    pattern, separator, setting = rule.partition("=")
+    pattern = pattern.strip().upper()
+    codec, _, min_bytes = setting.partition(":")
+    codec = codec.strip().lower()
+    if not separator or codec not in CODEC_IDS:
+        raise ValueError(f"Compression rule '{rule}' is not PATTERN=zlib or PATTERN=lzma.")
+    validate_pattern(pattern)
+    try:
+        min_bytes = int(min_bytes) if min_bytes.strip() else default_min_bytes
+    except ValueError:
+        raise ValueError(f"Compression rule '{rule}' has a non-numeric size threshold.") from None
+    return pattern, codec, min_bytes
+
+
+class CompressionPolicy:
+    """
+    Which codec each topic's payloads are compressed with, from rules
+    matched against the topic; the first matching rule wins. Lookups are
+    cached per topic.
+    """
+
+    def __init__(self, rules=()):
+        self._rules = TopicTrie()
+        self._count = 0
+        self._cache = {}  # topic -> (codec, min bytes) or None
+        for rule in rules:
+            self.add(*rule)
+
+    def add(self, pattern, codec, min_bytes=DEFAULT_MIN_BYTES):
+        self._rules.add(pattern, (self._count, codec, min_bytes))
+        self._count += 1
+        self._cache.clear()
+
+    def for_topic(self, topic):
+        """Returns (codec, min bytes) for a topic, or None if it is not compressed."""
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        matched = self._rules.match(topic) if self._count else ()
+        setting = min(matched)[1:] if matched else None
+        self._cache[topic] = setting
+        return setting
+
+    def __len__(self):
+        return self._count
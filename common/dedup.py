@@ -0,0 +1,161 @@
+"""
+Publish-side deduplication for publishers that resend after a reconnect.
+
+A publisher that gives the ";msg_ids=1" handshake option starts every
+message with an ID of its choosing, followed by one space:
+
+    text:    NEWS:<id> <content>
+    binary:  PUBLISH body = <id> <payload>, PUBLISH_COMPRESSED body = <codec><id> <data>
+
+The broker strips the ID and remembers it in the publisher's window. A
+message whose ID is still in the window is a duplicate and is dropped
+before it is routed, so subscribers see it once. A publisher's window is
+keyed by its ";client_id=", so it outlives the connection the message
+first came on; without one, IDs are only checked within a connection.
+
+IDs leave a window when it holds more than `max_ids` of them or when they
+are older than `ttl` seconds. All windows together are capped at
+`max_bytes` of estimated memory; beyond it the oldest IDs of any publisher
+are evicted first. Lookups and evictions are O(1): every window is an
+insertion-ordered dict, and one more ordered dict across all windows gives
+the oldest ID overall. A duplicate arriving after its ID was evicted is
+delivered again, so the window bounds how late a resend may come.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+MSG_IDS_OPTION = "msg_ids"
+ID_SEPARATOR = b" "
+MAX_ID_BYTES = 64
+DEFAULT_MAX_IDS = 100_000  # IDs remembered per publisher
+DEFAULT_TTL = 300.0  # Seconds an ID is remembered
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024  # Estimated memory of every window together
+ENTRY_BYTES = 400  # Memory of one remembered ID besides its own bytes, rounded up
+
+
+def msg_ids_from_options(options):
+    """Reads the ";msg_ids=" handshake option (0 or 1). Raises ValueError otherwise."""
+    msg_ids = options.get(MSG_IDS_OPTION, "0")
+    if msg_ids not in ("0", "1"):
+        raise ValueError(f"Invalid msg_ids option '{msg_ids}'.")
+    return msg_ids == "1"
+
+
+def split_message_id(body):
+    """
+    Splits b"<id> <rest>" into (id, rest). Raises ValueError if there is no
+    ID or it is longer than MAX_ID_BYTES.
+    """
+    message_id, separator, rest = bytes(body[: MAX_ID_BYTES + 1]).partition(ID_SEPARATOR)
+    if not separator or not message_id:
+        raise ValueError(f"Message without an ID of at most {MAX_ID_BYTES} bytes.")
+    return message_id, body[len(message_id) + 1 :]
+
+
+class DedupCache:
+    """
+    The dedup windows of every publisher. Thread-safe.
+
+        cache.seen(publisher_key, message_id)  # True: a duplicate, drop it
+    """
+
+    def __init__(self, max_ids=DEFAULT_MAX_IDS, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        if max_ids < 1 or ttl <= 0 or max_bytes < 1:
+            raise ValueError("A dedup window keeps at least one ID for some time.")
+        self.max_ids = max_ids
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0  # Estimated memory of the remembered IDs
+        self.checked = 0  # IDs looked up
+        self.duplicates = 0  # IDs found, i.e. messages dropped
+        self.evicted = 0  # IDs dropped early for the count or memory cap
+        self._windows = {}  # publisher key -> OrderedDict of id -> time seen, oldest first
+        self._oldest = OrderedDict()  # (publisher key, id) -> None, oldest first across windows
+        self._next_expiry = float("inf")  # When the oldest ID expires
+        self._lock = threading.Lock()
+
+    def seen(self, publisher, message_id, now=None):
+        """
+        Records a message ID of a publisher. Returns True if the ID is in the
+        publisher's window already, i.e. the message is a duplicate.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            if now >= self._next_expiry:
+                self._expire(now)
+            self.checked += 1
+            window = self._windows.get(publisher)
+            if window is None:
+                window = self._windows[publisher] = OrderedDict()
+            elif message_id in window:
+                self.duplicates += 1
+                return True
+            window[message_id] = now
+            if not self._oldest:
+                self._next_expiry = now + self.ttl
+            self._oldest[(publisher, message_id)] = None
+            self.bytes += ENTRY_BYTES + len(message_id)
+            if len(window) > self.max_ids:
+                self._forget(publisher, next(iter(window)))
+                self.evicted += 1
+            while self.bytes > self.max_bytes:
+                self._forget(*next(iter(self._oldest)))
+                self.evicted += 1
+            return False
+
+    def drop(self, publisher):
+        """Forgets a publisher's window, e.g. when a publisher without a client id leaves."""
+        with self._lock:
+            for message_id in list(self._windows.get(publisher, ())):
+                self._forget(publisher, message_id)
+
+    def sweep(self, now=None):
+        """Forgets expired IDs even if no message arrives. Returns how many."""
+        with self._lock:
+            return self._expire(time.monotonic() if now is None else now)
+
+    def __len__(self):
+        return len(self._oldest)
+
+    @property
+    def hit_rate(self):
+        """Share of the checked messages that were duplicates."""
+        return self.duplicates / self.checked if self.checked else 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "ids": len(self._oldest),
+                "publishers": len(self._windows),
+                "bytes": self.bytes,
+                "checked": self.checked,
+                "duplicates": self.duplicates,
+                "evicted": self.evicted,
+                "hit_rate": self.hit_rate,
+            }
+
+    def _expire(self, now):
+        # Every ID lives for the same ttl, so the oldest overall expires first
+        deadline = now - self.ttl
+        expired = 0
+        while self._oldest:
+            publisher, message_id = next(iter(self._oldest))
+            seen = self._windows[publisher][message_id]
+            if seen > deadline:
+                self._next_expiry = seen + self.ttl
+                return expired
+            self._forget(publisher, message_id)
+            expired += 1
+        self._next_expiry = float("inf")
+        return expired
+
+    def _forget(self, publisher, message_id):
+        window = self._windows[publisher]
+        del window[message_id]
+        if not window:
+            del self._windows[publisher]
+        del self._oldest[(publisher, message_id)]
+        self.bytes -= ENTRY_BYTES + len(message_id)
@@ -0,0 +1,363 @@
+"""
+Federation of independent broker nodes.
+
+Several topic-based brokers, each with its own port and subscribers, peer
+with each other so a publish on any node reaches the subscribers of every
+node. Each node listens for the other nodes on a separate TCP port
+(--node-port) and dials every node given with --peers, so every node must
+be given all the others (a full mesh).
+
+The connection a node dials to a peer carries both directions of one
+relationship, in framed messages:
+
+    NODE:<name>                 handshake of the dialing node
+    SUMMARY:<summary>           peer -> dialer: which topics the peer's subscribers want
+    DELIVER:<topic>:<content>   dialer -> peer: a publish for the peer's subscribers
+
+A summary is a Bloom filter of the plain topics the node's subscribers
+hold, plus their wildcard patterns spelled out (a Bloom filter can only
+answer for exact keys, and wildcard patterns are few). A node forwards a
+publish from one of its own publishers to each peer whose summary may
+match the topic, and delivers what it receives from a peer to its own
+subscribers only. Each message therefore crosses each link at most once,
+and only towards nodes with (probably) matching subscribers; a false
+positive costs one unneeded crossing, which the receiving node drops.
+
+Summaries are sent again, whole, shortly after the node's subscriptions
+change. Until a new subscription's summary reaches the other nodes, their
+publishes on it are not forwarded.
+"""
+
+import hashlib
+import logging
+import math
+import socket
+import struct
+import sys
+import threading
+import time
+
+from common.framing import FrameReader, encode_frame, send_frame
+from common.log import SERVER_LOGGER
+from common.outbound import DROP_OLDEST, SubscriberWriter
+from common.topic_trie import TopicTrie, is_wildcard
+
+NODE_ROLE = "NODE"
+DEFAULT_ERROR_RATE = 0.01  # False positive rate the Bloom filters are sized for
+DEFAULT_LINK_QUEUE = 65536  # Frames queued per peer link before the oldest are dropped
+ADVERTISE_DELAY = 0.05  # Seconds subscription changes are collected before a summary is sent
+RECONNECT_DELAY = 0.1  # First wait before dialing a peer again; doubles up to MAX_RECONNECT_DELAY
+MAX_RECONNECT_DELAY = 2.0
+
+BLOOM_HEADER = struct.Struct("!IB")  # Bits, hash functions
+SUMMARY_PREFIX = b"SUMMARY:"
+DELIVER_COMMAND = b"DELIVER"
+
+log = logging.getLogger(SERVER_LOGGER)
+
+
+def topic_hashes(topic):
+    """The two 64-bit hashes the Bloom filter positions of a topic are derived from."""
+    digest = hashlib.blake2b(topic.encode("utf-8"), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big")
+
+
+class BloomFilter:
+    """
+    A set of strings that answers "maybe present" or "certainly absent", in
+    about 9.6 bits per key at a 1% false positive rate. Positions come from
+    two hashes (Kirsch-Mitzenmacher), so a topic is hashed once however many
+    filters it is checked against.
+    """
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+
+    @classmethod
+    def sized_for(cls, keys, error_rate=DEFAULT_ERROR_RATE):
+        """An empty filter for `keys` keys with the given false positive rate."""
+        if not keys:
+            return cls(0, 0)
+        bits = math.ceil(-keys * math.log(error_rate) / math.log(2) ** 2)
+        bits = (bits + 7) // 8 * 8
+        return cls(bits, max(1, round(bits / keys * math.log(2))))
+
+    def add(self, key):
+        for position in self._positions(topic_hashes(key)):
+            self.array[position >> 3] |= 1 << (position & 7)
+
+    def may_contain(self, hashes):
+        """True if the key with these topic_hashes() may have been added."""
+        if not self.bits:
+            return False
+        array = self.array
+        return all(
+            array[position >> 3] & (1 << (position & 7)) for position in self._positions(hashes)
+        )
+
+    def __contains__(self, key):
+        return self.may_contain(topic_hashes(key))
+
+    def to_bytes(self):
+        return BLOOM_HEADER.pack(self.bits, self.hashes) + bytes(self.array)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Reads a filter written by to_bytes(). Returns it and the bytes after it."""
+        if len(data) < BLOOM_HEADER.size:
+            raise ValueError("Truncated Bloom filter.")
+        bits, hashes = BLOOM_HEADER.unpack_from(data)
+        end = BLOOM_HEADER.size + (bits + 7) // 8
+        if len(data) < end:
+            raise ValueError("Truncated Bloom filter.")
+        bloom = cls(bits, hashes)
+        bloom.array[:] = data[BLOOM_HEADER.size : end]
+        return bloom, data[end:]
+
+    def _positions(self, hashes):
+        first, second = hashes
+        return ((first + index * second) % self.bits for index in range(self.hashes))
+
+
+class Summary:
+    """What one node's subscribers want: a Bloom filter of topics and the wildcard patterns."""
+
+    def __init__(self, bloom, patterns):
+        self.bloom = bloom
+        self.patterns = list(patterns)
+        self._trie = TopicTrie()
+        for pattern in self.patterns:
+            self._trie.add(pattern, pattern)
+
+    @classmethod
+    def of(cls, patterns, error_rate=DEFAULT_ERROR_RATE):
+        topics = [pattern for pattern in patterns if not is_wildcard(pattern)]
+        bloom = BloomFilter.sized_for(len(topics), error_rate)
+        for topic in topics:
+            bloom.add(topic)
+        return cls(bloom, (pattern for pattern in patterns if is_wildcard(pattern)))
+
+    def may_match(self, topic, hashes):
+        """True if a publish on the topic (with its topic_hashes()) may have subscribers."""
+        return self.bloom.may_contain(hashes) or bool(self._trie.match(topic))
+
+    def encode(self):
+        """The SUMMARY frame, encoded."""
+        wildcards = "\n".join(self.patterns).encode("utf-8")
+        return encode_frame(SUMMARY_PREFIX + self.bloom.to_bytes() + wildcards)
+
+    @classmethod
+    def decode(cls, data):
+        """Reads the body of a SUMMARY frame. Raises ValueError if malformed."""
+        bloom, rest = BloomFilter.from_bytes(data)
+        patterns = rest.decode("utf-8").split("\n") if rest else []
+        return cls(bloom, patterns)
+
+
+def parse_peers(peers_text):
+    """Splits "host:port,host:port" into (host, port) pairs. Raises ValueError if malformed."""
+    peers = []
+    for peer in peers_text.split(","):
+        host, _, port = peer.strip().rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError(f"Invalid peer address '{peer.strip()}', expected host:port.")
+        peers.append((host, int(port)))
+    return peers
+
+
+class PeerLink:
+    """
+    The connection this node dialed to a peer: publishes go out through a
+    SubscriberWriter, and the peer's latest summary comes back on it.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.writer = None  # SubscriberWriter while connected
+        self.summary = None  # Latest summary received; None until the first one
+
+
+class Federation:
+    """
+    This node's side of the federation.
+
+        federation = Federation("node-a", 7100, [("127.0.0.1", 7101)])
+        federation.start(on_deliver)
+        federation.add_interest("NEWS")          # A local subscription
+        for writer in federation.links_for("NEWS"):
+            writer.send(frame)                   # Forward a local publish
+
+    on_deliver(frames) is called from a link's reader thread with the
+    DELIVER frames read together, as b"DELIVER:TOPIC:content" or, for a
+    payload that stays compressed, b"DELIVER;codec:TOPIC:payload" (the
+    framing of common/sharding.py).
+    """
+
+    def __init__(
+        self,
+        name,
+        port,
+        peers,
+        error_rate=DEFAULT_ERROR_RATE,
+        link_queue=DEFAULT_LINK_QUEUE,
+    ):
+        self.name = name
+        self.port = port
+        self.links = [PeerLink(address) for address in peers]
+        self.on_deliver = None
+        self.error_rate = error_rate
+        self.link_queue = link_queue
+        self._interest = {}  # pattern -> number of local subscriptions to it
+        self._listeners = set()  # SubscriberWriters of the peers that dialed us
+        self._summary = Summary.of((), error_rate).encode()
+        self._changed = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, on_deliver):
+        """Listens for the other nodes and starts dialing them, in background threads."""
+        self.on_deliver = on_deliver
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(("0.0.0.0", self.port))
+        server_socket.listen(socket.SOMAXCONN)
+        threading.Thread(target=self._accept, args=(server_socket,), daemon=True).start()
+        threading.Thread(target=self._advertise, daemon=True).start()
+        for link in self.links:
+            threading.Thread(target=self._dial, args=(link,), daemon=True).start()
+
+    def add_interest(self, pattern):
+        """Records a local subscription; the first one for a pattern changes the summary."""
+        with self._lock:
+            count = self._interest.get(pattern, 0) + 1
+            self._interest[pattern] = count
+        if count == 1:
+            self._changed.set()
+
+    def remove_interest(self, pattern):
+        """Drops a local subscription; the last one for a pattern changes the summary."""
+        with self._lock:
+            count = self._interest.get(pattern, 0) - 1
+            if count > 0:
+                self._interest[pattern] = count
+            elif count == 0:
+                del self._interest[pattern]
+        if count == 0:
+            self._changed.set()
+
+    def links_for(self, topic):
+        """
+        The SubscriberWriters of the connected peers whose subscribers may
+        want a publish on the topic.
+        """
+        hashes = topic_hashes(topic)
+        writers = []
+        for link in self.links:
+            writer, summary = link.writer, link.summary  # Swapped by the link's thread
+            if writer is not None and summary is not None and summary.may_match(topic, hashes):
+                writers.append(writer)
+        return writers
+
+    def stats(self):
+        with self._lock:
+            patterns = len(self._interest)
+        return {
+            "patterns": patterns,
+            "summary_bytes": len(self._summary),
+            "peers_connected": sum(link.writer is not None for link in self.links),
+            "peers_dialed_in": len(self._listeners),
+        }
+
+    def _advertise(self):
+        """Sends the summary to every peer shortly after the local subscriptions change."""
+        while True:
+            self._changed.wait()
+            time.sleep(ADVERTISE_DELAY)  # Collect a burst of subscriptions into one summary
+            self._changed.clear()
+            with self._lock:
+                patterns = list(self._interest)
+            summary = Summary.of(patterns, self.error_rate).encode()
+            with self._lock:
+                self._summary = summary
+                listeners = list(self._listeners)
+            for listener in listeners:
+                listener.send(summary)
+            log.debug(f"Advertised {len(patterns)} patterns in {len(summary)} bytes.")
+
+    def _accept(self, server_socket):
+        while True:
+            conn, addr = server_socket.accept()
+            threading.Thread(target=self._serve_peer, args=(conn, addr), daemon=True).start()
+
+    def _serve_peer(self, conn, addr):
+        """A peer dialed us: send it our summaries and deliver what it forwards."""
+        reader = FrameReader(conn)
+        try:
+            frames = reader.read_frames()
+        except (OSError, ValueError):  # ValueError: a frame over the maximum frame size
+            frames = []
+        handshake = frames[0].decode("utf-8", errors="replace") if frames else ""
+        role, _, name = handshake.partition(":")
+        if role != NODE_ROLE:
+            log.warning(f"Invalid node handshake from {addr}. Disconnecting.")
+            conn.close()
+            return
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        listener = SubscriberWriter(conn, addr, sys.maxsize, DROP_OLDEST)
+        with self._lock:
+            self._listeners.add(listener)
+            listener.send(self._summary)
+        log.info(f"Node '{name}' at {addr} joined the federation.")
+        frames = frames[1:]
+        try:
+            while True:
+                deliveries = [data for data in frames if data.startswith(DELIVER_COMMAND)]
+                if deliveries:
+                    self.on_deliver(deliveries)
+                frames = reader.read_frames()
+                if not frames:
+                    break
+        except OSError:
+            pass
+        except ValueError as e:
+            log.warning(f"Bad frame from node '{name}' at {addr}: {e}")
+        finally:
+            with self._lock:
+                self._listeners.discard(listener)
+            listener.close()
+            conn.close()
+            log.info(f"Node '{name}' at {addr} left the federation.")
+
+    def _dial(self, link):
+        """Keeps a connection open to one peer, redialing with backoff when it drops."""
+        delay = RECONNECT_DELAY
+        host, port = link.address
+        while True:
+            try:
+                conn = socket.create_connection((host, port), timeout=MAX_RECONNECT_DELAY)
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            delay = RECONNECT_DELAY
+            conn.settimeout(None)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                send_frame(conn, f"{NODE_ROLE}:{self.name}".encode("utf-8"))
+            except OSError:
+                conn.close()
+                continue
+            link.writer = SubscriberWriter(conn, f"{host}:{port}", self.link_queue, DROP_OLDEST)
+            log.info(f"Linked to node at {host}:{port}.")
+            try:
+                for data in FrameReader(conn).iter_frames():
+                    if data.startswith(SUMMARY_PREFIX):
+                        link.summary = Summary.decode(data[len(SUMMARY_PREFIX) :])
+            except (OSError, ValueError) as e:
+                log.warning(f"Link to node at {host}:{port} failed: {e}")
+            link.summary = None
+            writer, link.writer = link.writer, None
+            writer.close()
+            conn.close()
+            log.info(f"Lost the link to node at {host}:{port}; redialing.")
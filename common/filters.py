@@ -0,0 +1,353 @@
+"""
+Server-side content filters for topic subscribers.
+
+A subscriber may give a filter with the ";filter=<expression>" handshake
+option, or later with a "FILTER:<expression>" command (an empty expression
+removes it). It then only receives the messages on its topics whose
+attributes satisfy every condition of the expression, e.g.
+
+    region=eu&price>=10&price<20&symbol^=AB
+
+Attributes are the top-level fields of a message whose payload is a JSON
+object; any other message has none and passes no filter. Conditions are
+
+    name=value   name!=value   name<value   name<=value   name>value
+    name>=value  name^=prefix
+
+A value that reads as a number is compared with numeric attributes, any
+other value with string attributes (true, false and null stand for the
+JSON literals). An attribute of the wrong type, or a missing one, fails
+the condition.
+
+Each filter is compiled once, when it is set, into a list of predicates.
+A FilterIndex then files it under one of its conditions: an equality in
+a hash table keyed by attribute and value, a prefix in one keyed by
+attribute and prefix, and a range in a list sorted by its bound. Routing a
+message only looks up the message's own attribute values there, and only
+the filters found are tested in full, so its cost follows the filters that
+can match, not the number of filtered subscribers.
+"""
+
+import json
+import operator
+import re
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+FILTER_OPTION = "filter"
+CONDITION_SEPARATOR = "&"
+CONDITION = re.compile(r"^\s*([A-Za-z0-9_.\-]+)\s*(!=|<=|>=|\^=|=|<|>)\s*(.*?)\s*$")
+
+COMPARISONS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+LOWER_BOUNDS = (">", ">=")
+UPPER_BOUNDS = ("<", "<=")
+
+
+class _Literal:
+    """A JSON literal; unlike True and False, never equal to a number."""
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
+
+TRUE, FALSE, NULL = _Literal("true"), _Literal("false"), _Literal("null")
+LITERALS = {"true": TRUE, "false": FALSE, "null": NULL}
+_UNMATCHABLE = _Literal("unmatchable")
+
+
+def parse_value(text):
+    """A condition's value: a number, a JSON literal, or the text itself."""
+    if text in LITERALS:
+        return LITERALS[text]
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def canonical(value):
+    """
+    The form a message attribute is compared and looked up in: numbers as
+    floats, so 10 and 10.0 match, strings as themselves and the JSON
+    literals as TRUE, FALSE and NULL. Lists and objects match nothing.
+    """
+    if isinstance(value, str):
+        return value
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return TRUE if value else FALSE
+    if isinstance(value, (int, float)):
+        return float(value)
+    return _UNMATCHABLE
+
+
+def comparable(a, b):
+    """True if an attribute and a condition value can be ordered against each other."""
+    return type(a) is type(b) and isinstance(a, (float, str))
+
+
+class Condition:
+    """One compiled "name op value" test."""
+
+    __slots__ = ("name", "op", "value", "test")
+
+    def __init__(self, name, op, text):
+        self.name = name
+        self.op = op
+        if op == "^=":
+            self.value = text
+            self.test = lambda attribute: isinstance(attribute, str) and attribute.startswith(text)
+            return
+        value = self.value = parse_value(text)
+        compare = COMPARISONS[op]
+        if op in ("=", "!="):
+            self.test = lambda attribute: attribute is not _UNMATCHABLE and compare(attribute, value)
+        elif isinstance(value, _Literal):
+            raise ValueError(f"'{name}{op}{text}' compares with a literal that has no order.")
+        else:
+            self.test = lambda attribute: comparable(attribute, value) and compare(attribute, value)
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return f"{self.name}{self.op}{value}"
+
+
+class Filter:
+    """A compiled filter expression: every condition must hold."""
+
+    __slots__ = ("conditions", "text")
+
+    def __init__(self, conditions):
+        self.conditions = tuple(conditions)
+        self.text = CONDITION_SEPARATOR.join(str(condition) for condition in self.conditions)
+
+    def matches(self, attributes):
+        for condition in self.conditions:
+            attribute = attributes.get(condition.name, _UNMATCHABLE)
+            if not condition.test(canonical(attribute)):
+                return False
+        return True
+
+    def anchor(self):
+        """The condition the filter is indexed by: an equality, a prefix or a bound."""
+        for ops in (("=",), ("^=",), LOWER_BOUNDS + UPPER_BOUNDS):
+            for condition in self.conditions:
+                if condition.op in ops:
+                    return condition
+        return self.conditions[0]
+
+    def __str__(self):
+        return self.text
+
+
+def compile_filter(expression):
+    """
+    Compiles a filter expression. Returns None for an empty one (no filter).
+    Raises ValueError if it is malformed.
+    """
+    conditions = []
+    for part in expression.split(CONDITION_SEPARATOR):
+        if not part.strip():
+            continue
+        match = CONDITION.match(part)
+        if match is None or not match.group(3):
+            raise ValueError(f"Invalid filter condition '{part.strip()}'.")
+        name, op, value = match.groups()
+        conditions.append(Condition(name, op, value))
+    return Filter(conditions) if conditions else None
+
+
+def filter_from_options(options):
+    """Reads the ";filter=" handshake option: a compiled Filter, or None. Raises ValueError."""
+    return compile_filter(options.get(FILTER_OPTION, ""))
+
+
+def message_attributes(payload):
+    """The top-level fields of a JSON-object payload, or {} for any other payload."""
+    if not payload.lstrip()[:1] == b"{":
+        return {}
+    try:
+        attributes = json.loads(payload)
+    except (ValueError, UnicodeDecodeError):
+        return {}
+    return attributes if isinstance(attributes, dict) else {}
+
+
+class _Bounds:
+    """Filters anchored on one attribute's lower (or upper) bounds, sorted by bound."""
+
+    def __init__(self):
+        self.keys = []  # Sorted (bound, insertion number)
+        self.subscribers = {}  # (bound, insertion number) -> subscriber
+        self._inserted = 0
+
+    def add(self, bound, subscriber):
+        self._inserted += 1
+        key = (bound, self._inserted)
+        insort(self.keys, key)
+        self.subscribers[key] = subscriber
+        return key
+
+    def remove(self, key):
+        del self.keys[bisect_left(self.keys, key)]
+        del self.subscribers[key]
+
+    def at_most(self, value):
+        """Subscribers whose bound is at most value (lower bounds the value may satisfy)."""
+        end = bisect_right(self.keys, (value, float("inf")))
+        return [self.subscribers[key] for key in self.keys[:end]]
+
+    def at_least(self, value):
+        """Subscribers whose bound is at least value (upper bounds the value may satisfy)."""
+        start = bisect_left(self.keys, (value, 0))
+        return [self.subscribers[key] for key in self.keys[start:]]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class FilterIndex:
+    """
+    The filters of the subscribers that have one. Thread-safe.
+
+        index.set(subscriber, compile_filter("region=eu&price<20"))
+        passed = index.matching(message_attributes(payload), subscribers)
+    """
+
+    def __init__(self):
+        self._filters = {}  # subscriber -> (Filter, where it is filed)
+        self._equal = {}  # attribute -> {canonical value -> set of subscribers}
+        self._prefix = {}  # attribute -> {prefix -> set of subscribers}
+        self._prefix_lengths = {}  # attribute -> {prefix length -> filters with it}
+        self._lower = {}  # (attribute, float or str) -> _Bounds of ">"/">=" anchors
+        self._upper = {}  # (attribute, float or str) -> _Bounds of "<"/"<=" anchors
+        self._scan = {}  # attribute -> set of subscribers anchored on "!="
+        self._lock = threading.Lock()
+
+    def set(self, subscriber, compiled):
+        """Replaces a subscriber's filter; None removes it."""
+        with self._lock:
+            self._discard(subscriber)
+            if compiled is not None:
+                self._filters[subscriber] = (compiled, self._file(subscriber, compiled.anchor()))
+
+    def remove(self, subscriber):
+        with self._lock:
+            self._discard(subscriber)
+
+    def get(self, subscriber):
+        entry = self._filters.get(subscriber)
+        return entry[0] if entry is not None else None
+
+    def __contains__(self, subscriber):
+        return subscriber in self._filters
+
+    def __len__(self):
+        return len(self._filters)
+
+    def matching(self, attributes, among):
+        """
+        The subscribers in `among` whose filters the attributes satisfy. Only
+        those a lookup finds are tested, and only if they are in `among`.
+        """
+        passed = set()
+        if not attributes:
+            return passed
+        with self._lock:
+            candidates = []
+            for name, attribute in attributes.items():
+                value = canonical(attribute)
+                if value is _UNMATCHABLE:
+                    continue
+                equal = self._equal.get(name)
+                if equal is not None:
+                    candidates.extend(equal.get(value, ()))
+                if isinstance(value, str):
+                    prefixes = self._prefix.get(name)
+                    if prefixes is not None:
+                        for length in self._prefix_lengths[name]:
+                            candidates.extend(prefixes.get(value[:length], ()))
+                if isinstance(value, (float, str)):
+                    lower = self._lower.get((name, type(value)))
+                    if lower is not None:
+                        candidates.extend(lower.at_most(value))
+                    upper = self._upper.get((name, type(value)))
+                    if upper is not None:
+                        candidates.extend(upper.at_least(value))
+                candidates.extend(self._scan.get(name, ()))
+            filters = self._filters
+            for subscriber in candidates:
+                if (
+                    subscriber in among
+                    and subscriber not in passed
+                    and filters[subscriber][0].matches(attributes)
+                ):
+                    passed.add(subscriber)
+        return passed
+
+    def _file(self, subscriber, condition):
+        name, value = condition.name, condition.value
+        if condition.op == "=":
+            self._equal.setdefault(name, {}).setdefault(value, set()).add(subscriber)
+            return ("=", name, value)
+        if condition.op == "^=":
+            self._prefix.setdefault(name, {}).setdefault(value, set()).add(subscriber)
+            lengths = self._prefix_lengths.setdefault(name, {})
+            lengths[len(value)] = lengths.get(len(value), 0) + 1
+            return ("^=", name, value)
+        if condition.op in LOWER_BOUNDS + UPPER_BOUNDS:
+            # Numbers and strings do not sort together, so each has its own list
+            index = self._lower if condition.op in LOWER_BOUNDS else self._upper
+            bounds = index.setdefault((name, type(value)), _Bounds())
+            return (condition.op, (name, type(value)), bounds.add(value, subscriber))
+        self._scan.setdefault(name, set()).add(subscriber)
+        return ("!=", name, None)
+
+    def _discard(self, subscriber):
+        entry = self._filters.pop(subscriber, None)
+        if entry is None:
+            return
+        op, name, key = entry[1]
+        if op == "=":
+            _discard_from(self._equal, name, key, subscriber)
+        elif op == "^=":
+            _discard_from(self._prefix, name, key, subscriber)
+            lengths = self._prefix_lengths[name]
+            lengths[len(key)] -= 1
+            if not lengths[len(key)]:
+                del lengths[len(key)]
+                if not lengths:
+                    del self._prefix_lengths[name]
+        elif op in LOWER_BOUNDS + UPPER_BOUNDS:
+            index = self._lower if op in LOWER_BOUNDS else self._upper
+            index[name].remove(key)
+            if not index[name]:
+                del index[name]
+        else:
+            self._scan[name].discard(subscriber)
+            if not self._scan[name]:
+                del self._scan[name]
+
+
+def _discard_from(table, name, key, subscriber):
+    values = table[name]
+    values[key].discard(subscriber)
+    if not values[key]:
+        del values[key]
+        if not values:
+            del table[name]
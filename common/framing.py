@@ -0,0 +1,287 @@
+"""
+Length-prefixed message framing shared by every server and client.
+
+Each message on the wire is a 4-byte big-endian header followed by the
+payload bytes. The low 31 bits of the header are the payload length; the
+top bit marks a batch frame, whose payload is itself a sequence of
+complete frames. TCP is free to merge or split segments; the receiver
+uses the header to find where one message ends and the next one begins.
+
+A receiver only accepts frames up to max_frame_size bytes (16 MiB unless a
+server's --max-frame-size says otherwise): a larger header, bad or
+hostile, raises ValueError instead of making the buffer grow to 2 GiB.
+"""
+
+import os
+import struct
+
+HEADER = struct.Struct("!I")
+HEADER_SIZE = HEADER.size
+FLAG_BATCH = 0x80000000  # Payload is a sequence of complete frames
+LENGTH_MASK = 0x7FFFFFFF
+MAX_PAYLOAD_SIZE = LENGTH_MASK  # Largest length the header can describe
+
+DEFAULT_BUFFER_SIZE = 64 * 1024  # Initial size of the reusable receive buffer
+DEFAULT_MAX_FRAME_SIZE = 16 * 1024 * 1024  # Largest payload a receiver accepts
+max_frame_size = DEFAULT_MAX_FRAME_SIZE  # For buffers created without their own limit
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")  # Most buffers one sendmsg() call accepts
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def set_max_frame_size(size):
+    """Sets the largest payload the buffers created from now on accept (--max-frame-size)."""
+    global max_frame_size
+    if not 0 < size <= MAX_PAYLOAD_SIZE:
+        raise ValueError(f"The maximum frame size must be between 1 and {MAX_PAYLOAD_SIZE} bytes.")
+    max_frame_size = size
+
+
+def encode_frame(payload):
+    """Returns the payload (bytes) prefixed with its length header."""
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ValueError(f"Payload of {len(payload)} bytes is too large to frame.")
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_batch(frames):
+    """
+    Wraps already-encoded frames into one batch frame. The receiver unpacks
+    it into the individual frames and always sees the whole batch at once.
+    """
+    payload = b"".join(frames)
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ValueError(f"Batch of {len(payload)} bytes is too large to frame.")
+    return HEADER.pack(FLAG_BATCH | len(payload)) + payload
+
+
+def split_batch(payload):
+    """Returns the frames packed inside a batch frame's payload."""
+    frames = []
+    view = memoryview(payload)
+    position = 0
+    while position < len(payload):
+        if position + HEADER_SIZE > len(payload):
+            raise ValueError("Truncated frame header inside batch.")
+        (header,) = HEADER.unpack_from(payload, position)
+        start = position + HEADER_SIZE
+        end = start + (header & LENGTH_MASK)
+        if end > len(payload):
+            raise ValueError("Truncated frame inside batch.")
+        if header & FLAG_BATCH:
+            frames.extend(split_batch(view[start:end]))
+        else:
+            frames.append(bytes(view[start:end]))
+        position = end
+    return frames
+
+
+def send_frame(sock, payload):
+    """Sends one framed payload over a connected socket."""
+    sock.sendall(encode_frame(payload))
+
+
+def send_frames(sock, frames):
+    """
+    Sends already-encoded frames with vectored sendmsg() calls, up to IOV_MAX
+    buffers each, instead of one sendall() per frame. Handles partial sends.
+    Returns the number of sendmsg() calls made.
+    """
+    buffers = [memoryview(frame) for frame in frames]
+    calls = 0
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+        calls += 1
+        # Drop the buffers that went out completely and trim a partly sent one
+        done = 0
+        while done < len(buffers) and sent >= len(buffers[done]):
+            sent -= len(buffers[done])
+            done += 1
+        del buffers[:done]
+        if sent:
+            buffers[0] = buffers[0][sent:]
+    return calls
+
+
+class FrameBuffer:
+    """
+    Reusable receive buffer that slices complete frames out of a byte stream.
+
+    The buffer grows to fit a frame larger than itself, so a big payload is
+    received in as few reads as possible, and shrinks back once drained.
+    Batch frames are unpacked, so callers only ever see plain payloads; all
+    frames of a batch are returned by the same call. A header announcing more
+    than `max_frame_size` bytes raises ValueError; the connection cannot be
+    read any further and should be closed.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_size=None):
+        self.max_frame_size = max_frame_size if max_size is None else max_size
+        self._initial_size = buffer_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # Offset of the first byte not yet handed out
+        self._end = 0  # Offset one past the last byte received
+
+    def writable(self):
+        """Makes room for the next read and returns the free part of the buffer."""
+        self._make_room()
+        return self._view[self._end :]
+
+    def advance(self, received):
+        """Records that `received` bytes were written into writable()."""
+        self._end += received
+
+    def feed(self, data):
+        """Copies received bytes into the buffer (for readers without recv_into)."""
+        data = memoryview(data)
+        while data:
+            free = self.writable()
+            chunk = min(len(free), len(data))
+            free[:chunk] = data[:chunk]
+            self.advance(chunk)
+            data = data[chunk:]
+
+    def frames(self):
+        """Slices every complete frame out of the buffered bytes."""
+        frames = []
+        position = self._start
+        while self._end - position >= HEADER_SIZE:
+            (header,) = HEADER.unpack_from(self._buffer, position)
+            frame_end = position + HEADER_SIZE + self._length(header)
+            if frame_end > self._end:
+                break
+            payload = self._view[position + HEADER_SIZE : frame_end]
+            if header & FLAG_BATCH:
+                frames.extend(split_batch(payload))
+            else:
+                frames.append(bytes(payload))
+            position = frame_end
+        self._start = position
+        if self._start == self._end:
+            # Nothing pending: rewind so the next read uses the whole buffer
+            self._start = self._end = 0
+            if len(self._buffer) > self._initial_size:
+                self._resize(self._initial_size)
+        return frames
+
+    def _make_room(self):
+        """Ensures there is free space after the pending bytes for the next read."""
+        pending = self._end - self._start
+        needed = HEADER_SIZE
+        if pending >= HEADER_SIZE:
+            (header,) = HEADER.unpack_from(self._buffer, self._start)
+            needed = HEADER_SIZE + self._length(header)
+        needed = max(needed, pending + 1)
+
+        if needed > len(self._buffer):
+            # Grow so the whole frame fits, then receive the rest in big chunks
+            self._resize(max(needed, 2 * len(self._buffer)))
+        elif len(self._buffer) - self._start < needed:
+            # Move the partial frame to the front of the buffer
+            self._buffer[:pending] = bytes(self._view[self._start : self._end])
+            self._start, self._end = 0, pending
+
+    def _length(self, header):
+        """The payload length of a header. Raises ValueError past max_frame_size."""
+        length = header & LENGTH_MASK
+        if length > self.max_frame_size:
+            raise ValueError(
+                f"Frame of {length} bytes exceeds the maximum frame size of {self.max_frame_size}."
+            )
+        return length
+
+    def _resize(self, size):
+        """Replaces the buffer with one of the given size, keeping pending bytes."""
+        pending = self._end - self._start
+        new_buffer = bytearray(size)
+        new_buffer[:pending] = self._view[self._start : self._end]
+        self._view.release()
+        self._buffer = new_buffer
+        self._view = memoryview(new_buffer)
+        self._start, self._end = 0, pending
+
+
+class FrameReader(FrameBuffer):
+    """
+    Reads length-prefixed frames from a socket.
+
+    Data is received with recv_into() straight into one reusable buffer, and
+    every complete frame found after a read is returned at once, instead of
+    one recv call per 1 KB message.
+    """
+
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE):
+        super().__init__(buffer_size)
+        self.sock = sock
+
+    def read_frames(self):
+        """
+        Blocks until at least one complete frame is available and returns all
+        complete frames received so far as a list of bytes objects.
+        Returns an empty list once the peer has closed the connection.
+        """
+        while True:
+            frames = self.frames()
+            if frames:
+                return frames
+            received = self.sock.recv_into(self.writable())
+            if not received:
+                return []
+            self.advance(received)
+
+    def read_available(self):
+        """
+        For a non-blocking socket a selector reported readable: receives once
+        and returns the complete frames received so far, possibly none.
+        Returns None once the peer has closed the connection.
+        """
+        try:
+            received = self.sock.recv_into(self.writable())
+        except BlockingIOError:
+            return self.frames()
+        if not received:
+            return None
+        self.advance(received)
+        return self.frames()
+
+    def iter_frames(self):
+        """Yields frames one by one until the peer closes the connection."""
+        while True:
+            frames = self.read_frames()
+            if not frames:
+                return
+            yield from frames
+
+
+class AsyncFrameReader(FrameBuffer):
+    """Reads length-prefixed frames from an asyncio StreamReader."""
+
+    def __init__(self, reader, buffer_size=DEFAULT_BUFFER_SIZE):
+        super().__init__(buffer_size)
+        self.reader = reader
+
+    async def read_frames(self):
+        """
+        Waits until at least one complete frame is available and returns all
+        complete frames received so far. Returns an empty list on EOF.
+        """
+        while True:
+            frames = self.frames()
+            if frames:
+                return frames
+            data = await self.reader.read(len(self.writable()))
+            if not data:
+                return []
+            self.feed(data)
+
+    async def iter_frames(self):
+        """Yields frames one by one until the peer closes the connection."""
+        while True:
+            frames = await self.read_frames()
+            if not frames:
+                return
+            for frame in frames:
+                yield frame
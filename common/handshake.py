@@ -0,0 +1,27 @@
+"""
+Options appended to a client's first (handshake) message.
+
+A handshake may carry ";key=value" options after the role and topic, e.g.
+
+    SUBSCRIBER:NEWS;offset=42
+    SUBSCRIBER;from_ts=1700000000.5
+
+Servers that do not know an option ignore it, so clients can always send
+the plain "ROLE:TOPIC" form.
+"""
+
+OPTION_SEPARATOR = ";"
+
+
+def split_options(handshake):
+    """
+    Splits a handshake into its plain part and a dict of its options.
+    Option names are case-insensitive; values are kept as strings.
+    """
+    plain, *fields = handshake.split(OPTION_SEPARATOR)
+    options = {}
+    for field in fields:
+        key, _, value = field.partition("=")
+        if key.strip():
+            options[key.strip().lower()] = value.strip()
+    return plain.strip(), options
@@ -0,0 +1,56 @@
+"""
+Consistent hashing of keys (topics) onto nodes (broker workers).
+
+Every node is placed on a ring at many pseudo-random points ("virtual
+nodes"); a key belongs to the first node point at or after the key's own
+hash. Adding or removing a node only moves the keys next to its points,
+about 1/N of them, instead of reshuffling every key as `hash % N` would.
+"""
+
+import hashlib
+from bisect import bisect_left
+
+DEFAULT_REPLICAS = 128  # Points per node; more points spread keys more evenly
+
+
+def stable_hash(key):
+    """
+    64-bit hash of a string that is the same in every process. The built-in
+    hash() is randomized per interpreter, so workers would disagree on owners.
+    """
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class HashRing:
+    """Maps keys to nodes; nodes are any strings or ints with a stable str()."""
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        self.replicas = replicas
+        self._points = []  # Sorted (hash, node) pairs
+        self._hashes = []  # Just the hashes of self._points, for bisect
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        points = [
+            (stable_hash(f"{node}#{replica}"), node) for replica in range(self.replicas)
+        ]
+        self._points = sorted(self._points + points, key=lambda point: point[0])
+        self._hashes = [point_hash for point_hash, _ in self._points]
+
+    def remove_node(self, node):
+        self._points = [point for point in self._points if point[1] != node]
+        self._hashes = [point_hash for point_hash, _ in self._points]
+
+    def node_for(self, key):
+        """Returns the node that owns a key. Raises LookupError on an empty ring."""
+        if not self._points:
+            raise LookupError("The hash ring has no nodes.")
+        index = bisect_left(self._hashes, stable_hash(key))
+        if index == len(self._points):
+            index = 0  # Wrap around the ring
+        return self._points[index][1]
+
+    def nodes(self):
+        return sorted({node for _, node in self._points}, key=str)
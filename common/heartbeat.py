@@ -0,0 +1,210 @@
+"""
+Dead-connection detection: application-level heartbeats, idle timeouts and
+TCP keepalive.
+
+A client asks for heartbeats with the ";heartbeat=<seconds>" handshake
+option. It then sends a PING frame at least that often, and the broker
+answers each one with a PONG, so both sides notice when the other is gone.
+The broker disconnects a heartbeat client it has not heard from for
+HEARTBEAT_GRACE intervals. Without heartbeats, a broker started with
+--idle-timeout disconnects clients that stay silent for that long.
+
+Binary-protocol clients use the PING and PONG opcodes of
+common/binary_protocol.py instead of the text frames.
+
+The timeouts live in an IdleMonitor: a timing wheel holds one deadline per
+connection, and reads only record when the connection was last heard from.
+A deadline that comes up for a connection heard from since is pushed back
+once; the others are closed. Expiring connections therefore costs in
+proportion to the number that are due, not to the number open.
+
+TCP keepalive covers clients that send nothing at all, such as plain
+subscribers: the kernel probes a connection that has been idle for
+--tcp-keepalive seconds and resets it when the peer does not answer, which
+wakes up the broker's reader as for any other disconnect.
+"""
+
+import socket
+import threading
+import time
+
+from common.binary_protocol import BINARY, OP_PING, OP_PONG, TEXT, encode_command
+from common.framing import encode_frame
+from common.timer_wheel import DEFAULT_TICK, TimerWheel
+
+HEARTBEAT_OPTION = "heartbeat"
+HEARTBEAT_GRACE = 1.5  # Missed intervals before a heartbeat client is disconnected
+PING = b"PING"
+PONG = b"PONG"
+
+DEFAULT_TCP_KEEPALIVE = 60  # Idle seconds before the kernel probes a connection
+KEEPALIVE_PROBES = 4  # Unanswered probes before the kernel resets the connection
+
+
+def heartbeat_from_options(options):
+    """
+    Reads the ";heartbeat=" handshake option: seconds between a client's
+    PINGs, or None without heartbeats. Raises ValueError if malformed.
+    """
+    value = options.get(HEARTBEAT_OPTION)
+    if not value:
+        return None
+    try:
+        interval = float(value)
+    except ValueError:
+        raise ValueError(f"Heartbeat interval '{value}' is not a number.") from None
+    if not interval > 0:
+        raise ValueError("Heartbeat interval must be positive.")
+    return interval
+
+
+def ping_frame(protocol=TEXT):
+    return encode_command(OP_PING) if protocol == BINARY else encode_frame(PING)
+
+
+def pong_frame(protocol=TEXT):
+    return encode_command(OP_PONG) if protocol == BINARY else encode_frame(PONG)
+
+
+def is_ping(data, protocol=TEXT):
+    """Whether a received frame (without its length prefix) is a PING."""
+    return data == (bytes([OP_PING]) if protocol == BINARY else PING)
+
+
+def is_pong(data, protocol=TEXT):
+    """Whether a received frame (without its length prefix) is a PONG."""
+    return data == (bytes([OP_PONG]) if protocol == BINARY else PONG)
+
+
+def enable_keepalive(sock, idle=DEFAULT_TCP_KEEPALIVE, probes=KEEPALIVE_PROBES):
+    """
+    Turns on TCP keepalive: after `idle` silent seconds the kernel sends up
+    to `probes` probes, idle / probes seconds apart, so a dead peer is
+    detected within about twice `idle`. Options this platform lacks are
+    left at the system defaults.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    idle = max(1, int(idle))
+    for name, value in (
+        ("TCP_KEEPIDLE", idle),
+        ("TCP_KEEPINTVL", max(1, idle // probes)),
+        ("TCP_KEEPCNT", probes),
+    ):
+        option = getattr(socket, name, None)
+        if option is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+            except OSError:
+                pass
+
+
+class IdleMonitor:
+    """
+    Closes connections that have been silent for longer than their timeout.
+    Connections are keyed by any hashable; `close` is called, outside the
+    monitor's lock, when a connection times out.
+
+        monitor.watch(conn, timeout, close)   # after the handshake
+        monitor.seen(conn)                     # after every read
+        monitor.forget(conn)                   # when the connection ends
+        monitor.sweep(time.monotonic())        # periodically
+    """
+
+    def __init__(self, tick=DEFAULT_TICK):
+        self.tick = tick
+        self.expired = 0  # Connections closed for being silent
+        self._wheel = TimerWheel(tick, now=time.monotonic())
+        self._watched = {}  # key -> (timeout, close)
+        self._last_seen = {}  # key -> time.monotonic() of the last read
+        self._lock = threading.Lock()
+
+    def watch(self, key, timeout, close):
+        now = time.monotonic()
+        with self._lock:
+            self._watched[key] = (timeout, close)
+            self._last_seen[key] = now
+        self._wheel.schedule(key, now + timeout)
+
+    def seen(self, key):
+        """
+        Records activity; a lock-free dict store, cheap enough for every read.
+        Call it only from the connection's own reader, which also forgets it.
+        """
+        if key in self._last_seen:
+            self._last_seen[key] = time.monotonic()
+
+    def forget(self, key):
+        with self._lock:
+            self._watched.pop(key, None)
+            self._last_seen.pop(key, None)
+        self._wheel.cancel(key)
+
+    def sweep(self, now):
+        """Closes the connections whose timeout passed. Returns how many."""
+        closes = []
+        with self._lock:
+            for key in self._wheel.expire(now):
+                watched = self._watched.get(key)
+                if watched is None:
+                    continue
+                timeout, close = watched
+                deadline = self._last_seen[key] + timeout
+                if deadline > now:
+                    self._wheel.schedule(key, deadline)  # Heard from since it was scheduled
+                    continue
+                del self._watched[key]
+                del self._last_seen[key]
+                closes.append(close)
+        for close in closes:
+            close()
+        self.expired += len(closes)
+        return len(closes)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._watched)
+
+
+def start_heartbeat(sock, interval, protocol=TEXT, lock=None):
+    """
+    Client side: sends a PING every `interval` seconds from a daemon thread
+    until the socket fails. `lock`, if given, is held around each send so
+    PINGs do not interleave with the caller's own writes.
+    """
+    frame = ping_frame(protocol)
+    lock = lock or threading.Lock()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with lock:
+                    sock.sendall(frame)
+            except OSError:
+                return
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def drop_pings(frames, protocol=TEXT):
+    """Removes the PINGs from a batch of frames. Returns (other frames, whether any was a PING)."""
+    ping = bytes([OP_PING]) if protocol == BINARY else PING
+    if ping not in frames:
+        return frames, False
+    return [frame for frame in frames if frame != ping], True
+
+
+def drop_pongs(frames, protocol=TEXT):
+    """Removes the PONGs from a batch of received frames."""
+    pong = bytes([OP_PONG]) if protocol == BINARY else PONG
+    return [frame for frame in frames if frame != pong] if pong in frames else frames
+
+
+def close_quietly(sock):
+    """Shuts a socket down, waking up the threads blocked on it; they close it."""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
@@ -0,0 +1,405 @@
+"""
+Priority lanes: weighted fair scheduling of publishes between topics.
+
+Without lanes, every publisher's connection routes its own publishes as
+they arrive, so a burst on a bulk topic (say LOGS) takes the CPU, and the
+subscriber queues, ahead of a latency-critical topic (say ORDERS) that
+publishes a moment later. With --priority rules, publishers' connections
+only put their publishes in the lane of their topic's class, and one
+dispatcher routes them, lane by lane:
+
+    high    weight 16
+    normal  weight 4   (topics without a rule)
+    bulk    weight 1
+
+The dispatcher runs deficit round robin (DRR) over the lanes that have
+publishes. Each visit adds the lane's weight times QUANTUM_BYTES to its
+deficit and routes its oldest publishes while their size fits in the
+deficit; an emptied lane's deficit is reset. Every lane therefore gets a
+share of the routing work in proportion to its weight, in bytes, and a
+high-priority publish waits at most for one visit of each other lane, not
+for a whole burst. Publishes keep their order within a lane.
+
+High-priority publishes only queue when they have to: if none are waiting
+or being routed, the connection that read them routes them itself, as
+without lanes, and does not wait for the dispatcher to get to them.
+
+Lanes are bounded. A publisher whose lane is full waits, so a burst backs
+up into that publisher's own connection (TCP flow control) instead of the
+broker's memory or the other lanes.
+
+submit() may return before its publishes are routed. Whoever must wait for
+that, such as the PUBACK of a QoS-1 publisher, passes an `on_routed`
+callback; the dispatcher calls it once the last of them is routed. The
+callback must not block: a PUBACK is queued on the publisher's own
+outbound queue (ACK_QUEUE_SIZE), never written to its socket by the
+dispatcher, so a publisher that stops reading cannot stall every lane.
+"""
+
+import asyncio
+import threading
+from collections import deque
+
+from common.topic_trie import TopicTrie, validate_pattern
+
+HIGH = "high"
+NORMAL = "normal"
+BULK = "bulk"
+LANES = (HIGH, NORMAL, BULK)  # Also the order the dispatcher visits them in
+DEFAULT_WEIGHTS = {HIGH: 16, NORMAL: 4, BULK: 1}
+QUANTUM_BYTES = 4096  # Deficit a lane of weight 1 gains per visit
+PUBLISH_OVERHEAD = 64  # Bytes a publish is charged on top of its payload and topic
+DEFAULT_LANE_SIZE = 65536  # Publishes waiting per lane before publishers wait
+ACK_QUEUE_SIZE = 16  # Frames queued for a QoS-1 publisher; PUBACKs are cumulative, so the oldest may go
+
+
+def parse_priority_rule(rule):
+    """Parses a --priority rule "PATTERN=CLASS" into (pattern, lane). Raises ValueError."""
+    pattern, separator, lane = rule.partition("=")
+    pattern = pattern.strip().upper()
+    lane = lane.strip().lower()
+    if not separator or lane not in LANES:
+        raise ValueError(f"Priority rule '{rule}' is not PATTERN=high, normal or bulk.")
+    validate_pattern(pattern)
+    return pattern, lane
+
+
+def parse_weights(text):
+    """Parses --lane-weights "high=16,normal=4,bulk=1"; missing lanes keep their default."""
+    weights = dict(DEFAULT_WEIGHTS)
+    for field in text.split(","):
+        if not field.strip():
+            continue
+        lane, _, weight = field.partition("=")
+        lane = lane.strip().lower()
+        try:
+            weight = int(weight)
+        except ValueError:
+            weight = 0
+        if lane not in LANES or weight < 1:
+            raise ValueError(f"Lane weight '{field.strip()}' is not high, normal or bulk=<N >= 1>.")
+        weights[lane] = weight
+    return weights
+
+
+class PriorityPolicy:
+    """
+    The lane of each topic, from rules matched against the topic; the first
+    matching rule wins, and topics without one are NORMAL. Lookups are
+    cached per topic.
+    """
+
+    def __init__(self, rules=()):
+        self._rules = TopicTrie()
+        self._count = 0
+        self._cache = {}  # topic -> lane
+        for rule in rules:
+            self.add(*rule)
+
+    def add(self, pattern, lane):
+        self._rules.add(pattern, (self._count, lane))
+        self._count += 1
+        self._cache.clear()
+
+    def for_topic(self, topic):
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        matched = self._rules.match(topic) if self._count else ()
+        lane = self._cache[topic] = min(matched)[1] if matched else NORMAL
+        return lane
+
+    def __len__(self):
+        return self._count
+
+
+def publish_cost(publish):
+    """Bytes a (topic, content, compressed) publish is charged in its lane's deficit."""
+    published_topic, published_content, compressed = publish
+    size = len(published_content) if compressed is None else len(compressed[1])
+    return size + len(published_topic) + PUBLISH_OVERHEAD
+
+
+class DeficitRoundRobin:
+    """The lanes and their deficits. Not thread-safe; the schedulers below guard it."""
+
+    def __init__(self, weights=DEFAULT_WEIGHTS, lane_size=DEFAULT_LANE_SIZE):
+        self.weights = weights
+        self.lane_size = lane_size
+        self.lanes = {lane: deque() for lane in LANES}
+        self.routed = dict.fromkeys(LANES, 0)  # Publishes routed from each lane, queued or not
+        self.routing = dict.fromkeys(LANES, 0)  # Batches of each lane being routed now
+        self._deficits = dict.fromkeys(LANES, 0)
+        self._turn = 0  # Index in LANES of the lane visited next
+        self.waiting = 0  # Publishes in all lanes
+        self._pushed = dict.fromkeys(LANES, 0)  # Publishes ever put in each lane
+        self._taken = dict.fromkeys(LANES, 0)  # Publishes ever taken from each lane
+        self._callbacks = {lane: deque() for lane in LANES}  # (_pushed count, on_routed)
+
+    def room(self, lane):
+        return self.lane_size - len(self.lanes[lane])
+
+    def push(self, lane, publishes, on_routed=None):
+        """Queues publishes; `on_routed` goes with the batch that takes the last of them."""
+        self.lanes[lane].extend(publishes)
+        self.waiting += len(publishes)
+        self._pushed[lane] += len(publishes)
+        if on_routed is not None:
+            self._callbacks[lane].append((self._pushed[lane], on_routed))
+
+    def clear(self, lane):
+        """True if publishes of the lane may skip the dispatcher: see the module docstring."""
+        return lane == HIGH and not self.lanes[lane] and not self.routing[lane]
+
+    def begin(self, lane, count):
+        """Marks a batch of `count` publishes of a lane as being routed."""
+        self.routing[lane] += 1
+        self.routed[lane] += count
+
+    def done(self, lane):
+        self.routing[lane] -= 1
+
+    def next_batch(self):
+        """
+        Visits the lanes in turn and returns (lane, publishes, callbacks) for
+        the first one whose deficit covers its oldest publish: the publishes
+        the deficit covers, oldest first, and the on_routed callbacks to call
+        once they are routed. Returns None if all lanes are empty.
+
+        Deficit a lane does not spend is kept for its next visit, so a
+        publish larger than one quantum goes once the lane has saved up for
+        it. The caller calls done(lane) once the batch is routed.
+        """
+        if not self.waiting:
+            return None
+        while True:
+            lane = LANES[self._turn]
+            self._turn = (self._turn + 1) % len(LANES)
+            queue = self.lanes[lane]
+            if not queue:
+                self._deficits[lane] = 0
+                continue
+            deficit = self._deficits[lane] + self.weights[lane] * QUANTUM_BYTES
+            batch = []
+            while queue:
+                cost = publish_cost(queue[0])
+                if cost > deficit:
+                    break
+                deficit -= cost
+                batch.append(queue.popleft())
+            self._deficits[lane] = deficit if queue else 0
+            if not batch:
+                continue  # Saving up for a large publish; the other lanes go first
+            self.waiting -= len(batch)
+            self.begin(lane, len(batch))
+            self._taken[lane] += len(batch)
+            callbacks = []
+            pending = self._callbacks[lane]
+            while pending and pending[0][0] <= self._taken[lane]:
+                callbacks.append(pending.popleft()[1])
+            return lane, batch, callbacks
+
+
+class LaneScheduler:
+    """
+    Threaded mode: connections submit() publishes, one dispatcher thread
+    routes them with `route(lane, publishes)` in DRR order.
+    """
+
+    def __init__(self, policy, route, weights=DEFAULT_WEIGHTS, lane_size=DEFAULT_LANE_SIZE):
+        self.policy = policy
+        self.drr = DeficitRoundRobin(weights, lane_size)
+        self._route = route
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, publishes, on_routed=None):
+        """
+        Routes high-priority publishes right away if their lane is clear,
+        otherwise puts publishes in their lanes, waiting while a lane is full.
+        `on_routed()` is called, by this or the dispatcher thread, once all
+        of them are routed.
+        """
+        groups, on_routed = split_submit(self.policy, publishes, on_routed)
+        for lane, lane_publishes in groups:
+            with self._changed:
+                clear = self.drr.clear(lane)
+                if clear:
+                    self.drr.begin(lane, len(lane_publishes))
+                while lane_publishes and not clear:
+                    room = self.drr.room(lane)
+                    if room <= 0:
+                        self._changed.wait()
+                        continue
+                    rest = lane_publishes[room:]
+                    self.drr.push(lane, lane_publishes[:room], None if rest else on_routed)
+                    lane_publishes = rest
+                    self._changed.notify_all()
+            if clear:
+                try:
+                    self._route(lane, lane_publishes)
+                finally:
+                    with self._changed:
+                        self.drr.done(lane)
+                if on_routed is not None:
+                    on_routed()
+
+    def depths(self):
+        return {lane: len(queue) for lane, queue in self.drr.lanes.items()}
+
+    def _run(self):
+        while True:
+            with self._changed:
+                batch = self.drr.next_batch()
+                while batch is None:
+                    self._changed.wait()
+                    batch = self.drr.next_batch()
+                self._changed.notify_all()  # Room for publishers waiting on a full lane
+            lane, publishes, callbacks = batch
+            try:
+                self._route(lane, publishes)
+            finally:
+                with self._changed:
+                    self.drr.done(lane)
+            for on_routed in callbacks:
+                on_routed()
+
+
+class AsyncLaneScheduler:
+    """
+    asyncio mode: LaneScheduler on the event loop. The dispatcher task
+    yields after every batch, so reading the next publishes, and writing
+    to subscribers, goes on between them.
+    """
+
+    def __init__(self, policy, route, weights=DEFAULT_WEIGHTS, lane_size=DEFAULT_LANE_SIZE):
+        self.policy = policy
+        self.drr = DeficitRoundRobin(weights, lane_size)
+        self._route = route
+        self._changed = None
+        self._task = None
+
+    def start(self):
+        self._changed = asyncio.Condition()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, publishes, on_routed=None):
+        groups, on_routed = split_submit(self.policy, publishes, on_routed)
+        for lane, lane_publishes in groups:
+            if self.drr.clear(lane):
+                # Routing does not await, so nothing else runs until it is done
+                self.drr.begin(lane, len(lane_publishes))
+                try:
+                    self._route(lane, lane_publishes)
+                finally:
+                    self.drr.done(lane)
+                if on_routed is not None:
+                    on_routed()
+                continue
+            async with self._changed:
+                while lane_publishes:
+                    room = self.drr.room(lane)
+                    if room <= 0:
+                        await self._changed.wait()
+                        continue
+                    rest = lane_publishes[room:]
+                    self.drr.push(lane, lane_publishes[:room], None if rest else on_routed)
+                    lane_publishes = rest
+                    self._changed.notify_all()
+
+    def depths(self):
+        return {lane: len(queue) for lane, queue in self.drr.lanes.items()}
+
+    async def _run(self):
+        while True:
+            async with self._changed:
+                batch = self.drr.next_batch()
+                while batch is None:
+                    await self._changed.wait()
+                    batch = self.drr.next_batch()
+                self._changed.notify_all()
+            lane, publishes, callbacks = batch
+            try:
+                self._route(lane, publishes)
+            finally:
+                self.drr.done(lane)
+            for on_routed in callbacks:
+                on_routed()
+            await asyncio.sleep(0)
+
+
+def split_lanes(policy, publishes):
+    """Groups publishes by lane, keeping their order: [(lane, publishes), ...]."""
+    by_lane = {}
+    for publish in publishes:
+        by_lane.setdefault(policy.for_topic(publish[0]), []).append(publish)
+    return by_lane.items()
+
+
+def split_submit(policy, publishes, on_routed):
+    """
+    split_lanes() for submit(), and the callback each lane's share calls
+    once routed: `on_routed` itself after the last share. Without publishes
+    `on_routed` is called right away.
+    """
+    groups = list(split_lanes(policy, publishes))
+    if on_routed is None or len(groups) == 1:
+        return groups, on_routed
+    if not groups:
+        on_routed()
+        return groups, None
+    return groups, RoutedCountdown(len(groups), on_routed)
+
+
+class RoutedCountdown:
+    """Calls `on_routed` when it has been called `count` times. Thread-safe."""
+
+    def __init__(self, count, on_routed):
+        self._count = count
+        self._on_routed = on_routed
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self._count -= 1
+            if self._count:
+                return
+        self._on_routed()
+
+
+class RoutedAcks:
+    """
+    The cumulative PUBACKs of one QoS-1 publisher with lanes. The publishes
+    of a read can be routed before those of an earlier read (a high lane
+    overtakes a bulk one), but "PUBACK:<n>" covers every frame up to n, so
+    it is only sent once every earlier read has been routed too.
+
+        acks = RoutedAcks(send)  # send(n) queues the PUBACK, without blocking
+        lanes.submit(publishes, acks.read(received))
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self._reads = deque()  # [frames received up to this read, routed?], oldest first
+        self._lock = threading.Lock()
+
+    def read(self, received):
+        """Registers a read; returns the on_routed callback of its publishes."""
+        entry = [received, False]
+        with self._lock:
+            self._reads.append(entry)
+
+        def routed():
+            with self._lock:
+                entry[1] = True
+                acknowledged = None
+                while self._reads and self._reads[0][1]:
+                    acknowledged = self._reads.popleft()[0]
+                if acknowledged is not None:
+                    self._send(acknowledged)
+
+        return routed
@@ -0,0 +1,26 @@
+"""
+Process resource limits needed to hold many sockets open at once.
+"""
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def raise_open_file_limit():
+    """
+    Raises the soft limit on open file descriptors to the hard limit, so one
+    process can hold tens of thousands of client sockets.
+    Returns the resulting soft limit, or None if it cannot be queried.
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
@@ -0,0 +1,27 @@
+"""
+Leveled logging for the servers.
+
+Servers log through logging.getLogger(SERVER_LOGGER). Connection events are
+logged at INFO and every message at DEBUG, so at the default level the
+per-message lines cost nothing; code on the hot path checks
+log.isEnabledFor(logging.DEBUG) once instead of formatting lines that
+would be dropped.
+"""
+
+import logging
+import sys
+
+SERVER_LOGGER = "server"
+LOG_LEVELS = ("debug", "info", "warning", "error")
+DEFAULT_LOG_LEVEL = "info"
+
+
+def configure_logging(level=DEFAULT_LOG_LEVEL, prefix="[SERVER] "):
+    """Sends the server log to stdout, each line starting with `prefix`."""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(f"{prefix}%(message)s"))
+    logger = logging.getLogger(SERVER_LOGGER)
+    logger.handlers[:] = [handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    return logger
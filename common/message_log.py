@@ -0,0 +1,400 @@
+"""
+Append-only, per-topic message log for replaying what a subscriber missed.
+
+Each topic has its own directory of segment files. A segment stores the
+outbound frames exactly as subscribers receive them, so replay streams
+byte ranges of the files straight to the socket with sendfile() instead of
+loading messages into Python objects. Next to each segment, a sparse index
+records the offset, file position and timestamp of one message every
+INDEX_INTERVAL bytes; a lookup binary-searches the index and walks the
+frame headers from there, both through mmap.
+
+    <log dir>/<topic>/00000000000000000000.log     frames
+    <log dir>/<topic>/00000000000000000000.index   (offset, position, timestamp) entries
+
+A message's offset is its sequence number within its topic, starting at 0.
+Retention deletes whole segments, oldest first, once a topic's log is
+larger than `retention_bytes` or a segment's newest message is older than
+`retention_seconds`. The active segment is never deleted, but once its
+newest message is older than `retention_seconds` it is rolled over to an
+empty one. MessageLog.sweep() applies age-based retention to every topic at
+most once per RETENTION_CHECK_INTERVAL; servers call it from housekeeping,
+so a topic nobody publishes on any more still loses its expired segments.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+from urllib.parse import quote, unquote
+
+from common.framing import HEADER, HEADER_SIZE, LENGTH_MASK
+
+INDEX_ENTRY = struct.Struct("!QQd")  # Offset, position in the segment, timestamp
+INDEX_INTERVAL = 4096  # Bytes of frames between two index entries
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024  # Roll over to a new segment past this size
+RETENTION_CHECK_INTERVAL = 60.0  # Seconds between two age-based retention sweeps
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".index"
+
+
+def parse_replay_options(options):
+    """
+    Reads the replay position from handshake options ("offset" or "from_ts").
+    Returns keyword arguments for MessageLog.replay(), or None if the
+    subscriber did not ask for a replay. Raises ValueError for bad values.
+    """
+    if "offset" in options:
+        offset = int(options["offset"])
+        if offset < 0:
+            raise ValueError(f"Replay offset must not be negative, got {offset}.")
+        return {"offset": offset}
+    if "from_ts" in options:
+        return {"from_ts": float(options["from_ts"])}
+    return None
+
+
+class _Segment:
+    """One log file and its sparse index. Callers hold the topic lock."""
+
+    def __init__(self, directory, base_offset):
+        self.base_offset = base_offset
+        self.log_path = os.path.join(directory, f"{base_offset:020d}{LOG_SUFFIX}")
+        self.index_path = os.path.join(directory, f"{base_offset:020d}{INDEX_SUFFIX}")
+        self.next_offset = base_offset
+        # Size of an existing segment; recovered exactly once opened for appending
+        self.size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        self._indexed_position = None  # Position of the last index entry
+        self._log_file = None
+        self._index_file = None
+
+    def open_for_append(self):
+        """Opens the files for appending, recovering the state of an existing segment."""
+        self._log_file = open(self.log_path, "ab", buffering=0)
+        self._index_file = open(self.index_path, "ab", buffering=0)
+        self._recover()
+
+    def close(self):
+        for file in (self._log_file, self._index_file):
+            if file:
+                file.close()
+        self._log_file = self._index_file = None
+
+    def append(self, frame, timestamp):
+        """Appends one frame and returns its offset."""
+        if (
+            self._indexed_position is None
+            or self.size - self._indexed_position >= INDEX_INTERVAL
+        ):
+            entry = INDEX_ENTRY.pack(self.next_offset, self.size, timestamp)
+            self._index_file.write(entry)
+            self._indexed_position = self.size
+        self._log_file.write(frame)
+        self.size += len(frame)
+        self.next_offset += 1
+        return self.next_offset - 1
+
+    def first_timestamp(self):
+        """Timestamp of the segment's first message (always indexed), or None if empty."""
+        entries = self._index_entries()
+        return entries[0][2] if entries else None
+
+    def last_indexed_timestamp(self):
+        """Timestamp of the newest indexed message, or None if empty."""
+        entries = self._index_entries()
+        return entries[-1][2] if entries else None
+
+    def position_of_offset(self, offset):
+        """File position of the message with the given offset (or the end)."""
+        entries = self._index_entries()
+        # Last index entry at or before the offset, then walk the frame headers
+        low, high = 0, len(entries)
+        while low < high:
+            middle = (low + high) // 2
+            if entries[middle][0] <= offset:
+                low = middle + 1
+            else:
+                high = middle
+        current, position = self.base_offset, 0
+        if low:
+            current, position, _ = entries[low - 1]
+        return self._walk(position, offset - current)
+
+    def position_of_time(self, timestamp):
+        """
+        File position to replay from so that every message at or after the
+        timestamp is included. The index is sparse, so up to INDEX_INTERVAL
+        bytes of slightly older messages may be included too.
+        """
+        entries = self._index_entries()
+        low, high = 0, len(entries)
+        while low < high:
+            middle = (low + high) // 2
+            if entries[middle][2] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return 0
+        return entries[low - 1][1]
+
+    def _index_entries(self):
+        """Reads the index entries through mmap."""
+        count = os.path.getsize(self.index_path) // INDEX_ENTRY.size
+        if not count:
+            return []
+        with open(self.index_path, "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as index:
+            return [
+                INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)
+                for i in range(count)
+            ]
+
+    def _walk(self, position, frames):
+        """Skips `frames` frame headers from a position, through mmap, without copying payloads."""
+        if frames <= 0 or position >= self.size:
+            return position
+        with open(self.log_path, "rb") as file, mmap.mmap(
+            file.fileno(), self.size, access=mmap.ACCESS_READ
+        ) as log:
+            while frames and position + HEADER_SIZE <= self.size:
+                (header,) = HEADER.unpack_from(log, position)
+                position += HEADER_SIZE + (header & LENGTH_MASK)
+                frames -= 1
+        return min(position, self.size)
+
+    def _recover(self):
+        """Counts the frames of an existing segment and drops a torn last frame."""
+        size = os.path.getsize(self.log_path)
+        entries = [entry for entry in self._index_entries() if entry[1] < size]
+        if len(entries) * INDEX_ENTRY.size != os.path.getsize(self.index_path):
+            # Drop index entries past the end of the log (or a torn entry)
+            self._index_file.truncate(len(entries) * INDEX_ENTRY.size)
+        offset, position = self.base_offset, 0
+        if entries:
+            offset, position, _ = entries[-1]
+            self._indexed_position = position
+        if size:
+            with open(self.log_path, "rb") as file, mmap.mmap(
+                file.fileno(), size, access=mmap.ACCESS_READ
+            ) as log:
+                while position + HEADER_SIZE <= size:
+                    (header,) = HEADER.unpack_from(log, position)
+                    frame_end = position + HEADER_SIZE + (header & LENGTH_MASK)
+                    if frame_end > size:
+                        break
+                    position = frame_end
+                    offset += 1
+        if position != size:
+            self._log_file.truncate(position)  # A frame cut short by a crash
+        self.size = position
+        self.next_offset = offset
+
+
+class TopicLog:
+    """The segments of one topic."""
+
+    def __init__(self, directory, segment_bytes, retention_bytes, retention_seconds):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        base_offsets = sorted(
+            int(name[: -len(LOG_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(LOG_SUFFIX)
+        )
+        self._segments = [_Segment(directory, base) for base in base_offsets or [0]]
+        self._segments[-1].open_for_append()
+        # Timestamps never go backwards within a topic, which keeps time lookups a binary search
+        self._last_timestamp = self._segments[-1].last_indexed_timestamp() or 0.0
+
+    def append(self, frame, timestamp=None):
+        """Appends one frame and returns its offset."""
+        with self._lock:
+            active = self._segments[-1]
+            rolled = active.size and active.size + len(frame) > self.segment_bytes
+            if rolled:
+                active.close()
+                active = _Segment(self.directory, active.next_offset)
+                active.open_for_append()
+                self._segments.append(active)
+            if timestamp is None:
+                timestamp = time.time()
+            self._last_timestamp = max(self._last_timestamp, timestamp)
+            offset = active.append(frame, self._last_timestamp)
+            if rolled:
+                self._apply_retention()
+            return offset
+
+    def end_offset(self):
+        """Offset the next appended message will get."""
+        with self._lock:
+            return self._segments[-1].next_offset
+
+    def start_offset(self):
+        """Offset of the oldest message still retained."""
+        with self._lock:
+            return self._segments[0].base_offset
+
+    def replay(self, offset=None, from_ts=None):
+        """
+        Returns the (file, position, count) byte ranges holding every message
+        from the given offset or timestamp up to now, oldest first. The files
+        are opened here, so the ranges stay readable even if retention deletes
+        the segments; the caller sends them with sendfile() and closes them.
+        """
+        with self._lock:
+            segments = list(self._segments)
+            ranges = []
+            for index, segment in enumerate(segments):
+                if segment.size == 0:
+                    continue
+                following = segments[index + 1] if index + 1 < len(segments) else None
+                if offset is not None:
+                    if following and following.base_offset <= offset:
+                        continue  # Every message of this segment is before the offset
+                    position = segment.position_of_offset(offset)
+                elif from_ts is not None:
+                    # No message here is newer than the next segment's first one
+                    following_ts = following.first_timestamp() if following else None
+                    if following_ts is not None and following_ts < from_ts:
+                        continue
+                    position = segment.position_of_time(from_ts)
+                else:
+                    position = 0
+                if position < segment.size:
+                    ranges.append(
+                        (open(segment.log_path, "rb"), position, segment.size - position)
+                    )
+                # Later segments are replayed from their start
+                offset = from_ts = None
+            return ranges
+
+    def expire(self, now=None):
+        """
+        Applies age-based retention without waiting for the next roll-over:
+        rolls the active segment over once its newest message is too old,
+        then deletes the expired segments. Returns how many were deleted.
+        """
+        if not self.retention_seconds:
+            return 0
+        if now is None:
+            now = time.time()
+        with self._lock:
+            active = self._segments[-1]
+            if active.size and self._last_timestamp < now - self.retention_seconds:
+                active.close()
+                active = _Segment(self.directory, active.next_offset)
+                active.open_for_append()
+                self._segments.append(active)
+            return self._apply_retention(now)
+
+    def close(self):
+        with self._lock:
+            self._segments[-1].close()
+
+    def _apply_retention(self, now=None):
+        """
+        Deletes the oldest inactive segments that are too old or over the size
+        limit. Returns how many were deleted.
+        """
+        total = sum(segment.size for segment in self._segments)
+        if now is None:
+            now = time.time()
+        deleted = 0
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            too_big = self.retention_bytes and total > self.retention_bytes
+            # The oldest segment's newest message is no newer than the next segment's first
+            newest = self._segments[1].first_timestamp()
+            if newest is None:
+                newest = self._last_timestamp  # The next one is an empty active segment
+            too_old = self.retention_seconds and newest < now - self.retention_seconds
+            if not (too_big or too_old):
+                break
+            os.remove(oldest.log_path)
+            os.remove(oldest.index_path)
+            total -= oldest.size
+            del self._segments[0]
+            deleted += 1
+        return deleted
+
+
+class MessageLog:
+    """
+    Per-topic logs under one directory. Thread-safe; appends to different
+    topics do not contend.
+
+    retention_bytes / retention_seconds of 0 (or None) keep messages forever.
+    """
+
+    def __init__(
+        self,
+        directory,
+        segment_bytes=DEFAULT_SEGMENT_BYTES,
+        retention_bytes=None,
+        retention_seconds=None,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self._topics = {}
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0  # Monotonic time of the next age-based retention sweep
+        os.makedirs(directory, exist_ok=True)
+
+    def topic_log(self, topic):
+        """Returns the log of a topic, opening (or creating) it on first use."""
+        log = self._topics.get(topic)
+        if log is None:
+            with self._lock:
+                log = self._topics.get(topic)
+                if log is None:
+                    # Quote the topic so it is always a single, safe directory name
+                    path = os.path.join(self.directory, quote(topic, safe=""))
+                    log = self._topics[topic] = TopicLog(
+                        path, self.segment_bytes, self.retention_bytes, self.retention_seconds
+                    )
+        return log
+
+    def append(self, topic, frame, timestamp=None):
+        """Appends an encoded outbound frame to a topic's log and returns its offset."""
+        return self.topic_log(topic).append(frame, timestamp)
+
+    def replay(self, topic, offset=None, from_ts=None):
+        """Byte ranges of a topic's messages since an offset or timestamp; see TopicLog.replay."""
+        if topic not in self._topics and not os.path.isdir(
+            os.path.join(self.directory, quote(topic, safe=""))
+        ):
+            return []  # Nothing was ever logged for this topic
+        return self.topic_log(topic).replay(offset, from_ts)
+
+    def topics(self):
+        """Every topic that has a log on disk."""
+        return sorted(
+            unquote(name)
+            for name in os.listdir(self.directory)
+            if os.path.isdir(os.path.join(self.directory, name))
+        )
+
+    def sweep(self):
+        """
+        Applies age-based retention to every topic on disk, at most once per
+        RETENTION_CHECK_INTERVAL. Returns how many segments were deleted.
+        """
+        if not self.retention_seconds or time.monotonic() < self._next_sweep:
+            return 0
+        self._next_sweep = time.monotonic() + RETENTION_CHECK_INTERVAL
+        now = time.time()
+        return sum(self.topic_log(topic).expire(now) for topic in self.topics())
+
+    def close(self):
+        with self._lock:
+            for log in self._topics.values():
+                log.close()
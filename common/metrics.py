@@ -0,0 +1,198 @@
+"""
+Broker metrics: hot-path counters, latency histograms and gauges, served
+as Prometheus-style text over HTTP.
+
+Counters and histograms are sharded per thread. A thread only ever updates
+its own shard, a plain dict, so recording a value takes no lock and never
+contends with other client threads. The shards are summed when the metrics
+are read. Gauges (connection counts, queue depths) are callbacks evaluated
+on every read.
+
+    curl http://127.0.0.1:<metrics port>/metrics
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets, in microseconds: 1, 2, 4, ... ~1 s
+HISTOGRAM_BUCKETS = 21
+
+
+class _Shard:
+    """One thread's counters and histograms."""
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}  # (name, label value) -> count
+        self.histograms = {}  # name -> [bucket counts..., overflow, sum in seconds]
+
+
+class Metrics:
+    """
+    A registry of named counters, histograms and gauges. Each metric may
+    have one label (e.g. "topic"), given when it is declared.
+    """
+
+    def __init__(self):
+        self._descriptions = {}  # name -> (kind, help text, label name)
+        self._gauges = {}  # name -> callback
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard(None)  # Totals of threads that have exited
+        self._lock = threading.Lock()  # Guards _shards and _retired, not the hot path
+        self._fold_at = 64
+
+    def counter(self, name, help_text, label=None):
+        self._descriptions[name] = ("counter", help_text, label)
+
+    def histogram(self, name, help_text):
+        self._descriptions[name] = ("histogram", help_text, None)
+
+    def gauge(self, name, help_text, callback, label=None):
+        """callback() returns a number, or a {label value: number} dict for a labelled gauge."""
+        self._descriptions[name] = ("gauge", help_text, label)
+        self._gauges[name] = callback
+
+    def inc(self, name, amount=1, label=None):
+        """Adds to a counter; only touches the calling thread's shard."""
+        counters = self._shard().counters
+        key = (name, label)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, seconds):
+        """Records one duration in a histogram with power-of-two microsecond buckets."""
+        histograms = self._shard().histograms
+        buckets = histograms.get(name)
+        if buckets is None:
+            buckets = histograms[name] = [0] * (HISTOGRAM_BUCKETS + 2)
+        buckets[min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS)] += 1
+        buckets[-1] += seconds
+
+    def counters(self):
+        """Sums every thread's counters: {(name, label value): count}."""
+        totals = {}
+        for shard in self._snapshot():
+            for key, value in shard.counters.copy().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def histograms(self):
+        """Sums every thread's histograms: {name: [bucket counts..., overflow, sum]}."""
+        totals = {}
+        for shard in self._snapshot():
+            for name, buckets in shard.histograms.copy().items():
+                total = totals.setdefault(name, [0] * len(buckets))
+                for index, value in enumerate(list(buckets)):
+                    total[index] += value
+        return totals
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        counters = self.counters()
+        histograms = self.histograms()
+        lines = []
+        for name, (kind, help_text, label) in self._descriptions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                values = {
+                    label_value: count
+                    for (counter_name, label_value), count in counters.items()
+                    if counter_name == name
+                }
+                lines.extend(_samples(name, label, values or {None: 0}))
+            elif kind == "gauge":
+                values = self._gauges[name]()
+                if not isinstance(values, dict):
+                    values = {None: values}
+                lines.extend(_samples(name, label, values))
+            else:
+                lines.extend(_histogram_samples(name, histograms.get(name)))
+        return "\n".join(lines) + "\n"
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+                if len(self._shards) >= self._fold_at:
+                    # A thread per client leaves a shard per client behind; fold them
+                    self._fold_exited()
+                    self._fold_at = max(64, 2 * len(self._shards))
+            return shard
+
+    def _snapshot(self):
+        with self._lock:
+            self._fold_exited()
+            return [self._retired, *self._shards]
+
+    def _fold_exited(self):
+        """Merges the shards of exited threads into _retired. Call with _lock held."""
+        alive = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+                continue
+            for key, value in shard.counters.items():
+                self._retired.counters[key] = self._retired.counters.get(key, 0) + value
+            for name, buckets in shard.histograms.items():
+                total = self._retired.histograms.setdefault(name, [0] * len(buckets))
+                for index, value in enumerate(buckets):
+                    total[index] += value
+        self._shards = alive
+
+
+def _label_text(label, value):
+    if label is None or value is None:
+        return ""
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{{{label}="{escaped}"}}'
+
+
+def _samples(name, label, values):
+    ordered = sorted(values.items(), key=lambda item: str(item[0]))
+    return [f"{name}{_label_text(label, value)} {count}" for value, count in ordered]
+
+
+def _histogram_samples(name, buckets):
+    buckets = buckets or [0] * (HISTOGRAM_BUCKETS + 2)
+    lines = []
+    cumulative = 0
+    for index in range(HISTOGRAM_BUCKETS):
+        cumulative += buckets[index]
+        upper = (2**index) / 1e6  # Bucket i holds durations below 2**i microseconds
+        lines.append(f'{name}_bucket{{le="{upper:g}"}} {cumulative}')
+    cumulative += buckets[HISTOGRAM_BUCKETS]
+    lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+    lines.append(f"{name}_sum {buckets[-1]:.6f}")
+    lines.append(f"{name}_count {cumulative}")
+    return lines
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """
+    Serves metrics.render() at http://host:port/metrics from a daemon thread.
+    Returns the HTTP server.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are not worth a log line each
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,280 @@
+"""
+Per-subscriber outbound queues.
+
+A publish only appends the frame to each subscriber's bounded queue; a
+writer owned by that subscriber drains the queue to its socket. A stalled
+subscriber therefore fills up its own queue instead of blocking the
+publisher, and the overflow policy decides what happens when it is full.
+
+By default a writer coalesces everything queued since its last write into
+one vectored write, so a burst on a hot topic costs each subscriber one
+syscall instead of one per message.
+
+A writer can also be given `replay` byte ranges of the message log
+((file, position, count) tuples); it streams them with sendfile() before
+any queued frame, so a reconnecting subscriber gets the messages it missed
+in order, followed by live ones.
+"""
+
+import asyncio
+import socket
+import threading
+from collections import deque
+
+from common.framing import send_frames
+
+DROP_OLDEST = "drop-oldest"  # Discard the oldest queued frame to make room
+DROP_NEWEST = "drop-newest"  # Discard the frame being published
+DISCONNECT = "disconnect"  # Disconnect the slow subscriber
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+DEFAULT_QUEUE_SIZE = 1024  # Frames buffered per subscriber
+
+
+def close_replay(replay):
+    """Closes the files of replay ranges that will not be sent."""
+    for file, _, _ in replay:
+        file.close()
+
+
+class OutboundQueue:
+    """
+    Bounded FIFO of frames waiting to be written to one subscriber.
+    Not thread-safe by itself; the writers below guard it.
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}'.")
+        self.maxsize = maxsize
+        self.policy = policy
+        self._frames = deque()
+        self.enqueued = 0  # Frames accepted into the queue
+        self.dropped = 0  # Frames discarded by the overflow policy
+
+    def put(self, frame):
+        """
+        Queues a frame, applying the overflow policy when the queue is full.
+        Returns False if the subscriber must be disconnected.
+        """
+        if len(self._frames) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                self.dropped += 1
+                return False
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return True
+            self._frames.popleft()  # DROP_OLDEST
+        self._frames.append(frame)
+        self.enqueued += 1
+        return True
+
+    def take_all(self):
+        """Removes and returns every queued frame, oldest first."""
+        frames = list(self._frames)
+        self._frames.clear()
+        return frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def stats(self):
+        """Queue depth and drop counters for this subscriber."""
+        return {
+            "depth": len(self._frames),
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+        }
+
+
+class SubscriberWriter:
+    """
+    Threaded subscriber: publishers call send(), a dedicated writer thread
+    drains the queue to the socket, with one sendmsg() per drained batch when
+    `coalesce` is on, or one sendall() per frame when it is off.
+    """
+
+    def __init__(
+        self,
+        conn,
+        addr,
+        maxsize=DEFAULT_QUEUE_SIZE,
+        policy=DROP_OLDEST,
+        coalesce=True,
+        replay=(),
+    ):
+        self.socket = conn
+        self.address = addr
+        self.queue = OutboundQueue(maxsize, policy)
+        self.coalesce = coalesce
+        self.writes = 0  # Socket write calls made
+        self.replayed = 0  # Bytes of the message log sent before live frames
+        self._replay = list(replay)
+        self.closed = False
+        self._ready = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def send(self, frame):
+        """
+        Queues a frame without blocking on the socket.
+        Returns False if the subscriber was disconnected (queue overflow or closed).
+        """
+        with self._ready:
+            if self.closed:
+                return False
+            if not self.queue.put(frame):
+                self._close_locked()
+                return False
+            self._ready.notify()
+        return True
+
+    def send_many(self, frames):
+        """Queues several frames as one unit: one lock round-trip and one wake-up."""
+        with self._ready:
+            if self.closed:
+                return False
+            for frame in frames:
+                if not self.queue.put(frame):
+                    self._close_locked()
+                    return False
+            self._ready.notify()
+        return True
+
+    def close(self):
+        """Stops the writer thread and wakes up the connection's reader."""
+        with self._ready:
+            self._close_locked()
+
+    def stats(self):
+        with self._ready:
+            return {**self.queue.stats(), "writes": self.writes, "replayed": self.replayed}
+
+    def _close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._ready.notify()
+        try:
+            # Unblocks the thread reading from this socket so it can clean up
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _run(self):
+        try:
+            for file, position, count in self._replay:
+                self.replayed += self.socket.sendfile(file, position, count)
+                self.writes += 1
+        except OSError:
+            self.close()
+            return
+        finally:
+            close_replay(self._replay)
+        while True:
+            with self._ready:
+                while not len(self.queue) and not self.closed:
+                    self._ready.wait()
+                if self.closed:
+                    return
+                frames = self.queue.take_all()
+            try:
+                if self.coalesce:
+                    self.writes += send_frames(self.socket, frames)
+                else:
+                    for frame in frames:
+                        self.socket.sendall(frame)
+                    self.writes += len(frames)
+            except OSError:
+                self.close()
+                return
+
+
+class AsyncSubscriberWriter:
+    """
+    asyncio subscriber: publishers call send(), a writer task drains the
+    queue and awaits drain() so a slow socket only backs up its own queue.
+    With `coalesce` on, each drained batch is handed to the transport in one
+    writelines() call (a single send when the socket is writable).
+    """
+
+    def __init__(
+        self,
+        writer,
+        addr,
+        maxsize=DEFAULT_QUEUE_SIZE,
+        policy=DROP_OLDEST,
+        coalesce=True,
+        replay=(),
+    ):
+        self.writer = writer
+        self.address = addr
+        self.queue = OutboundQueue(maxsize, policy)
+        self.coalesce = coalesce
+        self.writes = 0  # Transport write calls made
+        self.replayed = 0  # Bytes of the message log sent before live frames
+        self._replay = list(replay)
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def send(self, frame):
+        """
+        Queues a frame; must be called from the event loop thread.
+        Returns False if the subscriber was disconnected (queue overflow or closed).
+        """
+        if self.closed:
+            return False
+        if not self.queue.put(frame):
+            self.close()
+            return False
+        self._ready.set()
+        return True
+
+    def send_many(self, frames):
+        """Queues several frames as one unit with a single wake-up of the writer task."""
+        if self.closed:
+            return False
+        for frame in frames:
+            if not self.queue.put(frame):
+                self.close()
+                return False
+        self._ready.set()
+        return True
+
+    def close(self):
+        """Stops the writer task and aborts the transport so the reader sees EOF."""
+        if self.closed:
+            return
+        self.closed = True
+        self._task.cancel()
+        self.writer.transport.abort()
+
+    def stats(self):
+        return {**self.queue.stats(), "writes": self.writes, "replayed": self.replayed}
+
+    async def _run(self):
+        try:
+            loop = asyncio.get_running_loop()
+            try:
+                for file, position, count in self._replay:
+                    self.replayed += await loop.sendfile(
+                        self.writer.transport, file, position, count
+                    )
+                    self.writes += 1
+            finally:
+                close_replay(self._replay)
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                frames = self.queue.take_all()
+                if self.coalesce:
+                    self.writer.writelines(frames)
+                    self.writes += 1
+                else:
+                    for frame in frames:
+                        self.writer.write(frame)
+                    self.writes += len(frames)
+                await self.writer.drain()
+        except (ConnectionError, OSError, RuntimeError):  # RuntimeError: transport closing
+            self.close()
@@ -0,0 +1,323 @@
+"""
+Programmatic publisher for the topic-based server.
+
+Publisher.publish() only appends a frame to an in-memory batch; the batch
+is sent as one batch frame, with one sendall(), once it reaches batch_size
+bytes or has waited `linger` seconds. Many small messages therefore cost a
+handful of syscalls on the publisher and one routing pass on the server,
+instead of one of each per message.
+
+With protocol="binary" (see common/binary_protocol.py) each topic is
+registered once and messages then carry a 4-byte topic id instead of the
+topic name. Binary publishers may also compress payloads of at least
+compress_min_bytes with compression="zlib" or "lzma"; the server forwards
+them compressed to the subscribers that accept the codec.
+
+With qos=1 (see common/qos.py) the server acknowledges every frame it has
+routed. Up to max_unacked frames are sent ahead of the acknowledgements;
+publish() blocks when that many are outstanding, and close() returns once
+every message was acknowledged.
+
+With heartbeat=S (see common/heartbeat.py) a PING is sent every S seconds,
+so the server can tell an idle publisher from a dead one.
+
+With message_ids=True (see common/dedup.py) every publish() names a
+message ID, and the server drops a message whose ID it has already seen
+from this publisher: resending after a reconnect delivers it only once.
+Give the same client_id to the publisher that resends, so the server
+knows it is the same one.
+
+`host` may be "unix:/path" for a server listening on a Unix socket (see
+common/transport.py). A publisher on the server's host may also pass
+shm_size=N to send its batches through an N-byte shared-memory ring
+instead of the socket (see common/shm_ring.py).
+"""
+
+import socket
+import threading
+
+from common.binary_protocol import (
+    BINARY,
+    OP_TERMINATE,
+    PROTOCOL_OPTION,
+    PROTOCOLS,
+    TEXT,
+    TopicAliases,
+    encode_command,
+    encode_publish,
+    encode_publish_compressed,
+)
+from common.compression import CODEC_IDS, COMPRESS_OPTION, DEFAULT_MIN_BYTES, maybe_compress
+from common.dedup import ID_SEPARATOR, MAX_ID_BYTES, MSG_IDS_OPTION
+from common.framing import FrameReader, encode_batch, encode_frame, send_frame
+from common.heartbeat import HEARTBEAT_OPTION, drop_pongs, start_heartbeat
+from common.qos import CLIENT_ID_OPTION, DEFAULT_MAX_UNACKED, QOS_OPTION, parse_puback
+from common.shm_ring import SHM_OPTION, ShmSender
+from common.transport import connect
+
+DEFAULT_BATCH_SIZE = 64 * 1024  # Flush once this many bytes are buffered
+DEFAULT_LINGER = 0.005  # Longest time (seconds) a message waits for its batch
+
+
+class Publisher:
+    """
+    Publishes messages without the interactive prompt:
+
+        with Publisher("localhost", 5000, "NEWS") as publisher:
+            for i in range(100000):
+                publisher.publish(f"update {i}")
+
+    publish() may be called from several threads. With linger=0 every
+    publish() is sent immediately (no batching); flush() sends whatever is
+    buffered right away.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        topic,
+        batch_size=DEFAULT_BATCH_SIZE,
+        linger=DEFAULT_LINGER,
+        protocol=TEXT,
+        compression=None,
+        compress_min_bytes=DEFAULT_MIN_BYTES,
+        qos=0,
+        max_unacked=DEFAULT_MAX_UNACKED,
+        heartbeat=None,
+        shm_size=0,
+        message_ids=False,
+        client_id=None,
+    ):
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"Unknown protocol '{protocol}'.")
+        if compression is not None and compression not in CODEC_IDS:
+            raise ValueError(f"Unknown compression codec '{compression}'.")
+        if compression is not None and protocol != BINARY:
+            raise ValueError("Compression needs the binary protocol.")
+        if qos not in (0, 1):
+            raise ValueError(f"Unsupported QoS level '{qos}'.")
+        if shm_size and heartbeat:
+            raise ValueError("Heartbeats go over the socket; a shared-memory publisher has none.")
+        self.topic = topic.upper()
+        self.protocol = protocol
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes
+        self.batch_size = batch_size
+        self.linger = linger
+        self.sent_messages = 0  # Messages handed to the socket
+        self.sent_batches = 0  # sendall() calls made for them
+        self.qos = qos
+        self.max_unacked = max_unacked
+        self.message_ids = message_ids
+        self.sent_frames = 0  # Frames handed to the socket, REGISTERs included (QoS 1)
+        self.acked_frames = 0  # Frames the server acknowledged (QoS 1)
+
+        self._frames = []  # Encoded frames waiting for the next flush
+        self._buffered = 0  # Bytes in self._frames
+        self._pending = 0  # Messages in self._frames (binary REGISTER frames are not messages)
+        self._prefix = f"{self.topic}:".encode("utf-8")
+        self._prefixes = {self.topic: self._prefix}
+        self._aliases = TopicAliases()  # Topic ids registered with the server (binary)
+        self._closed = False
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)  # Wakes the flusher thread
+        self._acked = threading.Condition(self._lock)  # Wakes publishers waiting for acks
+        self._lost = False  # The server closed the connection (QoS 1)
+
+        self.socket = connect(host, port)
+        self._out = self.socket  # Where frames go: the socket, or a ShmSender
+        handshake = f"PUBLISHER:{self.topic}"
+        if protocol == BINARY:
+            handshake += f";{PROTOCOL_OPTION}={BINARY}"
+        if compression is not None:
+            handshake += f";{COMPRESS_OPTION}={compression}"
+        if qos:
+            handshake += f";{QOS_OPTION}=1"
+        if heartbeat:
+            handshake += f";{HEARTBEAT_OPTION}={heartbeat:g}"
+        if message_ids:
+            handshake += f";{MSG_IDS_OPTION}=1"
+        if client_id:
+            handshake += f";{CLIENT_ID_OPTION}={client_id}"
+        if shm_size:
+            self._out = ShmSender(self.socket, shm_size)
+            handshake += f";{SHM_OPTION}={self._out.name}"
+        send_frame(self.socket, handshake.encode("utf-8"))
+
+        self._acker = None
+        if qos or heartbeat:
+            # Reads the server's PUBACKs, and its PONGs so they do not pile up unread
+            self._acker = threading.Thread(target=self._read_acks, daemon=True)
+            self._acker.start()
+        if heartbeat:
+            start_heartbeat(self.socket, heartbeat, protocol, self._lock)
+
+        self._flusher = None
+        if linger > 0:
+            # Flushes batches that stay below batch_size for longer than `linger`
+            self._flusher = threading.Thread(target=self._run, daemon=True)
+            self._flusher.start()
+
+    def publish(self, content, topic=None, message_id=None):
+        """
+        Queues one message (str or bytes) on the publisher's topic, or on
+        `topic` if given. Sends the batch if it reached batch_size. A
+        publisher with message_ids needs a `message_id` (str or bytes,
+        without spaces) for every message.
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        id_prefix = b""
+        if self.message_ids:
+            id_prefix = self._id_prefix(message_id)
+        elif message_id is not None:
+            raise ValueError("Message IDs need a publisher created with message_ids=True.")
+        if self.protocol == TEXT:
+            prefix = self._prefix if topic is None else self._topic_prefix(topic)
+            frame = encode_frame(prefix + id_prefix + content)
+        elif self.compression is not None:
+            # Compressed outside the lock, so other threads keep publishing meanwhile
+            compressed = maybe_compress(self.compression, content, self.compress_min_bytes)
+        with self._lock:
+            if self._closed:
+                raise ConnectionError("Publisher is closed.")
+            if self.protocol == BINARY:
+                # Under the lock, so a new topic's REGISTER always precedes its messages
+                topic_id, register = self._aliases.outgoing(
+                    self.topic if topic is None else topic.upper()
+                )
+                if register:
+                    self._frames.append(register)
+                    self._buffered += len(register)
+                if self.compression is not None and compressed is not None:
+                    frame = encode_publish_compressed(
+                        topic_id, self.compression, id_prefix + compressed
+                    )
+                else:
+                    frame = encode_publish(topic_id, id_prefix + content)
+            self._frames.append(frame)
+            self._buffered += len(frame)
+            self._pending += 1
+            if self.linger <= 0 or self._buffered >= self.batch_size:
+                self._flush_locked()
+            elif self._pending == 1:
+                self._ready.notify()  # Start the linger timer for this batch
+            if self.qos:
+                unacked = self.sent_frames + len(self._frames) - self.acked_frames
+                if unacked >= self.max_unacked:
+                    self._wait_for_acks_locked(self.max_unacked - 1)
+
+    def flush(self):
+        """Sends every buffered message now."""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        """
+        Sends what is still buffered, waits for its acknowledgement (QoS 1),
+        tells the server we are done and disconnects.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            try:
+                if self.qos:
+                    self._wait_for_acks_locked(0)
+                self._flush_locked()
+                if self.protocol == BINARY:
+                    self._out.sendall(encode_command(OP_TERMINATE))
+                else:
+                    self._out.sendall(encode_frame(b"terminate"))
+            finally:
+                self._closed = True
+                self._ready.notify()
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)  # Wakes the ack reader
+                except OSError:
+                    pass
+                self.socket.close()
+                if self._out is not self.socket:
+                    self._out.close()
+        if self._flusher:
+            self._flusher.join()
+        if self._acker:
+            self._acker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @staticmethod
+    def _id_prefix(message_id):
+        if isinstance(message_id, str):
+            message_id = message_id.encode("utf-8")
+        if not message_id or len(message_id) > MAX_ID_BYTES or ID_SEPARATOR in message_id:
+            raise ValueError(f"A message ID is 1 to {MAX_ID_BYTES} bytes without spaces.")
+        return message_id + ID_SEPARATOR
+
+    def _topic_prefix(self, topic):
+        prefix = self._prefixes.get(topic)
+        if prefix is None:
+            prefix = self._prefixes[topic] = f"{topic.upper()}:".encode("utf-8")
+        return prefix
+
+    def _flush_locked(self):
+        if not self._frames:
+            return
+        if len(self._frames) == 1:
+            payload = self._frames[0]  # A lone message needs no batch wrapper
+        else:
+            payload = encode_batch(self._frames)
+        self._out.sendall(payload)
+        self.sent_frames += len(self._frames)
+        self.sent_messages += self._pending
+        self.sent_batches += 1
+        self._frames = []
+        self._buffered = 0
+        self._pending = 0
+
+    def _run(self):
+        with self._lock:
+            while not self._closed:
+                if not self._frames:
+                    self._ready.wait()
+                    continue
+                # Give the batch `linger` seconds to fill up; publish() flushes it sooner if full
+                batch = self._frames
+                self._ready.wait(self.linger)
+                if self._frames is batch and not self._closed:
+                    try:
+                        self._flush_locked()
+                    except OSError:
+                        return
+
+    def _wait_for_acks_locked(self, limit):
+        """Flushes, then waits until at most `limit` frames are unacknowledged."""
+        self._flush_locked()
+        while self.sent_frames - self.acked_frames > limit:
+            if self._lost:
+                raise ConnectionError("Connection lost before every message was acknowledged.")
+            self._acked.wait()
+
+    def _read_acks(self):
+        reader = FrameReader(self.socket)
+        try:
+            while True:
+                frames = reader.read_frames()
+                if not frames:
+                    break
+                frames = drop_pongs(frames, self.protocol)
+                if not frames:
+                    continue
+                acked = max(parse_puback(frame, self.protocol) for frame in frames)
+                with self._lock:
+                    self.acked_frames = max(self.acked_frames, acked)
+                    self._acked.notify_all()
+        except (OSError, ValueError):
+            pass
+        with self._lock:
+            self._lost = True
+            self._acked.notify_all()
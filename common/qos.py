@@ -0,0 +1,323 @@
+"""
+At-least-once (QoS 1) delivery.
+
+A client asks for it with the ";qos=1" handshake option; without it,
+delivery stays fire-and-forget (QoS 0).
+
+Subscribers. The broker numbers every message it delivers to a QoS-1
+subscriber. The numbers are not written into the messages, whose frames are
+shared by every subscriber; instead a "SEQ:<n>" frame tells the subscriber
+the number of the next message, and each message after it counts up by
+one. The subscriber acknowledges with "ACK:<n>", which covers every message
+up to n. The broker keeps the unacknowledged messages of each subscriber, up
+to a window, and sends them again (after a new SEQ) when no acknowledgement
+arrives within the ack timeout, or when the subscriber reconnects. A
+subscriber that falls a whole window behind is disconnected, like one whose
+queue overflows; its unacknowledged messages are kept, never dropped. Sessions
+survive a reconnect when the subscriber names itself with ";client_id=<id>";
+a disconnected session is kept for the session expiry.
+
+Publishers. Once the frames of one read are routed, the broker answers a
+QoS-1 publisher with "PUBACK:<n>": n is the number of frames it has
+received from that publisher so far. A publisher can therefore pipeline
+messages and only wait when too many are unacknowledged.
+
+Binary-protocol clients use the ACK and SEQ opcodes of
+common/binary_protocol.py instead of the text frames; the broker's PUBACK
+is an ACK there.
+"""
+
+import threading
+import time
+from collections import deque
+
+from common.binary_protocol import (
+    BINARY,
+    OP_ACK,
+    OP_PUBLISH,
+    OP_PUBLISH_COMPRESSED,
+    OP_SEQ,
+    TEXT,
+    decode_sequence,
+    encode_sequence,
+)
+from common.framing import encode_frame
+from common.heartbeat import PONG
+
+QOS_OPTION = "qos"
+CLIENT_ID_OPTION = "client_id"
+
+DEFAULT_WINDOW = 1024  # Unacknowledged messages kept per subscriber
+DEFAULT_ACK_TIMEOUT = 5.0  # Seconds without an acknowledgement before redelivery
+DEFAULT_SESSION_EXPIRY = 60.0  # Seconds a disconnected session waits for its client
+DEFAULT_MAX_UNACKED = 1024  # Frames a QoS-1 publisher sends ahead of the broker's acks
+
+
+def sweep_interval(ack_timeout):
+    """How often a broker should look for timed-out deliveries and expired sessions."""
+    return min(1.0, ack_timeout / 4)
+
+
+def qos_from_options(options):
+    """Reads the ";qos=" handshake option (0 or 1). Raises ValueError otherwise."""
+    qos = options.get(QOS_OPTION, "0")
+    if qos not in ("0", "1"):
+        raise ValueError(f"Unsupported QoS level '{qos}'.")
+    return int(qos)
+
+
+def client_id_from_options(options):
+    """Reads the ";client_id=" handshake option, or None."""
+    return options.get(CLIENT_ID_OPTION) or None
+
+
+def encode_seq(seq, protocol=TEXT):
+    """The frame announcing the number of the next message."""
+    if protocol == BINARY:
+        return encode_sequence(OP_SEQ, seq)
+    return encode_frame(b"SEQ:%d" % seq)
+
+
+def encode_ack(seq, protocol=TEXT):
+    """A subscriber's acknowledgement of every message up to seq."""
+    if protocol == BINARY:
+        return encode_sequence(OP_ACK, seq)
+    return encode_frame(b"ACK:%d" % seq)
+
+
+def encode_puback(count, protocol=TEXT):
+    """The broker's acknowledgement of a publisher's first `count` frames."""
+    if protocol == BINARY:
+        return encode_sequence(OP_ACK, count)
+    return encode_frame(b"PUBACK:%d" % count)
+
+
+def parse_puback(data, protocol=TEXT):
+    """Returns the count of a PUBACK frame. Raises ValueError for anything else."""
+    if protocol == BINARY:
+        if data[:1] != bytes([OP_ACK]):
+            raise ValueError("Not an ACK frame.")
+        return decode_sequence(data)
+    command, _, count = data.partition(b":")
+    if command != b"PUBACK":
+        raise ValueError("Not a PUBACK frame.")
+    return int(count)
+
+
+class QosSession:
+    """
+    The unacknowledged messages of one QoS-1 subscriber, and the connection
+    it is attached to. Messages are opaque items the attached connection's
+    `send` callable queues, e.g. frames. Thread-safe; `send` is called with
+    the session's lock held, so numbering and wire order always agree.
+    """
+
+    def __init__(self, client_id=None, window=DEFAULT_WINDOW, ack_timeout=DEFAULT_ACK_TIMEOUT):
+        self.client_id = client_id
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.redelivered = 0  # Messages sent again
+        self.overflows = 0  # Times the subscriber fell a window behind and was disconnected
+        self.detached_at = None  # When the last connection went away
+        self._unacked = deque()  # (seq, item), oldest first
+        self._next_seq = 1
+        self._send = None  # Queues a list of items on the attached connection
+        self._marker = None  # Returns the item announcing a sequence number
+        self._close = None  # Disconnects the attached connection
+        self._wire_next = None  # Number the connection expects next; None: send a marker
+        self._deadline = None  # When the oldest unacknowledged message is sent again
+        self._lock = threading.Lock()
+
+    def attach(self, send, marker, close):
+        """
+        Binds the session to a connection, disconnecting any previous one,
+        and redelivers every unacknowledged message. Returns how many.
+        """
+        with self._lock:
+            previous = self._close
+            self._send, self._marker, self._close = send, marker, close
+            self._wire_next = None
+            self.detached_at = None
+            redelivered = self._resend_locked(time.monotonic())
+        if previous is not None:
+            previous()  # Another connection took this client id over
+        return redelivered
+
+    def detach(self, send):
+        """Unbinds the connection whose `send` this is, unless it was taken over."""
+        with self._lock:
+            if self._send == send:  # Bound methods are equal, not identical
+                self._send = self._marker = self._close = None
+                self.detached_at = time.monotonic()
+
+    def deliver(self, items):
+        """
+        Numbers messages and queues them on the attached connection, if any.
+        Returns False if the connection was disconnected (queue full or
+        closed, or more than a window of messages unacknowledged). The
+        messages are kept either way, and redelivered on reconnect.
+        """
+        with self._lock:
+            first = self._next_seq
+            for item in items:
+                self._unacked.append((self._next_seq, item))
+                self._next_seq += 1
+            if self._send is None:
+                return True
+            if len(self._unacked) <= self.window:
+                if self._deadline is None:
+                    self._deadline = time.monotonic() + self.ack_timeout
+                if self._wire_next != first:
+                    items = [self._marker(first), *items]
+                self._wire_next = self._next_seq
+                return self._send(items)
+            # Too far behind: disconnect rather than forget what it has not acknowledged
+            self.overflows += 1
+            close = self._close
+            self._send = self._marker = self._close = None
+            self.detached_at = time.monotonic()
+        close()
+        return False
+
+    def ack(self, seq):
+        """Forgets every message up to seq."""
+        with self._lock:
+            progress = False
+            while self._unacked and self._unacked[0][0] <= seq:
+                self._unacked.popleft()
+                progress = True
+            if not self._unacked:
+                self._deadline = None
+            elif progress:
+                self._deadline = time.monotonic() + self.ack_timeout
+
+    def redeliver_due(self, now):
+        """Sends the unacknowledged messages again if the ack timeout passed. Returns how many."""
+        with self._lock:
+            if self._send is None or self._deadline is None or now < self._deadline:
+                return 0
+            return self._resend_locked(now)
+
+    def unacked(self):
+        return len(self._unacked)
+
+    def _resend_locked(self, now):
+        if self._send is None or not self._unacked:
+            self._deadline = None
+            return 0
+        first = self._unacked[0][0]
+        self._send([self._marker(first), *(item for _, item in self._unacked)])
+        self._wire_next = self._next_seq
+        self._deadline = now + self.ack_timeout
+        self.redelivered += len(self._unacked)
+        return len(self._unacked)
+
+
+class QosSessions:
+    """
+    Every QoS-1 session of a broker: those with a client id by id, so a
+    reconnecting subscriber resumes its session, and anonymous ones, which
+    end with their connection. Thread-safe.
+    """
+
+    def __init__(self):
+        self._named = {}  # client id -> QosSession
+        self._anonymous = set()
+        self._lock = threading.Lock()
+
+    def open(self, client_id, window=DEFAULT_WINDOW, ack_timeout=DEFAULT_ACK_TIMEOUT):
+        """Returns the session of a client id, creating it if needed, or a new anonymous one."""
+        with self._lock:
+            if client_id is None:
+                session = QosSession(None, window, ack_timeout)
+                self._anonymous.add(session)
+                return session
+            session = self._named.get(client_id)
+            if session is None:
+                session = self._named[client_id] = QosSession(client_id, window, ack_timeout)
+            return session
+
+    def close(self, session, send):
+        """Detaches a connection from its session; an anonymous session ends with it."""
+        session.detach(send)
+        if session.client_id is None:
+            with self._lock:
+                self._anonymous.discard(session)
+
+    def sweep(self, now, expiry):
+        """
+        Redelivers what timed out and drops sessions disconnected for longer
+        than `expiry`. Returns (messages redelivered, sessions expired).
+        """
+        with self._lock:
+            sessions = list(self._named.values()) + list(self._anonymous)
+            expired = [
+                client_id
+                for client_id, session in self._named.items()
+                if session.detached_at is not None and now - session.detached_at > expiry
+            ]
+            for client_id in expired:
+                del self._named[client_id]
+        redelivered = sum(session.redeliver_due(now) for session in sessions)
+        return redelivered, len(expired)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._named) + len(self._anonymous)
+
+
+class QosReceiver:
+    """
+    Subscriber side of QoS 1: numbers the messages received after each SEQ
+    frame, tells redelivered duplicates apart and builds the acknowledgements.
+
+        receiver = QosReceiver()
+        for frame in frames:
+            if receiver.accept(frame):
+                handle(frame)
+        ack = receiver.ack()
+        if ack:
+            sock.sendall(ack)
+    """
+
+    def __init__(self, protocol=TEXT):
+        self.protocol = protocol
+        self.received = 0  # Highest number received
+        self.duplicates = 0
+        self._next_seq = None  # Number of the next message; None before the first SEQ
+        self._acked = 0
+
+    def accept(self, frame):
+        """
+        Returns True for a new message, False for a duplicate and None for
+        a frame that is not a message (a SEQ, a PONG or a binary REGISTER).
+        Messages before the first SEQ (e.g. a replay) are not numbered.
+        """
+        if self.protocol == BINARY:
+            opcode = frame[0] if frame else None
+            if opcode == OP_SEQ:
+                self._next_seq = decode_sequence(frame)
+                return None
+            if opcode not in (OP_PUBLISH, OP_PUBLISH_COMPRESSED):
+                return None
+        elif frame.startswith(b"SEQ:"):
+            self._next_seq = int(frame[4:])
+            return None
+        elif frame == PONG:
+            return None
+        if self._next_seq is None:
+            return True
+        seq = self._next_seq
+        self._next_seq += 1
+        if seq <= self.received:
+            self.duplicates += 1
+            return False
+        self.received = seq
+        return True
+
+    def ack(self):
+        """The acknowledgement of everything received, or None if there is nothing new."""
+        if self.received <= self._acked:
+            return None
+        self._acked = self.received
+        return encode_ack(self.received, self.protocol)
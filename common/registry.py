@@ -0,0 +1,78 @@
+"""
+Topic-indexed registry of subscriber connections.
+"""
+
+import threading
+
+from common.topic_trie import TopicTrie
+
+
+class SubscriberRegistry:
+    """
+    Maps subscription patterns to the subscribers listening on them.
+
+    Patterns live in a TopicTrie, so subscribing and unsubscribing cost
+    O(pattern depth) and resolving the recipients of a publish costs
+    O(topic depth + recipients) instead of a scan over every connected
+    client. A subscriber may hold many patterns; it receives a matching
+    publish once. The internal lock is held only while the maps are read
+    or changed, never while sending to a subscriber.
+    """
+
+    def __init__(self):
+        self._trie = TopicTrie()
+        self._patterns = {}  # subscriber -> set of its patterns
+        self._lock = threading.Lock()
+
+    def add(self, pattern, subscriber):
+        """
+        Subscribes to a pattern (a topic, or one with '*'/'#' wildcards).
+        Returns False if it was already subscribed. Raises ValueError for a
+        malformed pattern.
+        """
+        with self._lock:
+            if not self._trie.add(pattern, subscriber):
+                return False
+            self._patterns.setdefault(subscriber, set()).add(pattern)
+            return True
+
+    def remove(self, pattern, subscriber):
+        """Unsubscribes from one pattern. Returns False if it was not subscribed."""
+        with self._lock:
+            if not self._trie.remove(pattern, subscriber):
+                return False
+            patterns = self._patterns[subscriber]
+            patterns.discard(pattern)
+            if not patterns:
+                del self._patterns[subscriber]
+            return True
+
+    def remove_all(self, subscriber):
+        """
+        Drops every subscription of a subscriber, e.g. when it disconnects.
+        Returns the patterns it was subscribed to.
+        """
+        with self._lock:
+            patterns = self._patterns.pop(subscriber, ())
+            for pattern in patterns:
+                self._trie.remove(pattern, subscriber)
+            return sorted(patterns)
+
+    def patterns(self, subscriber):
+        """Returns the patterns a subscriber is currently subscribed to."""
+        with self._lock:
+            return sorted(self._patterns.get(subscriber, ()))
+
+    def all_subscribers(self):
+        """Returns a snapshot of every subscriber holding at least one pattern."""
+        with self._lock:
+            return tuple(self._patterns)
+
+    def subscribers(self, topic):
+        """Returns a snapshot of the subscribers matching a topic, safe to iterate unlocked."""
+        with self._lock:
+            return tuple(self._trie.match(topic))
+
+    def __len__(self):
+        """Total number of (pattern, subscriber) subscriptions."""
+        return len(self._trie)
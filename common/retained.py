@@ -0,0 +1,74 @@
+"""
+Retained last values of each topic, so a new subscriber learns the current
+state of a topic right after its handshake instead of at the next publish.
+
+The cache keeps the last `depth` messages of every topic, within one memory
+cap for all topics together. When a message would take the cache over the
+cap, whole topics are evicted, least recently used (published to or read)
+first.
+"""
+
+from collections import OrderedDict, deque
+
+DEFAULT_RETAINED_BYTES = 64 * 1024 * 1024
+
+
+class RetainedCache:
+    """
+    Last-value cache of messages keyed by topic. A message is stored as an
+    opaque value with the size it is charged for. Not thread-safe; callers
+    hold their own lock.
+    """
+
+    def __init__(self, depth=1, max_bytes=DEFAULT_RETAINED_BYTES):
+        if depth < 1:
+            raise ValueError("A retained cache keeps at least one message per topic.")
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.bytes = 0  # Sizes of every retained message
+        self.evicted_topics = 0
+        self._topics = OrderedDict()  # topic -> deque of (value, size), least recently used first
+
+    def add(self, topic, value, size):
+        """
+        Retains a message, dropping the topic's oldest one beyond `depth` and
+        evicting least recently used topics beyond the memory cap. Returns
+        False if the message alone is larger than the cap and was not kept.
+        """
+        if size > self.max_bytes:
+            return False
+        entries = self._topics.get(topic)
+        if entries is None:
+            entries = self._topics[topic] = deque()
+        else:
+            self._topics.move_to_end(topic)
+        if len(entries) == self.depth:
+            self.bytes -= entries.popleft()[1]
+        entries.append((value, size))
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self._topics))
+            if oldest == topic:
+                # Only this topic is left: keep its newest messages that fit
+                self.bytes -= entries.popleft()[1]
+                continue
+            for _, evicted_size in self._topics.pop(oldest):
+                self.bytes -= evicted_size
+            self.evicted_topics += 1
+        return True
+
+    def values(self, topic):
+        """Returns a topic's retained values, oldest first, and marks it as used."""
+        entries = self._topics.get(topic)
+        if entries is None:
+            return []
+        self._topics.move_to_end(topic)
+        return [value for value, _ in entries]
+
+    def topics(self):
+        """Returns the retained topics, least recently used first."""
+        return list(self._topics)
+
+    def __len__(self):
+        """Number of topics with retained messages."""
+        return len(self._topics)
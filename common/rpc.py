@@ -0,0 +1,301 @@
+"""
+Request/response RPC on top of the Client-Server application's framing.
+
+A client opens an RPC connection by sending the RPC_HELLO frame first; every
+frame after it is a request or a response:
+
+    request      request id (!I), method name length (!H), method (UTF-8), payload
+    response     request id (!I), status (!B), payload (result, or UTF-8 error)
+
+Request ids are chosen by the client and only need to be unique among its
+in-flight requests on one connection, so a connection carries many requests
+at once and responses come back in whatever order they complete.
+
+On the server, an RpcDispatcher maps method names to handlers: functions
+that take the request payload (bytes) and return the response payload.
+Handlers registered with cpu_bound=True run in a process pool so they do not
+hold up the I/O loop; the others run inline and should be quick.
+
+On the client, RpcConnection.call() returns a concurrent.futures.Future and
+RpcPool spreads calls over a bounded number of connections.
+"""
+
+import concurrent.futures
+import itertools
+import multiprocessing
+import socket
+import struct
+import threading
+
+from common.framing import FrameReader, encode_frame
+
+RPC_HELLO = b"RPC/1"  # First frame of an RPC connection
+
+REQUEST = struct.Struct("!IH")  # Request id, method name length
+RESPONSE = struct.Struct("!IB")  # Request id, status
+STATUS_OK = 0
+STATUS_ERROR = 1
+MAX_REQUEST_ID = 0xFFFFFFFF
+
+DEFAULT_POOL_SIZE = 4  # Connections an RpcPool opens at most
+
+
+class RpcError(Exception):
+    """The server could not run a call; the message comes from the server."""
+
+
+def encode_request(request_id, method, payload=b""):
+    name = method.encode("utf-8")
+    return encode_frame(REQUEST.pack(request_id, len(name)) + name + payload)
+
+
+def decode_request(data):
+    """Returns (request id, method, payload). Raises ValueError if malformed."""
+    if len(data) < REQUEST.size:
+        raise ValueError("Truncated RPC request.")
+    request_id, length = REQUEST.unpack_from(data)
+    end = REQUEST.size + length
+    if len(data) < end:
+        raise ValueError("Truncated RPC method name.")
+    return request_id, data[REQUEST.size : end].decode("utf-8"), data[end:]
+
+
+def encode_response(request_id, status, payload=b""):
+    return encode_frame(RESPONSE.pack(request_id, status) + payload)
+
+
+def decode_response(data):
+    """Returns (request id, status, payload). Raises ValueError if malformed."""
+    if len(data) < RESPONSE.size:
+        raise ValueError("Truncated RPC response.")
+    request_id, status = RESPONSE.unpack_from(data)
+    return request_id, status, data[RESPONSE.size :]
+
+
+def _result_response(request_id, result):
+    """The STATUS_OK response of a handler's result. Raises TypeError unless it is bytes."""
+    if not isinstance(result, (bytes, bytearray, memoryview)):
+        raise TypeError(f"Handler returned {type(result).__name__}, not bytes.")
+    return encode_response(request_id, STATUS_OK, result)
+
+
+def _error_response(request_id, error):
+    return encode_response(request_id, STATUS_ERROR, f"{type(error).__name__}: {error}".encode("utf-8"))
+
+
+class RpcDispatcher:
+    """
+    Server side: runs requests through their registered handlers.
+
+        dispatcher = RpcDispatcher(workers=4)
+        dispatcher.register("echo", lambda payload: payload)
+        dispatcher.register("primes", count_primes, cpu_bound=True)
+        dispatcher.dispatch(frame, reply)   # reply(encoded response) may be
+                                            # called later, from another thread
+
+    cpu_bound handlers must be picklable (module-level functions). With
+    workers=0 they run inline like the others.
+    """
+
+    def __init__(self, workers=0):
+        self.workers = workers
+        self.calls = 0
+        self.errors = 0
+        self._handlers = {}  # method -> (handler, cpu_bound)
+        self._pool = None  # Started on the first cpu_bound call
+        self._lock = threading.Lock()
+
+    def register(self, method, handler, cpu_bound=False):
+        self._handlers[method] = (handler, cpu_bound)
+
+    def handler(self, method=None, cpu_bound=False):
+        """Decorator form of register(); the method defaults to the function's name."""
+
+        def decorate(function):
+            self.register(method or function.__name__, function, cpu_bound)
+            return function
+
+        return decorate
+
+    def methods(self):
+        return sorted(self._handlers)
+
+    def dispatch(self, data, reply):
+        """
+        Runs one request frame (without its length prefix). `reply` receives
+        the encoded response: right away for inline handlers, from a pool
+        thread once a cpu_bound one completes. Raises ValueError for a
+        malformed request.
+        """
+        request_id, method, payload = decode_request(data)
+        self.calls += 1
+        registered = self._handlers.get(method)
+        if registered is None:
+            self.errors += 1
+            reply(_error_response(request_id, LookupError(f"Unknown method '{method}'")))
+            return
+        handler, cpu_bound = registered
+        if cpu_bound and self.workers:
+            future = self._process_pool().submit(handler, payload)
+            future.add_done_callback(lambda done: reply(self._response(request_id, done)))
+            return
+        try:
+            response = _result_response(request_id, handler(payload))
+        except Exception as e:
+            self.errors += 1
+            response = _error_response(request_id, e)
+        reply(response)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _process_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # Spawned, not forked: forked workers would inherit the server's
+                # sockets and keep connections the server closed open
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+    def _response(self, request_id, future):
+        try:
+            return _result_response(request_id, future.result())
+        except Exception as e:  # Raised by the handler or for its result, or the pool broke
+            self.errors += 1
+            return _error_response(request_id, e)
+
+
+class RpcConnection:
+    """
+    Client side: one connection with any number of requests in flight.
+
+        with RpcConnection("localhost", 5000) as rpc:
+            futures = [rpc.call("echo", b"%d" % i) for i in range(100)]
+            results = [future.result() for future in futures]
+
+    call() may be used from several threads. A future fails with RpcError
+    when the handler failed, and with ConnectionError when the connection
+    is lost before the response arrives.
+    """
+
+    def __init__(self, host, port, timeout=None):
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.socket.settimeout(None)  # The reader blocks until responses arrive
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.sendall(encode_frame(RPC_HELLO))
+        self._pending = {}  # request id -> Future
+        self._ids = itertools.count(1)
+        self._closed = False
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def call(self, method, payload=b""):
+        """Sends a request and returns the Future of its response payload (bytes)."""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise ConnectionError("RPC connection is closed.")
+            request_id = next(self._ids) & MAX_REQUEST_ID
+            self._pending[request_id] = future
+            try:
+                self.socket.sendall(encode_request(request_id, method, payload))
+            except OSError:
+                del self._pending[request_id]
+                raise
+        return future
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._reader.join()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read_responses(self):
+        reader = FrameReader(self.socket)
+        try:
+            for data in reader.iter_frames():
+                request_id, status, payload = decode_response(data)
+                future = self._pending.pop(request_id, None)
+                if future is None:
+                    continue  # Not ours: ignore rather than fail every call
+                if status == STATUS_OK:
+                    future.set_result(payload)
+                else:
+                    future.set_exception(RpcError(payload.decode("utf-8", errors="replace")))
+        except (OSError, ValueError):
+            pass
+        with self._lock:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError("RPC connection lost."))
+
+
+class RpcPool:
+    """
+    A bounded pool of RpcConnections to one server. Each call goes to the
+    connection with the fewest requests in flight; a new connection is
+    opened only while every open one is busy and fewer than `size` are
+    open. Lost connections are replaced on the next call.
+    """
+
+    def __init__(self, host, port, size=DEFAULT_POOL_SIZE, timeout=None):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1.")
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def call(self, method, payload=b""):
+        """Returns the Future of the call's response payload, as RpcConnection.call()."""
+        return self._connection().call(method, payload)
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connection(self):
+        with self._lock:
+            self._connections = [c for c in self._connections if not c.closed]
+            idle = min(self._connections, key=lambda c: c.in_flight, default=None)
+            if idle is not None and (idle.in_flight == 0 or len(self._connections) >= self.size):
+                return idle
+            connection = RpcConnection(self.host, self.port, self.timeout)
+            self._connections.append(connection)
+            return connection
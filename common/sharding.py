@@ -0,0 +1,186 @@
+"""
+Multi-process broker sharding.
+
+run_workers() starts N copies of a server in separate processes that all
+accept on the same TCP port through SO_REUSEPORT, so the kernel spreads
+incoming connections across them and each worker runs on its own GIL.
+
+Topics are partitioned across the workers with consistent hashing: the
+worker owning a topic routes every publish on it. Workers talk over Unix
+sockets, one listening socket per worker under a shared directory, with
+framed text messages:
+
+    PEER:<worker id>            handshake of a worker connecting to another one
+    PUBLISH:<topic>:<content>   a publish received by a worker that does not own the topic
+    DELIVER:<topic>:<content>   the owner handing a publish to a worker with subscribers for it
+    SUBSCRIBE:<pattern>         this worker has subscribers for the pattern (sent to the
+    UNSUBSCRIBE:<pattern>       pattern's owner, or to every worker for a wildcard pattern)
+"""
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from common.framing import encode_frame, send_frame
+from common.hash_ring import HashRing
+from common.outbound import DROP_OLDEST, SubscriberWriter
+from common.topic_trie import is_wildcard
+
+PEER_ROLE = "PEER"
+CONNECT_TIMEOUT = 10  # Seconds to wait for the other workers' Unix sockets
+
+
+def worker_socket_path(socket_dir, worker_id):
+    """Path of the Unix socket a worker accepts other workers on."""
+    return os.path.join(socket_dir, f"worker-{worker_id}.sock")
+
+
+class ShardCluster:
+    """
+    One worker's view of the cluster: which worker owns a topic, a link to
+    every other worker, and which patterns this worker's own subscribers
+    hold, so the owners know where to deliver.
+    """
+
+    def __init__(self, worker_id, workers, socket_dir):
+        self.worker_id = worker_id
+        self.workers = workers
+        self.socket_dir = socket_dir
+        self.ring = HashRing(range(workers))
+        self.peers = {}  # worker id -> SubscriberWriter over a Unix socket
+        self._interest = {}  # pattern -> number of local subscriptions to it
+        self._lock = threading.Lock()
+        self.connected = threading.Event()  # Set once every peer link is open
+
+    def connect(self):
+        """Opens a link to every other worker; their Unix sockets must be listening."""
+        for worker_id in range(self.workers):
+            if worker_id == self.worker_id:
+                continue
+            path = worker_socket_path(self.socket_dir, worker_id)
+            deadline = time.monotonic() + CONNECT_TIMEOUT
+            while True:
+                peer_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    peer_socket.connect(path)
+                    break
+                except OSError:
+                    peer_socket.close()
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+            send_frame(peer_socket, f"{PEER_ROLE}:{self.worker_id}".encode("utf-8"))
+            # Peer links must never drop an interest update, so their queue is unbounded
+            self.peers[worker_id] = SubscriberWriter(
+                peer_socket, f"worker-{worker_id}", sys.maxsize, DROP_OLDEST
+            )
+        self.connected.set()
+
+    def owner(self, topic):
+        """Id of the worker that routes publishes on a topic."""
+        return self.ring.node_for(topic)
+
+    def owns(self, topic):
+        return self.ring.node_for(topic) == self.worker_id
+
+    def add_interest(self, pattern):
+        """Records a local subscription; the first one for a pattern is announced."""
+        with self._lock:
+            count = self._interest.get(pattern, 0) + 1
+            self._interest[pattern] = count
+            if count == 1:
+                self._announce("SUBSCRIBE", pattern)
+
+    def remove_interest(self, pattern):
+        """Drops a local subscription; the last one for a pattern is withdrawn."""
+        with self._lock:
+            count = self._interest.get(pattern, 0) - 1
+            if count > 0:
+                self._interest[pattern] = count
+            elif count == 0:
+                del self._interest[pattern]
+                self._announce("UNSUBSCRIBE", pattern)
+
+    def close(self):
+        for peer in self.peers.values():
+            peer.close()
+
+    def _announce(self, command, pattern):
+        # A wildcard pattern can match topics of any owner; a plain topic has exactly one
+        if is_wildcard(pattern):
+            targets = self.peers.values()
+        elif self.owns(pattern):
+            targets = ()
+        else:
+            targets = [self.peers[self.owner(pattern)]]
+        frame = encode_frame(f"{command}:{pattern}".encode("utf-8"))
+        for peer in targets:
+            peer.send(frame)
+
+
+def run_workers(workers, target, *args):
+    """
+    Runs target(worker_id, workers, socket_dir, ready, *args) in `workers`
+    processes and waits for them. `ready` is a barrier each worker passes once
+    its Unix socket listens, before connecting to the others. If one worker
+    exits, the others are stopped too, and so are all of them when this
+    process gets SIGINT or SIGTERM. A worker also exits by itself if this
+    process dies without stopping it (e.g. SIGKILL), so no orphan keeps
+    accepting on the port.
+    """
+    socket_dir = tempfile.mkdtemp(prefix="broker-workers-")
+    ready = multiprocessing.Barrier(workers)
+    # Only this process holds the write end; the workers see EOF once it is gone
+    parent_alive, alive_writer = multiprocessing.Pipe(duplex=False)
+    processes = [
+        multiprocessing.Process(
+            target=_run_worker,
+            args=(target, parent_alive, alive_writer, worker_id, workers, socket_dir, ready, *args),
+        )
+        for worker_id in range(workers)
+    ]
+    previous_handler = signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        for process in processes:
+            process.start()
+        multiprocessing.connection.wait([process.sentinel for process in processes])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        alive_writer.close()
+        parent_alive.close()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def _interrupt(signum, frame):
+    """Turns SIGTERM into the same clean shutdown as Ctrl-C."""
+    raise KeyboardInterrupt
+
+
+def _run_worker(target, parent_alive, alive_writer, *args):
+    """Runs one worker process, which dies with the parent process."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # Not the parent's handler
+    alive_writer.close()
+    threading.Thread(target=_exit_with_parent, args=(parent_alive,), daemon=True).start()
+    target(*args)
+
+
+def _exit_with_parent(parent_alive):
+    try:
+        parent_alive.recv()  # Nothing is ever sent: this returns on EOF, when the parent is gone
+    except (EOFError, OSError):
+        pass
+    os.kill(os.getpid(), signal.SIGTERM)
@@ -0,0 +1,293 @@
+"""
+Shared-memory transport for high-rate publishers on the broker's host.
+
+A publisher that asks for it creates a ring buffer in shared memory
+(multiprocessing.shared_memory) and names it in its handshake with the
+";shm=<name>" option. From then on it writes its frames, exactly as it
+would send them, into the ring instead of the socket, and the broker reads
+them from there. A busy publisher therefore costs no system call per batch
+on either side. The socket stays open for everything else:
+
+- While the ring is empty the broker sleeps on the socket. It flags that in
+  the ring, and a publisher that sees the flag after writing sends it one
+  "doorbell" byte.
+- The broker's PUBACKs (QoS 1) still come back over it.
+- Either side closing it ends the session, as for any connection.
+
+The ring is single-producer, single-consumer. Its header holds the total
+bytes written (head, only written by the publisher), the total bytes
+consumed (tail, only written by the broker), the capacity, the sleeping
+flag and a magic number; data wraps around after the header.
+
+The broker writes into the segment a handshake names, so it only attaches
+to rings: the name must start with RING_PREFIX and the header must carry
+MAGIC. Over a Unix socket the segment must also belong to the user of the
+connected process (SO_PEERCRED), and over TCP the peer must be on the
+loopback interface. The ring carries a byte stream,
+like the socket, so a frame may be split across writes. When the ring is
+full the publisher waits for room, as sendall() waits on a full socket.
+
+This relies on each side's stores becoming visible to the other in program
+order, which x86-64 guarantees. The flag and the head can still cross (a
+store followed by a load of the other variable), so the broker never sleeps
+longer than WAKE_TIMEOUT without looking at the ring again.
+"""
+
+import asyncio
+import ipaddress
+import os
+import secrets
+import select
+import socket
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+from common.framing import FrameBuffer
+
+SHM_OPTION = "shm"
+DEFAULT_RING_SIZE = 4 * 1024 * 1024  # Bytes of a publisher's ring
+WAKE_TIMEOUT = 0.01  # Longest the broker sleeps on the socket without checking the ring
+FULL_WAIT = 0.0005  # Seconds the publisher waits for room before looking again
+LIVENESS_INTERVAL = 0.1  # Seconds between doorbells while the ring stays full
+DOORBELL = b"\x00"
+DOORBELL_READ = 4096
+
+U64 = struct.Struct("=Q")
+U32 = struct.Struct("=I")
+HEAD_OFFSET = 0
+TAIL_OFFSET = 8
+CAPACITY_OFFSET = 16
+SLEEPING_OFFSET = 20
+MAGIC_OFFSET = 24
+DATA_OFFSET = 64  # The header gets a cache line of its own
+MAGIC = b"SHMRING1"
+RING_PREFIX = "mwring_"  # Short enough for macOS's 31-character segment names
+PEER_CREDENTIALS = struct.Struct("3i")  # pid, uid, gid of SO_PEERCRED
+
+
+def local_peer_uid(sock):
+    """
+    The uid of the process at the other end of a Unix socket, or None where
+    it cannot be known (TCP, or no SO_PEERCRED). Raises ValueError for a
+    TCP peer on another host, which cannot have created a ring on this one.
+    """
+    if sock.family == socket.AF_UNIX:
+        if not hasattr(socket, "SO_PEERCRED"):
+            return None
+        credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size)
+        return PEER_CREDENTIALS.unpack(credentials)[1]
+    if not ipaddress.ip_address(sock.getpeername()[0]).is_loopback:
+        raise ValueError("Shared memory rings are only for clients on the broker's host.")
+    return None
+
+
+class ShmRing:
+    """One ring buffer in shared memory; see the module docstring for the layout."""
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner  # The creator unlinks the segment when closing it
+        self.capacity = U32.unpack_from(shm.buf, CAPACITY_OFFSET)[0]
+        self._head = U64.unpack_from(shm.buf, HEAD_OFFSET)[0]  # Producer's own copy
+
+    @classmethod
+    def create(cls, size=DEFAULT_RING_SIZE):
+        """Creates a ring with room for `size` bytes (the publisher side)."""
+        if not 0 < size < 2**32:
+            raise ValueError("The ring size must be between 1 byte and 4 GiB.")
+        name = f"{RING_PREFIX}{secrets.token_hex(8)}"
+        shm = shared_memory.SharedMemory(name=name, create=True, size=DATA_OFFSET + size)
+        shm.buf[:DATA_OFFSET] = bytes(DATA_OFFSET)
+        U32.pack_into(shm.buf, CAPACITY_OFFSET, size)
+        shm.buf[MAGIC_OFFSET : MAGIC_OFFSET + len(MAGIC)] = MAGIC
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name, uid=None):
+        """
+        Opens a ring another process created (the broker side); with `uid`,
+        only one that user owns. Raises ValueError for anything else.
+        """
+        if not name.startswith(RING_PREFIX) or "/" in name:
+            raise ValueError(f"'{name}' is not the name of a ring buffer.")
+        shm = shared_memory.SharedMemory(name=name)
+        # Python registers attached segments with its resource tracker too, which
+        # would destroy the publisher's segment when the broker exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+        if uid is not None and os.fstat(shm._fd).st_uid != uid:
+            shm.close()
+            raise ValueError(f"Shared memory '{name}' belongs to another user.")
+        capacity = 0
+        if shm.size >= DATA_OFFSET and shm.buf[MAGIC_OFFSET : MAGIC_OFFSET + len(MAGIC)] == MAGIC:
+            capacity = U32.unpack_from(shm.buf, CAPACITY_OFFSET)[0]
+        if not capacity or DATA_OFFSET + capacity > shm.size:
+            shm.close()
+            raise ValueError(f"Shared memory '{name}' is not a ring buffer.")
+        return cls(shm, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def sleeping(self):
+        return bool(U32.unpack_from(self.shm.buf, SLEEPING_OFFSET)[0])
+
+    @sleeping.setter
+    def sleeping(self, flag):
+        U32.pack_into(self.shm.buf, SLEEPING_OFFSET, int(flag))
+
+    def free(self):
+        """Bytes the producer can write without waiting."""
+        return self.capacity - (self._head - U64.unpack_from(self.shm.buf, TAIL_OFFSET)[0])
+
+    def write(self, data):
+        """
+        Copies `data` into the ring; the caller made sure it fits (free()).
+        Only one thread of one process may write to a ring.
+        """
+        data = memoryview(data)
+        buf = self.shm.buf
+        position = self._head % self.capacity
+        first = min(len(data), self.capacity - position)
+        buf[DATA_OFFSET + position : DATA_OFFSET + position + first] = data[:first]
+        if first < len(data):
+            buf[DATA_OFFSET : DATA_OFFSET + len(data) - first] = data[first:]
+        self._head += len(data)
+        U64.pack_into(buf, HEAD_OFFSET, self._head)  # Publishes the bytes to the broker
+
+    def read_into(self, frame_buffer):
+        """Moves every byte written so far into a FrameBuffer. Returns how many."""
+        buf = self.shm.buf
+        head = U64.unpack_from(buf, HEAD_OFFSET)[0]
+        tail = U64.unpack_from(buf, TAIL_OFFSET)[0]
+        available = head - tail
+        if available <= 0:
+            return 0
+        position = tail % self.capacity
+        first = min(available, self.capacity - position)
+        frame_buffer.feed(buf[DATA_OFFSET + position : DATA_OFFSET + position + first])
+        if first < available:
+            frame_buffer.feed(buf[DATA_OFFSET : DATA_OFFSET + available - first])
+        U64.pack_into(buf, TAIL_OFFSET, head)  # Hands the space back to the publisher
+        return available
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ShmSender:
+    """
+    Publisher side: sendall() writes to a new ring instead of the socket and
+    rings the doorbell when the broker sleeps. The ring's name goes in the
+    handshake, which is still sent over the socket.
+    """
+
+    def __init__(self, sock, size=DEFAULT_RING_SIZE):
+        self.socket = sock
+        self.ring = ShmRing.create(size)
+
+    @property
+    def name(self):
+        return self.ring.name
+
+    def sendall(self, data):
+        """
+        Writes already-framed bytes to the ring, waiting while it is full.
+        Raises OSError once the broker is gone, as a socket would.
+        """
+        data = memoryview(data)
+        probed = time.monotonic()
+        while data:
+            free = self.ring.free()
+            if not free:
+                time.sleep(FULL_WAIT)
+                if time.monotonic() - probed >= LIVENESS_INTERVAL:
+                    self.socket.sendall(DOORBELL)  # Fails if the broker closed the connection
+                    probed = time.monotonic()
+                continue
+            # The broker reassembles frames split across writes, as from a socket
+            self.ring.write(data[:free])
+            data = data[free:]
+            if self.ring.sleeping:
+                self.socket.sendall(DOORBELL)
+
+    def close(self):
+        self.ring.close()
+
+
+class ShmFrameReader(FrameBuffer):
+    """
+    Broker side, threaded: read_frames() as FrameReader's, but the frames
+    come from the publisher's ring and the socket only wakes it up.
+    """
+
+    def __init__(self, sock, name):
+        super().__init__()
+        self.socket = sock
+        self.ring = ShmRing.attach(name, local_peer_uid(sock))
+        self._poll = select.poll()
+        self._poll.register(sock, select.POLLIN)
+        self._eof = False
+
+    def read_frames(self):
+        """
+        Blocks until at least one complete frame is available and returns
+        all complete frames written so far. Returns an empty list once the
+        publisher has closed the connection and its ring is drained.
+        """
+        while True:
+            self.ring.read_into(self)
+            frames = self.frames()
+            if frames or self._eof:
+                return frames
+            self.ring.sleeping = True
+            if self.ring.read_into(self):  # Written before the publisher saw the flag
+                self.ring.sleeping = False
+                continue
+            if self._poll.poll(WAKE_TIMEOUT * 1000):
+                self._eof = not self.socket.recv(DOORBELL_READ)
+            self.ring.sleeping = False
+
+    def close(self):
+        self.ring.close()
+
+
+class AsyncShmFrameReader(FrameBuffer):
+    """Broker side, asyncio: ShmFrameReader for a StreamReader and its socket."""
+
+    def __init__(self, reader, name, sock):
+        super().__init__()
+        self.reader = reader
+        self.ring = ShmRing.attach(name, local_peer_uid(sock))
+        self._eof = False
+
+    async def read_frames(self):
+        while True:
+            self.ring.read_into(self)
+            frames = self.frames()
+            if frames:
+                # A publisher that never lets its ring run empty must not starve the loop
+                await asyncio.sleep(0)
+                return frames
+            if self._eof:
+                return frames
+            self.ring.sleeping = True
+            if self.ring.read_into(self):
+                self.ring.sleeping = False
+                continue
+            try:
+                doorbells = await asyncio.wait_for(self.reader.read(DOORBELL_READ), WAKE_TIMEOUT)
+                self._eof = not doorbells
+            except asyncio.TimeoutError:
+                pass
+            self.ring.sleeping = False
+
+    def close(self):
+        self.ring.close()
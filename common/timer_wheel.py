@@ -0,0 +1,78 @@
+"""
+Hashed timing wheel for the brokers' connection timeouts.
+
+A deadline goes into the slot of the tick it falls in, modulo the number of
+slots; scheduling, rescheduling and cancelling are O(1) dict operations.
+expire() visits only the slots whose ticks passed since the previous call,
+so expiring n timers costs O(n) plus the number of ticks elapsed, however
+many timers are pending. Deadlines further away than one turn of the wheel
+stay in their slot until the turn they are due in.
+"""
+
+import math
+import threading
+
+DEFAULT_TICK = 0.25  # Seconds per slot: the resolution of the deadlines
+DEFAULT_SLOTS = 512  # One turn of the wheel covers DEFAULT_TICK * DEFAULT_SLOTS seconds
+
+
+class TimerWheel:
+    """
+    Deadlines keyed by any hashable (e.g. a connection); at most one per
+    key. Thread-safe.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, now=0.0):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]  # key -> deadline
+        self._slot_of = {}  # key -> index of its slot
+        self._current = self._tick_of(now) - 1  # Last tick expire() finished
+        self._lock = threading.Lock()
+
+    def schedule(self, key, deadline):
+        """Sets the deadline of `key`, replacing the one it had."""
+        with self._lock:
+            self._cancel_locked(key)
+            # A deadline already past goes into the first tick expire() visits next
+            index = max(self._tick_of(deadline), self._current + 1) % len(self._slots)
+            self._slots[index][key] = deadline
+            self._slot_of[key] = index
+
+    def cancel(self, key):
+        """Forgets the deadline of `key`, if it has one."""
+        with self._lock:
+            self._cancel_locked(key)
+
+    def expire(self, now):
+        """Removes and returns the keys whose deadline is at or before `now`."""
+        expired = []
+        with self._lock:
+            target = self._tick_of(now)
+            # Past one full turn, every slot is visited once
+            first = max(self._current + 1, target - len(self._slots) + 1)
+            for tick in range(first, target + 1):
+                slot = self._slots[tick % len(self._slots)]
+                due = [key for key, deadline in slot.items() if deadline <= now]
+                for key in due:
+                    del slot[key]
+                    del self._slot_of[key]
+                expired.extend(due)
+            # The current tick is not over: later deadlines may still land in it
+            self._current = max(self._current, target - 1)
+        return expired
+
+    def __len__(self):
+        with self._lock:
+            return len(self._slot_of)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._slot_of
+
+    def _tick_of(self, when):
+        return math.floor(when / self.tick)
+
+    def _cancel_locked(self, key):
+        index = self._slot_of.pop(key, None)
+        if index is not None:
+            del self._slots[index][key]
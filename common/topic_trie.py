@@ -0,0 +1,140 @@
+"""
+Hierarchical topic matching.
+
+Topics are dot-separated levels, e.g. SPORTS.FOOTBALL.SCORES. A subscription
+pattern may use two wildcards, each standing for a whole level:
+
+    *   matches exactly one level       SPORTS.*.SCORES
+    #   matches zero or more levels     NEWS.#   (only allowed as the last level)
+
+Subscriptions are stored in a trie keyed by level, so resolving the
+recipients of a publish walks the topic's levels once instead of testing
+every subscription.
+"""
+
+LEVEL_SEPARATOR = "."
+SINGLE_LEVEL_WILDCARD = "*"
+MULTI_LEVEL_WILDCARD = "#"
+
+
+def split_topic(topic):
+    """Splits a topic or pattern into its levels, rejecting empty levels."""
+    levels = topic.split(LEVEL_SEPARATOR)
+    if not all(levels):
+        raise ValueError(f"Topic '{topic}' has an empty level.")
+    return levels
+
+
+def validate_pattern(pattern):
+    """Returns the pattern's levels, or raises ValueError if it is malformed."""
+    levels = split_topic(pattern)
+    for index, level in enumerate(levels):
+        if MULTI_LEVEL_WILDCARD in level and (
+            level != MULTI_LEVEL_WILDCARD or index != len(levels) - 1
+        ):
+            raise ValueError(f"'#' must be the whole last level in '{pattern}'.")
+        if SINGLE_LEVEL_WILDCARD in level and level != SINGLE_LEVEL_WILDCARD:
+            raise ValueError(f"'*' must be a whole level in '{pattern}'.")
+    return levels
+
+
+def validate_topic(topic):
+    """Returns a publish topic's levels, or raises ValueError if it has wildcards."""
+    levels = split_topic(topic)
+    for level in levels:
+        if level in (SINGLE_LEVEL_WILDCARD, MULTI_LEVEL_WILDCARD):
+            raise ValueError(f"Cannot publish to wildcard topic '{topic}'.")
+    return levels
+
+
+def is_wildcard(pattern):
+    """True if the pattern contains a wildcard level."""
+    return any(
+        level in (SINGLE_LEVEL_WILDCARD, MULTI_LEVEL_WILDCARD)
+        for level in pattern.split(LEVEL_SEPARATOR)
+    )
+
+
+class _Node:
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children = {}  # level -> _Node
+        self.subscribers = set()  # Subscribers whose pattern ends at this node
+
+
+class TopicTrie:
+    """
+    Trie of subscription patterns. Not thread-safe; callers hold their own lock.
+
+    add() and remove() cost O(pattern depth). match() costs O(topic depth)
+    times the number of wildcard branches taken, plus the size of the result,
+    independent of how many subscriptions are stored.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._count = 0
+
+    def add(self, pattern, subscriber):
+        """Subscribes to a pattern. Returns False if it was already subscribed."""
+        node = self._root
+        for level in validate_pattern(pattern):
+            node = node.children.setdefault(level, _Node())
+        if subscriber in node.subscribers:
+            return False
+        node.subscribers.add(subscriber)
+        self._count += 1
+        return True
+
+    def remove(self, pattern, subscriber):
+        """Unsubscribes from a pattern, pruning empty branches. Returns False if absent."""
+        path = [self._root]
+        levels = pattern.split(LEVEL_SEPARATOR)
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return False
+            path.append(node)
+        if subscriber not in path[-1].subscribers:
+            return False
+        path[-1].subscribers.discard(subscriber)
+        self._count -= 1
+
+        # Walk back up, dropping nodes that no longer lead to any subscription
+        for depth in range(len(levels), 0, -1):
+            node = path[depth]
+            if node.subscribers or node.children:
+                break
+            del path[depth - 1].children[levels[depth - 1]]
+        return True
+
+    def match(self, topic):
+        """Returns the set of subscribers whose patterns match a concrete topic."""
+        matched = set()
+        nodes = [self._root]
+        for level in topic.split(LEVEL_SEPARATOR):
+            next_nodes = []
+            for node in nodes:
+                multi = node.children.get(MULTI_LEVEL_WILDCARD)
+                if multi is not None:
+                    matched |= multi.subscribers  # '#' swallows this and all later levels
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                single = node.children.get(SINGLE_LEVEL_WILDCARD)
+                if single is not None:
+                    next_nodes.append(single)
+            nodes = next_nodes
+            if not nodes:
+                return matched
+        for node in nodes:
+            matched |= node.subscribers
+            multi = node.children.get(MULTI_LEVEL_WILDCARD)
+            if multi is not None:
+                matched |= multi.subscribers  # '#' also matches zero levels
+        return matched
+
+    def __len__(self):
+        """Number of (pattern, subscriber) subscriptions stored."""
+        return self._count
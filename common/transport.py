@@ -0,0 +1,81 @@
+"""
+Server addresses: TCP, or Unix domain sockets for clients on the broker's host.
+
+Clients accept "unix:/path/to/socket" wherever they take a host, and then
+ignore the port. A Unix socket skips the loopback TCP/IP stack (no
+checksums, segmentation or delayed ACKs), which lowers the latency and CPU
+cost of every message between co-located processes. The handshake and
+everything after it are the same over both.
+"""
+
+import asyncio
+import os
+import socket
+import stat
+
+UNIX_PREFIX = "unix:"
+
+
+def unix_path(host):
+    """The socket path of a "unix:/path" address, or None for a TCP host."""
+    if isinstance(host, str) and host.startswith(UNIX_PREFIX):
+        return host[len(UNIX_PREFIX) :]
+    return None
+
+
+def describe(host, port):
+    """The address as written in logs and error messages."""
+    return host if unix_path(host) is not None else f"{host}:{port}"
+
+
+def format_address(address):
+    """A client's address as one string: "host:port" over TCP, its name otherwise."""
+    if isinstance(address, tuple):
+        return f"{address[0]}:{address[1]}"
+    return str(address)
+
+
+def connect(host, port=None, timeout=None):
+    """
+    Opens a connection to a "unix:/path" address or to host:port over TCP,
+    where Nagle's algorithm is turned off so small frames go out at once.
+    """
+    path = unix_path(host)
+    if path is None:
+        sock = socket.create_connection((host, port), timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+async def open_connection(host, port=None):
+    """asyncio.open_connection() for either kind of address."""
+    path = unix_path(host)
+    if path is None:
+        return await asyncio.open_connection(host, port)
+    return await asyncio.open_unix_connection(path)
+
+
+def remove_stale_socket(path):
+    """Removes a socket file left behind by a server that did not shut down cleanly."""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def listen_unix(path):
+    """Returns a listening Unix socket bound to path."""
+    remove_stale_socket(path)
+    server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server_socket.bind(path)
+    server_socket.listen(socket.SOMAXCONN)
+    return server_socket